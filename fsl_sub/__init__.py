@@ -8,27 +8,50 @@ import errno
 import getpass
 import logging
 import os
+import random
 import socket
 import shlex
+import shutil
+import time
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 from math import ceil
 from fsl_sub.exceptions import (
     BadConfiguration,
     BadSubmission,
     CommandError,
+    UnknownJobId,
     UnrecognisedModule,
 )
 from fsl_sub.coprocessors import (
-    max_coprocessors,
+    CoprocessorCatalog,
+    coprocessor_catalog,
     coproc_get_module,
 )
+from fsl_sub.arrays import (
+    OFFSET_VAR,
+    chunk_specifier,
+    chunk_task_file,
+    composite_id,
+    expand_holds,
+    is_composite,
+    merge_reports,
+    split_composite,
+)
 from fsl_sub.config import (
     read_config,
     method_config,
     coprocessor_config,
     uses_projects,
 )
+from fsl_sub.config_model import (
+    coprocessor_spec,
+    method_options,
+    queue_specs,
+)
+import fsl_sub.audit
 import fsl_sub.consts
+import fsl_sub.metrics
 from fsl_sub.projects import (
     get_project_env,
     project_exists,
@@ -41,10 +64,51 @@ from fsl_sub.utils import (
     get_plugin_qdel,
     control_threads,
     human_to_ram,
-    update_envvar_list,
+    EnvSpec,
+)
+from fsl_sub.dedup import (
+    index_key,
+    locked as submission_lock,
+    lookup as submission_lookup,
+    record as submission_record,
+)
+from fsl_sub.holds import (
+    barrier_holds,
+    compress_holds,
+)
+from fsl_sub.jsonlog import (
+    correlated,
+    correlation,
+    correlation_id,
+)
+from fsl_sub.profiling import (
+    lap,
+    profiled,
+)
+from fsl_sub.uptodate import (
+    TASK_IDS_VAR,
+    command_line,
+    filter_array_file,
+    is_up_to_date,
+    record_on_success,
 )
 from fsl_sub.version import VERSION
 
+# Consecutive polls a job may be missing from the scheduler's reports before
+# wait() gives up on it
+UNKNOWN_POLLS = 3
+
+
+class _Joined(object):
+    '''Joins a list with spaces when (and only if) it is logged'''
+    __slots__ = ('items', )
+
+    def __init__(self, items):
+        self.items = items
+
+    def __str__(self):
+        return ' '.join(str(i) for i in self.items)
+
 
 def fsl_sub_warnings_formatter(
         message, category, filename, lineno, file=None, line=None):
@@ -133,9 +197,312 @@ def report(
             + " ({0})".format(str(e))
         )
 
+    if is_composite(job_id):
+        # Array submitted in chunks - report as one job
+        merged = merge_reports(
+            job_id,
+            [(job_status(j, None), o) for j, o in split_composite(job_id)])
+        if subjob_id is not None:
+            merged['tasks'] = {
+                k: v for k, v in merged['tasks'].items()
+                if k == str(subjob_id)}
+        return merged
+
     return job_status(job_id, subjob_id)
 
 
+def _job_state(job_details):
+    '''Collapse the per-task states of a job_status() dict into a single
+    state. A job is only terminal once all of its tasks are terminal.'''
+    if job_details is None:
+        return None
+    return _combined_state(
+        [t['status'] for t in job_details['tasks'].values()])
+
+
+def _combined_state(states):
+    '''Overall state of a list of task (or chunk) states'''
+    if not states or None in states:
+        return None
+    pending = [s for s in states if s not in fsl_sub.consts.TERMINAL_STATES]
+    if pending:
+        if fsl_sub.consts.RUNNING in pending:
+            return fsl_sub.consts.RUNNING
+        return pending[0]
+    if fsl_sub.consts.FAILED in states:
+        return fsl_sub.consts.FAILED
+    return fsl_sub.consts.FINISHED
+
+
+def _job_status_batch(plugin, grid_module):
+    '''The plugin's job_status_batch() or the equivalent using its
+    job_status()'''
+    job_status_batch = getattr(plugin, 'job_status_batch', None)
+    if job_status_batch is not None:
+        return job_status_batch
+    try:
+        job_status = plugin.job_status
+    except AttributeError as e:
+        raise BadConfiguration(
+            "Failed to load plugin " + grid_module
+            + " ({0})".format(str(e))
+        )
+
+    def job_status_batch(jids):
+        statuses = {}
+        for j in jids:
+            try:
+                statuses[j] = job_status(j)
+            except UnknownJobId:
+                # Omitted, as plugins' job_status_batch() do
+                pass
+        return statuses
+    return job_status_batch
+
+
+def _plugin(config):
+    '''(plugin module, module name) of the configured method'''
+    PLUGINS = load_plugins()
+    grid_module = 'fsl_sub_plugin_' + config['method']
+    if grid_module not in PLUGINS:
+        raise BadConfiguration(
+            "{} not a supported method".format(config['method']))
+    return (PLUGINS[grid_module], grid_module, )
+
+
+class _Waiting(object):
+    '''Progress of a wait on job_ids, updated from each poll's statuses.
+    Shared by wait(), fsl_sub.aio.wait() and the FslSubExecutor.'''
+
+    def __init__(self, job_ids):
+        self.components = {}
+        self.not_done = {}
+        self.missing = {}
+        self.track(job_ids)
+
+    def track(self, job_ids):
+        '''Wait on job_ids (forgetting those done or no longer listed),
+        keeping the progress of jobs already being waited on'''
+        for j in job_ids:
+            if j not in self.components:
+                # Chunked arrays are waited on via all their chunks
+                self.components[j] = [
+                    c for c, _ in split_composite(j)
+                ] if is_composite(j) else [j, ]
+        self.components = {j: self.components[j] for j in job_ids}
+        self.done = {}
+        self.not_done = {j: self.not_done.get(j) for j in job_ids}
+        self.missing = {j: self.missing.get(j, 0) for j in job_ids}
+
+    def queries(self):
+        '''Job ids to query the status of'''
+        return [c for jid in self.not_done for c in self.components[jid]]
+
+    def update(self, statuses):
+        '''Record the states in statuses (job_status_batch() output). Jobs
+        missing from UNKNOWN_POLLS polls in a row are done, with state
+        fsl_sub.consts.UNKNOWN.'''
+        for jid in list(self.not_done.keys()):
+            state = _combined_state(
+                [_job_state(statuses.get(c)) for c in self.components[jid]])
+            if state is None:
+                self.missing[jid] += 1
+                if self.missing[jid] >= UNKNOWN_POLLS:
+                    logging.getLogger(__name__).warning(
+                        "Job {0} is no longer known to the scheduler".format(
+                            jid))
+                    state = fsl_sub.consts.UNKNOWN
+            else:
+                self.missing[jid] = 0
+            if state in fsl_sub.consts.TERMINAL_STATES + (
+                    fsl_sub.consts.UNKNOWN, ):
+                del self.not_done[jid]
+                self.done[jid] = state
+            else:
+                self.not_done[jid] = state
+
+    def finished(self, mode):
+        return not self.not_done or (
+            self.done and mode == fsl_sub.consts.WAIT_ANY)
+
+
+def wait(
+    job_ids,
+    timeout=None,
+    mode=fsl_sub.consts.WAIT_ALL,
+    poll_interval=5,
+    max_poll_interval=120,
+    backoff=1.5,
+):
+    '''Block until the specified job(s) reach a terminal state
+    (fsl_sub.consts.FINISHED or fsl_sub.consts.FAILED).
+
+    Requires:
+
+    job_ids - job id or list of job ids (as returned by submit)
+
+    Optional:
+    timeout - maximum time (in seconds) to wait, None waits indefinitely
+    mode - fsl_sub.consts.WAIT_ALL to return when all jobs are terminal,
+            fsl_sub.consts.WAIT_ANY to return when any job is terminal
+    poll_interval - initial time (in seconds) between status queries
+    max_poll_interval - maximum time (in seconds) between status queries
+    backoff - multiplier applied to the poll interval after each query
+
+    Returns a tuple of two dicts (done, not_done) each keyed on job id with
+    the value being the job's overall state (fsl_sub.consts.*). Jobs the
+    scheduler hasn't reported on for UNKNOWN_POLLS polls in a row are done
+    with state fsl_sub.consts.UNKNOWN.
+
+    All outstanding jobs are queried in one batch per poll, via the plugin's
+    job_status_batch() where provided. Plugins that can block on job
+    completion without polling may provide job_wait(job_ids, timeout, mode)
+    which will be used in preference.
+    '''
+    logger = logging.getLogger(__name__)
+    if mode not in (fsl_sub.consts.WAIT_ALL, fsl_sub.consts.WAIT_ANY, ):
+        raise BadSubmission("Unrecognised wait mode " + str(mode))
+    if isinstance(job_ids, (str, int, )):
+        job_ids = [job_ids, ]
+    job_ids = list(job_ids)
+
+    config = read_config()
+
+    if config['method'] == 'shell' or not job_ids:
+        # Shell jobs have completed by the time submit returns
+        return ({j: fsl_sub.consts.FINISHED for j in job_ids}, {}, )
+
+    plugin, grid_module = _plugin(config)
+
+    job_wait = getattr(plugin, 'job_wait', None)
+    if job_wait is not None and not any(is_composite(j) for j in job_ids):
+        logger.debug("Using plugin's job_wait")
+        return job_wait(job_ids, timeout, mode)
+
+    job_status_batch = _job_status_batch(plugin, grid_module)
+
+    if timeout is not None:
+        deadline = time.monotonic() + timeout
+    interval = poll_interval
+    waiting = _Waiting(job_ids)
+    while True:
+        waiting.update(job_status_batch(waiting.queries()))
+        if waiting.finished(mode):
+            break
+        # Equal jitter - sleep between half and all of the current interval
+        # so that many waiting processes don't query the scheduler in step
+        delay = random.uniform(interval / 2, interval)
+        if timeout is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            delay = min(delay, remaining)
+        logger.debug(
+            "{0} job(s) outstanding, sleeping for {1:.1f}s".format(
+                len(waiting.not_done), delay))
+        time.sleep(delay)
+        interval = min(interval * backoff, max_poll_interval)
+
+    return (waiting.done, waiting.not_done, )
+
+
+def _submit_once(submit_args):
+    '''Submit unless an identical job was submitted recently, returning
+    the existing job id'''
+    logger = logging.getLogger(__name__)
+    idempotency_key = submit_args['idempotency_key']
+    if idempotency_key is not True and not isinstance(idempotency_key, str):
+        raise BadSubmission(
+            "idempotency_key should be True or a string, not "
+            + repr(idempotency_key))
+    config = read_config()
+    as_tuple = submit_args['as_tuple']
+    args = dict(submit_args, idempotency_key=None, as_tuple=False)
+    if config['method'] == 'shell':
+        # Shell jobs run to completion on submission so are never in flight
+        job_id = submit(**args)
+    else:
+        window = config.get('dedup_window', 3600)
+        key = index_key(idempotency_key, submit_args)
+        with submission_lock(key):
+            job_id = submission_lookup(key, window)
+            if job_id is not None:
+                logger.info(
+                    "Identical job already submitted as {0}".format(job_id))
+            else:
+                job_id = submit(**args)
+                if job_id is not None:
+                    submission_record(key, job_id, window)
+    if as_tuple:
+        return (job_id, )
+    return job_id
+
+
+def _remove_files(files):
+    for f in files:
+        try:
+            if os.path.isdir(f):
+                shutil.rmtree(f)
+            else:
+                os.remove(f)
+        except OSError:
+            pass
+
+
+def _remove_after(files, job_ids, name, project=None):
+    '''Remove files or folders (e.g. array task files, which are read as the
+    tasks run) once the jobs job_ids have finished, via a job held on them'''
+    if read_config()['method'] == 'shell':
+        # Shell jobs have completed by the time submit returns
+        _remove_files(files)
+        return
+    rm = ['rm', '-f', ]
+    if any(os.path.isdir(f) for f in files):
+        rm = ['rm', '-rf', ]
+    try:
+        submit(
+            rm + list(files), name=name + '_cleanup',
+            jobhold=list(job_ids), jobtime=1, logdir='/dev/null',
+            project=project, validate_command=False)
+    except Exception as e:
+        logging.getLogger(__name__).warning(
+            "Unable to submit removal of " + ', '.join(files) + ": " + str(e))
+
+
+def _submit_chunks(chunks, chunk_files=()):
+    '''Submit the chunks of an oversized array task concurrently. chunks is
+    a list of (submit arguments, task offset). Returns a composite job id.
+    If any chunk fails to submit the others are deleted. chunk_files (the
+    chunks' task files) are removed by a job held on all the chunks, or
+    immediately if submission fails.'''
+    logger = logging.getLogger(__name__)
+    logger.info("Submitting array task as %d chunks", len(chunks))
+    cid = correlation_id()
+
+    def submit_chunk(args):
+        with correlation(cid):
+            return submit(**args)
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        futures = [pool.submit(submit_chunk, args) for args, _ in chunks]
+    failed = [f.exception() for f in futures if f.exception() is not None]
+    if failed:
+        for f in futures:
+            if f.exception() is None:
+                delete_job(f.result())
+        _remove_files(chunk_files)
+        raise failed[0]
+    job_ids = [f.result() for f in futures]
+    if chunk_files:
+        args = chunks[0][0]
+        with correlation(cid):
+            _remove_after(
+                chunk_files, job_ids, args['name'], args.get('project'))
+    return composite_id(
+        (j, offset) for j, (_, offset) in zip(job_ids, chunks))
+
+
+@profiled('submit')
+@correlated
 def submit(
     command,
     name=None,
@@ -169,7 +536,11 @@ def submit(
     as_tuple=False,
     project=None,
     export_vars=None,
-    keep_jobscript=False
+    keep_jobscript=False,
+    inputs=None,
+    outputs=None,
+    skip_completed=False,
+    idempotency_key=None
 ):
     '''Submit job(s) to a queue, returns the job id as an int (pass as_tuple=True
     to return a single value tuple).
@@ -219,51 +590,74 @@ def submit(
     usescript - queue config is defined in script
     project - Cluster project to submit job to, defaults to None
     export_vars - list of environment variables to preserve for job
+            ('VAR' or 'VAR=VALUE') or a fsl_sub.utils.EnvSpec
             ignored if job is copying complete environment
     keep_jobscript - whether to generate and keep a script defining the parameters
             used to run your task
     validate_command - whether to validate the command or not.
+    inputs - list of files the job reads
+    outputs - list of files the job creates. If all outputs exist and are
+            newer than the inputs the job is not submitted. For array task
+            files these are lists with a list of files for each line of the
+            task file and only the lines that are out of date are submitted
+    skip_completed - don't submit if this command line (run in this folder)
+            has previously completed successfully since the inputs changed.
+            For array task files this applies line by line
+    idempotency_key - if True, a key derived from the command, folder,
+            exported variables and resources, otherwise a (non-empty) string
+            identifying this submission; None, False or '' disable this. If a job with the same key was submitted within
+            the configured dedup_window (seconds) its job id is returned
+            rather than submitting a duplicate
+
+    If the job is up to date then None is returned in place of the job id.
     '''
+    submit_args = dict(locals())
+    if idempotency_key:
+        return _submit_once(submit_args)
+    submit_start = time.perf_counter()
     logger = logging.getLogger(__name__)
     try:
         debugging = os.environ['FSLSUB_DEBUG'] == '1'
     except KeyError:
         debugging = False
-    if debugging:
-        update_envvar_list(export_vars, 'FSLSUB_DEBUG=1')
-        logger.setLevel(logging.DEBUG)
 
     # Can't just have export_vars=[] in function definition as the list is mutable so subsequent calls
     # will return the updated list!
     if export_vars is None:
         export_vars = []
-    my_export_vars = list(export_vars)
+    my_export_vars = EnvSpec(export_vars)
+    if debugging:
+        my_export_vars.set('FSLSUB_DEBUG', '1')
+        logger.setLevel(logging.DEBUG)
 
     # Ensure FSLSUB's configuration file path is propagated to jobs
     if 'FSLSUB_CONF' in os.environ.keys():
-        update_envvar_list(my_export_vars, '='.join(('FSLSUB_CONF', os.environ['FSLSUB_CONF'])))
-
-    logger.debug("Submit called with:")
-    logger.debug(
-        " ".join(
-            [
-                str(a) for a in [
-                    command, name, threads, queue, jobhold, array_task,
-                    array_hold, array_limit, array_specifier, parallel_env,
-                    jobram, jobtime, resources, ramsplit, priority,
-                    validate_command, mail_on, mailto, logdir,
-                    coprocessor, coprocessor_toolkit, coprocessor_class,
-                    coprocessor_class_strict, coprocessor_multi,
-                    usescript, architecture, requeueable,
-                    as_tuple, project,
+        my_export_vars.set('FSLSUB_CONF', os.environ['FSLSUB_CONF'])
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Submit called with:")
+        logger.debug(
+            " ".join(
+                [
+                    str(a) for a in [
+                        command, name, threads, queue, jobhold, array_task,
+                        array_hold, array_limit, array_specifier, parallel_env,
+                        jobram, jobtime, resources, ramsplit, priority,
+                        validate_command, mail_on, mailto, logdir,
+                        coprocessor, coprocessor_toolkit, coprocessor_class,
+                        coprocessor_class_strict, coprocessor_multi,
+                        usescript, architecture, requeueable,
+                        as_tuple, project,
+                    ]
                 ]
-            ]
+            )
         )
-    )
 
     PLUGINS = load_plugins()
+    lap('plugins')
 
     config = read_config()
+    lap('config')
 
     grid_module = 'fsl_sub_plugin_' + config['method']
     if grid_module not in PLUGINS:
@@ -281,6 +675,7 @@ def submit(
 
     if config['method'] != 'shell':
         if already_queued():
+            fsl_sub.metrics.shell_fallback(config['method'], 'already_queued')
             config['method'] = 'shell'
             warnings.warn(
                 'Warning: job on queue attempted to submit more jobs -'
@@ -289,13 +684,16 @@ def submit(
 
     config['qtest'] = qtest()
     if config['qtest'] is None:
+        fsl_sub.metrics.shell_fallback(config['method'], 'no_scheduler')
         config['method'] = 'shell'
         warnings.warn(
             'Warning: fsl_sub configured for {0} but {0}'
             ' software not found.'.format(config['method'])
         )
 
-    logger.debug("Configuring plugin " + config['method'])
+    lap('plugin_checks')
+
+    logger.debug("Configuring plugin %s", config['method'])
     # Reset grid_module in case we've switched to the Shell plugin
     grid_module = 'fsl_sub_plugin_' + config['method']
     try:
@@ -328,14 +726,14 @@ def submit(
     elif not isinstance(command, list):
         raise BadSubmission("Command should be a list or string")
 
-    logger.debug("Loading configuration for " + config['method'])
-    mconfig = method_config(config['method'])
-    logger.debug("Method configuration is " + str(mconfig))
+    logger.debug("Loading configuration for %s", config['method'])
+    mconfig = method_options(config['method'], method_config(config['method']))
+    logger.debug("Method configuration is %s", mconfig)
 
     logger.debug(
-        "Adding export_vars from config to provided list "
-        + str(my_export_vars) + str(config.get('export_vars', [])))
-    [update_envvar_list(my_export_vars, a, overwrite=False) for a in config.get('export_vars', [],)]
+        "Adding export_vars from config to provided list %s%s",
+        my_export_vars, config.get('export_vars', []))
+    my_export_vars.update(config.get('export_vars', []), overwrite=False)
 
     parallel_env_requested = parallel_env
 
@@ -370,14 +768,14 @@ def submit(
     if mconfig['mail_support'] is True:
         if mail_on is None:
             try:
-                mail_on = mconfig['mail_mode']
+                mail_on = mconfig.raw['mail_mode']
             except KeyError:
                 warnings.warn(
                     "Mail not configured but enabled in configuration for "
                     + config['method'])
         else:
             # Mail modes is a dictionary
-            if mail_on not in mconfig['mail_modes']:
+            if mail_on not in mconfig.raw['mail_modes']:
                 raise BadSubmission(
                     "Unrecognised mail mode " + mail_on)
 
@@ -391,6 +789,19 @@ def submit(
         if not isinstance(array_hold, (str, int, list, tuple)):
             raise BadSubmission(
                 "array_hold must be a string, int, list or tuple")
+    if is_composite(array_hold):
+        warnings.warn(
+            "Array hold requested on an array submitted in chunks - "
+            "holding on the complete array instead")
+        if jobhold is None:
+            jobhold = []
+        elif not isinstance(jobhold, (list, tuple, )):
+            jobhold = [jobhold, ]
+        jobhold = list(jobhold) + [array_hold, ]
+        array_hold = None
+    jobhold = compress_holds(expand_holds(jobhold))
+    array_hold = compress_holds(array_hold, collapse_tasks=False)
+    lap('setup')
 
     validate_type = 'command'
     if array_task is False:
@@ -409,17 +820,15 @@ def submit(
         validate_type = 'command'
 
     logger.info(
-        "METHOD={0} : TYPE={1} : args={2}".format(
-            config['method'],
-            job_type,
-            " ".join(command)
-        ))
+        "METHOD=%s : TYPE=%s : args=%s",
+        config['method'], job_type, _Joined(command))
 
     if validate_command:
         if validate_type == 'array':
             try:
                 check_command_file(command[0])
             except CommandError as e:
+                fsl_sub.metrics.validation_failure(config['method'], 'array')
                 raise BadSubmission(
                     "Array task definition file fault: " + str(e)
                 )
@@ -428,43 +837,116 @@ def submit(
                 try:
                     check_command(command[0])
                 except CommandError as e:
+                    fsl_sub.metrics.validation_failure(
+                        config['method'], 'command')
                     raise BadSubmission(
                         "Command not usable: " + str(e)
                     )
             else:
                 if not os.path.exists(command[0]):
+                    fsl_sub.metrics.validation_failure(
+                        config['method'], 'script')
                     raise BadSubmission(
                         "Script file not found"
                     )
         else:
             raise BadConfiguration(
                 "Unknown validation type: " + validate_type)
+    lap('validation')
+
+    if inputs is not None or outputs is not None or skip_completed:
+        if skip_completed and usescript:
+            raise BadSubmission(
+                "skip_completed cannot be used with job scripts")
+        if name is None:
+            # Name the job after the original command, not the rewritten one
+            name = build_job_name(command)
+        if job_type == 'array file':
+            task_file, skipped, task_ids = filter_array_file(
+                command[0], inputs, outputs, skip_completed)
+            if task_file is None:
+                logger.info("All array tasks are up to date - not submitting")
+                return (None, ) if as_tuple else None
+            if task_file != command[0]:
+                # Submit the tasks that need to run, then remove their file
+                try:
+                    job_id = submit(**dict(
+                        submit_args, command=[task_file, ], name=name,
+                        jobhold=jobhold, array_hold=array_hold, jobram=jobram,
+                        validate_command=False, inputs=None, outputs=None,
+                        skip_completed=False, idempotency_key=None,
+                        as_tuple=False,
+                        export_vars=list(export_vars) + [
+                            '='.join((TASK_IDS_VAR, task_ids)), ]))
+                except BaseException:
+                    _remove_files([task_file, ])
+                    raise
+                _remove_after([task_file, ], [job_id, ], name, project)
+                return (job_id, ) if as_tuple else job_id
+        else:
+            cmd_line = command_line(command)
+            if is_up_to_date(
+                    inputs, outputs,
+                    cmd_line=cmd_line if skip_completed else None):
+                logger.info("Job is up to date - not submitting")
+                return (None, ) if as_tuple else None
+            if skip_completed:
+                command = [record_on_success(cmd_line), ]
+        lap('up_to_date')
 
     if name is None:
         task_name = build_job_name(command)
-        logger.debug("No name passed - setting to " + task_name)
+        logger.debug("No name passed - setting to %s", task_name)
     else:
         task_name = name
 
-    if mconfig['queues'] is False:
+    max_array_size = mconfig.max_array_size
+    if array_task and max_array_size and not usescript:
+        chunk_args = dict(
+            submit_args, name=task_name, jobhold=jobhold,
+            array_hold=array_hold, jobram=jobram, validate_command=False,
+            inputs=None, outputs=None, skip_completed=False,
+            idempotency_key=None, as_tuple=False)
+        if array_specifier is None:
+            chunks = [
+                (dict(chunk_args, command=[chunk_file, ]), offset, )
+                for chunk_file, offset in chunk_task_file(
+                    command[0], max_array_size)]
+            chunk_files = [c['command'][0] for c, _ in chunks]
+        else:
+            chunks = [
+                (dict(chunk_args, command=command, array_specifier=c), offset, )
+                for c, offset in chunk_specifier(
+                    array_specifier, max_array_size)]
+            chunk_files = []
+        if len(chunks) > 1:
+            for args, offset in chunks:
+                args['export_vars'] = list(export_vars) + [
+                    '='.join((OFFSET_VAR, str(offset))), ]
+            job_id = _submit_chunks(chunks, chunk_files)
+            return (job_id, ) if as_tuple else job_id
+
+    if not mconfig.queues:
         queue = None
         split_on_ram = None
     else:
+        qspecs = queue_specs(config['queues'])
         split_on_ram = mconfig.get('map_ram', True) and ramsplit
 
         if (split_on_ram
                 and parallel_env is None
-                and 'large_job_split_pe' in mconfig):
-            parallel_env = mconfig['large_job_split_pe']
+                and mconfig.large_job_split_pe):
+            parallel_env = mconfig.large_job_split_pe
 
         if queue is None:
             queue_details = getq_and_slots(
                 job_time=jobtime,
                 job_ram=jobram,
                 job_threads=threads,
-                queues=config['queues'],
+                queues=qspecs,
                 coprocessor=coprocessor,
-                ll_env=parallel_env
+                ll_env=parallel_env,
+                catalog=coprocessor_catalog(config)
             )
             logger.debug("Automatic queue selection:")
             logger.debug(queue_details)
@@ -472,8 +954,8 @@ def submit(
         else:
             if not queue_exists(queue):
                 raise BadSubmission("Unrecognised queue " + queue)
-            logger.debug("Specific queue: " + queue)
-            slots_required = _slots_required(queue, jobram, config['queues'], threads)
+            logger.debug("Specific queue: %s", queue)
+            slots_required = _slots_required(queue, jobram, qspecs, threads)
         threads = max(slots_required, threads)
 
         control_threads(config['thread_control'], threads, add_to_list=my_export_vars)
@@ -484,18 +966,19 @@ def submit(
             raise BadSubmission(
                 "Job requires {} slots but no parallel envrionment "
                 "available or requested".format(threads))
-        if threads > 1 and mconfig.get('thread_ram_divide', False) and not split_on_ram:
+        if threads > 1 and mconfig.thread_ram_divide and not split_on_ram:
             split_on_ram = True
+        lap('queue_selection')
 
     if coprocessor:
-        if mconfig['queues']:
+        if mconfig.queues:
             # If coprocessor resource is in Scheduling multiple GPUS...
             #  PE as first port of call, do we need a separate way of specifying gpu qty
             if isinstance(coprocessor_multi, int):
                 coprocessor_multi = str(coprocessor_multi)
             if coprocessor_multi != '1':
                 try:
-                    if int(coprocessor_multi) > max_coprocessors(coprocessor):
+                    if int(coprocessor_multi) > coprocessor_catalog(config).max_quantity(coprocessor):
                         raise BadSubmission(
                             "Unable to provide {} coprocessors for job".format(
                                 coprocessor_multi
@@ -504,10 +987,11 @@ def submit(
                 except ValueError:
                     # Complex coprocessor_multi passed - do not validate
                     pass
-                usepe = coprocessor_config(coprocessor).get('uses_pe', False)
+                usepe = coprocessor_spec(
+                    coprocessor, coprocessor_config(coprocessor)).uses_pe
                 if usepe:
                     try:
-                        if usepe not in config['queues'][queue]['parallel_envs']:
+                        if usepe not in qspecs[queue].parallel_envs:
                             raise KeyError()
                     except KeyError:
                         raise BadSubmission(
@@ -523,7 +1007,7 @@ def submit(
                             "configured with 'uses_pe' which requires a simple integer"
                         )
                     if gpus_req > threads:
-                        if gpus_req > config['queues'][queue]['max_slots']:
+                        if gpus_req > qspecs[queue].max_slots:
                             raise BadSubmission("More GPUs than queue slots have been requested")
                         threads = gpus_req
                     control_threads(config['thread_control'], threads, add_to_list=my_export_vars)
@@ -537,6 +1021,7 @@ def submit(
                 raise BadSubmission(
                     "Unable to load coprocessor toolkit " + str(e)
                 )
+        lap('coprocessor')
     if uses_projects():
         q_project = get_project_env(project)
         if q_project is not None and not project_exists(q_project):
@@ -546,16 +1031,29 @@ def submit(
     else:
         q_project = None
 
-    logger.debug("Calling queue_submit fsl_sub_plugin_{0} with: ".format(config['method']))
-    logger.debug(
-        ", ".join(
-            [str(a) for a in [
-                command, task_name, queue, jobhold, array_task,
-                array_hold, array_limit, array_specifier, parallel_env,
-                jobram, jobtime, resources, ramsplit, priority,
-                mail_on, mailto, logdir, coprocessor, coprocessor_toolkit,
-                coprocessor_class, coprocessor_class_strict, coprocessor_multi,
-                usescript, architecture, requeueable]]))
+    max_holds = mconfig.get('max_jobholds', None)
+    if max_holds and isinstance(jobhold, list) and len(jobhold) > max_holds:
+        # Hold on a few cheap barrier jobs that themselves hold on the list
+        jobhold = barrier_holds(
+            jobhold, max_holds,
+            lambda chunk: submit(
+                ['true', ], name=task_name + '_hold', jobhold=chunk,
+                jobtime=1, logdir='/dev/null', project=project,
+                validate_command=False))
+        lap('holds')
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
+            "Calling queue_submit fsl_sub_plugin_%s with: ", config['method'])
+        logger.debug(
+            ", ".join(
+                [str(a) for a in [
+                    command, task_name, queue, jobhold, array_task,
+                    array_hold, array_limit, array_specifier, parallel_env,
+                    jobram, jobtime, resources, ramsplit, priority,
+                    mail_on, mailto, logdir, coprocessor, coprocessor_toolkit,
+                    coprocessor_class, coprocessor_class_strict, coprocessor_multi,
+                    usescript, architecture, requeueable]]))
 
     job_id = queue_submit(
         command,
@@ -588,6 +1086,18 @@ def submit(
         export_vars=my_export_vars,
         keep_jobscript=keep_jobscript
     )
+    lap('plugin_submit')
+    submit_time = time.perf_counter() - submit_start
+    fsl_sub.metrics.submission(config['method'], queue, submit_time)
+    fsl_sub.audit.record(
+        job_id, queue, threads, jobram, jobtime, coprocessor, command,
+        config['method'], array_task=bool(array_task))
+    logger.info(
+        "Submitted job %s", job_id,
+        extra={
+            'method': config['method'], 'queue': queue, 'slots': threads,
+            'job_type': job_type, 'job_id': job_id,
+            'submit_seconds': round(submit_time, 6), })
 
     if as_tuple:
         return (job_id,)
@@ -600,10 +1110,11 @@ def _slots_required(q_name, jobram, qconfig, threads):
     if '@' in q_name:
         logger.debug("q@host requested, removing @host from all queues")
         q_name = ','.join([q.split('@')[0] for q in q_name.split(',')])
+    qconfig = queue_specs(qconfig)
     if q_name in qconfig:
         return calc_slots(
             jobram,
-            qconfig[q_name]['slot_size'],
+            qconfig[q_name].slot_size,
             threads)
     else:
         logger.debug("queue definition not found, defaulting to single slot")
@@ -626,47 +1137,46 @@ def calc_slots(job_ram, slot_size, job_threads):
         return job_threads
 
 
+def _within(limit, value):
+    return limit is None or limit >= value
+
+
 def getq_and_slots(
         queues, job_time=0, job_ram=0,
         job_threads=1, coprocessor=None,
-        ll_env=None):
+        ll_env=None, catalog=None):
     '''Calculate which queue to run the job on. job_time is in minutes, job_ram in units given in configuration.
+    queues may be the queues dictionary or its compiled queue_specs().
+    catalog is the CoprocessorCatalog of queues, built if not given.
     Still needs job splitting across slots'''
     logger = logging.getLogger(__name__)
     if job_ram is None:
         job_ram = 0
 
+    queues = queue_specs(queues)
     queue_list = list(queues.keys())
 
     if not queue_list:
         raise BadSubmission("No queues found")
+    if catalog is None:
+        catalog = CoprocessorCatalog(queues)
 
     # Filter on coprocessor availability
     if coprocessor is not None:
-        queue_list = [
-            q for q in queue_list if 'copros' in queues[q]
-            and coprocessor in queues[q]['copros']]
+        cp_queues = catalog.queues(coprocessor)
+        queue_list = [q for q in queue_list if q in cp_queues]
         if not queue_list:
             raise BadSubmission("No queues with requested co-processor found")
     else:
-        tq = []
-        for q in queue_list:
-            qd = queues[q]
-            if 'copros' not in qd:
-                tq.append(q)
-            else:
-                qdcp = qd['copros']
-                if not all([qdcp[c].get('exclusive', True) for c in qdcp]):
-                    tq.append(q)
-        queue_list = tq
+        queue_list = [
+            q for q in queue_list if q not in catalog.exclusive_queues]
         if not queue_list:
             raise BadSubmission("No queues found without co-processors defined that are non-exclusive")
 
     # Filter on parallel environment availability
     if ll_env is not None:
         queue_list = [
-            q for q in queue_list if 'parallel_envs' in queues[q]
-            and ll_env in queues[q]['parallel_envs']
+            q for q in queue_list if ll_env in queues[q].parallel_envs
         ]
         if not queue_list:
             raise BadSubmission("No queues with requested parallel environment found")
@@ -675,7 +1185,7 @@ def getq_and_slots(
     # (if defined)
     if job_time is None or job_time == 0:
         d_queues = [
-            q for q in queue_list if 'default' in queues[q]
+            q for q in queue_list if queues[q].default
         ]
         if d_queues:
             queue_list = d_queues
@@ -683,22 +1193,21 @@ def getq_and_slots(
         job_time = 0
 
     slots = {}
+    groups = {}
     for index, q in enumerate(queue_list):
         slots[q] = calc_slots(
-            job_ram, queues[q]['slot_size'], job_threads)
-        # If group/priority not specified then create pseudo-groups, one for each queue
-        if 'group' not in queues[q].keys():
-            queues[q]['group'] = index
-        if 'priority' not in queues[q].keys():
-            queues[q]['priority'] = 1
+            job_ram, queues[q].slot_size, job_threads)
+        # If group not specified then create pseudo-groups, one for each queue
+        groups[q] = index if queues[q].group is None else queues[q].group
 
-    queue_list.sort(key=lambda x: queues[x]['priority'], reverse=True)
-    queue_list.sort(key=lambda x: (queues[x]['group'], slots[x]))
+    queue_list.sort(key=lambda x: queues[x].priority, reverse=True)
+    queue_list.sort(key=lambda x: (groups[x], slots[x]))
 
+    # Unset limits don't restrict the queue
     ql = [
-        q for q in queue_list if queues[q]['time'] >= job_time
-        and queues[q]['max_size'] >= job_ram
-        and queues[q]['max_slots'] >= job_threads]
+        q for q in queue_list if _within(queues[q].time, job_time)
+        and _within(queues[q].max_size, job_ram)
+        and _within(queues[q].max_slots, job_threads)]
     if not ql:
         raise BadSubmission("No queues matching time/RAM/thread requirements found")
 
@@ -738,4 +1247,10 @@ def delete_job(job_id):
         )
     if already_queued():
         config['method'] = 'shell'
-    return get_plugin_qdel(config['method'])(job_id)
+    qdel = get_plugin_qdel(config['method'])
+    if is_composite(job_id):
+        results = [qdel(j) for j, _ in split_composite(job_id)]
+        return (
+            '\n'.join(r[0] for r in results if r[0]),
+            max(r[1] for r in results))
+    return qdel(job_id)
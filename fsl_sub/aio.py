@@ -0,0 +1,195 @@
+# fsl_sub python module
+# Copyright (c) 2018-2021 University of Oxford (Duncan Mortimer)
+
+# asyncio interface - submit, report and wait coroutines that don't block
+# the event loop
+import asyncio
+import functools
+import logging
+import os
+import random
+import subprocess
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+import fsl_sub
+import fsl_sub.consts
+from fsl_sub.arrays import is_composite
+from fsl_sub.config import read_config
+from fsl_sub.exceptions import (BadSubmission, UnknownJobId, )
+
+DEFAULT_CONCURRENCY = 32
+
+_lock = threading.Lock()
+_executor = None
+_concurrency = None
+_semaphores = weakref.WeakKeyDictionary()
+
+
+def _get_logger():
+    return logging.getLogger(__name__)
+
+
+def concurrency():
+    '''Maximum number of fsl_sub operations in flight at once, set with
+    set_concurrency() or the environment variable FSLSUB_AIO_CONCURRENCY'''
+    if _concurrency is not None:
+        return _concurrency
+    try:
+        return max(int(os.environ['FSLSUB_AIO_CONCURRENCY']), 1)
+    except (KeyError, ValueError, ):
+        return DEFAULT_CONCURRENCY
+
+
+def set_concurrency(limit):
+    '''Change the concurrency limit, operations already in flight are
+    unaffected'''
+    global _concurrency, _executor
+    with _lock:
+        _concurrency = max(int(limit), 1)
+        old, _executor = _executor, None
+        _semaphores.clear()
+    if old is not None:
+        old.shutdown(wait=False)
+
+
+def _semaphore():
+    loop = asyncio.get_event_loop()
+    with _lock:
+        try:
+            return _semaphores[loop]
+        except KeyError:
+            sem = _semaphores[loop] = asyncio.Semaphore(concurrency())
+            return sem
+
+
+def _get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=concurrency(), thread_name_prefix='fsl_sub_aio')
+        return _executor
+
+
+async def _in_thread(func, *args, **kwargs):
+    '''Run a blocking function in the thread pool'''
+    async with _semaphore():
+        return await asyncio.get_event_loop().run_in_executor(
+            _get_executor(), functools.partial(func, *args, **kwargs))
+
+
+async def run_command(args, input=None, env=None, cwd=None):
+    '''Run a command (list) without blocking the event loop, returning a
+    subprocess.CompletedProcess with text stdout and stderr. For use by
+    plugins providing coroutine hooks (e.g. job_status_batch_async).
+
+    Optional:
+    input - text to send to the command's stdin
+    env - environment for the command
+    cwd - folder to run the command in'''
+    async with _semaphore():
+        proc = await asyncio.create_subprocess_exec(
+            *args,
+            stdin=subprocess.PIPE if input is not None else subprocess.DEVNULL,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            env=env, cwd=cwd)
+        stdout, stderr = await proc.communicate(
+            input.encode('utf-8') if input is not None else None)
+    return subprocess.CompletedProcess(
+        args, proc.returncode,
+        stdout.decode('utf-8', 'replace'), stderr.decode('utf-8', 'replace'))
+
+
+async def submit(command, **kwargs):
+    '''Coroutine version of fsl_sub.submit, taking the same arguments.
+
+    Submission (command validation, queue selection and the scheduler's
+    submission command) runs in a thread pool shared by all coroutines, so
+    any number of submissions may be awaited at once with at most
+    concurrency() running. With the shell plugin the job runs to completion
+    before this returns.'''
+    return await _in_thread(fsl_sub.submit, command, **kwargs)
+
+
+async def report(job_id, subjob_id=None):
+    '''Coroutine version of fsl_sub.report. Uses the plugin's
+    job_status_batch_async() where provided, otherwise the plugin's
+    job_status() is run in the thread pool.'''
+    config = read_config()
+    if config['method'] != 'shell' and not is_composite(job_id):
+        plugin, _ = fsl_sub._plugin(config)
+        batch_async = getattr(plugin, 'job_status_batch_async', None)
+        if batch_async is not None:
+            query = str(job_id)
+            if subjob_id is not None:
+                query = '.'.join((query.split('.')[0], str(subjob_id)))
+            status = await batch_async([query, ])
+            try:
+                return status[query]
+            except KeyError:
+                raise UnknownJobId("Unrecognised job id " + str(job_id))
+    return await _in_thread(fsl_sub.report, job_id, subjob_id)
+
+
+async def _status_batch(plugin, grid_module, job_ids):
+    batch_async = getattr(plugin, 'job_status_batch_async', None)
+    if batch_async is not None:
+        # Coroutine hooks are bounded by run_command()
+        return await batch_async(job_ids)
+    return await _in_thread(
+        fsl_sub._job_status_batch(plugin, grid_module), job_ids)
+
+
+async def wait(
+    job_ids,
+    timeout=None,
+    mode=fsl_sub.consts.WAIT_ALL,
+    poll_interval=5,
+    max_poll_interval=120,
+    backoff=1.5,
+):
+    '''Coroutine version of fsl_sub.wait, taking the same arguments and
+    returning (done, not_done).
+
+    Between polls the coroutine sleeps without holding a thread, so many
+    waits may be outstanding at once. Status queries use the plugin's
+    job_status_batch_async() where provided, otherwise job_status_batch()
+    (or job_status()) in the thread pool. A plugin's blocking job_wait() is
+    not used.'''
+    logger = _get_logger()
+    if mode not in (fsl_sub.consts.WAIT_ALL, fsl_sub.consts.WAIT_ANY, ):
+        raise BadSubmission("Unrecognised wait mode " + str(mode))
+    if isinstance(job_ids, (str, int, )):
+        job_ids = [job_ids, ]
+    job_ids = list(job_ids)
+
+    config = read_config()
+    if config['method'] == 'shell' or not job_ids:
+        return ({j: fsl_sub.consts.FINISHED for j in job_ids}, {}, )
+    plugin, grid_module = fsl_sub._plugin(config)
+
+    loop = asyncio.get_event_loop()
+    if timeout is not None:
+        deadline = loop.time() + timeout
+    interval = poll_interval
+    waiting = fsl_sub._Waiting(job_ids)
+    while True:
+        waiting.update(
+            await _status_batch(plugin, grid_module, waiting.queries()))
+        if waiting.finished(mode):
+            break
+        delay = random.uniform(interval / 2, interval)
+        if timeout is not None:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            delay = min(delay, remaining)
+        logger.debug(
+            "%d job(s) outstanding, sleeping for %.1fs",
+            len(waiting.not_done), delay)
+        await asyncio.sleep(delay)
+        interval = min(interval * backoff, max_poll_interval)
+
+    return (waiting.done, waiting.not_done, )
@@ -0,0 +1,153 @@
+# fsl_sub python module
+# Copyright (c) 2018-2021 University of Oxford (Duncan Mortimer)
+
+# Splitting of array tasks that exceed the scheduler's maximum array size
+import copy
+import logging
+import os
+import tempfile
+
+from fsl_sub.exceptions import BadSubmission
+from fsl_sub.utils import parse_array_specifier
+
+# Composite job ids are the chunk job ids joined with COMPOSITE_SEP, each
+# optionally followed by OFFSET_SEP and the number to add to the chunk's
+# task ids to give the task's number in the original array, e.g.
+# 1001+1002@1000+1003@2000
+COMPOSITE_SEP = '+'
+OFFSET_SEP = '@'
+# Environment variable set to the offset of an array chunk's task ids
+OFFSET_VAR = 'FSLSUB_ARRAY_TASK_OFFSET'
+
+
+def _get_logger():
+    return logging.getLogger(__name__)
+
+
+def is_composite(job_id):
+    return isinstance(job_id, str) and COMPOSITE_SEP in job_id
+
+
+def composite_id(parts):
+    '''Build a composite job id from a list of (job id, task offset)'''
+    return COMPOSITE_SEP.join(
+        OFFSET_SEP.join((str(j), str(o))) if o else str(j)
+        for j, o in parts)
+
+
+def split_composite(job_id):
+    '''Return list of (job id, task offset) for a (composite) job id'''
+    parts = []
+    for part in str(job_id).split(COMPOSITE_SEP):
+        if OFFSET_SEP in part:
+            j, o = part.split(OFFSET_SEP, 1)
+            try:
+                parts.append((j, int(o), ))
+            except ValueError:
+                raise BadSubmission("Unrecognised job id " + str(job_id))
+        else:
+            parts.append((part, 0, ))
+    return parts
+
+
+def chunk_task(job_id, task_id):
+    '''Return (job id, task id) of the chunk running task task_id of the
+    (composite) array job job_id'''
+    task_id = int(task_id)
+    chunk, offset = split_composite(job_id)[0]
+    for j, o in split_composite(job_id):
+        # Chunk task ids are the original ids less the chunk's offset
+        if offset < o < task_id:
+            chunk, offset = j, o
+    return chunk, task_id - offset
+
+
+def expand_holds(holds):
+    '''Replace composite job ids in a hold (id or list of ids) with the ids
+    of all their chunks'''
+    if holds is None:
+        return None
+    if isinstance(holds, (list, tuple, )):
+        items = holds
+    else:
+        items = [holds, ]
+    if not any(is_composite(h) for h in items):
+        return holds
+    expanded = []
+    for h in items:
+        if is_composite(h):
+            expanded.extend(j for j, _ in split_composite(h))
+        else:
+            expanded.append(h)
+    return expanded
+
+
+def chunk_specifier(spec, max_size):
+    '''Split an array specifier (n[-m[:s]]) into specifiers covering at most
+    max_size tasks each. Returns a list of (specifier, offset), chunks are
+    renumbered from 1 (schedulers may limit task ids as well as counts) so
+    offset must be added to a chunk's task ids to give the original id.'''
+    start, end, step = parse_array_specifier(spec)
+    if end is None:
+        start, end = 1, start
+    if step is None:
+        step = 1
+    tasks = range(start, end + 1, step)
+    if len(tasks) <= max_size:
+        return [(spec, 0, ), ]
+    chunks = []
+    for i in range(0, len(tasks), max_size):
+        chunk = tasks[i:i + max_size]
+        c_spec = '1-{0}'.format(chunk[-1] - chunk[0] + 1)
+        if step != 1:
+            c_spec += ':{0}'.format(step)
+        chunks.append((c_spec, chunk[0] - 1, ))
+    return chunks
+
+
+def chunk_task_file(task_file, max_size):
+    '''Split an array task file into files of at most max_size lines,
+    written alongside the original. Returns a list of (file, offset) where
+    offset is the number of lines preceding the chunk in task_file.'''
+    try:
+        with open(task_file, 'r') as tf:
+            lines = tf.readlines()
+    except OSError as e:
+        raise BadSubmission(
+            "Unable to read array task file {0}: {1}".format(task_file, str(e)))
+    if lines and not lines[-1].endswith('\n'):
+        lines[-1] += '\n'
+    if len(lines) <= max_size:
+        return [(task_file, 0), ]
+    chunks = []
+    for offset in range(0, len(lines), max_size):
+        fd, chunk_file = tempfile.mkstemp(
+            prefix=os.path.basename(task_file) + '.',
+            suffix='.part{0}'.format(offset // max_size + 1),
+            dir=os.path.dirname(os.path.abspath(task_file)))
+        with os.fdopen(fd, 'w') as cf:
+            cf.writelines(lines[offset:offset + max_size])
+        chunks.append((chunk_file, offset, ))
+    _get_logger().info(
+        "Array task file {0} split into {1} chunks".format(
+            task_file, len(chunks)))
+    return chunks
+
+
+def merge_reports(job_id, reports):
+    '''Combine the job_status() reports of the chunks of a composite job.
+    reports is a list of (report, task offset). Tasks are renumbered to
+    their position in the original array.'''
+    merged = None
+    for report, offset in reports:
+        if merged is None:
+            merged = copy.copy(report)
+            merged['id'] = job_id
+            merged['tasks'] = {}
+        for task_id, task in report['tasks'].items():
+            try:
+                task_id = str(int(task_id) + offset)
+            except ValueError:
+                pass
+            merged['tasks'][task_id] = task
+    return merged
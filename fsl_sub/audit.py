@@ -0,0 +1,196 @@
+# fsl_sub python module
+# Copyright (c) 2018-2021 University of Oxford (Duncan Mortimer)
+
+# Append-only audit log of submissions, one fixed size binary record each
+import fcntl
+import getpass
+import logging
+import mmap
+import os
+import struct
+import time
+from collections import (Counter, OrderedDict, )
+from operator import itemgetter
+
+from fsl_sub.config import read_config
+from fsl_sub.exceptions import (BadConfiguration, MissingConfiguration, )
+
+MAGIC = b'FSLSUBA1'
+HEADER = struct.Struct('<8sHH4x')
+# time, jobram (GB), jobtime (minutes), slots, array task, user, method,
+# job id, queue, coprocessor, command basename
+RECORD = struct.Struct('<dfIH?x16s12s24s24s12s32s')
+FIELDS = (
+    'time', 'jobram', 'jobtime', 'slots', 'array_task', 'user', 'method',
+    'job_id', 'queue', 'coprocessor', 'command', )
+GROUPS = ('queue', 'command', 'user', 'coprocessor', 'method', )
+
+
+def _get_logger():
+    return logging.getLogger(__name__)
+
+
+def audit_log():
+    '''File submissions are recorded in, None if auditing is disabled'''
+    try:
+        return os.environ['FSLSUB_AUDIT_LOG'] or None
+    except KeyError:
+        pass
+    try:
+        return read_config().get('audit_log', None)
+    except (BadConfiguration, MissingConfiguration, ):
+        return None
+
+
+def _bytes(value, size):
+    if value is None:
+        return b''
+    # Truncate without splitting a multi-byte character
+    return str(value).encode('utf-8')[:size].decode(
+        'utf-8', 'ignore').encode('utf-8')
+
+
+def pack(when, user, job_id, queue, slots, jobram, jobtime, coprocessor,
+         command, method='', array_task=False):
+    '''Return the binary record for a submission, strings longer than
+    their field are truncated'''
+    return RECORD.pack(
+        when, jobram or 0, jobtime or 0, min(slots or 1, 65535), array_task,
+        _bytes(user, 16), _bytes(method, 12), _bytes(job_id, 24),
+        _bytes(queue, 24), _bytes(coprocessor, 12), _bytes(command, 32))
+
+
+def append(record, log_file):
+    '''Append a packed record to log_file, writing the header to new files.
+    The file is locked while writing.'''
+    with open(log_file, 'ab') as lf:
+        fcntl.flock(lf, fcntl.LOCK_EX)
+        try:
+            if lf.tell() == 0:
+                lf.write(HEADER.pack(MAGIC, 1, RECORD.size))
+            lf.write(record)
+        finally:
+            fcntl.flock(lf, fcntl.LOCK_UN)
+
+
+def record(job_id, queue, slots, jobram, jobtime, coprocessor, command,
+           method, array_task=False, when=None, log_file=None):
+    '''Record a submission if auditing is enabled. Failures are logged,
+    never raised.'''
+    if log_file is None:
+        log_file = audit_log()
+        if log_file is None:
+            return
+    if when is None:
+        when = time.time()
+    if isinstance(command, (list, tuple, )):
+        command = command[0] if command else ''
+    try:
+        append(
+            pack(
+                when, getpass.getuser(), job_id, queue, slots, jobram,
+                jobtime, coprocessor, os.path.basename(str(command)),
+                method, array_task),
+            log_file)
+    except (OSError, struct.error, ) as e:
+        _get_logger().warning("Unable to write audit log: " + str(e))
+
+
+def records(log_file):
+    '''Generator of record tuples (see FIELDS) from log_file, strings are
+    returned as bytes. A partially written final record is ignored.'''
+    with open(log_file, 'rb') as lf:
+        size = os.fstat(lf.fileno()).st_size
+        if size < HEADER.size:
+            return
+        with mmap.mmap(lf.fileno(), size, access=mmap.ACCESS_READ) as mm:
+            magic, _, rec_size = HEADER.unpack_from(mm)
+            if magic != MAGIC or rec_size != RECORD.size:
+                raise ValueError(log_file + " is not an fsl_sub audit log")
+            count = (size - HEADER.size) // rec_size
+            view = memoryview(mm)[HEADER.size:HEADER.size + count * rec_size]
+            unpacked = RECORD.iter_unpack(view)
+            try:
+                yield from unpacked
+            finally:
+                # Buffers must be released before the mmap is closed
+                del unpacked
+                view.release()
+
+
+class _Distribution(object):
+    '''Streaming distribution of (mostly repeated) values'''
+    __slots__ = ('values', 'count', 'total', )
+
+    def __init__(self):
+        self.values = Counter()
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, value, n=1):
+        self.values[value] += n
+        self.count += n
+        self.total += value * n
+
+    def percentile(self, pct):
+        if not self.count:
+            return None
+        target = pct / 100 * self.count
+        seen = 0
+        for value in sorted(self.values):
+            seen += self.values[value]
+            if seen >= target:
+                return value
+        return value
+
+    def summary(self):
+        return OrderedDict((
+            ('mean', self.total / self.count if self.count else None),
+            ('median', self.percentile(50)),
+            ('p90', self.percentile(90)),
+            ('max', max(self.values) if self.values else None),
+        ))
+
+
+def aggregate(log_file, by='queue', since=None, until=None, user=None):
+    '''Scan log_file, returning an OrderedDict keyed on the by field
+    (one of GROUPS) of submission statistics, busiest first.
+
+    Optional:
+
+    since/until - only include submissions in this period (epoch seconds)
+    user - only include this user's submissions'''
+    recs = records(log_file)
+    if since is not None:
+        recs = (r for r in recs if r[0] >= since)
+    if until is not None:
+        recs = (r for r in recs if r[0] < until)
+    if user is not None:
+        user_b = _bytes(user, 16).ljust(16, b'\0')
+        recs = (r for r in recs if r[5] == user_b)
+    # Submissions are highly repetitive so count distinct (group, slots,
+    # jobram, jobtime, array task) combinations, which runs at C speed
+    counts = Counter(map(itemgetter(FIELDS.index(by), 3, 1, 2, 4), recs))
+    stats = {}
+    for (key, slots, jobram, jobtime, array_task), n in counts.items():
+        try:
+            group = stats[key]
+        except KeyError:
+            group = stats[key] = {
+                'jobs': 0, 'array_tasks': 0, 'slots': _Distribution(),
+                'jobram': _Distribution(), 'jobtime': _Distribution(), }
+        group['jobs'] += n
+        if array_task:
+            group['array_tasks'] += n
+        group['slots'].add(slots, n)
+        if jobram:
+            group['jobram'].add(round(jobram, 3), n)
+        if jobtime:
+            group['jobtime'].add(jobtime, n)
+    result = OrderedDict()
+    for key, group in sorted(
+            stats.items(), key=lambda kv: kv[1]['jobs'], reverse=True):
+        for dist in ('slots', 'jobram', 'jobtime', ):
+            group[dist] = group[dist].summary()
+        result[key.rstrip(b'\0').decode('utf-8', 'replace')] = group
+    return result
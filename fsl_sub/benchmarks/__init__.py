@@ -0,0 +1,167 @@
+# fsl_sub python module
+# Copyright (c) 2018-2021 University of Oxford (Duncan Mortimer)
+
+# Performance benchmarks for fsl_sub, run with:
+#   python -m fsl_sub.benchmarks [--output results.json] [--baseline base.json]
+import argparse
+import datetime
+import json
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+from fsl_sub.benchmarks import scenarios
+from fsl_sub.version import VERSION
+
+# name: (scenario, default number of repeats)
+SCENARIOS = OrderedDict((
+    ('cli_cold', (scenarios.cli_cold, 5, ), ),
+    ('cli_warm', (scenarios.cli_warm, 10, ), ),
+    ('read_config_large', (scenarios.read_config_large, 10, ), ),
+    ('queue_selection', (scenarios.queue_selection, 20, ), ),
+    ('check_command_file', (scenarios.check_command_file, 3, ), ),
+    ('shell_parallel', (scenarios.shell_parallel, 3, ), ),
+    ('local_array', (scenarios.local_array, 3, ), ),
+))
+
+
+def summarise(times):
+    '''Return statistics (seconds) for a list of timings'''
+    return {
+        'repeats': len(times),
+        'min': min(times),
+        'median': statistics.median(times),
+        'mean': statistics.mean(times),
+        'stdev': statistics.stdev(times) if len(times) > 1 else 0.0,
+        'times': times,
+    }
+
+
+def run_scenario(name, repeat=None, scale=1.0):
+    '''Time scenario name, returning summarise() output.
+
+    Requires:
+
+    name - scenario name (key of SCENARIOS)
+
+    Optional:
+
+    repeat - number of timings to take, defaults to the scenario's default
+    scale - multiplier for the scenario's problem size'''
+    scenario, default_repeat = SCENARIOS[name]
+    if repeat is None:
+        repeat = default_repeat
+    workdir = tempfile.mkdtemp(prefix='fsl_sub_bench_')
+    try:
+        func = scenario(workdir, scale)
+        try:
+            times = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                func()
+                times.append(time.perf_counter() - start)
+        finally:
+            cleanup = getattr(func, 'cleanup', None)
+            if cleanup is not None:
+                cleanup()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return summarise(times)
+
+
+def run(names=None, repeat=None, scale=1.0, progress=None):
+    '''Run the named scenarios (default all), returning a results dictionary
+    suitable for saving as JSON and use as a baseline'''
+    if names is None:
+        names = list(SCENARIOS)
+    results = {
+        'meta': {
+            'fsl_sub': VERSION,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'date': datetime.datetime.now().isoformat(),
+            'scale': scale,
+        },
+        'scenarios': OrderedDict(),
+    }
+    for name in names:
+        if progress is not None:
+            progress(name)
+        results['scenarios'][name] = run_scenario(name, repeat, scale)
+    return results
+
+
+def compare(results, baseline, threshold=0.1):
+    '''Compare median timings with a baseline. Returns a list of
+    (name, baseline median, median, ratio, regressed) tuples, a scenario
+    has regressed if it is more than threshold (fraction) slower'''
+    comparison = []
+    for name, result in results['scenarios'].items():
+        try:
+            base = baseline['scenarios'][name]['median']
+        except KeyError:
+            continue
+        ratio = result['median'] / base if base else float('inf')
+        comparison.append(
+            (name, base, result['median'], ratio, ratio > 1 + threshold, ))
+    return comparison
+
+
+def _print_results(results, comparison=None):
+    compared = {c[0]: c for c in comparison or []}
+    for name, result in results['scenarios'].items():
+        line = "{0:<20} median {1:9.4f}s  min {2:9.4f}s  stdev {3:8.4f}s".format(
+            name, result['median'], result['min'], result['stdev'])
+        if name in compared:
+            _, base, _, ratio, regressed = compared[name]
+            line += "  baseline {0:9.4f}s  x{1:.2f}{2}".format(
+                base, ratio, '  REGRESSION' if regressed else '')
+        print(line)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        prog='fsl_sub_benchmark',
+        description="Benchmark fsl_sub")
+    parser.add_argument(
+        'scenarios', nargs='*', metavar='scenario',
+        help="Scenarios to run (default all): " + ', '.join(SCENARIOS))
+    parser.add_argument(
+        '--repeat', type=int, default=None,
+        help="Number of timings to take of each scenario")
+    parser.add_argument(
+        '--scale', type=float, default=1.0,
+        help="Multiply the problem size of each scenario by this factor")
+    parser.add_argument(
+        '--output', default=None,
+        help="Write results to this JSON file (suitable for use as a baseline)")
+    parser.add_argument(
+        '--baseline', default=None,
+        help="Compare results with this JSON file, "
+        "exiting with status 1 if any scenario has regressed")
+    parser.add_argument(
+        '--threshold', type=float, default=10,
+        help="Percentage slow down from the baseline that is a regression")
+    options = parser.parse_args(args)
+    for name in options.scenarios:
+        if name not in SCENARIOS:
+            parser.error("Unknown scenario " + name)
+
+    results = run(
+        options.scenarios or None, options.repeat, options.scale,
+        progress=lambda n: print("Running " + n, file=sys.stderr))
+    if options.output:
+        with open(options.output, 'w') as out:
+            json.dump(results, out, indent=2)
+    comparison = None
+    if options.baseline:
+        with open(options.baseline, 'r') as base:
+            comparison = compare(
+                results, json.load(base), options.threshold / 100)
+    _print_results(results, comparison)
+    if comparison and any(c[4] for c in comparison):
+        sys.exit(1)
@@ -0,0 +1,3 @@
+from fsl_sub.benchmarks import main
+
+main()
@@ -0,0 +1,200 @@
+# fsl_sub python module
+# Copyright (c) 2018-2021 University of Oxford (Duncan Mortimer)
+
+# Benchmark scenarios - each scenario function takes a scratch folder and a
+# size scale and returns a function to time
+import os
+import subprocess as sp
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from ruamel.yaml import YAML
+
+QUEUE_COUNT = 150
+QUEUE_CONFIG_COUNT = 500
+COMMAND_FILE_LINES = 100000
+PARALLEL_TASKS = 200
+LOCAL_ARRAY_TASKS = 500
+
+
+def _scaled(count, scale):
+    return max(1, int(count * scale))
+
+
+def _queues(count):
+    '''Queue definitions varying in run time, RAM and slots'''
+    queues = {}
+    for i in range(count):
+        queues['q{0}.q'.format(i)] = {
+            'time': 60 * (1 + i % 48),
+            'max_size': 16 * (1 + i % 24),
+            'slot_size': 4 * (1 + i % 4),
+            'max_slots': 4 * (1 + i % 8),
+            'map_ram': True,
+            'parallel_envs': ['shmem', ],
+            'priority': i % 3,
+            'group': i // 3,
+        }
+    return queues
+
+
+def _write_config(folder, config):
+    config_file = os.path.join(folder, 'fsl_sub.yml')
+    yaml = YAML(typ='safe')
+    yaml.default_flow_style = False
+    with open(config_file, 'w') as cf:
+        yaml.dump(config, cf)
+    return config_file
+
+
+@contextmanager
+def _configured(config_file):
+    '''Point fsl_sub at config_file for the duration of the block'''
+    from fsl_sub.config import read_config
+    old = os.environ.get('FSLSUB_CONF')
+    os.environ['FSLSUB_CONF'] = config_file
+    read_config.cache_clear()
+    try:
+        yield
+    finally:
+        if old is None:
+            del os.environ['FSLSUB_CONF']
+        else:
+            os.environ['FSLSUB_CONF'] = old
+        read_config.cache_clear()
+
+
+def _cli(env):
+    sp.run(
+        [sys.executable, '-c',
+         'from fsl_sub.cmdline import main; main(["--version"])'],
+        stdout=sp.DEVNULL, env=env, check=True)
+
+
+def cli_cold(workdir, scale=1.0):
+    '''Start the fsl_sub command with no compiled byte code available'''
+    config_file = _write_config(workdir, {'method': 'shell', })
+
+    def run():
+        with tempfile.TemporaryDirectory(dir=workdir) as cache:
+            env = dict(os.environ)
+            env['FSLSUB_CONF'] = config_file
+            # Python >= 3.8, earlier versions will use any existing byte code
+            env['PYTHONPYCACHEPREFIX'] = cache
+            _cli(env)
+    return run
+
+
+def cli_warm(workdir, scale=1.0):
+    '''Start the fsl_sub command with the byte code cache populated'''
+    env = dict(os.environ)
+    env['FSLSUB_CONF'] = _write_config(workdir, {'method': 'shell', })
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    _cli(env)
+    return lambda: _cli(env)
+
+
+def read_config_large(workdir, scale=1.0):
+    '''Parse and merge a configuration with many queue definitions'''
+    from fsl_sub.config import read_config
+    config_file = _write_config(
+        workdir,
+        {'method': 'shell',
+         'queues': _queues(_scaled(QUEUE_CONFIG_COUNT, scale)), })
+
+    def run():
+        with _configured(config_file):
+            read_config()
+    return run
+
+
+def queue_selection(workdir, scale=1.0):
+    '''Choose queues for a range of job requirements'''
+    from fsl_sub import getq_and_slots
+    # Enough queues that every request can be satisfied
+    queues = _queues(max(_scaled(QUEUE_COUNT, scale), 48))
+    requests = [
+        (t, r, th)
+        for t in (None, 30, 600, 2000)
+        for r in (None, 8, 100)
+        for th in (1, 8)]
+
+    def run():
+        for job_time, job_ram, threads in requests:
+            getq_and_slots(
+                queues, job_time=job_time, job_ram=job_ram,
+                job_threads=threads)
+    return run
+
+
+def check_command_file(workdir, scale=1.0):
+    '''Validate a large array task file'''
+    from fsl_sub.utils import check_command_file as ccf
+    task_file = os.path.join(workdir, 'tasks')
+    commands = ('true', 'echo', 'sleep', 'ls', )
+    with open(task_file, 'w') as tf:
+        for i in range(_scaled(COMMAND_FILE_LINES, scale)):
+            tf.write('{0} {1}\n'.format(commands[i % len(commands)], i))
+    return lambda: ccf(task_file)
+
+
+def shell_parallel(workdir, scale=1.0):
+    '''Run many short array tasks with the shell plugin'''
+    from fsl_sub.plugins.fsl_sub_plugin_shell import _run_parallel
+    config_file = _write_config(workdir, {'method': 'shell', })
+    jobs = [['true', ] for _ in range(_scaled(PARALLEL_TASKS, scale))]
+
+    def run():
+        with _configured(config_file):
+            _run_parallel(
+                jobs, 1, dict(os.environ), '/dev/null', '/dev/null')
+    return run
+
+
+def local_array(workdir, scale=1.0):
+    '''Submit an array task to the local scheduler and wait for it'''
+    import fsl_sub
+    from fsl_sub.plugins import local_scheduler
+
+    socket_path = os.path.join(workdir, 'scheduler.sock')
+    queues = {'bench.q': {
+        'time': 60, 'max_size': 64, 'slot_size': 4,
+        'max_slots': 16, 'parallel_envs': ['shmem', ],
+        'default': True, }, }
+    config_file = _write_config(workdir, {
+        'method': 'local',
+        'queues': queues,
+        'method_opts': {'local': {
+            'socket': socket_path, 'autostart': False, }, }, })
+    task_file = os.path.join(workdir, 'tasks')
+    with open(task_file, 'w') as tf:
+        tf.write('true\n' * _scaled(LOCAL_ARRAY_TASKS, scale))
+    log_dir = os.path.join(workdir, 'logs')
+    os.makedirs(log_dir)
+
+    server = threading.Thread(
+        target=local_scheduler.serve, args=(socket_path, queues),
+        kwargs={'poll_interval': 0.01}, daemon=True)
+    server.start()
+    deadline = time.monotonic() + 10
+    while not os.path.exists(socket_path):
+        if time.monotonic() > deadline:
+            raise RuntimeError("Local scheduler did not start")
+        time.sleep(0.01)
+
+    def run():
+        with _configured(config_file):
+            job_id = fsl_sub.submit(
+                task_file, name='bench', array_task=True, logdir=log_dir)
+            fsl_sub.wait(
+                job_id, timeout=600, poll_interval=0.05,
+                max_poll_interval=0.05)
+
+    def stop():
+        local_scheduler.request(socket_path, 'shutdown')
+        server.join()
+    run.cleanup = stop
+    return run
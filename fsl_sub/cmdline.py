@@ -4,9 +4,12 @@
 # Copyright (c) 2018-2021 University of Oxford (Duncan Mortimer)
 
 import argparse
+import datetime
 import getpass
+import json
 import logging
 import os
+import re
 import socket
 import sys
 import traceback
@@ -15,21 +18,33 @@ from fsl_sub import (
     submit,
     report,
     delete_job,
+    wait,
+)
+import fsl_sub.audit
+import fsl_sub.compression
+from fsl_sub.arrays import (
+    is_composite,
+    split_composite,
 )
 from fsl_sub.config import (
     read_config,
+    annotated_config,
+    config_provenance,
     method_config,
     coprocessor_config,
     has_queues,
     has_coprocessor,
+    has_coprocessors,
+    refresh_queue_overlay,
     uses_projects,
 )
 from fsl_sub.config import example_config as e_conf
 
 import fsl_sub.consts
+import fsl_sub.tasklogs
 from fsl_sub.coprocessors import (
     coproc_info,
-    coproc_classes,
+    coprocessor_catalog,
 )
 from fsl_sub.exceptions import (
     ArgumentError,
@@ -42,11 +57,13 @@ from fsl_sub.exceptions import (
     NoModule,
     NotAFslDir,
     PackageError,
+    UnknownJobId,
     UpdateError,
     CONFIG_ERROR,
     SUBMISSION_ERROR,
     RUNNER_ERROR,
 )
+from fsl_sub.jsonlog import configure as configure_logging
 from fsl_sub.shell_modules import (
     get_modules,
     find_module_cmd,
@@ -55,6 +72,12 @@ from fsl_sub.parallel import (
     parallel_envs,
     process_pe_def,
 )
+from fsl_sub.profiling import (
+    destination as profile_destination,
+    enable as enable_profiling,
+    lap,
+    profiled,
+)
 from fsl_sub.projects import (
     get_project_env,
 )
@@ -74,6 +97,10 @@ from fsl_sub.utils import (
     yaml_repr_none,
 )
 from fsl_sub.version import VERSION
+from fsl_sub.workflow import (
+    load_workflow,
+    submit_dag,
+)
 
 
 class MyArgParseFormatter(
@@ -82,6 +109,21 @@ class MyArgParseFormatter(
     pass
 
 
+def job_id_arg(value):
+    '''argparse type for job ids - integers or the composite ids of arrays
+    submitted in chunks'''
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        parts = split_composite(value)
+        [int(j) for j, _ in parts]
+    except (BadSubmission, ValueError, ):
+        raise argparse.ArgumentTypeError("invalid job id: " + value)
+    return value
+
+
 def build_parser(
         config=None, cp_info=None,
         plugin_name=None, plugin_version=None):
@@ -165,7 +207,7 @@ There are several batch queues configured on the cluster:
                     except NoModule as e:
                         raise BadConfiguration from e
                     epilog += "      " + ', '.join(module_list) + '\n'
-            cp_classes = coproc_classes(cp)
+            cp_classes = coprocessor_catalog(config).classes(cp)
             if cp_classes:
                 epilog += (
                     "    Co-processor classes available: " + '\n'
@@ -290,6 +332,13 @@ There are several batch queues configured on the cluster:
         action='store_true',
         help=argparse.SUPPRESS
     )
+    advanced_g.add_argument(
+        '--profile',
+        action='store_true',
+        help="Report the time taken by each stage of submission on stderr "
+        "(or append a JSON record to the file named by the environment "
+        "variable FSLSUB_PROFILE)."
+    )
     if 'script_conf' in mconf and mconf['script_conf']:
         advanced_g.add_argument(
             '-F', '--usescript',
@@ -310,6 +359,31 @@ There are several batch queues configured on the cluster:
         help="Place a hold on this task until specified job id has "
         "completed."
     )
+    basic_g.add_argument(
+        '--workflow',
+        default=None,
+        metavar="WORKFLOW_FILE",
+        help="Submit all the steps defined in this YAML pipeline file, "
+        "holding each step on the steps it depends on. Prints the job ID of "
+        "each step."
+    )
+    basic_g.add_argument(
+        '--skip_completed',
+        action='store_true',
+        help="Don't submit if this command (or array task line) has previously "
+        "completed successfully in this folder. If nothing needs to run no "
+        "job ID is printed."
+    )
+    basic_g.add_argument(
+        '--dedup',
+        nargs='?',
+        const=True,
+        default=None,
+        metavar='KEY',
+        help="If this command was submitted with the same options from this "
+        "folder recently (or with the same KEY), print the existing job ID "
+        "rather than submitting it again."
+    )
     basic_g.add_argument(
         '--not_requeueable',
         action='store_true',
@@ -425,7 +499,7 @@ There are several batch queues configured on the cluster:
     advanced_g.add_argument(
         '--delete_job',
         default=None,
-        type=int,
+        type=job_id_arg,
         help="Deletes a queued/running job."
     )
     basic_g.add_argument(
@@ -503,6 +577,8 @@ There are several batch queues configured on the cluster:
         metavar='COPROCESSOR_NAME',
         help="fsl_sub returns with exit code of 0 if specified coprocessor is configured. "
         "Exits with a return code of 1 if the coprocessor is not configured/availble. "
+        "Several coprocessors may be given as a comma separated list, each is reported "
+        "and the exit code is 0 only if all are available. "
     )
     query_g.add_argument(
         '--has_queues',
@@ -563,7 +639,14 @@ There are several batch queues configured on the cluster:
     query_g.add_argument(
         '--show_config',
         action="store_true",
-        help="Display the configuration currently in force"
+        help="Display the configuration currently in force, with comments "
+        "naming the file (or defaults) each setting came from"
+    )
+    query_g.add_argument(
+        '--refresh_queues', '--refresh-queues',
+        action="store_true",
+        help="Query the cluster for the current queue limits and store them "
+        "as the live queue overlay used by later submissions"
     )
     parser.add_argument(
         '-v', '--verbose',
@@ -630,7 +713,7 @@ def report_parser(parser_class=argparse.ArgumentParser):
     )
     parser.add_argument(
         'job_id',
-        type=int,
+        type=job_id_arg,
         help="Report job details for this job ID."
     )
     parser.add_argument(
@@ -643,9 +726,203 @@ def report_parser(parser_class=argparse.ArgumentParser):
         action="store_true",
         help="Include all output '|' separated"
     )
+    parser.add_argument(
+        '--wait',
+        action="store_true",
+        help="Wait until the job has finished (or failed) before reporting."
+    )
+    parser.add_argument(
+        '--timeout',
+        type=int,
+        default=None,
+        metavar="SECONDS",
+        help="Maximum time to --wait for, exits with a non-zero return code "
+        "if the job has not finished in this time."
+    )
+    return parser
+
+
+def stats_parser(parser_class=argparse.ArgumentParser):
+    '''Parse the command line, returns a dict keyed on option'''
+
+    parser = parser_class(
+        prog="fsl_sub_stats",
+        description='Summarise the fsl_sub audit log.',
+    )
+    parser.add_argument(
+        '--log',
+        default=None,
+        help="Audit log to read, defaults to the configured audit_log"
+    )
+    parser.add_argument(
+        '--by',
+        default='queue',
+        choices=fsl_sub.audit.GROUPS,
+        help="Group submissions by this field."
+    )
+    parser.add_argument(
+        '--since',
+        type=_date_arg,
+        default=None,
+        metavar='YYYY-MM-DD',
+        help="Only include submissions made on or after this date."
+    )
+    parser.add_argument(
+        '--until',
+        type=_date_arg,
+        default=None,
+        metavar='YYYY-MM-DD',
+        help="Only include submissions made before this date."
+    )
+    parser.add_argument(
+        '--user',
+        default=None,
+        help="Only include this user's submissions."
+    )
+    parser.add_argument(
+        '--json',
+        action="store_true",
+        help="Output JSON."
+    )
+    return parser
+
+
+def _date_arg(value):
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m-%d').timestamp()
+    except ValueError:
+        raise argparse.ArgumentTypeError("Dates should be YYYY-MM-DD")
+
+
+def stats_cmd(args=None):
+    cmd_parser = stats_parser()
+    options = cmd_parser.parse_args(args=args)
+    log_file = options.log
+    if log_file is None:
+        try:
+            log_file = fsl_sub.audit.audit_log()
+        except BadConfiguration as e:
+            cmd_parser.error("Bad configuration: " + str(e))
+        if log_file is None:
+            cmd_parser.error("No audit log configured - use --log")
+    try:
+        stats = fsl_sub.audit.aggregate(
+            log_file, options.by, options.since, options.until, options.user)
+    except (OSError, ValueError, ) as e:
+        cmd_parser.exit(
+            message="Unable to read audit log - " + str(e) + '\n', status=1)
+    if options.json:
+        json.dump(stats, sys.stdout, indent=2)
+        print()
+        return
+
+    def fmt(value):
+        if value is None:
+            return '-'
+        return '{0:g}'.format(round(value, 1))
+    columns = (
+        options.by.title(), 'Jobs', 'Arrays', 'Slots(mean/max)',
+        'RAM(median/p90/max)', 'Time(median/p90/max)', )
+    rows = [columns]
+    for key, group in stats.items():
+        rows.append((
+            key or '-', str(group['jobs']), str(group['array_tasks']),
+            '/'.join(fmt(group['slots'][s]) for s in ('mean', 'max', )),
+            '/'.join(fmt(group['jobram'][s]) for s in ('median', 'p90', 'max', )),
+            '/'.join(fmt(group['jobtime'][s]) for s in ('median', 'p90', 'max', )),
+        ))
+    widths = [max(len(r[i]) for r in rows) for i in range(len(columns))]
+    for row in rows:
+        print('  '.join(c.ljust(w) for c, w in zip(row, widths)).rstrip())
+
+
+def logs_parser(parser_class=argparse.ArgumentParser):
+    '''Parse the command line, returns a dict keyed on option'''
+
+    parser = parser_class(
+        prog="fsl_sub_logs",
+        description='Output the (possibly compressed or consolidated) logs of jobs run by the shell plugin.',
+    )
+    parser.add_argument(
+        'job_id',
+        help="Job ID"
+    )
+    parser.add_argument(
+        'task_id',
+        type=int,
+        nargs='?',
+        default=None,
+        help="Task to output, all tasks are output in order if not given"
+    )
+    parser.add_argument(
+        '--logdir',
+        default='.',
+        help="Folder containing the logs, defaults to the current folder"
+    )
+    parser.add_argument(
+        '--stderr',
+        action="store_true",
+        help="Output the standard error rather than the standard output."
+    )
     return parser
 
 
+def _find_task_log(logdir, job_id, stream):
+    '''Return the consolidated log file of stream ('o' or 'e') for job_id'''
+    suffix = '.' + stream + str(job_id)
+    matches = [
+        os.path.join(logdir, f) for f in os.listdir(logdir)
+        if f.endswith(suffix + fsl_sub.tasklogs.INDEX_SUFFIX)]
+    if not matches:
+        return None
+    if len(matches) > 1:
+        raise ValueError(
+            "Several logs for job {0} in {1}".format(job_id, logdir))
+    return matches[0][:-len(fsl_sub.tasklogs.INDEX_SUFFIX)]
+
+
+def _find_logs(logdir, job_id, stream, task_id=None):
+    '''Return the (possibly compressed) log files of stream ('o' or 'e')
+    for job_id, one per task in task order for array tasks'''
+    log_re = re.compile(
+        r'\.{0}{1}(?:\.(\d+))?(?:{2})?$'.format(
+            stream, re.escape(str(job_id)),
+            '|'.join(re.escape(x) for x in fsl_sub.compression.SUFFIXES.values())))
+    logs = []
+    for f in os.listdir(logdir):
+        match = log_re.search(f)
+        if match is None:
+            continue
+        task = int(match.group(1)) if match.group(1) else 0
+        if task_id is None or task == task_id:
+            logs.append((task, os.path.join(logdir, f)))
+    if not logs:
+        raise FileNotFoundError(
+            "No logs for job {0} in {1}".format(job_id, logdir))
+    return [f for _, f in sorted(logs)]
+
+
+def logs_cmd(args=None):
+    cmd_parser = logs_parser()
+    options = cmd_parser.parse_args(args=args)
+    out = sys.stdout.buffer
+    stream = 'e' if options.stderr else 'o'
+    try:
+        data_file = _find_task_log(options.logdir, options.job_id, stream)
+        if data_file is None:
+            for log in _find_logs(
+                    options.logdir, options.job_id, stream, options.task_id):
+                fsl_sub.compression.open_log(log, out)
+        elif options.task_id is not None:
+            fsl_sub.tasklogs.read(data_file, options.task_id, out)
+        else:
+            for task_id in sorted(fsl_sub.tasklogs.tasks(data_file)):
+                fsl_sub.tasklogs.read(data_file, task_id, out)
+        out.flush()
+    except (OSError, ValueError, UnknownJobId, BadConfiguration, ) as e:
+        cmd_parser.exit(message=str(e) + '\n', status=1)
+
+
 class LogFormatter(logging.Formatter):
 
     default_fmt = logging.Formatter('%(levelname)s:%(name)s: %(message)s')
@@ -684,6 +961,18 @@ def report_cmd(args=None):
     plugin_logger.addHandler(lhdr)
     cmd_parser = report_parser()
     options = cmd_parser.parse_args(args=args)
+    if options.wait:
+        job_id = options.job_id
+        if options.subjob_id is not None and not is_composite(job_id):
+            job_id = '.'.join((str(job_id), str(options.subjob_id)))
+        try:
+            _, not_done = wait(job_id, timeout=options.timeout)
+        except BadConfiguration as e:
+            cmd_parser.error("Bad configuration: " + str(e))
+        if not_done:
+            cmd_parser.exit(
+                message="Timed out waiting for job " + str(job_id) + '\n',
+                status=1)
     try:
         job_details = report(options.job_id, options.subjob_id)
     except BadConfiguration as e:
@@ -792,6 +1081,7 @@ def report_cmd(args=None):
             print('|'.join(line))
 
 
+@profiled('fsl_sub', start_session=True)
 def main(args=None):
     lhdr = logging.StreamHandler()
     fmt = LogFormatter()
@@ -800,12 +1090,16 @@ def main(args=None):
     logger.addHandler(lhdr)
     try:
         config = read_config()
+        lap('config')
+        configure_logging(logger, lhdr, config)
         cp_info = coproc_info()
+        lap('coprocessors')
     except BadConfiguration as e:
         logger.error("Error in fsl_sub configuration - " + str(e))
         sys.exit(CONFIG_ERROR)
 
     PLUGINS = load_plugins()
+    lap('plugins')
 
     grid_module = 'fsl_sub_plugin_' + config['method']
     if grid_module not in PLUGINS:
@@ -824,14 +1118,35 @@ def main(args=None):
         config, cp_info, plugin_name=grid_module,
         plugin_version=plugin_version())
     options = vars(cmd_parser.parse_args(args=args))
+    lap('parse_args')
+    if options['profile']:
+        enable_profiling(profile_destination() or 'stderr')
     if options['show_config']:
         yaml = YAML()
         yaml.indent(mapping=2, sequence=4, offset=2)
         yaml.compact(seq_seq=False, seq_map=False)
         yaml.representer.add_representer(type(None), yaml_repr_none)
-        yaml.dump(config, sys.stdout)
+        yaml.dump(annotated_config(config, config_provenance()), sys.stdout)
+        sys.exit(0)
+    if options['refresh_queues']:
+        live = refresh_queue_overlay(config['method'])
+        if not live:
+            print(
+                "The " + config['method'] + " plugin can't report live "
+                "queue limits",
+                file=sys.stderr)
+            sys.exit(1)
+        for queue, limits in sorted(live.items()):
+            print(queue + ": " + ', '.join(
+                "{0}={1}".format(k, v) for k, v in sorted(limits.items())))
         sys.exit(0)
     if options['has_coprocessor'] is not None:
+        coprocs = [c for c in options['has_coprocessor'].split(',') if c]
+        if len(coprocs) > 1:
+            has_copros = has_coprocessors(coprocs)
+            for copro in coprocs:
+                print(copro + ": " + ("Yes" if has_copros[copro] else "No"))
+            sys.exit(0 if all(has_copros.values()) else 1)
         has_copro = has_coprocessor(options['has_coprocessor'])
         if has_copro:
             print("Yes")
@@ -869,9 +1184,22 @@ def main(args=None):
 
     if options['verbose']:
         logger.setLevel(logging.INFO)
+        lhdr.setLevel(logging.NOTSET)
     if options['debug']:
         logger.setLevel(logging.DEBUG)
+        lhdr.setLevel(logging.NOTSET)
         os.environ['FSLSUB_DEBUG'] = '1'
+    if options['workflow'] is not None:
+        try:
+            steps, defaults = load_workflow(options['workflow'])
+            job_ids = submit_dag(steps, defaults)
+        except BadSubmission as e:
+            cmd_parser.exit(
+                message="Error submitting workflow - " + str(e) + '\n',
+                status=SUBMISSION_ERROR)
+        for name, job_id in job_ids.items():
+            print(name, job_id)
+        sys.exit(0)
     if options['array_task'] and options['args']:
         cmd_parser.error(
             "Individual and array tasks are mutually exclusive."
@@ -944,6 +1272,7 @@ def main(args=None):
         exports = []
 
     keep_jobscript = options['keep_jobscript']
+    lap('prepare')
 
     try:
         job_id = submit(
@@ -977,7 +1306,9 @@ def main(args=None):
             as_tuple=False,
             project=project,
             export_vars=exports,
-            keep_jobscript=keep_jobscript
+            keep_jobscript=keep_jobscript,
+            skip_completed=options['skip_completed'],
+            idempotency_key=options['dedup']
         )
     except BadSubmission as e:
         cmd_parser.exit(
@@ -991,7 +1322,8 @@ def main(args=None):
     except Exception as e:
         traceback.print_exc(file=sys.stderr)
         cmd_parser.error("Unexpected error: " + str(e) + '\n')
-    print(job_id)
+    if job_id is not None:
+        print(job_id)
 
 
 def update_parser(parser_class=argparse.ArgumentParser):
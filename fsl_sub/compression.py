@@ -0,0 +1,168 @@
+# fsl_sub python module
+# Copyright (c) 2018-2021 University of Oxford (Duncan Mortimer)
+
+# Streaming compression of job logs
+import logging
+import os
+import shutil
+import tempfile
+import zlib
+
+from fsl_sub.config import read_config
+from fsl_sub.exceptions import (BadConfiguration, MissingConfiguration, )
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CODECS = ('gzip', 'zstd', )
+SUFFIXES = {'gzip': '.gz', 'zstd': '.zst', }
+# Codec identifiers stored in binary log indices
+CODEC_IDS = {None: 0, 'gzip': 1, 'zstd': 2, }
+CHUNK = 1024 * 1024
+
+
+def _get_logger():
+    return logging.getLogger(__name__)
+
+
+def log_compression():
+    '''Codec used to compress finished logs, from FSLSUB_LOG_COMPRESSION or
+    the log_compression option, or None. zstd falls back to gzip if the
+    zstandard module is not installed.'''
+    codec = os.environ.get('FSLSUB_LOG_COMPRESSION')
+    if codec is None:
+        try:
+            codec = read_config().get('log_compression')
+        except (BadConfiguration, MissingConfiguration, ):
+            codec = None
+    if not codec:
+        return None
+    if codec not in CODECS:
+        raise BadConfiguration(
+            "Unrecognised log_compression " + str(codec)
+            + " (should be one of " + ', '.join(CODECS) + ")")
+    if codec == 'zstd' and zstandard is None:
+        _get_logger().debug("zstandard not installed, using gzip")
+        return 'gzip'
+    return codec
+
+
+def codec_of(path):
+    '''Codec a log file was compressed with, from its suffix'''
+    for codec, suffix in SUFFIXES.items():
+        if path.endswith(suffix):
+            return codec
+    return None
+
+
+def compressor(codec):
+    '''Object with compress(data) and flush() methods'''
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor().compressobj()
+    return zlib.compressobj(6, zlib.DEFLATED, 31)
+
+
+def decompressor(codec):
+    '''Object with a decompress(data) method'''
+    if codec == 'zstd':
+        if zstandard is None:
+            raise BadConfiguration(
+                "The zstandard module is required to read zstd logs")
+        return zstandard.ZstdDecompressor().decompressobj()
+    return zlib.decompressobj(31)
+
+
+def compress_stream(src, dst, codec, chunk=CHUNK):
+    '''Compress binary file object src into dst, one chunk at a time'''
+    comp = compressor(codec)
+    while True:
+        data = src.read(chunk)
+        if not data:
+            break
+        dst.write(comp.compress(data))
+    dst.write(comp.flush())
+
+
+def decompress_stream(src, dst, codec, length=None, chunk=CHUNK):
+    '''Decompress binary file object src (or only the next length bytes of
+    it) into dst, one chunk at a time'''
+    decomp = decompressor(codec)
+    while length is None or length > 0:
+        data = src.read(chunk if length is None else min(chunk, length))
+        if not data:
+            break
+        if length is not None:
+            length -= len(data)
+        dst.write(decomp.decompress(data))
+
+
+def compress_file(path, codec):
+    '''Replace the file path with a compressed copy, path + suffix.
+    Returns the new file name.'''
+    target = path + SUFFIXES[codec]
+    folder = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=folder, prefix='.', suffix='.tmp')
+    try:
+        with open(path, 'rb') as src, os.fdopen(fd, 'wb') as dst:
+            compress_stream(src, dst, codec)
+        shutil.copymode(path, tmp_path)
+        os.replace(tmp_path, target)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    os.remove(path)
+    return target
+
+
+def compress_logs(paths, codec):
+    '''Compress the listed logs, problems are logged rather than raised.
+    /dev/null and missing files are skipped.'''
+    for path in paths:
+        if path == '/dev/null':
+            continue
+        try:
+            compress_file(path, codec)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            _get_logger().warning(
+                "Unable to compress {0}: {1}".format(path, str(e)))
+
+
+def open_log(path, out, chunk=CHUNK):
+    '''Write the (possibly compressed) log path to the binary file object
+    out'''
+    codec = codec_of(path)
+    with open(path, 'rb') as src:
+        if codec is None:
+            shutil.copyfileobj(src, out, chunk)
+        else:
+            decompress_stream(src, out, codec, chunk=chunk)
+
+
+def epilogue(codec, log_files):
+    '''Lines to append to a job script that compress the job's logs (shell
+    expressions, e.g. using the scheduler's job id variable) once the
+    command has finished, see job_script(). zstd falls back to gzip where
+    the zstd command isn't installed on the compute node.'''
+    logs = ' '.join('"{0}"'.format(f) for f in log_files)
+    gzip = 'gzip -c "$fsl_sub_log" > "$fsl_sub_log.gz"'
+    if codec == 'zstd':
+        compress = (
+            'if command -v zstd >/dev/null 2>&1; then '
+            'zstd -q -c "$fsl_sub_log" > "$fsl_sub_log.zst"; '
+            'else ' + gzip + '; fi')
+    else:
+        compress = gzip
+    return [
+        'for fsl_sub_log in ' + logs + '; do',
+        '    if [ -f "$fsl_sub_log" ]; then',
+        '        ' + compress + ' && rm -f "$fsl_sub_log"',
+        '    fi',
+        'done',
+    ]
@@ -1,79 +1,112 @@
 # fsl_sub python module
 # Copyright (c) 2018-2021 University of Oxford (Duncan Mortimer)
 
+import json
 import os
 import os.path
+import socket
 from shutil import which
 import subprocess as sp
+import tempfile
+import time
 import warnings
 from ruamel.yaml import (YAML, YAMLError, )
+from ruamel.yaml.comments import CommentedMap
 
-from fsl_sub.exceptions import (BadConfiguration, MissingConfiguration, )
+from fsl_sub.config_model import invalidate as invalidate_compiled
+from fsl_sub.exceptions import (
+    BadConfiguration,
+    CommandError,
+    MissingConfiguration,
+)
 from fsl_sub.utils import (
     get_plugin_default_conf,
     get_plugin_queue_defs,
+    get_plugin_live_queue_defs,
     get_plugin_already_queued,
     available_plugins,
-    merge_dict,
     merge_commentedmap,
+    fsl_sub_state_dir,
 )
+from collections.abc import (Mapping, MutableMapping, )
+from contextlib import contextmanager
 from functools import lru_cache
 
 
-def find_config_file():
-    # Find most appropriate config file
-    search_path = []
-    try:
-        env_config = os.environ['FSLSUB_CONF']
-        search_path.append(env_config)
-    except KeyError:
-        pass
+# Configuration layers, lowest precedence first
+LAYERS = (
+    'defaults', 'plugin defaults', 'site', 'user', 'FSLSUB_CONF',
+    'live queues', )
 
-    search_path.append(
-        os.path.join(
-            os.path.expanduser("~"),
-            '.fsl_sub.yml')
-    )
 
+def _shell_config_file():
+    return os.path.abspath(
+        os.path.join(
+            os.path.realpath(__file__),
+            os.path.pardir,
+            'plugins',
+            'fsl_sub_shell.yml'))
+
+
+def config_files():
+    '''List of (layer, path) of the configuration files to be merged,
+    lowest precedence first - the site file ($FSLDIR/etc/fslconf/fsl_sub.yml),
+    the user's ~/.fsl_sub.yml and the file named by FSLSUB_CONF. If none of
+    these exist the shell plugin's configuration is used.'''
+    candidates = []
     try:
         fsl_dir = os.environ['FSLDIR']
         default_conf = os.path.realpath(
             os.path.join(fsl_dir, 'etc', 'fslconf', 'fsl_sub.yml')
         )
-        search_path.append(
-            os.path.abspath(default_conf)
-        )
+        candidates.append(('site', os.path.abspath(default_conf), ))
+    except KeyError:
+        pass
+
+    candidates.append(
+        ('user', os.path.join(os.path.expanduser("~"), '.fsl_sub.yml'), ))
+
+    try:
+        candidates.append(('FSLSUB_CONF', os.environ['FSLSUB_CONF'], ))
     except KeyError:
         pass
-    search_path.append(
-        os.path.abspath(
-            os.path.join(
-                os.path.realpath(__file__),
-                os.path.pardir,
-                'plugins',
-                'fsl_sub_shell.yml')))
-
-    for p in search_path:
+
+    found = []
+    seen = set()
+    for layer, p in candidates:
         if os.path.exists(p) and os.path.getsize(p) > 0:
-            return p
+            real = os.path.realpath(p)
+            if real not in seen:
+                seen.add(real)
+                found.append((layer, p, ))
+    if not found:
+        shell_conf = _shell_config_file()
+        if os.path.exists(shell_conf) and os.path.getsize(shell_conf) > 0:
+            found.append(('site', shell_conf, ))
+    if not found:
+        raise MissingConfiguration("Unable to find fsl_sub config")
+    return found
 
-    raise MissingConfiguration("Unable to find fsl_sub config")
+
+def find_config_file():
+    '''The highest precedence configuration file'''
+    return config_files()[-1][1]
 
 
 def _internal_config_file(filename):
     return os.path.join(os.path.realpath(os.path.dirname(__file__)), filename)
 
 
-def load_default_config():
+def _shipped_layers():
+    '''List of (layer, source, dict) of the shipped defaults'''
     dc_file = _internal_config_file("default_config.yml")
     dcc_file = _internal_config_file("default_coproc_config.yml")
-    default_config = {}
+    layers = []
     yaml = YAML(typ='safe')
     for d_conf_f in (dc_file, dcc_file, ):
         try:
             with open(d_conf_f, 'r') as yaml_source:
-                yc = yaml.load(yaml_source)
-                default_config = merge_dict(default_config, yc)
+                layers.append(('defaults', d_conf_f, yaml.load(yaml_source), ))
         except YAMLError as e:
             raise BadConfiguration(
                 "Unable to understand default configuration: " + str(e))
@@ -83,53 +116,402 @@ def load_default_config():
         except PermissionError:
             raise MissingConfiguration(
                 "Unable to open default configuration file: " + d_conf_f)
+    return layers
+
 
-    for plugin in available_plugins():
+def _plugin_layer(plugin):
+    '''(layer, source, dict) of plugin's default configuration'''
+    try:
+        plugin_yaml = get_plugin_default_conf(plugin)
+        p_dc = YAML(typ='safe').load(plugin_yaml)
+    except Exception as e:
+        raise BadConfiguration(
+            "Unable to understand plugin "
+            "{0}'s default configuration: ".format(plugin) + str(e))
+    return ('plugin defaults', plugin, p_dc, )
+
+
+def _default_layers(methods=None):
+    '''List of (layer, source, dict) of the shipped defaults and the
+    defaults of the plugins for methods (all installed plugins if None).
+    Unknown methods are skipped.'''
+    layers = _shipped_layers()
+    plugins = available_plugins()
+    if methods is not None:
+        plugins = [p for p in plugins if p in methods]
+    layers.extend(_plugin_layer(plugin) for plugin in plugins)
+    layers.append(('defaults', None, {'method': 'shell'}, ))
+    return layers
+
+
+def _configured_methods(file_layers):
+    '''The method selected by the configuration files (default shell) and
+    those they give method_opts for'''
+    method = 'shell'
+    methods = set()
+    for _, _, config_dict in file_layers:
+        method = config_dict.get('method', method)
+        methods.update((config_dict.get('method_opts') or {}).keys())
+    methods.add(method)
+    return methods
+
+
+def _file_layers():
+    '''List of (layer, path, dict) of the configuration files'''
+    yaml = YAML(typ='safe')
+    layers = []
+    for layer, config_file in config_files():
         try:
-            plugin_yaml = get_plugin_default_conf(plugin)
-            p_dc = yaml.load(plugin_yaml)
-        except Exception as e:
+            with open(config_file, 'r') as yaml_source:
+                config_dict = yaml.load(yaml_source)
+        except IsADirectoryError:
             raise BadConfiguration(
-                "Unable to understand plugin "
-                "{0}'s default configuration: ".format(plugin) + str(e))
-
-        default_config = merge_dict(default_config, p_dc)
-
-    default_config['method'] = 'shell'
-    return default_config
+                "Unable to open configuration file - "
+                "looks like FSLSUB_CONF may be pointing at a directory? " + config_file)
+        except YAMLError as e:
+            raise BadConfiguration(
+                "Unable to understand configuration file: " + str(e))
+        except (FileNotFoundError, PermissionError, ):
+            raise BadConfiguration(
+                "Unable to open configuration file: " + config_file
+            )
+        if config_dict is None:
+            config_dict = {}
+        if not isinstance(config_dict, dict):
+            raise BadConfiguration(
+                "Configuration file should contain a dictionary: "
+                + config_file)
+        layers.append((layer, config_file, config_dict, ))
+    return layers
+
+
+# Settings a layer replaces whole rather than merging into, so a queue
+# can be removed by a later file
+REPLACED_SETTINGS = ('queues', )
+# Layers that update replaced settings rather than replacing them
+UPDATE_LAYERS = ('live queues', )
+
+
+class LayeredConfig(MutableMapping):
+    '''Read only view of configuration layers, looking keys up from the
+    highest precedence layer down when first used. Dictionaries given by
+    several layers are returned as views of their own, other values are
+    those of the layer that supplied them (not copies). Settings named in
+    replace are taken whole from the highest layer giving them (layers named
+    in updates merge into them instead). Assignments and deletions only
+    change the view, never the layers.
+
+    Requires:
+
+    layers - list of (layer, source, dict), lowest precedence first. The
+        dict may be a LayeredConfig, whose layers are used.
+
+    Optional:
+    replace - top level settings replaced whole by a layer
+    updates - names of layers that merge into replaced settings
+    '''
+
+    def __init__(self, layers, replace=(), updates=()):
+        # (origin, mapping, replaces) highest precedence first
+        self._maps = []
+        for layer, source, values in reversed(layers):
+            if isinstance(values, LayeredConfig):
+                self._maps.extend(
+                    (origin, mapping, layer not in updates, )
+                    for origin, mapping, _ in values._maps)
+            elif values:
+                self._maps.append(
+                    ((layer, source, ), values, layer not in updates, ))
+        self._replace = frozenset(replace)
+        self._resolved = {}
+        self._local = set()
+        self._deleted = set()
+        self._provenance = None
+
+    @classmethod
+    def _view(cls, sources):
+        view = cls([])
+        view._maps = [(origin, value, False, ) for origin, value in sources]
+        return view
+
+    def _sources(self, key):
+        '''(origin, value) of the values given for key, highest precedence
+        first, stopping at a value that hides those below'''
+        sources = []
+        for origin, mapping, replaces in self._maps:
+            try:
+                value = mapping[key]
+            except KeyError:
+                continue
+            if not isinstance(value, Mapping):
+                if not sources:
+                    sources.append((origin, value, ))
+                break
+            sources.append((origin, value, ))
+            if replaces and key in self._replace:
+                break
+        return sources
+
+    def __getitem__(self, key):
+        try:
+            return self._resolved[key]
+        except KeyError:
+            pass
+        if key in self._deleted:
+            raise KeyError(key)
+        sources = self._sources(key)
+        if not sources:
+            raise KeyError(key)
+        value = sources[0][1]
+        if isinstance(value, Mapping):
+            value = self._view(sources)
+        self._resolved[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        if key not in self or self[key] != value:
+            invalidate_compiled()
+        self._resolved[key] = value
+        self._local.add(key)
+        self._deleted.discard(key)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        invalidate_compiled()
+        self._resolved.pop(key, None)
+        self._local.discard(key)
+        self._deleted.add(key)
+
+    def __iter__(self):
+        keys = {}
+        for _, mapping, _ in reversed(self._maps):
+            keys.update(dict.fromkeys(mapping))
+        keys.update(dict.fromkeys(self._local))
+        return (k for k in keys if k not in self._deleted)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __contains__(self, key):
+        if key in self._local:
+            return True
+        if key in self._deleted:
+            return False
+        return any(key in mapping for _, mapping, _ in self._maps)
+
+    def __repr__(self):
+        return "{0}({1!r})".format(type(self).__name__, dict(self.items()))
+
+    def _record(self, provenance, path):
+        for key in self:
+            if key in self._local:
+                continue
+            sources = self._sources(key)
+            if len(sources) == 1:
+                provenance[path + (key, )] = sources[0][0]
+            else:
+                self[key]._record(provenance, path + (key, ))
+
+    def provenance(self):
+        '''{key path tuple: (layer, source)} of the layer that supplied each
+        value, worked out once. Dictionaries supplied whole by one layer have
+        no entries for their values, see value_origin(). Values assigned to
+        the view have no entry.'''
+        if self._provenance is None:
+            provenance = {}
+            self._record(provenance, ())
+            self._provenance = provenance
+        return self._provenance
+
+
+def load_default_config(methods=None):
+    '''Shipped defaults layered with the defaults of the plugins for
+    methods (all installed plugins if None)'''
+    return LayeredConfig(_default_layers(methods))
+
+
+def _resolve(layers):
+    '''Layer the configuration and the live queue overlay'''
+    config = LayeredConfig(
+        layers, replace=REPLACED_SETTINGS, updates=UPDATE_LAYERS)
+    overlay = _queue_overlay_layer(config)
+    if overlay is not None:
+        config = LayeredConfig(
+            layers + [overlay], replace=REPLACED_SETTINGS,
+            updates=UPDATE_LAYERS)
+    return config
 
 
 @lru_cache()
 def read_config():
-    yaml = YAML(typ='safe')
-    default_config = load_default_config()
-    config_file = find_config_file()
-    try:
-        with open(config_file, 'r') as yaml_source:
-            config_dict = yaml.load(yaml_source)
-    except IsADirectoryError:
-        raise BadConfiguration(
-            "Unable to open configuration file - "
-            "looks like FSLSUB_CONF may be pointing at a directory? " + config_file)
-    except YAMLError as e:
-        raise BadConfiguration(
-            "Unable to understand configuration file: " + str(e))
-    except (FileNotFoundError, PermissionError, ):
-        raise BadConfiguration(
-            "Unable to open configuration file: " + config_file
-        )
-    except MissingConfiguration:
-        config_dict = {}
-    this_config = merge_dict(default_config, config_dict)
-    if config_dict.get('coproc_opts', {}):
-        if 'cuda' not in config_dict['coproc_opts'].keys():
-            if 'cuda' not in config_dict.get('silence_warnings', []):
-                warnings.warn(
-                    '(cuda) Coprocessors configured but no "cuda" coprocessor found. '
-                    'FSL tools will not be able to autoselect CUDA versions of software.')
+    '''The configuration - the shipped defaults, the defaults of the
+    plugins of the configured methods and the configuration files layered
+    in order, see config_files(). Other methods' defaults are loaded by
+    method_config() when needed.'''
+    # Views compiled from a previous read are out of date
+    invalidate_compiled()
+    file_layers = _file_layers()
+    default_config = load_default_config(_configured_methods(file_layers))
+    this_config = _resolve(
+        [('defaults', None, default_config, )] + file_layers)
+    configured_coprocs = set()
+    for _, _, config_dict in file_layers:
+        configured_coprocs.update((config_dict.get('coproc_opts') or {}).keys())
+    if configured_coprocs and 'cuda' not in configured_coprocs:
+        if 'cuda' not in this_config.get('silence_warnings', []):
+            warnings.warn(
+                '(cuda) Coprocessors configured but no "cuda" coprocessor found. '
+                'FSL tools will not be able to autoselect CUDA versions of software.')
     return this_config
 
 
+def config_provenance():
+    '''Returns {key path tuple: (layer, source)} giving the layer that
+    supplied each value of read_config(), e.g.
+    {('method', ): ('site', '/usr/local/fsl/etc/fslconf/fsl_sub.yml')}.
+    Values within a dictionary supplied whole have no entry of their own,
+    see value_origin().'''
+    return read_config().provenance()
+
+
+def value_origin(provenance, path):
+    '''(layer, source) that supplied the value at key path'''
+    path = tuple(path)
+    while path:
+        try:
+            return provenance[path]
+        except KeyError:
+            path = path[:-1]
+    return None
+
+
+def annotated_config(config, provenance):
+    '''config as a ruamel.yaml CommentedMap with comments naming the layer
+    each value came from, where that differs from its parent's'''
+    def describe(origin):
+        layer, source = origin
+        return layer if source is None else "{0} ({1})".format(layer, source)
+
+    def annotate(mapping, path, parent):
+        annotated = CommentedMap()
+        for k, v in mapping.items():
+            key = path + (k, )
+            origin = value_origin(provenance, key)
+            if isinstance(v, Mapping):
+                annotated[k] = annotate(v, key, origin)
+            else:
+                annotated[k] = v
+            if origin is not None and origin != parent:
+                annotated.yaml_add_eol_comment(describe(origin), k)
+        return annotated
+    return annotate(config, (), None)
+
+
+# The live queue overlay is off unless live_queue_ttl is set
+DEFAULT_LIVE_QUEUE_TTL = 0
+# Queue limits taken from the scheduler
+LIVE_QUEUE_KEYS = ('time', 'max_size', 'max_slots', 'slot_size', )
+# Age after which an unfinished refresh is assumed to have died
+REFRESH_LOCK_AGE = 600
+
+
+def _queue_overlay_file(method):
+    return os.path.join(
+        fsl_sub_state_dir(), 'queues-{0}.json'.format(method))
+
+
+def _live_queue_ttl(config):
+    return int(config.get('live_queue_ttl', DEFAULT_LIVE_QUEUE_TTL) or 0)
+
+
+def _load_queue_overlay(method):
+    '''Returns (time, queues) of the stored overlay or (None, {})'''
+    try:
+        with open(_queue_overlay_file(method), 'r') as overlay_file:
+            overlay = json.load(overlay_file)
+        return (float(overlay['time']), dict(overlay['queues']), )
+    except (OSError, ValueError, TypeError, KeyError, ):
+        return (None, {}, )
+
+
+def _live_queues(method):
+    '''{queue: {limit: value}} of the limits the scheduler enforces, from
+    the plugin's live_queue_defs(). Plugins without one (e.g. those whose
+    build_queue_defs() only suggests limits) have no live limits.'''
+    queue_defs = get_plugin_live_queue_defs(method)
+    if not queue_defs:
+        return {}
+    live = {}
+    for q, q_def in queue_defs.items():
+        if not isinstance(q_def, dict):
+            continue
+        live[str(q)] = {
+            k: q_def[k] for k in LIVE_QUEUE_KEYS
+            if isinstance(q_def.get(k), (int, float, ))}
+    return live
+
+
+@contextmanager
+def _refresh_lock(method):
+    '''Hold the refresh lock of method's overlay for the block, raising
+    CommandError if another refresh holds it. The lock file is only
+    removed by its holder.'''
+    lock = _queue_overlay_file(method) + '.lock'
+    os.makedirs(os.path.dirname(lock), exist_ok=True)
+    try:
+        if time.time() - os.stat(lock).st_mtime > REFRESH_LOCK_AGE:
+            os.remove(lock)
+    except FileNotFoundError:
+        pass
+    try:
+        os.close(os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        raise CommandError(
+            "A refresh of the {0} queue limits is already running".format(
+                method))
+    try:
+        yield
+    finally:
+        os.remove(lock)
+
+
+def refresh_queue_overlay(method=None):
+    '''Query method's scheduler (via the plugin's live_queue_defs()) and
+    store the queue limits found as the live queue overlay. Returns the
+    {queue: {limit: value}} stored. Refreshes only happen when this is
+    called, e.g. by fsl_sub --refresh_queues.'''
+    if method is None:
+        method = read_config()['method']
+    with _refresh_lock(method):
+        queues = _live_queues(method)
+        if queues:
+            _save_json(
+                _queue_overlay_file(method),
+                {'time': time.time(), 'queues': queues})
+    return queues
+
+
+def _queue_overlay_layer(config):
+    '''(layer, source, dict) updating the limits of the configured queues
+    from a live queue overlay younger than live_queue_ttl, or None. Only
+    reads the stored overlay, it is never refreshed here.'''
+    method = config.get('method', 'shell')
+    queues = config.get('queues') or {}
+    ttl = _live_queue_ttl(config)
+    if method == 'shell' or not queues or ttl <= 0:
+        return None
+    stored, live = _load_queue_overlay(method)
+    if stored is None or time.time() - stored > ttl:
+        return None
+    overlay = {
+        q: limits for q, limits in live.items()
+        if q in queues and isinstance(limits, dict) and limits}
+    if not overlay:
+        return None
+    return ('live queues', _queue_overlay_file(method), {'queues': overlay}, )
+
+
 def method_config(method):
     '''Returns the configuration dict for the requested submission
     method, e.g. sge'''
@@ -142,9 +524,20 @@ def method_config(method):
     try:
         return m_opts[method]
     except KeyError:
+        pass
+    # Only the configured methods' plugin defaults are loaded by
+    # read_config(), others are loaded (once) here
+    if method not in available_plugins():
+        raise BadConfiguration(
+            "Unable to find configuration for {}".format(method)
+        )
+    try:
+        m_opts[method] = _plugin_layer(method)[2]['method_opts'][method]
+    except (KeyError, TypeError, ):
         raise BadConfiguration(
             "Unable to find configuration for {}".format(method)
         )
+    return m_opts[method]
 
 
 def _read_config_file(fname):
@@ -220,36 +613,134 @@ def has_queues(method=None):
     return mconf['queues'] and config['queues']
 
 
-def has_coprocessor(coproc):
-    '''Is the specified coprocessor available on this system?'''
+DEFAULT_PRESENCE_TTL = 3600
+BOOT_ID = '/proc/sys/kernel/random/boot_id'
+
+
+def _boot_id():
+    try:
+        with open(BOOT_ID, 'r') as boot_id:
+            return boot_id.read().strip()
+    except OSError:
+        return None
+
+
+def _presence_cache_file():
+    return os.path.join(
+        fsl_sub_state_dir(),
+        'coprocessors-{0}.json'.format(socket.gethostname()))
+
+
+def _load_presence_cache(boot_id):
+    try:
+        with open(_presence_cache_file(), 'r') as cache_file:
+            cache = json.load(cache_file)
+    except (OSError, ValueError, ):
+        return {}
+    if not isinstance(cache, dict) or cache.get('boot_id') != boot_id:
+        return {}
+    return cache.get('tests', {})
+
+
+def _save_json(cache_file, data):
+    '''Atomically replace cache_file with data as JSON, problems are
+    ignored as caches are an optimisation only'''
+    folder = os.path.dirname(cache_file)
+    try:
+        os.makedirs(folder, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=folder, prefix='.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as tmp_file:
+                json.dump(data, tmp_file)
+            os.replace(tmp_path, cache_file)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+    except OSError:
+        pass
+
+
+def _save_presence_cache(boot_id, tests):
+    _save_json(_presence_cache_file(), {'boot_id': boot_id, 'tests': tests})
+
+
+def _presence_ttl(config):
+    return int(config.get('coproc_presence_ttl', DEFAULT_PRESENCE_TTL) or 0)
+
+
+def _run_presence_test(tester):
+    output = sp.run(
+        [tester, ]
+    )
+    return output.returncode == 0
+
+
+def _presence(testers, ttl):
+    '''Run each presence test (path to program) returning {path: bool}.
+    Results are cached for ttl seconds per host, keyed on the boot id and
+    the test program's path and modification time so they are invalidated
+    by a reboot or a driver update.'''
+    boot_id = _boot_id() if ttl > 0 else None
+    cache = _load_presence_cache(boot_id) if boot_id is not None else {}
+    now = time.time()
+    results = {}
+    updated = False
+    for tester in testers:
+        try:
+            mtime = os.stat(tester).st_mtime
+        except OSError:
+            mtime = None
+        cached = cache.get(tester)
+        if (mtime is not None and cached is not None
+                and cached.get('mtime') == mtime
+                and now - cached.get('time', 0) < ttl):
+            results[tester] = cached['present']
+            continue
+        results[tester] = _run_presence_test(tester)
+        if boot_id is not None and mtime is not None:
+            cache[tester] = {
+                'mtime': mtime, 'time': now, 'present': results[tester], }
+            updated = True
+    if updated:
+        _save_presence_cache(boot_id, cache)
+    return results
+
+
+def has_coprocessors(coprocs):
+    '''Are the specified coprocessors available on this system? Returns
+    {coprocessor: True/False}. Presence tests are run once for all of the
+    coprocessors and their results cached, see coproc_presence_ttl.'''
     config = read_config()
     method = config['method']
     queues = config.get('queues', {})
-    coprocs = config.get('coproc_opts', {})
+    coproc_opts = config.get('coproc_opts', {})
     if get_plugin_already_queued(method):
         method = 'shell'
     if method == 'shell':
-        co_conf = coprocs.get(coproc, None)
-        if co_conf is not None:
-            tester = which(co_conf['presence_test'])
-            if tester is None:
-                return False
-            else:
-                output = sp.run(
-                    [tester, ]
-                )
-                if output.returncode != 0:
-                    return False
-            return True
-        else:
-            # Unsupported coprocessor
-            return False
+        testers = {}
+        for coproc in coprocs:
+            co_conf = coproc_opts.get(coproc, None)
+            if co_conf is not None:
+                # Unsupported coprocessors have no test
+                testers[coproc] = which(co_conf['presence_test'])
+        found = _presence(
+            set(t for t in testers.values() if t is not None),
+            _presence_ttl(config))
+        return {c: bool(found.get(testers.get(c))) for c in coprocs}
     if queues:
-        return any([(coproc in a.get('copros', {}).keys()) for qname, a in queues.items()])
+        offered = set()
+        for a in queues.values():
+            offered.update(a.get('copros', {}).keys())
+        return {c: c in offered for c in coprocs}
     else:
         raise BadConfiguration("Grid backend specified but no queues configured")
 
 
+def has_coprocessor(coproc):
+    '''Is the specified coprocessor available on this system?'''
+    return has_coprocessors([coproc, ])[coproc]
+
+
 def uses_projects(method=None):
     '''Returns True if method has projects'''
     if method is None:
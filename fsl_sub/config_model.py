@@ -0,0 +1,284 @@
+# fsl_sub python module
+# Copyright (c) 2018-2021 University of Oxford (Duncan Mortimer)
+
+# Typed, read only views of the configuration compiled once from the YAML
+# dictionaries. Each view keeps the dictionary it was compiled from (raw)
+# and supports dictionary style access to it for code that needs it.
+import difflib
+import warnings
+from collections import OrderedDict
+from collections.abc import Mapping
+from types import MappingProxyType
+
+from fsl_sub.exceptions import BadConfiguration
+
+NUMBER = (int, float, )
+TYPO_CUTOFF = 0.85
+# Compiled views keyed on the id of their source, which is held so the id
+# can't be reused. Cleared by invalidate() when the configuration is
+# re-read or changed.
+_compiled = {}
+_MAX_COMPILED = 64
+
+
+def _type_names(types):
+    if not isinstance(types, tuple):
+        types = (types, )
+    return '/'.join(t.__name__ for t in types)
+
+
+def _typos(options, fields):
+    '''(option, suggestion) for unrecognised options that look like
+    misspellings of a known field'''
+    for option in options:
+        if option in fields or not isinstance(option, str):
+            continue
+        close = difflib.get_close_matches(option, fields, 1, TYPO_CUTOFF)
+        if close:
+            yield (option, close[0], )
+
+
+def _read_only(value):
+    if isinstance(value, list):
+        return tuple(value)
+    if isinstance(value, Mapping):
+        return MappingProxyType(value)
+    return value
+
+
+class _Spec(object):
+    '''Base of the compiled configuration sections. FIELDS maps field name to
+    (type(s), default).'''
+    __slots__ = ('name', 'raw', )
+    KIND = 'Section'
+    FIELDS = {}
+    # Whether a likely misspelt option is an error or a warning
+    STRICT_TYPOS = True
+
+    def __init__(self, name, options):
+        if options is None:
+            options = {}
+        if not isinstance(options, Mapping):
+            raise BadConfiguration(
+                "{0} {1} should be a dictionary of options".format(
+                    self.KIND, name))
+        object.__setattr__(self, 'name', name)
+        object.__setattr__(self, 'raw', MappingProxyType(options))
+        for field, value in self._validated(name, options):
+            object.__setattr__(self, field, _read_only(value))
+
+    def _validated(self, name, options):
+        '''(field, value) for each of FIELDS, with defaults applied'''
+        for option, suggestion in _typos(options, self.FIELDS):
+            message = (
+                "{0} {1}: unrecognised option '{2}' "
+                "(did you mean '{3}'?)".format(
+                    self.KIND, name, option, suggestion))
+            if self.STRICT_TYPOS:
+                raise BadConfiguration(message)
+            warnings.warn(message)
+        for field, (types, default) in self.FIELDS.items():
+            value = options.get(field, default)
+            if value is not None and not isinstance(value, types):
+                raise BadConfiguration(
+                    "{0} {1}: {2} should be {3} (found {4!r})".format(
+                        self.KIND, name, field, _type_names(types), value))
+            yield (field, value, )
+
+    def __setattr__(self, name, value):
+        raise AttributeError(
+            "{0} {1} is read only".format(self.KIND, self.name))
+
+    def __getitem__(self, key):
+        return self.raw[key]
+
+    def __contains__(self, key):
+        return key in self.raw
+
+    def __iter__(self):
+        return iter(self.raw)
+
+    def __len__(self):
+        return len(self.raw)
+
+    def get(self, key, default=None):
+        return self.raw.get(key, default)
+
+    def keys(self):
+        return self.raw.keys()
+
+    def items(self):
+        return self.raw.items()
+
+    def __repr__(self):
+        return "{0}({1!r}, {2!r})".format(
+            type(self).__name__, self.name, dict(self.raw))
+
+
+class QueueSpec(_Spec):
+    '''A queue (partition) definition'''
+    __slots__ = (
+        'time', 'max_size', 'slot_size', 'max_slots', 'copros',
+        'parallel_envs', 'map_ram', 'priority', 'group', 'default', )
+    KIND = 'Queue'
+    FIELDS = OrderedDict((
+        ('time', (NUMBER, None, )),
+        ('max_size', (NUMBER, None, )),
+        ('slot_size', (NUMBER, None, )),
+        ('max_slots', (int, None, )),
+        ('copros', (Mapping, {}, )),
+        ('parallel_envs', (list, [], )),
+        ('map_ram', (bool, False, )),
+        ('priority', (NUMBER, 1, )),
+        ('group', (int, None, )),
+        ('default', (bool, False, )),
+    ))
+
+    def __init__(self, name, options):
+        super().__init__(name, options)
+        for cp, cp_def in self.copros.items():
+            if not isinstance(cp_def, Mapping):
+                raise BadConfiguration(
+                    "Queue {0}: coprocessor {1} should be a dictionary".format(
+                        name, cp))
+            if not isinstance(cp_def.get('max_quantity', 0), int):
+                raise BadConfiguration(
+                    "Queue {0}: {1} max_quantity should be int".format(
+                        name, cp))
+
+
+class CoprocessorSpec(_Spec):
+    '''A coprocessor definition (coproc_opts entry)'''
+    __slots__ = (
+        'resource', 'classes', 'class_resource', 'class_types',
+        'default_class', 'include_more_capable', 'uses_modules',
+        'module_parent', 'presence_test', 'uses_pe', )
+    KIND = 'Coprocessor'
+    FIELDS = OrderedDict((
+        ('resource', (str, None, )),
+        ('classes', (bool, False, )),
+        ('class_resource', (str, None, )),
+        ('class_types', (Mapping, {}, )),
+        ('default_class', (str, None, )),
+        ('include_more_capable', (bool, True, )),
+        ('uses_modules', (bool, False, )),
+        ('module_parent', (str, None, )),
+        ('presence_test', (str, None, )),
+        ('uses_pe', ((str, bool, ), False, )),
+    ))
+
+    def __init__(self, name, options):
+        super().__init__(name, options)
+        for c, c_def in self.class_types.items():
+            if (not isinstance(c_def, Mapping)
+                    or not isinstance(c_def.get('capability', 0), int)):
+                raise BadConfiguration(
+                    "Coprocessor {0}: class {1} should be a dictionary with an "
+                    "integer capability".format(name, c))
+        if self.classes and self.default_class is not None and (
+                self.default_class not in self.class_types):
+            raise BadConfiguration(
+                "Coprocessor {0}: default_class {1} is not one of the "
+                "class_types".format(name, self.default_class))
+
+
+class MethodOptions(_Spec):
+    '''Options of a submission method (method_opts entry). Options are
+    plugin specific, so only the common ones are type checked; unset options
+    read as False, e.g. options['map_ram'] or options.map_ram.'''
+    __slots__ = ()
+    KIND = 'Method'
+    STRICT_TYPOS = False
+    FIELDS = OrderedDict((
+        ('queues', (bool, False, )),
+        ('large_job_split_pe', (str, None, )),
+        ('copy_environment', (bool, False, )),
+        ('mail_support', (bool, False, )),
+        ('map_ram', (bool, False, )),
+        ('thread_ram_divide', (bool, False, )),
+        ('notify_ram_usage', (bool, False, )),
+        ('job_priorities', (bool, False, )),
+        ('min_priority', (int, None, )),
+        ('max_priority', (int, None, )),
+        ('array_holds', (bool, False, )),
+        ('array_limit', (bool, False, )),
+        ('array_limits', (bool, False, )),
+        ('architecture', (bool, False, )),
+        ('job_resources', (bool, False, )),
+        ('script_conf', (bool, False, )),
+        ('projects', (bool, False, )),
+        ('keep_jobscript', (bool, False, )),
+        ('preserve_modules', (bool, False, )),
+        ('use_jobscript', (bool, False, )),
+        ('run_parallel', (bool, False, )),
+        ('parallel_disable_matches', ((list, str, ), None, )),
+        ('max_array_size', (int, None, )),
+        ('consolidate_logs', (bool, False, )),
+    ))
+
+    def __init__(self, name, options):
+        if options is None:
+            options = {}
+        if not isinstance(options, Mapping):
+            raise BadConfiguration(
+                "Method {0} should be a dictionary of options".format(name))
+        object.__setattr__(self, 'name', name)
+        object.__setattr__(self, 'raw', MappingProxyType(options))
+        # Checked only, values are looked up in raw
+        for _ in self._validated(name, options):
+            pass
+
+    def __getattr__(self, option):
+        if option.startswith('__'):
+            raise AttributeError(option)
+        return self.raw.get(option, False)
+
+    def __getitem__(self, option):
+        return self.raw.get(option, False)
+
+    def get(self, option, default=None):
+        return self.raw.get(option, default)
+
+
+def invalidate():
+    '''Discard the compiled views, so they are compiled again from their
+    (changed) dictionaries when next used'''
+    _compiled.clear()
+
+
+def _cached(kind, source, build):
+    key = (kind, id(source), )
+    try:
+        held, compiled = _compiled[key]
+        if held is source:
+            return compiled
+    except KeyError:
+        pass
+    compiled = build()
+    if len(_compiled) >= _MAX_COMPILED:
+        _compiled.clear()
+    _compiled[key] = (source, compiled, )
+    return compiled
+
+
+def queue_specs(queues):
+    '''Read only mapping of queue name to QueueSpec compiled once from the
+    queues dictionary (returned unchanged if already compiled)'''
+    if queues is None:
+        queues = {}
+    if isinstance(queues, MappingProxyType) and all(
+            isinstance(q, QueueSpec) for q in queues.values()):
+        return queues
+    return _cached('queues', queues, lambda: MappingProxyType(OrderedDict(
+        (name, QueueSpec(name, q)) for name, q in queues.items())))
+
+
+def method_options(method, options):
+    '''MethodOptions compiled once from method's options dictionary'''
+    return _cached('method', options, lambda: MethodOptions(method, options))
+
+
+def coprocessor_spec(coprocessor, options):
+    '''CoprocessorSpec compiled once from coprocessor's options dictionary'''
+    return _cached(
+        'coprocessor', options, lambda: CoprocessorSpec(coprocessor, options))
@@ -9,6 +9,15 @@ REQUEUED = 5
 RESTARTED = 6
 SUSPENDED = 7
 STARTING = 8
+# No longer reported by the scheduler, see fsl_sub.wait()
+UNKNOWN = 9
+
+# States from which a job will not progress further
+TERMINAL_STATES = (FINISHED, FAILED, )
+
+# Modes for fsl_sub.wait()
+WAIT_ALL = 'all'
+WAIT_ANY = 'any'
 
 REPORTING = [
     'Queued',
@@ -19,7 +28,8 @@ REPORTING = [
     'Requeued',
     'Restarted',
     'Suspended',
-    'Starting'
+    'Starting',
+    'Unknown',
 ]
 
 RAMUNITS = 'G'
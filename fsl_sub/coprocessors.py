@@ -1,11 +1,11 @@
 # fsl_sub python module
 # Copyright (c) 2018-2021 University of Oxford (Duncan Mortimer)
 
-import sys
 from collections import defaultdict
+
+import fsl_sub.config
 from fsl_sub.config import (
     coprocessor_config,
-    queue_config,
     has_queues,
 )
 from fsl_sub.exceptions import (
@@ -19,84 +19,149 @@ from fsl_sub.shell_modules import (
 )
 
 
+class CoprocessorCatalog(object):
+    '''Coprocessor details derived once from the queue definitions (and
+    coproc_opts) - which queues offer each coprocessor, the maximum quantity,
+    the classes ordered by capability and the queues unavailable to jobs
+    that don't request a coprocessor (all of their coprocessors are
+    exclusive). Toolkit lists are queried from the module system on first
+    use.'''
+    __slots__ = (
+        'available', 'exclusive_queues', '_queues', '_max', '_classes',
+        '_toolkits', '_coproc_opts', )
+
+    def __init__(self, queues, coproc_opts=None, enabled=True):
+        '''queues - queue definitions; coproc_opts - coprocessor
+        definitions, needed for class ordering; enabled - whether the method
+        uses queues, otherwise no coprocessors are available'''
+        if coproc_opts is None:
+            coproc_opts = {}
+        self._coproc_opts = coproc_opts
+        self._queues = defaultdict(list)
+        self._max = defaultdict(int)
+        capabilities = defaultdict(dict)
+        exclusive = []
+        for qname, q in queues.items():
+            copros = q.get('copros') or {}
+            if copros and all(
+                    cp.get('exclusive', True) for cp in copros.values()):
+                exclusive.append(qname)
+            for cp, cp_def in copros.items():
+                self._queues[cp].append(qname)
+                self._max[cp] = max(self._max[cp], cp_def.get('max_quantity', 0))
+                class_types = coproc_opts.get(cp, {}).get('class_types', {})
+                for c in cp_def.get('classes', []):
+                    try:
+                        capabilities[cp][c] = class_types[c]['capability']
+                    except KeyError:
+                        continue
+        self.exclusive_queues = frozenset(exclusive)
+        self._queues = {cp: frozenset(q) for cp, q in self._queues.items()}
+        self._classes = {
+            cp: sorted(c, key=c.get) for cp, c in capabilities.items() if c}
+        self.available = list(self._queues) if enabled else []
+        self._toolkits = {}
+
+    def __contains__(self, coprocessor):
+        return coprocessor in self._queues
+
+    def queues(self, coprocessor):
+        '''Set of the queues offering coprocessor'''
+        return self._queues.get(coprocessor, frozenset())
+
+    def max_quantity(self, coprocessor):
+        return self._max.get(coprocessor, 0)
+
+    def classes(self, coprocessor):
+        '''Classes of coprocessor sorted by capability or None if it
+        doesn't have classes'''
+        return self._classes.get(coprocessor)
+
+    def more_capable(self, coprocessor, class_name):
+        '''Classes of coprocessor at least as capable as class_name'''
+        return coproc_class(class_name, self.classes(coprocessor) or [])
+
+    def toolkits(self, coprocessor):
+        '''List of toolkit versions (modules) of coprocessor or None'''
+        if coprocessor not in self._queues:
+            raise BadConfiguration(
+                "Coprocessor {} not available in any queues".format(
+                    coprocessor
+                )
+            )
+        if coprocessor not in self._toolkits:
+            copro_conf = self._coproc_opts.get(coprocessor)
+            if copro_conf is None:
+                copro_conf = coprocessor_config(coprocessor)
+            cp_mods = None
+            if copro_conf.get('uses_modules'):
+                try:
+                    cp_mods = get_modules(copro_conf['module_parent'])
+                except NoModule:
+                    pass
+            self._toolkits[coprocessor] = cp_mods
+        return self._toolkits[coprocessor]
+
+
+# Catalogs keyed on the id of their configuration, which is held so the id
+# can't be reused
+_catalogs = {}
+_MAX_CATALOGS = 8
+
+
+def coprocessor_catalog(config=None):
+    '''The CoprocessorCatalog of config (default the fsl_sub configuration),
+    built once per configuration'''
+    if config is None:
+        config = fsl_sub.config.read_config()
+    try:
+        cached_config, catalog = _catalogs[id(config)]
+        if cached_config is config:
+            return catalog
+    except KeyError:
+        pass
+    queues = config.get('queues') or {}
+    catalog = CoprocessorCatalog(
+        queues, config.get('coproc_opts') or {},
+        enabled=bool(queues and has_queues()))
+    if len(_catalogs) >= _MAX_CATALOGS:
+        _catalogs.clear()
+    _catalogs[id(config)] = (config, catalog, )
+    return catalog
+
+
 def list_coprocessors():
     '''Return a list of coprocessors found in the queue definitions'''
-    # Are there any queues defined?
-    avail_cops = []
-    if has_queues():
-        for q in queue_config().values():
-            try:
-                avail_cops.extend(q['copros'].keys())
-            except KeyError:
-                pass
-    return avail_cops
+    return list(coprocessor_catalog().available)
 
 
 def max_coprocessors(coprocessor):
     '''Return the maximum number of coprocessors per node from the
     queue definitions'''
-
-    num_cops = 0
-
-    for q in queue_config().values():
-        if 'copros' in q:
-            try:
-                num_cops = max(
-                    num_cops,
-                    q['copros'][coprocessor]['max_quantity'])
-            except KeyError:
-                pass
-
-    return num_cops
+    return coprocessor_catalog().max_quantity(coprocessor)
 
 
 def coproc_classes(coprocessor):
     '''Return whether a coprocessor supports multiple classes of hardware.
     Classes are sorted by capability'''
-    classes = defaultdict(lambda: 1)
-    copro_opts = coprocessor_config(coprocessor)
-    for q in queue_config().values():
-        if 'copros' in q:
-            try:
-                for c in q['copros'][coprocessor]['classes']:
-                    classes[c] = copro_opts['class_types'][c]['capability']
-            except KeyError:
-                continue
-    if not classes:
-        return None
-    return sorted(classes.keys(), key=classes.get)
+    coprocessor_config(coprocessor)
+    classes = coprocessor_catalog().classes(coprocessor)
+    return None if classes is None else list(classes)
 
 
 def coproc_toolkits(coprocessor):
     '''Return list of coprocessor toolkit versions.'''
-    copro_conf = coprocessor_config(coprocessor)
-    # Check that we have queues configured for this coproceesor
-    if not all([q for q in queue_config() if (
-            'copros' in q and coprocessor in q['copros'])]):
-        raise BadConfiguration(
-            "Coprocessor {} not available in any queues".format(
-                coprocessor
-            )
-        )
-    if not copro_conf['uses_modules']:
-        return None
-    try:
-        cp_mods = get_modules(copro_conf['module_parent'])
-    except NoModule:
-        return None
-    return cp_mods
+    return coprocessor_catalog().toolkits(coprocessor)
 
 
 def coproc_class(coproc_class, coproc_classes):
+    '''Return the classes in coproc_classes (sorted by capability) at least
+    as capable as coproc_class'''
     try:
-        for c, i in enumerate(coproc_classes):
-            if c['shortcut'] == coproc_class:
-                break
-    except KeyError:
+        return coproc_classes[coproc_classes.index(coproc_class):]
+    except ValueError:
         raise BadConfiguration(
-            "Co-processor class {} not configured".format(coproc_class),
-            file=sys.stderr)
-    return coproc_classes[:i]
+            "Co-processor class {} not configured".format(coproc_class))
 
 
 def coproc_load_module(coproc, module_version):
@@ -127,32 +192,17 @@ def coproc_get_module(coproc, module_version):
 
 
 def coproc_info():
-    available_coprocessors = list_coprocessors()
-    coprocessor_classes = []
-    coprocessor_toolkits = []
+    catalog = coprocessor_catalog()
+    available_coprocessors = catalog.available
+    coprocessor_classes = set()
+    coprocessor_toolkits = set()
     for c in available_coprocessors:
-        cp_classes = coproc_classes(c)
-        cp_tkits = coproc_toolkits(c)
-        if cp_classes is not None:
-            coprocessor_classes.extend(cp_classes)
-        if cp_tkits is not None:
-            coprocessor_toolkits.extend(cp_tkits)
-    if not available_coprocessors:
-        available_coprocessors = None
-    if not coprocessor_classes:
-        coprocessor_classes = None
-    if not coprocessor_toolkits:
-        coprocessor_toolkits = None
+        coprocessor_classes.update(catalog.classes(c) or [])
+        coprocessor_toolkits.update(catalog.toolkits(c) or [])
 
     # Collapse to single copies of each type
-    if available_coprocessors:
-        available_coprocessors = sorted(list(set(available_coprocessors)))
-    if coprocessor_classes:
-        coprocessor_classes = sorted(list(set(coprocessor_classes)))
-    if coprocessor_toolkits:
-        coprocessor_toolkits = sorted(list(set(coprocessor_toolkits)))
     return {
-        'available': available_coprocessors,
-        'classes': coprocessor_classes,
-        'toolkits': coprocessor_toolkits,
+        'available': sorted(set(available_coprocessors)) or None,
+        'classes': sorted(coprocessor_classes) or None,
+        'toolkits': sorted(coprocessor_toolkits) or None,
     }
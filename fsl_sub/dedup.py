@@ -0,0 +1,137 @@
+# fsl_sub python module
+# Copyright (c) 2018-2021 University of Oxford (Duncan Mortimer)
+
+# Index of recent submissions, used to avoid submitting duplicate jobs
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+from fsl_sub.uptodate import command_line
+from fsl_sub.utils import fsl_sub_state_dir
+
+# submit() arguments that do not change what is run
+_IGNORED = ('as_tuple', 'idempotency_key', 'validate_command', 'keep_jobscript', )
+_STAMP = '.pruned'
+
+
+def _get_logger():
+    return logging.getLogger(__name__)
+
+
+def index_dir():
+    '''Folder holding the index of recent submissions'''
+    return os.path.join(fsl_sub_state_dir(), 'submissions')
+
+
+def _file_digest(filename):
+    try:
+        with open(filename, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    except OSError:
+        return None
+
+
+def submission_key(submit_args, cwd=None):
+    '''Derive an idempotency key from the fsl_sub.submit arguments (a dict),
+    the folder the job is submitted from and the values of any exported
+    environment variables'''
+    if cwd is None:
+        cwd = os.getcwd()
+    args = {
+        k: v for k, v in submit_args.items() if k not in _IGNORED}
+    args['command'] = command_line(args['command'])
+    if args.get('array_task') and not args.get('array_specifier'):
+        # Array task file - the lines to run matter, not just its name
+        args['task_file_digest'] = _file_digest(args['command'])
+    export_vars = []
+    for var in args.get('export_vars') or []:
+        if '=' not in var:
+            var = '='.join((var, os.environ.get(var, '')))
+        export_vars.append(var)
+    args['export_vars'] = export_vars
+    return hashlib.sha1(
+        '\0'.join(
+            (cwd, json.dumps(args, sort_keys=True, default=str), )
+        ).encode('utf-8')).hexdigest()
+
+
+def index_key(idempotency_key, submit_args):
+    '''Return the index key for a caller supplied idempotency key, or
+    derive one from submit_args if idempotency_key is True'''
+    if idempotency_key is True:
+        return submission_key(submit_args)
+    return hashlib.sha1(str(idempotency_key).encode('utf-8')).hexdigest()
+
+
+@contextmanager
+def locked(key):
+    '''Hold an exclusive lock on key for the duration of the context.
+    Keys share one of 256 lock files so lock files never need removing.'''
+    folder = index_dir()
+    os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(folder, key[:2] + '.lock'), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def lookup(key, window):
+    '''Return job id recorded against key within the last window seconds
+    or None'''
+    try:
+        with open(os.path.join(index_dir(), key), 'r') as entry:
+            record = json.load(entry)
+    except (OSError, ValueError, ):
+        return None
+    if time.time() - record.get('time', 0) > window:
+        return None
+    return record.get('job_id')
+
+
+def record(key, job_id, window):
+    '''Record that key was submitted as job_id, dropping expired entries'''
+    folder = index_dir()
+    entry = os.path.join(folder, key)
+    now = time.time()
+    with open(entry + '.tmp', 'w') as ef:
+        json.dump({'job_id': job_id, 'time': now, }, ef)
+    os.utime(entry + '.tmp', (now, now))
+    os.replace(entry + '.tmp', entry)
+    _maybe_prune(folder, window)
+
+
+def _maybe_prune(folder, window):
+    '''Drop expired entries at most once an hour (or window)'''
+    stamp = os.path.join(folder, _STAMP)
+    now = time.time()
+    try:
+        if now - os.stat(stamp).st_mtime < min(window, 3600):
+            return
+    except FileNotFoundError:
+        pass
+    with open(stamp, 'a'):
+        pass
+    os.utime(stamp, (now, now))
+    _prune(folder, window)
+
+
+def _prune(folder, window):
+    expired = time.time() - window
+    try:
+        entries = list(os.scandir(folder))
+    except OSError:
+        return
+    for e in entries:
+        if e.name.endswith('.lock') or e.name == _STAMP:
+            continue
+        try:
+            if e.stat().st_mtime < expired:
+                os.remove(e.path)
+        except OSError:
+            pass
@@ -54,6 +54,10 @@ class UnknownJobId(Exception):
     pass
 
 
+class JobFailed(Exception):
+    pass
+
+
 class NotAFslDir(Exception):
     pass
 
@@ -0,0 +1,309 @@
+# fsl_sub python module
+# Copyright (c) 2018-2021 University of Oxford (Duncan Mortimer)
+
+# concurrent.futures compatible executor that runs tasks via fsl_sub.submit
+import itertools
+import logging
+import os
+import pickle
+import shlex
+import shutil
+import sys
+import tempfile
+import threading
+from concurrent.futures import (Executor, Future, )
+from concurrent.futures import wait as futures_wait
+
+import fsl_sub
+import fsl_sub.consts
+from fsl_sub.arrays import chunk_task
+from fsl_sub.exceptions import (BadSubmission, JobFailed, )
+
+
+def _get_logger():
+    return logging.getLogger(__name__)
+
+
+class JobFuture(Future):
+    '''Future representing an fsl_sub job (or array sub-task).
+    Cancelling a pending future deletes the job from the queue.'''
+
+    def __init__(self, job_id=None, task_id=None, result_file=None):
+        super().__init__()
+        self.job_id = job_id
+        self.task_id = task_id
+        self.result_file = result_file
+
+    def cancel(self):
+        if self.cancelled():
+            return True
+        if not super().cancel():
+            return False
+        # Jobs are never marked as running so notify waiters ourselves
+        self.set_running_or_notify_cancel()
+        if self.job_id is not None:
+            job = self.job_id
+            if self.task_id is not None:
+                job = '.'.join(
+                    str(p) for p in chunk_task(self.job_id, self.task_id))
+            try:
+                fsl_sub.delete_job(job)
+            except Exception as e:
+                _get_logger().warning(
+                    "Unable to delete job {0}: {1}".format(job, str(e)))
+        return True
+
+
+class FslSubExecutor(Executor):
+    '''Executor that submits commands or picklable callables with
+    fsl_sub.submit, returning JobFuture objects.
+
+    Optional:
+    workdir - folder for task payloads and results, must be visible to the
+            compute nodes. Defaults to a temporary folder in the current
+            directory, removed on shutdown
+    poll_interval - initial time (in seconds) between job status queries
+    max_poll_interval - maximum time (in seconds) between job status queries
+    python - Python interpreter used to run callables on the compute node
+    Any other keyword arguments are passed to fsl_sub.submit for every job,
+    e.g. jobram, jobtime, queue or logdir.
+
+    Futures for all jobs are resolved by a single poller thread that queries
+    the status of every outstanding job in one batch, as fsl_sub.wait does.
+    map() submits a single array task. When running with the shell plugin
+    jobs run to completion at submission time.
+    '''
+
+    def __init__(
+            self, workdir=None, poll_interval=5, max_poll_interval=60,
+            python=sys.executable, **submit_args):
+        self._own_workdir = workdir is None
+        if workdir is None:
+            workdir = tempfile.mkdtemp(
+                prefix='.fsl_sub_executor_', dir=os.getcwd())
+        else:
+            os.makedirs(workdir, exist_ok=True)
+        self.workdir = workdir
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.python = python
+        self.submit_args = submit_args
+        self._counter = itertools.count(1)
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._shutdown = False
+        self._poller = None
+        # Status query of the configured plugin, looked up by the poller
+        self._job_status_batch = None
+        self._waiting = fsl_sub._Waiting([])
+
+    def _payload(self, fn, args, kwargs):
+        n = next(self._counter)
+        payload = os.path.join(self.workdir, 'task_{0}.pkl'.format(n))
+        with open(payload, 'wb') as pf:
+            pickle.dump((fn, args, kwargs), pf)
+        return payload
+
+    def _task_command(self, payload):
+        return [self.python, '-m', 'fsl_sub.executor', payload, ]
+
+    def _check_open(self):
+        if self._shutdown:
+            raise RuntimeError("cannot schedule new futures after shutdown")
+
+    def _submit(self, command, **kwargs):
+        args = dict(self.submit_args)
+        args.update(kwargs)
+        return fsl_sub.submit(command, **args)
+
+    def _track(self, job_id, futures):
+        with self._lock:
+            self._pending.setdefault(job_id, []).extend(futures)
+            if self._poller is None:
+                self._poller = threading.Thread(
+                    target=self._poll, name='fsl_sub_executor', daemon=True)
+                self._poller.start()
+        self._wakeup.set()
+
+    def submit(self, fn, *args, **kwargs):
+        '''Submit fn(*args, **kwargs) as a job. If fn is a command line
+        (string or list) it is submitted directly and the future's result
+        is the job id.'''
+        self._check_open()
+        if isinstance(fn, (str, list, )):
+            if args or kwargs:
+                raise BadSubmission(
+                    "Arguments cannot be given when submitting a command")
+            future = JobFuture()
+            command = fn
+        else:
+            payload = self._payload(fn, args, kwargs)
+            future = JobFuture(result_file=payload + '.out')
+            command = self._task_command(payload)
+        try:
+            future.job_id = self._submit(command)
+        except Exception as e:
+            future.set_exception(e)
+            return future
+        if future.job_id is None:
+            # Outputs are up to date so nothing was submitted
+            future.set_result(None)
+            return future
+        self._track(future.job_id, [future])
+        return future
+
+    def map(self, fn, *iterables, timeout=None, chunksize=1):
+        '''Returns an iterator equivalent to map(fn, *iterables), with the
+        calls run as a single array task.'''
+        self._check_open()
+        futures = []
+        lines = []
+        for task_id, call_args in enumerate(zip(*iterables), start=1):
+            payload = self._payload(fn, call_args, {})
+            futures.append(JobFuture(task_id=task_id, result_file=payload + '.out'))
+            lines.append(' '.join(
+                shlex.quote(a) for a in self._task_command(payload)))
+        if futures:
+            task_file = os.path.join(
+                self.workdir, 'map_{0}.txt'.format(next(self._counter)))
+            with open(task_file, 'w') as tf:
+                tf.write('\n'.join(lines) + '\n')
+            try:
+                job_id = self._submit(
+                    task_file, array_task=True,
+                    name=getattr(fn, '__name__', None))
+            except Exception as e:
+                for f in futures:
+                    f.set_exception(e)
+            else:
+                if job_id is None:
+                    # All tasks are up to date so nothing was submitted
+                    for f in futures:
+                        f.set_result(None)
+                else:
+                    for f in futures:
+                        f.job_id = job_id
+                    self._track(job_id, futures)
+
+        def result_iterator():
+            for f in futures:
+                yield f.result(timeout)
+        return result_iterator()
+
+    def _resolve(self, job_id, state):
+        with self._lock:
+            futures = self._pending.pop(job_id, [])
+        for future in futures:
+            if future.done():
+                continue
+            if state == fsl_sub.consts.UNKNOWN:
+                future.set_exception(JobFailed(
+                    "Job {0} is no longer known to the scheduler".format(
+                        job_id)))
+                continue
+            if future.result_file is None:
+                if state == fsl_sub.consts.FAILED:
+                    future.set_exception(
+                        JobFailed("Job {0} failed".format(job_id)))
+                else:
+                    future.set_result(job_id)
+                continue
+            try:
+                with open(future.result_file, 'rb') as rf:
+                    ok, value = pickle.load(rf)
+            except (OSError, EOFError, pickle.UnpicklingError, ) as e:
+                future.set_exception(JobFailed(
+                    "Job {0} produced no result ({1})".format(job_id, str(e))))
+                continue
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+    def _poll_states(self, job_ids):
+        '''States of those of job_ids that have finished, querying the
+        scheduler for all of them at once'''
+        if self._job_status_batch is None:
+            config = fsl_sub.read_config()
+            if config['method'] == 'shell':
+                # Shell jobs have completed by the time submit returns
+                self._job_status_batch = False
+            else:
+                self._job_status_batch = fsl_sub._job_status_batch(
+                    *fsl_sub._plugin(config))
+        if not self._job_status_batch:
+            return {j: fsl_sub.consts.FINISHED for j in job_ids}
+        self._waiting.track(job_ids)
+        self._waiting.update(self._job_status_batch(self._waiting.queries()))
+        return self._waiting.done
+
+    def _poll(self):
+        logger = _get_logger()
+        interval = self.poll_interval
+        while True:
+            with self._lock:
+                job_ids = [
+                    j for j, fl in self._pending.items()
+                    if not all(f.done() for f in fl)]
+                for j in [j for j in self._pending if j not in job_ids]:
+                    del self._pending[j]
+                if not job_ids and self._shutdown:
+                    return
+            if not job_ids:
+                self._wakeup.wait()
+                self._wakeup.clear()
+                interval = self.poll_interval
+                continue
+            try:
+                done = self._poll_states(job_ids)
+            except Exception as e:
+                logger.warning("Unable to query job status: " + str(e))
+                done = {}
+            for job_id, state in done.items():
+                self._resolve(job_id, state)
+            if len(done) < len(job_ids):
+                if self._wakeup.wait(interval):
+                    # New jobs have been submitted - poll soon
+                    self._wakeup.clear()
+                    interval = self.poll_interval
+                else:
+                    interval = min(interval * 2, self.max_poll_interval)
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        with self._lock:
+            self._shutdown = True
+            futures = [f for fl in self._pending.values() for f in fl]
+        if cancel_futures:
+            for f in futures:
+                f.cancel()
+        self._wakeup.set()
+        if wait:
+            futures_wait(futures)
+            if self._poller is not None:
+                self._poller.join()
+            if self._own_workdir:
+                shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+def _run_payload(payload):
+    '''Run a pickled (fn, args, kwargs) and store (success, result/exception)
+    alongside the payload. Exceptions raised by fn are returned via the
+    result file so the job itself succeeds.'''
+    with open(payload, 'rb') as pf:
+        fn, args, kwargs = pickle.load(pf)
+    try:
+        outcome = (True, fn(*args, **kwargs))
+    except Exception as e:
+        outcome = (False, e)
+    try:
+        pickled = pickle.dumps(outcome)
+    except Exception as e:
+        outcome = (False, JobFailed("Unable to pickle result: " + str(e)))
+        pickled = pickle.dumps(outcome)
+    with open(payload + '.out', 'wb') as rf:
+        rf.write(pickled)
+
+
+if __name__ == '__main__':
+    _run_payload(sys.argv[1])
@@ -0,0 +1,67 @@
+# fsl_sub python module
+# Copyright (c) 2018-2021 University of Oxford (Duncan Mortimer)
+
+# Normalisation of job hold lists
+import logging
+import re
+
+# Job id, optionally with an array task id (SGE style 123.4, Slurm style 123_4)
+_JOB_ID = re.compile(r'^(?P<job>\d+)(?:[._](?P<task>\d+))?$')
+
+
+def _get_logger():
+    return logging.getLogger(__name__)
+
+
+def _hold_items(holds):
+    if not isinstance(holds, (list, tuple, )):
+        holds = [holds, ]
+    return [i.strip() for h in holds for i in str(h).split(',')]
+
+
+def compress_holds(holds, collapse_tasks=True):
+    '''Normalise a jobhold/array_hold value (int, string, comma separated
+    string, list or tuple of job ids). Duplicate ids are removed and, if
+    collapse_tasks is True, several task ids of one array become a single
+    hold on the array job.
+    Single ids and holds that aren't simple job ids (e.g. scheduler specific
+    dependency expressions) are returned unchanged, otherwise a list of
+    job id strings is returned.'''
+    if holds is None:
+        return None
+    items = _hold_items(holds)
+    if len(items) < 2:
+        return holds
+    matches = [_JOB_ID.match(i) for i in items]
+    if not all(matches):
+        return holds
+    if collapse_tasks:
+        tasks = {}
+        for m in matches:
+            tasks.setdefault(m.group('job'), set()).add(m.group('task'))
+        items = [
+            m.group('job') if len(tasks[m.group('job')]) > 1 else m.group(0)
+            for m in matches]
+    compressed = list(dict.fromkeys(items))
+    if len(compressed) < len(items):
+        _get_logger().debug(
+            "Hold list reduced from {0} to {1} ids".format(
+                len(items), len(compressed)))
+    return compressed
+
+
+def barrier_holds(holds, max_holds, submit_barrier):
+    '''Reduce a list of hold ids to at most max_holds ids by calling
+    submit_barrier(chunk) to submit jobs that each hold on up to max_holds
+    of the ids, returning the ids of these barrier jobs (repeating as
+    necessary).'''
+    if max_holds < 2:
+        raise ValueError("max_holds must be at least 2")
+    logger = _get_logger()
+    while len(holds) > max_holds:
+        logger.info(
+            "Submitting barrier jobs to hold on {0} jobs".format(len(holds)))
+        holds = [
+            str(submit_barrier(holds[i:i + max_holds]))
+            for i in range(0, len(holds), max_holds)]
+    return holds
@@ -0,0 +1,113 @@
+# fsl_sub python module
+# Copyright (c) 2018-2021 University of Oxford (Duncan Mortimer)
+
+# Structured (JSON lines) logging, with a correlation id per submission
+import datetime
+import functools
+import getpass
+import json
+import logging
+import os
+import socket
+import threading
+import uuid
+from contextlib import contextmanager
+
+_local = threading.local()
+# Attributes of every LogRecord, anything else was passed with extra=
+_RECORD_ATTRS = set(
+    logging.LogRecord('', 0, '', 0, '', (), None).__dict__) | {'message', }
+
+
+def correlation_id():
+    '''Correlation id of the submission in progress in this thread'''
+    return getattr(_local, 'correlation_id', None)
+
+
+@contextmanager
+def correlation(cid=None):
+    '''Tag log records made within the block with a correlation id. Uses
+    cid, the environment variable FSLSUB_CORRELATION_ID or a new id.
+    Nested blocks keep the outermost id.'''
+    current = correlation_id()
+    if current is not None:
+        yield current
+        return
+    if cid is None:
+        cid = os.environ.get('FSLSUB_CORRELATION_ID') or uuid.uuid4().hex[:16]
+    _local.correlation_id = cid
+    try:
+        yield cid
+    finally:
+        _local.correlation_id = None
+
+
+def correlated(func):
+    '''Decorator running each call of func within correlation()'''
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with correlation():
+            return func(*args, **kwargs)
+    return wrapper
+
+
+class JsonFormatter(logging.Formatter):
+    '''Formats records as single line JSON objects. Values passed with
+    extra= (e.g. method, queue, slots, job_id) become fields.'''
+    def __init__(self):
+        super().__init__()
+        self.user = getpass.getuser()
+        self.host = socket.gethostname()
+
+    def format(self, record):
+        entry = {
+            'time': datetime.datetime.fromtimestamp(
+                record.created).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'correlation_id': correlation_id(),
+            'user': self.user,
+            'host': self.host,
+            'pid': record.process,
+        }
+        for k, v in record.__dict__.items():
+            if k not in _RECORD_ATTRS and not k.startswith('_'):
+                entry[k] = v
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def log_settings(config):
+    '''Return (format, file) from the environment (FSLSUB_LOG_FORMAT,
+    FSLSUB_LOG_FILE) or configuration (log_format, log_file)'''
+    log_format = os.environ.get(
+        'FSLSUB_LOG_FORMAT', config.get('log_format') or 'text')
+    log_file = os.environ.get('FSLSUB_LOG_FILE', config.get('log_file'))
+    return (log_format, log_file or None, )
+
+
+def configure(logger, handler, config):
+    '''Configure structured logging for the fsl_sub commands. handler is
+    the command's (text) stderr handler. If a log file is configured JSON
+    records at INFO level and above are appended to it and the stderr
+    handler is limited to warnings, otherwise handler is switched to JSON
+    output.'''
+    log_format, log_file = log_settings(config)
+    if log_format != 'json':
+        return
+    if log_file is None:
+        handler.setFormatter(JsonFormatter())
+        return
+    try:
+        file_handler = logging.FileHandler(log_file, delay=True)
+    except OSError as e:
+        logger.warning("Unable to open log file {0}: {1}".format(log_file, e))
+        return
+    file_handler.setFormatter(JsonFormatter())
+    file_handler.setLevel(logging.INFO)
+    logger.addHandler(file_handler)
+    handler.setLevel(logging.WARNING)
+    if logger.getEffectiveLevel() > logging.INFO:
+        logger.setLevel(logging.INFO)
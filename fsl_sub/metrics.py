@@ -0,0 +1,189 @@
+# fsl_sub python module
+# Copyright (c) 2018-2021 University of Oxford (Duncan Mortimer)
+
+# Prometheus metrics written for node_exporter's textfile collector
+import fcntl
+import getpass
+import json
+import logging
+import os
+import tempfile
+
+from fsl_sub.config import read_config
+from fsl_sub.exceptions import (BadConfiguration, MissingConfiguration, )
+
+SUBMIT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, )
+TASK_BUCKETS = (1, 10, 60, 300, 900, 3600, 14400, 86400, )
+
+# name: (type, help, histogram buckets)
+METRICS = {
+    'fsl_sub_submissions_total': (
+        'counter', 'Jobs submitted', None, ),
+    'fsl_sub_submit_duration_seconds': (
+        'histogram', 'Time taken to submit a job', SUBMIT_BUCKETS, ),
+    'fsl_sub_validation_failures_total': (
+        'counter', 'Submissions rejected by command validation', None, ),
+    'fsl_sub_shell_fallbacks_total': (
+        'counter', 'Submissions run with the shell plugin instead of the '
+        'configured method', None, ),
+    'fsl_sub_shell_tasks_total': (
+        'counter', 'Tasks run by the shell plugin', None, ),
+    'fsl_sub_shell_task_duration_seconds': (
+        'histogram', 'Run time of tasks run by the shell plugin',
+        TASK_BUCKETS, ),
+}
+
+
+def _get_logger():
+    return logging.getLogger(__name__)
+
+
+def metrics_dir():
+    '''Textfile collector folder metrics are written to, None if metrics
+    are disabled'''
+    try:
+        return os.environ['FSLSUB_METRICS_DIR'] or None
+    except KeyError:
+        pass
+    try:
+        return read_config().get('metrics_dir', None)
+    except (BadConfiguration, MissingConfiguration, ):
+        return None
+
+
+def _label_key(labels):
+    '''Prometheus label set, e.g. method="sge",queue="short.q"'''
+    return ','.join(
+        '{0}="{1}"'.format(k, str(v).replace('\\', r'\\').replace('"', r'\"'))
+        for k, v in sorted(labels.items()))
+
+
+def _apply(state, counters, observations):
+    for name, labels, value in counters:
+        series = state.setdefault(name, {})
+        key = _label_key(labels)
+        series[key] = series.get(key, 0) + value
+    for name, labels, value in observations:
+        buckets = METRICS[name][2]
+        series = state.setdefault(name, {})
+        hist = series.setdefault(
+            _label_key(labels),
+            {'buckets': [0] * len(buckets), 'sum': 0.0, 'count': 0, })
+        for i, le in enumerate(buckets):
+            if value <= le:
+                hist['buckets'][i] += 1
+        hist['sum'] += value
+        hist['count'] += 1
+
+
+def render(state):
+    '''Return state as Prometheus text exposition format'''
+    lines = []
+    for name in sorted(state):
+        m_type, m_help, buckets = METRICS[name]
+        lines.append('# HELP {0} {1}'.format(name, m_help))
+        lines.append('# TYPE {0} {1}'.format(name, m_type))
+        for key, value in sorted(state[name].items()):
+            if m_type == 'counter':
+                lines.append('{0}{{{1}}} {2}'.format(name, key, value))
+                continue
+            sep = ',' if key else ''
+            for le, count in zip(buckets, value['buckets']):
+                lines.append('{0}_bucket{{{1}{2}le="{3}"}} {4}'.format(
+                    name, key, sep, le, count))
+            lines.append('{0}_bucket{{{1}{2}le="+Inf"}} {3}'.format(
+                name, key, sep, value['count']))
+            lines.append('{0}_sum{{{1}}} {2}'.format(name, key, value['sum']))
+            lines.append('{0}_count{{{1}}} {2}'.format(
+                name, key, value['count']))
+    return '\n'.join(lines) + '\n'
+
+
+def _replace(filename, content):
+    '''Atomically replace filename with content'''
+    fd, tmp = tempfile.mkstemp(
+        dir=os.path.dirname(filename), prefix='.fsl_sub_tmp')
+    try:
+        with os.fdopen(fd, 'w') as tf:
+            tf.write(content)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, filename)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def update(counters=(), observations=(), folder=None):
+    '''Add to counters and histograms and rewrite the metrics file.
+
+    Optional:
+
+    counters - list of (metric name, labels dict, increment)
+    observations - list of (metric name, labels dict, value) for histograms
+    folder - textfile collector folder, defaults to metrics_dir()
+
+    Each user has their own file (fsl_sub_<user>.prom) and all series are
+    labelled with the user, the totals are kept alongside in a hidden JSON
+    file. Updates are serialised with a lock file and files are replaced
+    atomically so the collector never sees a partial file. Failures are
+    logged, never raised.'''
+    if folder is None:
+        folder = metrics_dir()
+    if folder is None or not (counters or observations):
+        return
+    user = getpass.getuser()
+    labelled = [
+        [(n, dict(labels, user=user), v) for n, labels, v in updates]
+        for updates in (counters, observations)]
+    base = os.path.join(folder, 'fsl_sub_' + user)
+    state_file = os.path.join(folder, '.fsl_sub_{0}.json'.format(user))
+    try:
+        with open(state_file + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                with open(state_file, 'r') as sf:
+                    state = json.load(sf)
+            except (FileNotFoundError, ValueError, ):
+                state = {}
+            _apply(state, *labelled)
+            _replace(state_file, json.dumps(state))
+            _replace(base + '.prom', render(state))
+    except OSError as e:
+        _get_logger().warning("Unable to write metrics: " + str(e))
+
+
+def submission(method, queue, seconds):
+    '''Record a job submission and the time it took'''
+    labels = {'method': method, 'queue': queue or '', }
+    update(
+        counters=[('fsl_sub_submissions_total', labels, 1), ],
+        observations=[(
+            'fsl_sub_submit_duration_seconds', {'method': method, }, seconds)])
+
+
+def validation_failure(method, validate_type):
+    update(counters=[(
+        'fsl_sub_validation_failures_total',
+        {'method': method, 'type': validate_type, }, 1), ])
+
+
+def shell_fallback(method, reason):
+    '''Record a submission run with the shell plugin, reason is
+    'already_queued' or 'no_scheduler' '''
+    update(counters=[(
+        'fsl_sub_shell_fallbacks_total',
+        {'method': method, 'reason': reason, }, 1), ])
+
+
+def shell_tasks(tasks):
+    '''Record tasks run by the shell plugin, tasks is a list of
+    (exit status, run time in seconds)'''
+    if metrics_dir() is None:
+        return
+    update(
+        counters=[
+            ('fsl_sub_shell_tasks_total', {'exit_status': str(rc), }, 1)
+            for rc, _ in tasks],
+        observations=[
+            ('fsl_sub_shell_task_duration_seconds', {}, duration)
+            for _, duration in tasks])
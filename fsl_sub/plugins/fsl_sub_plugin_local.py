@@ -0,0 +1,612 @@
+# fsl_sub python module
+# Copyright (c) 2018-2021 University of Oxford (Duncan Mortimer)
+
+# fsl_sub plugin for a batch scheduler emulated on this computer - allows
+# the cluster code paths to be tested and benchmarked without a cluster
+import argparse
+import datetime
+import logging
+import os
+import shlex
+import subprocess as sp
+import sys
+import time
+from ruamel.yaml.comments import CommentedMap
+
+from fsl_sub.config import (
+    method_config,
+    read_config,
+)
+from fsl_sub.config_model import method_options
+from fsl_sub.exceptions import (
+    BadConfiguration,
+    BadSubmission,
+    GridOutputError,
+    MissingConfiguration,
+    UnknownJobId,
+)
+import fsl_sub.consts
+from fsl_sub import (compression, staging, )
+from fsl_sub.coprocessors import coproc_get_module
+from fsl_sub.shell_modules import loaded_modules
+from fsl_sub.utils import (
+    bash_cmd,
+    human_to_ram,
+    parse_array_specifier,
+    job_script,
+    EnvSpec,
+)
+from fsl_sub.plugins.local_scheduler import (
+    default_socket,
+    request,
+    request_async,
+)
+
+METHOD_NAME = 'local'
+# Prefix of option lines in job scripts
+SCRIPT_PREFIX = '#LOCAL'
+# Variables set in the environment of a job to use the shell if it is
+# not copying the submitting environment
+_BASE_ENV = ('HOME', 'LOGNAME', 'PATH', 'SHELL', 'USER', 'FSLSUB_CONF', )
+
+
+def plugin_version():
+    return '1.0.0'
+
+
+def _get_logger():
+    return logging.getLogger('fsl_sub.' + __name__)
+
+
+def _socket():
+    return method_config(METHOD_NAME).get('socket') or default_socket()
+
+
+def _start_scheduler(socket_path, timeout=10):
+    '''Start the local scheduler daemon and wait for it to respond'''
+    logger = _get_logger()
+    logger.info("Starting local scheduler on " + socket_path)
+    os.makedirs(
+        os.path.dirname(os.path.abspath(socket_path)), mode=0o700,
+        exist_ok=True)
+    with open(socket_path + '.log', 'a') as log:
+        sp.Popen(
+            [sys.executable, '-m', 'fsl_sub.plugins.local_scheduler',
+             '--socket', socket_path, ],
+            stdout=log, stderr=log, stdin=sp.DEVNULL,
+            start_new_session=True)
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return request(socket_path, 'ping')
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def _request(op, **kwargs):
+    '''Send a request to the local scheduler, starting it if necessary'''
+    socket_path = _socket()
+    try:
+        return request(socket_path, op, **kwargs)
+    except (FileNotFoundError, ConnectionRefusedError, ):
+        if not method_config(METHOD_NAME).get('autostart', True):
+            raise
+    _start_scheduler(socket_path)
+    return request(socket_path, op, **kwargs)
+
+
+def qtest():
+    '''Command that confirms method is available'''
+    if method_config(METHOD_NAME).get('autostart', True):
+        return sys.executable
+    try:
+        request(_socket(), 'ping')
+    except OSError:
+        return None
+    return _socket()
+
+
+def queue_exists(qname, qtest=None):
+    '''Does qname exist'''
+    return qname in read_config().get('queues', {})
+
+
+def already_queued():
+    '''Is this a running job?'''
+    return 'LOCAL_JOB_ID' in os.environ.keys()
+
+
+def _split_job_id(job_id):
+    job_id = str(job_id)
+    if '.' in job_id:
+        job_id, task_id = job_id.split('.', 1)
+        return (int(job_id), int(task_id), )
+    return (int(job_id), None, )
+
+
+def qdel(job_id):
+    '''Returns (output, return code) for running the appropriate
+    job deletion command'''
+    try:
+        job_id, task_id = _split_job_id(job_id)
+        return (_request('qdel', job_id=job_id, task_id=task_id), 0, )
+    except (ValueError, RuntimeError, OSError, ) as e:
+        return (str(e), 1, )
+
+
+def _hold_ids(jobhold):
+    if jobhold is None:
+        return []
+    if not isinstance(jobhold, (list, tuple, )):
+        jobhold = str(jobhold).split(',')
+    try:
+        return sorted(set(_split_job_id(j)[0] for j in jobhold))
+    except ValueError:
+        raise BadSubmission("Unrecognised job hold " + str(jobhold))
+
+
+def _script_parser():
+    parser = argparse.ArgumentParser(prog=SCRIPT_PREFIX, add_help=False)
+    parser.add_argument('--name')
+    parser.add_argument('--queue')
+    parser.add_argument('--threads', type=int)
+    parser.add_argument('--ram', type=int)
+    parser.add_argument('--time', type=int)
+    parser.add_argument('--priority', type=int)
+    parser.add_argument('--hold')
+    parser.add_argument('--array_hold', type=int)
+    parser.add_argument('--array')
+    parser.add_argument('--array_limit', type=int)
+    parser.add_argument('--logdir')
+    return parser
+
+
+def _script_options(script):
+    '''Read the #LOCAL option lines of a job script'''
+    args = []
+    for line in script.splitlines():
+        if line.startswith(SCRIPT_PREFIX + ' '):
+            args.extend(shlex.split(line[len(SCRIPT_PREFIX):]))
+    try:
+        options, unknown = _script_parser().parse_known_args(args)
+    except SystemExit:
+        raise BadSubmission("Unable to understand job script options")
+    if unknown:
+        raise BadSubmission(
+            "Unrecognised job script options " + ' '.join(unknown))
+    return vars(options)
+
+
+def _array_range(array_specifier):
+    (
+        array_start,
+        array_end,
+        array_stride
+    ) = parse_array_specifier(array_specifier)
+    if not array_start:
+        raise BadSubmission("array_specifier doesn't make sense")
+    if array_end is None:
+        return [1, array_start, 1]
+    return [array_start, array_end, array_stride or 1]
+
+
+def _log_files(logdir, job_name, array=False):
+    '''stdout and stderr log paths of the job as shell expressions, named
+    as the scheduler names them (see local_scheduler.Job.log_files)'''
+    suffix = '${LOCAL_JOB_ID}'
+    if array:
+        suffix += '.${LOCAL_TASK_ID}'
+    return [
+        os.path.join(logdir, job_name + '.' + s + suffix)
+        for s in ('o', 'e', )]
+
+
+def _job_env(export_vars, copy_environment):
+    if copy_environment:
+        env = dict(os.environ)
+    else:
+        env = {k: v for k, v in os.environ.items() if k in _BASE_ENV}
+    return EnvSpec(export_vars).environment(env)
+
+
+def submit(
+        command,
+        job_name,
+        queue,
+        threads=1,
+        array_task=False,
+        jobhold=None,
+        array_hold=None,
+        array_limit=None,
+        array_specifier=None,
+        parallel_env=None,
+        jobram=None,
+        jobtime=None,
+        resources=None,
+        ramsplit=False,
+        priority=None,
+        mail_on=None,
+        mailto=None,
+        logdir=None,
+        coprocessor=None,
+        coprocessor_toolkit=None,
+        coprocessor_class=None,
+        coprocessor_class_strict=False,
+        coprocessor_multi=1,
+        usescript=False,
+        architecture=None,
+        requeueable=True,
+        project=None,
+        export_vars=None,
+        keep_jobscript=None):
+    '''Submits the job to the local scheduler
+    Requires:
+
+    command - list containing command to run
+                or the file name of the array task file.
+                If array_specifier is given then this must be
+                a list containing the command to run.
+    job_name - Symbolic name for task
+    queue - Queue to submit to
+
+    Optional:
+    array_task - is the command is an array task (defaults to False)
+    jobhold - id(s) of jobs to hold for (string or list)
+    array_hold - id of the array job to hold for, task by task
+    array_limit - limit concurrently scheduled array
+            tasks to specified number
+    array_specifier - n[-m[:s]] n subtasks or starts at n, ends at m with
+            a step of s
+    parallel_env - parallel environment name (ignored, threads slots are
+            always allocated on a single node)
+    jobram - RAM required by job (total of all threads)
+    jobtime - time (in minutes for task), jobs are killed after this time
+    priority - job priority (-1023-0), higher priority jobs start first
+    logdir - directory to put log files in
+    coprocessor - name of coprocessor required (not emulated)
+    coprocessor_toolkit - coprocessor toolkit version
+    usescript - command is a job script, configured with #LOCAL lines
+    export_vars - EnvSpec (or list) of environment variables to preserve
+            for job, ignored if job is copying complete environment
+    keep_jobscript - whether to keep the job script as wrapper_<jobid>.sh
+
+    Mail, resources, architecture, project and requeueable requests are
+    accepted but have no effect.
+    '''
+    logger = _get_logger()
+    if command is None:
+        raise BadSubmission(
+            "Must provide command line or array task file name")
+    if not isinstance(command, list):
+        raise BadSubmission(
+            "Internal error: command argument must be a list"
+        )
+    if export_vars is None:
+        export_vars = []
+    my_export_vars = EnvSpec(export_vars)
+
+    mconf = method_options(METHOD_NAME, method_config(METHOD_NAME))
+    if keep_jobscript is None:
+        keep_jobscript = mconf['keep_jobscript']
+    if logdir is None:
+        logdir = os.getcwd()
+    elif logdir != os.devnull:
+        logdir = os.path.abspath(logdir)
+
+    if coprocessor is not None:
+        logger.debug("Co-processors are not emulated, ignoring " + coprocessor)
+
+    # This maps FSLSUB task variables to local scheduler variables
+    array_map = {
+        'FSLSUB_JOB_ID_VAR': 'LOCAL_JOB_ID',
+        'FSLSUB_ARRAYTASKID_VAR': 'LOCAL_TASK_ID',
+        'FSLSUB_ARRAYSTARTID_VAR': 'LOCAL_TASK_FIRST',
+        'FSLSUB_ARRAYENDID_VAR': 'LOCAL_TASK_LAST',
+        'FSLSUB_ARRAYSTEPSIZE_VAR': 'LOCAL_TASK_STEPSIZE',
+        'FSLSUB_ARRAYCOUNT_VAR': 'LOCAL_TASK_COUNT',
+    }
+    for var, value in array_map.items():
+        my_export_vars.set(var, value)
+
+    if jobram and mconf['notify_ram_usage']:
+        try:
+            ram = human_to_ram(
+                jobram, units=fsl_sub.consts.RAMUNITS, output="M")
+        except ValueError:
+            raise BadConfiguration("ram_units not one of P, T, G, M, K")
+    else:
+        ram = None
+
+    holds = _hold_ids(jobhold)
+    if isinstance(array_hold, (list, tuple, )):
+        if len(array_hold) > 1:
+            raise BadSubmission(
+                "Only one array job can be held on task by task")
+        array_hold = array_hold[0] if array_hold else None
+    if array_hold is not None:
+        array_hold = _split_job_id(array_hold)[0]
+    if mconf['job_priorities'] and priority is not None:
+        priority = max(
+            mconf['min_priority'], min(mconf['max_priority'], int(priority)))
+    else:
+        priority = None
+
+    extra_lines = []
+    array = None
+    if usescript:
+        if len(command) > 1:
+            raise BadSubmission(
+                "Command should be a grid submission script (no arguments)")
+        try:
+            with open(command[0], 'r') as script_f:
+                script = script_f.read()
+        except OSError as e:
+            raise BadSubmission("Unable to read job script: " + str(e))
+        options = _script_options(script)
+        job_name = options['name'] or os.path.basename(command[0])
+        queue = options['queue'] or queue
+        threads = options['threads'] or threads
+        ram = options['ram'] or ram
+        jobtime = options['time'] or jobtime
+        priority = options['priority'] if options['priority'] is not None else priority
+        if options['hold']:
+            holds = sorted(set(holds + _hold_ids(options['hold'])))
+        array_hold = options['array_hold'] or array_hold
+        array_limit = options['array_limit'] or array_limit
+        if options['array']:
+            array = _array_range(options['array'])
+        if options['logdir']:
+            logdir = os.path.abspath(options['logdir'])
+        keep_jobscript = False
+    else:
+        epilogue = None
+        prologue = []
+        if logdir != os.devnull:
+            codec = compression.log_compression()
+            if codec is not None:
+                # Compress the logs once the command finishes
+                epilogue = compression.epilogue(
+                    codec, _log_files(logdir, job_name, array_task))
+            stage_in = staging.script_staging_dir()
+            if stage_in is not None:
+                # Write logs to node-local storage, copying them to the
+                # log files (then compressing them) when the job exits
+                prologue = staging.prologue(stage_in, epilogue)
+                epilogue = None
+        extra_lines = list(prologue)
+        if array_task:
+            if array_specifier:
+                array = _array_range(array_specifier)
+            else:
+                try:
+                    with open(command[0], 'r') as cmd_f:
+                        array_slots = len(cmd_f.readlines())
+                except OSError as e:
+                    raise BadSubmission(
+                        "Unable to read array task file: " + str(e))
+                array = [1, array_slots, 1]
+                extra_lines += [
+                    '',
+                    'the_command=$(sed -n -e "${{LOCAL_TASK_ID}}p" {0})'.format(
+                        shlex.quote(os.path.abspath(command[0]))),
+                    '',
+                ]
+                # exec prevents the epilogue (or log staging) from running
+                command = [bash_cmd(), '-c', '"$the_command"', ]
+                if epilogue is None and not prologue:
+                    command.insert(0, 'exec')
+
+        command_args = [
+            ['--name', shlex.quote(job_name)],
+            ['--queue', queue],
+            ['--threads', threads],
+            ['--logdir', shlex.quote(logdir)],
+        ]
+        if ram:
+            command_args.append(['--ram', ram])
+        if jobtime:
+            command_args.append(['--time', jobtime])
+        if priority is not None:
+            command_args.append(['--priority', priority])
+        if holds:
+            command_args.append(['--hold', ','.join(str(h) for h in holds)])
+        if array_hold is not None:
+            command_args.append(['--array_hold', array_hold])
+        if array is not None:
+            command_args.append(['--array', '{0}-{1}:{2}'.format(*array)])
+        if array_limit and mconf['array_limits']:
+            command_args.append(['--array_limit', array_limit])
+
+        modules = []
+        if mconf['preserve_modules']:
+            modules = loaded_modules()
+            if coprocessor_toolkit:
+                cp_module = coproc_get_module(coprocessor, coprocessor_toolkit)
+                if cp_module is not None:
+                    modules.append(cp_module)
+        script = '\n'.join(job_script(
+            command, command_args, SCRIPT_PREFIX,
+            (METHOD_NAME, plugin_version()),
+            modules=modules, extra_lines=extra_lines, epilogue=epilogue))
+    logger.debug(script)
+
+    if not array_limit or not mconf['array_limits']:
+        array_limit = None
+
+    job = {
+        'name': job_name,
+        'queue': queue,
+        'threads': threads,
+        'ram': ram,
+        'time': jobtime,
+        'priority': priority,
+        'holds': holds,
+        'array_hold': array_hold,
+        'array_limit': array_limit,
+        'array': array,
+        'script': script,
+        'shell': bash_cmd(),
+        'env': _job_env(my_export_vars, mconf['copy_environment']),
+        'cwd': os.getcwd(),
+        'logdir': logdir,
+    }
+    try:
+        job_id = _request('submit', job=job)
+    except RuntimeError as e:
+        raise BadSubmission(str(e))
+    except OSError as e:
+        raise GridOutputError(
+            "Unable to contact local scheduler: " + str(e))
+    logger.info("Submitted job {0} ({1}) to {2}".format(job_id, job_name, queue))
+
+    if keep_jobscript:
+        wrapper_name = os.path.join(
+            os.getcwd(), '_'.join(('wrapper', str(job_id))) + '.sh')
+        try:
+            with open(wrapper_name, 'w') as wrapper:
+                wrapper.write(script + '\n')
+        except OSError:
+            logger.warn("Unable to preserve wrapper script")
+    return job_id
+
+
+def _default_config_file():
+    return os.path.join(
+        os.path.realpath(os.path.dirname(__file__)),
+        'fsl_sub_' + METHOD_NAME + '.yml')
+
+
+def default_conf():
+    '''Returns a string containing the default configuration for this
+    cluster plugin.'''
+
+    try:
+        with open(_default_config_file()) as d_conf_f:
+            d_conf = d_conf_f.read()
+    except FileNotFoundError as e:
+        raise MissingConfiguration("Unable to find default configuration file: " + str(e))
+    return d_conf
+
+
+def _to_datetime(timestamp):
+    if timestamp is None:
+        return None
+    return datetime.datetime.fromtimestamp(timestamp)
+
+
+def _job_details(status, sub_job_id=None):
+    details = dict(status)
+    details['submission_time'] = _to_datetime(status['submission_time'])
+    tasks = {}
+    for task_id, task in status['tasks'].items():
+        if sub_job_id is not None and int(task_id) != sub_job_id:
+            continue
+        tasks[task_id] = dict(task)
+        for t in ('start_time', 'end_time', 'sub_time', ):
+            tasks[task_id][t] = _to_datetime(task[t])
+    details['tasks'] = tasks
+    return details
+
+
+def job_status(job_id, sub_job_id=None):
+    '''Return details for the job with given ID, see
+    fsl_sub.report() for the format'''
+    if isinstance(job_id, str) and '.' in job_id:
+        job_id, task_id = _split_job_id(job_id)
+        if sub_job_id is None:
+            sub_job_id = task_id
+    job_id = int(job_id)
+    if sub_job_id is not None:
+        sub_job_id = int(sub_job_id)
+    try:
+        status = _request('status', job_ids=[job_id])
+    except (OSError, RuntimeError, ) as e:
+        raise GridOutputError from e
+    try:
+        return _job_details(status[str(job_id)], sub_job_id)
+    except KeyError:
+        raise UnknownJobId("Unrecognised job id " + str(job_id))
+
+
+def job_status_batch(job_ids):
+    '''Return a dict keyed on job id of job_status() results, all jobs are
+    queried with one request'''
+    ids = {j: _split_job_id(j) for j in job_ids}
+    try:
+        status = _request(
+            'status', job_ids=sorted(set(j for j, _ in ids.values())))
+    except (OSError, RuntimeError, ) as e:
+        raise GridOutputError from e
+    return _batch_details(ids, status)
+
+
+async def job_status_batch_async(job_ids):
+    '''Coroutine version of job_status_batch() for fsl_sub.aio, the
+    scheduler is not started if it isn't running'''
+    ids = {j: _split_job_id(j) for j in job_ids}
+    try:
+        status = await request_async(
+            _socket(), 'status',
+            job_ids=sorted(set(j for j, _ in ids.values())))
+    except (OSError, RuntimeError, ) as e:
+        raise GridOutputError from e
+    return _batch_details(ids, status)
+
+
+def _batch_details(ids, status):
+    return {
+        j: _job_details(status[str(job_id)], task_id)
+        for j, (job_id, task_id) in ids.items() if str(job_id) in status}
+
+
+def _machine():
+    '''Return (cores, RAM in GB) of this computer'''
+    try:
+        cores = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cores = os.cpu_count() or 1
+    try:
+        ram = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // 1024 ** 3
+    except (ValueError, OSError, AttributeError, ):
+        ram = 1
+    return (cores, max(ram, 1), )
+
+
+def live_queue_defs():
+    '''Return {queue name: {'max_slots': threads, 'max_size': RAM}} of the
+    node sizes the local scheduler enforces. The scheduler keeps the queue
+    definitions it was started with, so these may differ from the current
+    configuration.'''
+    return _request('limits')
+
+
+def build_queue_defs():
+    '''Return ruamel.yaml YAML suitable for configuring queues that match
+    this computer'''
+    cores, ram = _machine()
+    q_base = CommentedMap()
+    q_base['queues'] = CommentedMap()
+    queues = q_base['queues']
+    for qname, qtime, default in (
+            ('short.q', 60, False, ), ('long.q', 10080, True, ), ):
+        queues[qname] = CommentedMap()
+        qd = queues[qname]
+        queues.yaml_add_eol_comment("Queue name", qname, column=0)
+        add_key_comment = qd.yaml_add_eol_comment
+        qd['time'] = qtime
+        add_key_comment('Maximum job run time in minutes', 'time', column=0)
+        qd['max_slots'] = cores
+        add_key_comment("Maximum number of threads/slots on a queue", 'max_slots', column=0)
+        qd['max_size'] = ram
+        add_key_comment("Maximum RAM size of a job", 'max_size', column=0)
+        qd['slot_size'] = max(ram // cores, 1)
+        add_key_comment("Maximum memory per thread", 'slot_size')
+        qd['parallel_envs'] = ['shmem', ]
+        qd['map_ram'] = True
+        qd['priority'] = 1
+        qd['group'] = 1
+        if default:
+            qd['default'] = True
+    return q_base
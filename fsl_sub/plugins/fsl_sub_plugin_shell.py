@@ -9,22 +9,30 @@ import os
 import shlex
 import subprocess as sp
 import sys
+import tempfile
+import time
 import warnings
+from contextlib import contextmanager
 
 from fsl_sub.config import (
     method_config,
     read_config,
 )
+from fsl_sub.config_model import method_options
 from fsl_sub.exceptions import (BadSubmission, MissingConfiguration, UnrecognisedModule, )
+from fsl_sub.compression import log_compression
+from fsl_sub.metrics import shell_tasks
+import fsl_sub.staging as staging
+import fsl_sub.tasklogs as tasklogs
 from fsl_sub.shell_modules import (loaded_modules, load_module, )
 from fsl_sub.utils import (
     bash_cmd,
     parse_array_specifier,
     writelines_nl,
     control_threads,
+    EnvSpec,
 )
 from fsl_sub.version import VERSION
-from collections import defaultdict
 
 
 def plugin_version():
@@ -57,7 +65,7 @@ def build_queue_defs():
 
 
 def _disable_parallel(job):
-    mconf = defaultdict(lambda: False, method_config('shell'))
+    mconf = method_options('shell', method_config('shell'))
 
     matches = mconf['parallel_disable_matches']
 
@@ -103,7 +111,7 @@ def submit(
         **kwargs):
     '''Submits the job'''
     logger = _get_logger()
-    mconf = defaultdict(lambda: False, method_config('shell'))
+    mconf = method_options('shell', method_config('shell'))
     jobid_var = None
     taskid_var = None
 
@@ -123,7 +131,7 @@ def submit(
     if (';' in ' '.join(command) or '|' in ' '.join(command)):
         command = [bash_cmd(), '-c', ' '.join(command), ]
 
-    set_vars = dict(var.split('=', 1) for var in export_vars if '=' in var)
+    set_vars = EnvSpec(export_vars).assignments()
 
     logger.debug("Looking for parent job id(s)")
     try:
@@ -191,10 +199,10 @@ def submit(
         if not mconf['run_parallel']:
             array_args['parallel_limit'] = 1
         if array_limit is not None:
-            logger.debug("Limiting number of parallel tasks to " + str(array_limit))
+            logger.debug("Limiting number of parallel tasks to %s", array_limit)
             array_args['parallel_limit'] = array_limit
         if array_specifier:
-            logger.debug("Attempting to parse array specifier " + array_specifier)
+            logger.debug("Attempting to parse array specifier %s", array_specifier)
             (
                 array_start,
                 array_end,
@@ -269,59 +277,100 @@ def _write_joblog(job_log, jid, logdir):
 
 def _run_job(job, job_id, child_env, stdout_file, stderr_file):
     logger = _get_logger()
-    with open(stdout_file, mode='w') as stdout:
-        with open(stderr_file, mode='w') as stderr:
-            child_env['JOB_ID'] = str(job_id)
-            logger.info(
-                "executing: " + str(' '.join(job)))
-
-            output = sp.run(
-                job,
-                stdout=stdout,
-                stderr=stderr,
-                universal_newlines=True,
-                env=child_env)
+    err_msg = None
+    with staging.logs(
+            (stdout_file, stderr_file, ), log_compression()) as logs:
+        stdout_log, stderr_log = logs
+        with open(stdout_log, mode='w') as stdout:
+            with open(stderr_log, mode='w') as stderr:
+                child_env['JOB_ID'] = str(job_id)
+                logger.info(
+                    "executing: " + str(' '.join(job)))
+
+                start = time.monotonic()
+                output = sp.run(
+                    job,
+                    stdout=stdout,
+                    stderr=stderr,
+                    universal_newlines=True,
+                    env=child_env)
+        shell_tasks([(output.returncode, time.monotonic() - start), ])
 
-    if output.returncode != 0:
-        with open(stderr_file, mode='r') as stderr:
-            err_msg = stderr.read()
-            raise BadSubmission(err_msg)
+        if output.returncode != 0:
+            with open(stderr_log, mode='r') as stderr:
+                err_msg = stderr.read()
+    if err_msg is not None:
+        raise BadSubmission(err_msg)
 
 
 def _end_job_number(njobs, start, stride):
     return (njobs - 1) * stride + start
 
 
+def _task_output(log_file, consolidate):
+    '''File object for a task's stdout/stderr. Output destined for a
+    consolidated log is captured in an unlinked temporary file.'''
+    if consolidate and log_file != '/dev/null':
+        return tempfile.TemporaryFile(mode='w+b')
+    return open(log_file, mode='w')
+
+
+@contextmanager
+def _unstaged(log_files):
+    yield log_files
+
+
 def _mp_run(args):
-    job, parent_id, task_id, env, stdout_file, stderr_file = args
+    job, parent_id, task_id, env, stdout_file, stderr_file = args[:6]
+    consolidate = args[6] if len(args) > 6 else False
+    codec = args[7] if len(args) > 7 else None
     if not isinstance(task_id, str):
         task_id = str(task_id)
     if not isinstance(parent_id, str):
         parent_id = str(parent_id)
+    err_msg = None
     try:
-        with open(stdout_file, mode='w') as stdout:
-            with open(stderr_file, mode='w') as stderr:
-                env['JOB_ID'] = parent_id
-                env['SHELL_TASK_ID'] = task_id
-                log = "Task {0} executed {1}".format(
-                    task_id,
-                    ' '.join(job))
-
-                output = sp.run(
-                    job,
-                    stdout=stdout,
-                    stderr=stderr,
-                    universal_newlines=True,
-                    env=env)
-
+        if consolidate:
+            # Captured in temporary files - there is nothing to stage
+            logs = _unstaged((stdout_file, stderr_file, ))
+        else:
+            logs = staging.logs((stdout_file, stderr_file, ), codec)
+        with logs as (stdout_log, stderr_log, ):
+            with _task_output(stdout_log, consolidate) as stdout:
+                with _task_output(stderr_log, consolidate) as stderr:
+                    env['JOB_ID'] = parent_id
+                    env['SHELL_TASK_ID'] = task_id
+                    log = "Task {0} executed {1}".format(
+                        task_id,
+                        ' '.join(job))
+
+                    start = time.monotonic()
+                    output = sp.run(
+                        job,
+                        stdout=stdout,
+                        stderr=stderr,
+                        universal_newlines=True,
+                        env=env)
+                    duration = time.monotonic() - start
+                    if consolidate:
+                        for tmp, data_file in (
+                                (stdout, stdout_file), (stderr, stderr_file), ):
+                            if data_file != '/dev/null':
+                                tasklogs.append(data_file, tmp, task_id, codec)
+                        if output.returncode != 0 and stderr_file != '/dev/null':
+                            stderr.seek(0)
+                            err_msg = stderr.read().decode('utf-8', 'replace')
+
+            if output.returncode != 0 and err_msg is None:
+                with open(stderr_log, mode='r') as stderr:
+                    err_msg = stderr.read()
         if output.returncode != 0:
-            with open(stderr_file, mode='r') as stderr:
-                return (1, "Task {0} failed executing: {1} ({2})".format(
-                    task_id,
-                    ' '.join(job),
-                    stderr.read()))
+            return (1, "Task {0} failed executing: {1} ({2})".format(
+                task_id,
+                ' '.join(job),
+                err_msg), output.returncode, duration)
         else:
-            return (0, log)
+            return (0, log, output.returncode, duration)
     except (PermissionError, IOError, ) as e:
         return "Error in subtask {0}, unable to open output file: ".format(task_id) + str(e)
     except KeyboardInterrupt:
@@ -341,18 +390,26 @@ def _run_parallel(
         available_cores = parallel_limit
     control_threads(read_config()['thread_control'], 1, parent_env)
 
-    logger.debug("Have {0} cores available for parallelising over".format(available_cores))
+    logger.debug("Have %d cores available for parallelising over", available_cores)
+
+    consolidate = bool(method_config('shell').get('consolidate_logs', False))
+    codec = log_compression()
+    if consolidate:
+        # One data file and index per stream rather than files per task
+        for log_file in (stdout_file, stderr_file, ):
+            if log_file != '/dev/null':
+                tasklogs.create(log_file, codec)
 
     job_list = []
     for id, job in enumerate(jobs):
         task_id = id + 1
         child_env = dict(parent_env)
-        if stdout_file != '/dev/null':
+        if stdout_file != '/dev/null' and not consolidate:
             child_stdout = '.'.join((stdout_file, str(task_id)))
         else:
             child_stdout = stdout_file
 
-        if stderr_file != '/dev/null':
+        if stderr_file != '/dev/null' and not consolidate:
             child_stderr = '.'.join((stderr_file, str(task_id)))
         else:
             child_stderr = stderr_file
@@ -362,21 +419,28 @@ def _run_parallel(
         child_env['SHELL_TASK_LAST'] = str(array_end)
         child_env['SHELL_TASK_STEPSIZE'] = str(array_stride)
         child_env['SHELL_ARRAYCOUNT'] = ''
-        job_list.append([job, parent_id, task_id, child_env, child_stdout, child_stderr, ])
+        job_list.append([
+            job, parent_id, task_id, child_env, child_stdout, child_stderr,
+            consolidate, codec, ])
 
     job_errors = []
+    task_metrics = []
     with get_context("spawn").Pool(available_cores) as pool:
-        logger.debug(str(job_list))
+        logger.debug("%s", job_list)
         try:
             for out in pool.imap(_mp_run, job_list):
                 if out[0]:
                     job_errors.append(out[1])
                 else:
                     logger.info(out[1])
+                if isinstance(out, tuple) and len(out) == 4:
+                    task_metrics.append(out[2:])
         except RuntimeError as e:
             raise BadSubmission from e
         except KeyboardInterrupt:
             raise BadSubmission("Terminated")
+        finally:
+            shell_tasks(task_metrics)
 
     if job_errors:
         raise BadSubmission(
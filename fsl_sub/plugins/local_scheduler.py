@@ -0,0 +1,525 @@
+# fsl_sub python module
+# Copyright (c) 2018-2021 University of Oxford (Duncan Mortimer)
+
+# Batch scheduler emulation on this computer, used by fsl_sub_plugin_local.
+# The daemon listens on a UNIX socket for one JSON request per connection
+# and runs jobs from the configured queues, accounting for slots and RAM.
+import argparse
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import subprocess
+import sys
+import threading
+import time
+
+from fsl_sub.utils import fsl_sub_state_dir
+
+QUEUED = 0
+RUNNING = 1
+FINISHED = 2
+FAILED = 3
+HELD = 4
+TERMINAL = (FINISHED, FAILED, )
+
+
+def _get_logger():
+    return logging.getLogger('fsl_sub.' + __name__)
+
+
+def default_socket():
+    return os.path.join(fsl_sub_state_dir(), 'local_scheduler.sock')
+
+
+def request(socket_path, op, timeout=30, **kwargs):
+    '''Send a request to the daemon, returning its result. Raises OSError if
+    the daemon can't be reached and RuntimeError if the request fails.'''
+    kwargs['op'] = op
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.settimeout(timeout)
+        s.connect(socket_path)
+        s.sendall(json.dumps(kwargs).encode('utf-8') + b'\n')
+        s.shutdown(socket.SHUT_WR)
+        response = b''
+        while True:
+            data = s.recv(65536)
+            if not data:
+                break
+            response += data
+    return _result(response)
+
+
+async def request_async(socket_path, op, timeout=30, **kwargs):
+    '''Coroutine version of request()'''
+    kwargs['op'] = op
+
+    async def exchange():
+        reader, writer = await asyncio.open_unix_connection(socket_path)
+        try:
+            writer.write(json.dumps(kwargs).encode('utf-8') + b'\n')
+            writer.write_eof()
+            return await reader.read()
+        finally:
+            writer.close()
+    try:
+        response = await asyncio.wait_for(exchange(), timeout)
+    except asyncio.TimeoutError:
+        raise socket.timeout("No response from local scheduler")
+    return _result(response)
+
+
+def _result(response):
+    if not response:
+        raise ConnectionResetError("No response from local scheduler")
+    reply = json.loads(response.decode('utf-8'))
+    if not reply['ok']:
+        raise RuntimeError(reply['error'])
+    return reply['result']
+
+
+class Node(object):
+    __slots__ = ('slots', 'ram', )
+
+    def __init__(self, slots, ram):
+        self.slots = slots
+        self.ram = ram
+
+
+class Task(object):
+    __slots__ = (
+        'task_id', 'state', 'pid', 'node', 'sub_time', 'start_time',
+        'end_time', 'exit_status', 'error_message', 'utime', 'stime',
+        'maxmemory', )
+
+    def __init__(self, task_id, state, sub_time):
+        self.task_id = task_id
+        self.state = state
+        self.pid = None
+        self.node = None
+        self.sub_time = sub_time
+        self.start_time = None
+        self.end_time = None
+        self.exit_status = None
+        self.error_message = None
+        self.utime = None
+        self.stime = None
+        self.maxmemory = None
+
+    def report(self):
+        return {
+            'status': self.state,
+            'start_time': self.start_time,
+            'end_time': self.end_time,
+            'sub_time': self.sub_time,
+            'utime': self.utime,
+            'stime': self.stime,
+            'exit_status': self.exit_status,
+            'error_message': self.error_message,
+            'maxmemory': self.maxmemory,
+        }
+
+
+class Job(object):
+    def __init__(self, job_id, spec, sub_time):
+        self.id = job_id
+        self.name = spec['name']
+        self.queue = spec['queue']
+        self.threads = int(spec.get('threads') or 1)
+        self.ram = int(spec.get('ram') or 0)
+        self.time_limit = spec.get('time')
+        self.priority = int(spec.get('priority') or 0)
+        self.holds = [int(h) for h in spec.get('holds') or []]
+        self.array_hold = spec.get('array_hold')
+        self.array_limit = spec.get('array_limit')
+        self.array = spec.get('array')
+        self.script = spec['script']
+        self.shell = spec.get('shell') or '/bin/bash'
+        self.env = spec.get('env') or {}
+        self.cwd = spec.get('cwd') or '/'
+        self.logdir = spec.get('logdir')
+        self.sub_time = sub_time
+        if self.array:
+            first, last, step = self.array
+            ids = range(first, last + 1, step)
+        else:
+            ids = [1, ]
+        self.tasks = {t: Task(t, QUEUED, sub_time) for t in ids}
+
+    def log_files(self, task_id):
+        if self.logdir == os.devnull:
+            return (os.devnull, os.devnull, )
+        suffix = str(self.id)
+        if self.array:
+            suffix += '.' + str(task_id)
+        return tuple(
+            os.path.join(self.logdir, '{0}.{1}{2}'.format(self.name, s, suffix))
+            for s in ('o', 'e', ))
+
+    def report(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'script': self.script,
+            'arguments': None,
+            'submission_time': self.sub_time,
+            'tasks': {str(t): task.report() for t, task in self.tasks.items()},
+            'parents': self.holds or None,
+            'children': None,
+            'job_directory': self.cwd,
+        }
+
+
+class Scheduler(object):
+    '''Queues jobs and starts them as slots and RAM become available.
+    queues is the fsl_sub queue configuration, each queue emulates nodes
+    nodes of max_slots slots and max_size GB RAM.'''
+
+    def __init__(self, queues, nodes=1, poll_interval=0.1):
+        if not queues:
+            raise ValueError("No queues configured")
+        self.queues = queues
+        # Capacity of each node of a queue, RAM in MB (0 is unlimited)
+        self.capacity = {
+            q: (int(qc.get('max_slots', 1)), int(qc.get('max_size', 0)) * 1024, )
+            for q, qc in queues.items()}
+        self.nodes = {
+            q: [Node(*self.capacity[q]) for _ in range(nodes)]
+            for q in queues}
+        self.poll_interval = poll_interval
+        self.jobs = {}
+        self.pending = []
+        self.running = {}
+        self.next_id = 1
+        self.cond = threading.Condition()
+        self.stopping = False
+        # Set when a change may allow a pending task to start
+        self.dirty = False
+
+    def _check_fits(self, spec):
+        queue = spec.get('queue')
+        if queue not in self.queues:
+            raise ValueError("Unknown queue " + str(queue))
+        threads = int(spec.get('threads') or 1)
+        ram = int(spec.get('ram') or 0)
+        slots, node_ram = self.capacity[queue]
+        if threads > slots or (node_ram and ram > node_ram):
+            raise ValueError(
+                "Job requires more resources than a node of queue "
+                + queue + " provides")
+
+    def submit(self, spec):
+        self._check_fits(spec)
+        with self.cond:
+            job = Job(self.next_id, spec, time.time())
+            self.next_id += 1
+            self.jobs[job.id] = job
+            for task in job.tasks.values():
+                if not self._holds_satisfied(job, task):
+                    task.state = HELD
+            self.pending.extend((job, t) for t in job.tasks.values())
+            self.pending.sort(key=lambda jt: (-jt[0].priority, jt[0].id, jt[1].task_id))
+            self.dirty = True
+            self.cond.notify()
+        _get_logger().info(
+            "Job {0} ({1}) queued on {2}".format(job.id, job.name, job.queue))
+        return job.id
+
+    def status(self, job_ids):
+        with self.cond:
+            return {
+                str(j): self.jobs[int(j)].report()
+                for j in job_ids if int(j) in self.jobs}
+
+    def limits(self):
+        '''{queue: {limit: value}} of the node sizes enforced, RAM in GB'''
+        limits = {}
+        for q, (slots, ram) in self.capacity.items():
+            limits[q] = {'max_slots': slots, }
+            if ram:
+                limits[q]['max_size'] = ram // 1024
+        return limits
+
+    def qdel(self, job_id, task_id=None):
+        with self.cond:
+            try:
+                job = self.jobs[int(job_id)]
+            except KeyError:
+                raise ValueError("Unknown job " + str(job_id))
+            tasks = job.tasks.values()
+            if task_id is not None:
+                tasks = [job.tasks[int(task_id)]]
+            now = time.time()
+            for task in tasks:
+                if task.state in TERMINAL:
+                    continue
+                if task.pid is not None:
+                    try:
+                        os.killpg(task.pid, signal.SIGTERM)
+                    except OSError:
+                        pass
+                else:
+                    task.state = FAILED
+                    task.end_time = now
+                task.error_message = 'Deleted'
+            self.pending = [
+                (j, t) for j, t in self.pending if t.state not in TERMINAL]
+            self.dirty = True
+            self.cond.notify()
+        return "Job {0} deleted".format(job_id)
+
+    def _holds_satisfied(self, job, task):
+        for h in job.holds:
+            held = self.jobs.get(h)
+            if held is not None and any(
+                    t.state not in TERMINAL for t in held.tasks.values()):
+                return False
+        if job.array_hold is not None:
+            held = self.jobs.get(int(job.array_hold))
+            if held is not None:
+                h_task = held.tasks.get(task.task_id)
+                if h_task is not None and h_task.state not in TERMINAL:
+                    return False
+        return True
+
+    def _find_node(self, job):
+        for node in self.nodes[job.queue]:
+            if node.slots >= job.threads and (
+                    not job.ram or not node.ram or node.ram >= job.ram):
+                return node
+        return None
+
+    def _start(self, job, task, node):
+        node.slots -= job.threads
+        node.ram -= job.ram
+        task.node = node
+        env = dict(job.env)
+        env.update({
+            'LOCAL_JOB_ID': str(job.id),
+            'LOCAL_JOB_NAME': job.name,
+            'LOCAL_QUEUE': job.queue,
+            'NSLOTS': str(job.threads),
+        })
+        if job.array:
+            first, last, step = job.array
+            env.update({
+                'LOCAL_TASK_ID': str(task.task_id),
+                'LOCAL_TASK_FIRST': str(first),
+                'LOCAL_TASK_LAST': str(last),
+                'LOCAL_TASK_STEPSIZE': str(step),
+                'LOCAL_TASK_COUNT': str(len(job.tasks)),
+            })
+        stdout, stderr = job.log_files(task.task_id)
+        try:
+            with open(stdout, 'a') as out, open(stderr, 'a') as err:
+                proc = subprocess.Popen(
+                    [job.shell, '-c', job.script],
+                    cwd=job.cwd, env=env, stdout=out, stderr=err,
+                    stdin=subprocess.DEVNULL, start_new_session=True)
+        except OSError as e:
+            self._finish(job, task, 1, None, 'Unable to start job: ' + str(e))
+            return
+        task.pid = proc.pid
+        task.state = RUNNING
+        task.start_time = time.time()
+        self.running[proc.pid] = (job, task, proc, )
+
+    def _finish(self, job, task, exit_status, rusage, message=None):
+        self.dirty = True
+        if task.node is not None:
+            task.node.slots += job.threads
+            task.node.ram += job.ram
+            task.node = None
+        task.pid = None
+        task.end_time = time.time()
+        task.exit_status = exit_status
+        if message is not None and task.error_message is None:
+            task.error_message = message
+        # Deleted or timed out tasks have failed, whatever their exit status
+        task.state = (
+            FINISHED if exit_status == 0 and task.error_message is None
+            else FAILED)
+        if rusage is not None:
+            task.utime = rusage.ru_utime
+            task.stime = rusage.ru_stime
+            # ru_maxrss is in kilobytes on Linux
+            task.maxmemory = rusage.ru_maxrss // 1024
+        _get_logger().info(
+            "Job {0}.{1} exited with status {2}".format(
+                job.id, task.task_id, exit_status))
+
+    def _reap(self):
+        now = time.time()
+        for pid, (job, task, proc) in list(self.running.items()):
+            message = None
+            try:
+                # Reaped with os.wait4 so the resource usage is available
+                wpid, status, rusage = os.wait4(pid, os.WNOHANG)
+            except ChildProcessError:
+                wpid, status, rusage = pid, 1 << 8, None
+                message = 'Job process lost'
+            if wpid == 0:
+                limit = job.time_limit
+                if limit and now - task.start_time > limit * 60:
+                    task.error_message = 'Time limit exceeded'
+                    try:
+                        os.killpg(pid, signal.SIGKILL)
+                    except OSError:
+                        pass
+                continue
+            del self.running[pid]
+            if os.WIFSIGNALED(status):
+                exit_status = 128 + os.WTERMSIG(status)
+                # Already reaped - stop Popen waiting on the pid
+                proc.returncode = -os.WTERMSIG(status)
+            else:
+                exit_status = os.WEXITSTATUS(status)
+                proc.returncode = exit_status
+            self._finish(job, task, exit_status, rusage, message)
+
+    def _schedule(self):
+        self.dirty = False
+        running_tasks = {}
+        for job, _, _ in self.running.values():
+            running_tasks[job.id] = running_tasks.get(job.id, 0) + 1
+        # Rebuilt rather than removing started tasks, which is O(n^2)
+        waiting = []
+        for job, task in self.pending:
+            if all(n.slots == 0 for n in self.nodes[job.queue]):
+                waiting.append((job, task))
+                continue
+            if not self._holds_satisfied(job, task):
+                task.state = HELD
+                waiting.append((job, task))
+                continue
+            task.state = QUEUED
+            node = None
+            if not job.array_limit or running_tasks.get(job.id, 0) < job.array_limit:
+                node = self._find_node(job)
+            if node is None:
+                waiting.append((job, task))
+                continue
+            self._start(job, task, node)
+            if task.state == RUNNING:
+                running_tasks[job.id] = running_tasks.get(job.id, 0) + 1
+        self.pending = waiting
+
+    def run(self):
+        '''Scheduling loop, returns once stop() has been called'''
+        with self.cond:
+            while not self.stopping:
+                self._reap()
+                if self.dirty:
+                    self._schedule()
+                self.cond.wait(self.poll_interval)
+            for pid in list(self.running):
+                try:
+                    os.killpg(pid, signal.SIGTERM)
+                except OSError:
+                    pass
+
+    def stop(self):
+        with self.cond:
+            self.stopping = True
+            self.cond.notify()
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        scheduler = self.server.scheduler
+        try:
+            req = json.loads(self.rfile.read().decode('utf-8'))
+            op = req.pop('op')
+            if op == 'submit':
+                result = scheduler.submit(req['job'])
+            elif op == 'status':
+                result = scheduler.status(req['job_ids'])
+            elif op == 'qdel':
+                result = scheduler.qdel(req['job_id'], req.get('task_id'))
+            elif op == 'queues':
+                result = sorted(scheduler.queues)
+            elif op == 'limits':
+                result = scheduler.limits()
+            elif op == 'ping':
+                result = os.getpid()
+            elif op == 'shutdown':
+                result = True
+                threading.Thread(target=self.server.shutdown).start()
+            else:
+                raise ValueError("Unknown request " + str(op))
+            reply = {'ok': True, 'result': result, }
+        except Exception as e:
+            reply = {'ok': False, 'error': str(e), }
+        self.wfile.write(json.dumps(reply).encode('utf-8'))
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(socket_path, queues, nodes=1, poll_interval=0.1):
+    '''Run the scheduler until shutdown is requested or SIGTERM received.
+    Returns False if another daemon already holds the socket.'''
+    logger = _get_logger()
+    folder = os.path.dirname(os.path.abspath(socket_path))
+    # Anyone who can connect to the socket can run commands as us
+    os.makedirs(folder, mode=0o700, exist_ok=True)
+    lock_file = open(socket_path + '.lock', 'a')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        logger.info("Local scheduler already running")
+        return False
+    try:
+        os.unlink(socket_path)
+    except FileNotFoundError:
+        pass
+    scheduler = Scheduler(queues, nodes=nodes, poll_interval=poll_interval)
+    umask = os.umask(0o177)
+    try:
+        server = _Server(socket_path, _Handler)
+    finally:
+        os.umask(umask)
+    os.chmod(socket_path, 0o600)
+    server.scheduler = scheduler
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(
+            signal.SIGTERM,
+            lambda s, f: threading.Thread(target=server.shutdown).start())
+    sched_thread = threading.Thread(target=scheduler.run, daemon=True)
+    sched_thread.start()
+    logger.info("Local scheduler listening on " + socket_path)
+    try:
+        server.serve_forever()
+    finally:
+        scheduler.stop()
+        sched_thread.join()
+        server.server_close()
+        os.unlink(socket_path)
+        lock_file.close()
+    return True
+
+
+def main(args=None):
+    from fsl_sub.config import (method_config, read_config, )
+    parser = argparse.ArgumentParser(
+        prog='local_scheduler',
+        description="Batch scheduler emulation for fsl_sub's local plugin")
+    parser.add_argument('--socket', default=None, help="Socket to listen on")
+    parser.add_argument('--debug', action='store_true')
+    options = parser.parse_args(args)
+    logging.basicConfig(
+        level=logging.DEBUG if options.debug else logging.INFO,
+        format='%(asctime)s %(message)s')
+    mconf = method_config('local')
+    socket_path = options.socket or mconf.get('socket') or default_socket()
+    if not serve(socket_path, read_config()['queues'], mconf.get('nodes', 1)):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,7 +2,6 @@
 import logging
 import os
 import subprocess as sp
-from collections import defaultdict
 from ruamel.yaml import YAML
 
 from fsl_sub.version import (VERSION, )
@@ -17,7 +16,9 @@ from fsl_sub.config import (
     method_config,
     coprocessor_config,
 )
+from fsl_sub.config_model import method_options
 import fsl_sub.consts
+from fsl_sub import (compression, staging, )
 from fsl_sub.coprocessors import (
     coproc_get_module
 )
@@ -29,10 +30,11 @@ from fsl_sub.utils import (
     parse_array_specifier,
     fix_permissions,
     flatten_list,
-    write_wrapper,
     job_script,
-    update_envvar_list,
+    EnvSpec,
+    writelines_nl,
 )
+from fsl_sub.wrappers import cached_wrapper
 from .version import PLUGIN_VERSION
 
 
@@ -153,14 +155,14 @@ def submit(
             complex description) (string)
     usescript - queue config is defined in script
     project - which account to associate this job with
-    export_vars - list of environment variables to preserve for job
+    export_vars - EnvSpec of environment variables to preserve for job,
+            iterates as 'VAR'/'VAR=VALUE' strings
             ignored if job is copying complete environment
     keep_jobscript - whether to generate (if not configured already) and keep
             a wrapper script for the job
     '''
 
     logger = _get_logger()
-    my_export_vars = list(export_vars)
     if command is None:
         raise BadSubmission(
             "Must provide command line or array task file name")
@@ -173,13 +175,16 @@ def submit(
     # will return the updated list!
     if export_vars is None:
         export_vars = []
+    my_export_vars = EnvSpec(export_vars)
 
     # Set this to the name of the plugin, e.g. a in fsl_sub_plugin_a
-    mconf = defaultdict(lambda: False, method_config(METHOD_NAME))
+    mconf = method_options(METHOD_NAME, method_config(METHOD_NAME))
     qsub = _qsub_cmd()
     command_args = []
 
     modules = []
+    prologue = []
+    epilogue = None
     mconfig = method_config(METHOD_NAME)
     if logdir is None:
         logdir = os.getcwd()
@@ -217,13 +222,13 @@ def submit(
         for var, value in array_map.items():
             if not value:
                 value = '""'
-            update_envvar_list(my_export_vars, '='.join((var, value)))
+            my_export_vars.set(var, value)
         if mconf.get('copy_environment', False):
             # Add queue's argument for cloning current environment
             pass
 
         if my_export_vars:
-            command_args.append(  # Queue argument for exporting variables to job
+            command_args.append(  # Queue argument for exporting variables to job, e.g. my_export_vars.render(',')
             )
 
         if coprocessor is not None:
@@ -249,7 +254,18 @@ def submit(
             pass
         else:
             # Add arguments to define stdout and stderr log paths
-            pass
+            codec = compression.log_compression()
+            if codec is not None:
+                # Compress the logs once the command finishes
+                epilogue = compression.epilogue(
+                    codec, _log_files(
+                        logdir, job_name, array_map, array_task))
+            stage_in = staging.script_staging_dir()
+            if stage_in is not None:
+                # Write logs to node-local storage, copying them to the
+                # log files (then compressing them) when the job exits
+                prologue = staging.prologue(stage_in, epilogue)
+                epilogue = None
 
         # Processing of jobhold necessary for array_holds
         if jobhold:
@@ -346,14 +362,17 @@ def submit(
     logger.debug(type(command_args))
     logger.debug(command_args)
 
-    extra_lines = []
+    extra_lines = list(prologue)
     if array_task and not array_specifier:
-        extra_lines = [
+        extra_lines += [
             '',
             'the_command=$(sed -n -e "${{VARIABLE INDICATING_ARRAY_TASK_ID}}p" {0})'.format(command),  # Change this line
             '',
         ]
-        command = ['exec', bash, '-c', '"$the_command"', ]
+        # exec prevents any epilogue (or log staging) from completing
+        command = (
+            [bash, '-c', '"$the_command"', ] if epilogue or prologue
+            else ['exec', bash, '-c', '"$the_command"', ])
         command_args = command_args if use_jobscript else []
         use_jobscript = True
 
@@ -364,14 +383,14 @@ def submit(
             if cp_module is not None:
                 modules.append(cp_module)
     js_lines = job_script(
-        command, command_args, modules=modules, extra_lines=extra_lines)
+        command, command_args, modules=modules, extra_lines=extra_lines,
+        epilogue=epilogue)
     logger.debug('\n'.join(js_lines))
     if keep_jobscript:
-        wrapper_name = write_wrapper(js_lines)
+        # Shared with identical submissions - copy, don't rename
+        wrapper_name = cached_wrapper(js_lines)
         logger.debug(wrapper_name)
         command_args = [wrapper_name]
-        logger.debug("Calling fix_permissions " + str(0o755))
-        fix_permissions(wrapper_name, 0o755)
     else:
         if not usescript:
             command_args = []
@@ -406,16 +425,27 @@ def submit(
             '_'.join(('wrapper', str(job_id))) + '.sh'
         )
         try:
-            logger.debug("Renaming wrapper to " + new_name)
-            os.rename(
-                wrapper_name,
-                new_name
-            )
+            logger.debug("Saving wrapper as " + new_name)
+            with open(new_name, 'w') as wrapper:
+                writelines_nl(wrapper, js_lines)
+            fix_permissions(new_name, 0o755)
         except OSError:
             logger.warn("Unable to preserve wrapper script")
     return job_id
 
 
+def _log_files(logdir, job_name, array_map, array_task=False):
+    '''stdout and stderr log paths of the job as shell expressions evaluated
+    on the compute node - change to match your cluster's log naming, here
+    <job_name>.o<job id>[.<task id>]'''
+    suffix = '${' + array_map['FSLSUB_JOB_ID_VAR'] + '}'
+    if array_task:
+        suffix += '.${' + array_map['FSLSUB_ARRAYTASKID_VAR'] + '}'
+    return [
+        os.path.join(logdir, job_name + '.' + s + suffix)
+        for s in ('o', 'e', )]
+
+
 def _default_config_file():
     return os.path.join(
         os.path.realpath(os.path.dirname(__file__)),
@@ -490,6 +520,17 @@ def job_status(job_id, sub_job_id=None):
     return job_details
 
 
+def job_status_batch(job_ids):
+    '''Optional - return a dict keyed on job id of job_status() results.
+    Used by fsl_sub.wait() to query all outstanding jobs at once, replace
+    with a single scheduler query where possible.
+    A plugin that can be notified of job completion may also provide
+    job_wait(job_ids, timeout, mode) returning (done, not_done) dicts.
+    A coroutine job_status_batch_async(job_ids) may be provided for
+    fsl_sub.aio, running commands with fsl_sub.aio.run_command().'''
+    return {j: job_status(j) for j in job_ids}
+
+
 def _running_job(job_id, sub_job_id=None):
     '''Get information on a running job'''
     pass
@@ -505,6 +546,15 @@ def _get_queues():
     pass
 
 
+def live_queue_defs():
+    '''Return {queue name: {'time': minutes, 'max_size': RAM, 'max_slots':
+    threads, 'slot_size': RAM}} of the limits the cluster currently enforces.
+    Used by fsl_sub --refresh_queues to keep configured queue limits current
+    (see live_queue_ttl). Remove this function if the limits can't be
+    queried, suggested limits must not be returned.'''
+    pass
+
+
 def _add_comment(comments, comment):
     if comment not in comments:
         comments.append(comment)
@@ -0,0 +1,250 @@
+# fsl_sub python module
+# Copyright (c) 2018-2021 University of Oxford (Duncan Mortimer)
+
+# Phase timing of submissions, enabled by setting FSLSUB_PROFILE to 1/true
+# (report on stderr) or the path of a file to append JSON records to.
+# FSLSUB_PROFILE_DUMP=cprofile|tracemalloc additionally writes a profile.
+import cProfile
+import datetime
+import functools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from fsl_sub.utils import (affirmative, negative, )
+
+DUMP_TYPES = ('cprofile', 'tracemalloc', )
+_STDERR = ('1', 'stderr', )
+_OFF = ('', '0', 'off', )
+_ON = ('1', 'on', 'stderr', )
+FILE_PREFIX = 'file:'
+
+_session = None
+_lock = threading.Lock()
+_local = threading.local()
+
+
+def _get_logger():
+    return logging.getLogger(__name__)
+
+
+def destination():
+    '''Where profiling is reported - 'stderr' or the path of a file - from
+    FSLSUB_PROFILE, None if profiling is disabled. Values are taken as
+    paths only if they contain a / or start file:, anything else not
+    meaning off (0, no, false...) reports on stderr.'''
+    dest = os.environ.get('FSLSUB_PROFILE', '').strip()
+    if dest.startswith(FILE_PREFIX):
+        return dest[len(FILE_PREFIX):] or None
+    if os.sep in dest:
+        return dest
+    if dest.lower() in _OFF or negative(dest):
+        return None
+    if dest.lower() not in _ON and not affirmative(dest):
+        _get_logger().warning(
+            "FSLSUB_PROFILE={0} is not a path (use file:{0} to write to a "
+            "file in the current folder), reporting on stderr".format(dest))
+    return 'stderr'
+
+
+class Session(object):
+    '''Accumulates the phase timings of one fsl_sub invocation'''
+    def __init__(self, label):
+        self.label = label
+        self.start = time.perf_counter()
+        self.phases = OrderedDict()
+        self.live = set()
+        self.destination = None
+        self.dump = None
+        self.profiler = None
+
+    def enable(self, dest, dump=None):
+        if self.destination is not None:
+            return
+        self.destination = dest
+        if dump is None:
+            dump = os.environ.get('FSLSUB_PROFILE_DUMP') or None
+        if dump == 'cprofile':
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        elif dump == 'tracemalloc':
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+        elif dump is not None:
+            _get_logger().warning(
+                "Unknown profile type {0} (expecting one of {1})".format(
+                    dump, ', '.join(DUMP_TYPES)))
+            dump = None
+        self.dump = dump
+
+    def add(self, name, seconds):
+        with _lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def _dump_file(self):
+        if self.destination in _STDERR:
+            folder = os.getcwd()
+        else:
+            folder = os.path.dirname(os.path.abspath(self.destination))
+        return os.path.join(folder, 'fsl_sub_{0}.{1}'.format(
+            os.getpid(), 'prof' if self.dump == 'cprofile' else 'tracemalloc'))
+
+    def _write_dump(self):
+        dump_file = self._dump_file()
+        if self.dump == 'cprofile':
+            self.profiler.disable()
+            self.profiler.dump_stats(dump_file)
+        else:
+            tracemalloc.take_snapshot().dump(dump_file)
+            tracemalloc.stop()
+        return dump_file
+
+    def record(self):
+        return {
+            'date': datetime.datetime.now().isoformat(),
+            'pid': os.getpid(),
+            'argv': sys.argv,
+            'label': self.label,
+            'total': time.perf_counter() - self.start,
+            'phases': self.phases,
+        }
+
+    def finish(self):
+        if self.destination is None:
+            return
+        record = self.record()
+        try:
+            if self.dump is not None:
+                record['dump'] = self._write_dump()
+            if self.destination in _STDERR:
+                print(summary(record), file=sys.stderr)
+            else:
+                with open(self.destination, 'a') as prof_file:
+                    prof_file.write(json.dumps(record) + '\n')
+        except OSError as e:
+            _get_logger().warning("Unable to write profile: " + str(e))
+
+
+def summary(record):
+    '''One line description of a profile record'''
+    line = "fsl_sub profile ({0} {1:.3f}s): ".format(
+        record['label'], record['total'])
+    line += ', '.join(
+        "{0} {1:.3f}s".format(n, s) for n, s in record['phases'].items()
+        if n != record['label'])
+    if 'dump' in record:
+        line += " [" + record['dump'] + "]"
+    return line
+
+
+@contextmanager
+def session(label, dest=None):
+    '''Profile the enclosed block, reporting on exit if profiling has been
+    enabled (through FSLSUB_PROFILE, dest or enable()). Nested sessions
+    are part of the enclosing session.'''
+    global _session
+    # Threads (e.g. those submitting array chunks) share the session
+    with _lock:
+        this_session = _session
+        if this_session is None:
+            this_session = _session = Session(label)
+            owner = True
+        else:
+            owner = False
+    if not owner:
+        yield this_session
+        return
+    if dest is None:
+        dest = destination()
+    if dest is not None:
+        this_session.enable(dest)
+    try:
+        yield this_session
+    finally:
+        with _lock:
+            _session = None
+        this_session.finish()
+
+
+def enable(dest, dump=None):
+    '''Turn on reporting of the current session'''
+    if _session is not None:
+        _session.enable(dest, dump)
+
+
+class _Timer(object):
+    __slots__ = ('session', 'name', 'last', )
+
+    def __init__(self, session, name):
+        self.session = session
+        self.name = name
+        self.last = time.perf_counter()
+
+    def lap(self, phase):
+        now = time.perf_counter()
+        self.session.add('.'.join((self.name, phase)), now - self.last)
+        self.last = now
+
+
+def _timed(name, func, args, kwargs):
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    this_session = _session
+    if this_session is None:
+        return func(*args, **kwargs)
+    with _lock:
+        nested = name in this_session.live
+        if not nested:
+            this_session.live.add(name)
+    if nested:
+        # Recursive/concurrent calls are part of the outermost call's time
+        stack.append(None)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            stack.pop()
+    timer = _Timer(this_session, name)
+    stack.append(timer)
+    start = timer.last
+    try:
+        return func(*args, **kwargs)
+    finally:
+        stack.pop()
+        with _lock:
+            this_session.live.discard(name)
+        this_session.add(name, time.perf_counter() - start)
+
+
+def profiled(name, start_session=False):
+    '''Decorator timing calls of the function as phase name, with lap()
+    calls within the function timing its sub-phases. When profiling is
+    disabled this costs one environment lookup per call. If start_session
+    the function always runs in a session, which may be enabled later
+    with enable().'''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _session is None:
+                dest = destination()
+                if dest is None and not start_session:
+                    return func(*args, **kwargs)
+                with session(name, dest):
+                    return _timed(name, func, args, kwargs)
+            return _timed(name, func, args, kwargs)
+        return wrapper
+    return decorator
+
+
+def lap(phase):
+    '''Record the time since the start of the current profiled function
+    (or the previous lap) as phase'''
+    stack = getattr(_local, 'stack', None)
+    if stack and stack[-1] is not None:
+        stack[-1].lap(phase)
@@ -0,0 +1,158 @@
+# fsl_sub python module
+# Copyright (c) 2018-2021 University of Oxford (Duncan Mortimer)
+
+# Node-local staging of job logs - logs are written to local scratch space
+# and copied to the (shared) log folder in one go when the job ends
+import logging
+import os
+import shutil
+import signal
+import tempfile
+import threading
+from contextlib import contextmanager
+
+from fsl_sub.compression import (compress_logs, SUFFIXES, )
+from fsl_sub.config import read_config
+from fsl_sub.exceptions import (BadConfiguration, MissingConfiguration, )
+
+_SIGNALS = (signal.SIGTERM, signal.SIGHUP, )
+
+
+def _get_logger():
+    return logging.getLogger(__name__)
+
+
+def _setting():
+    setting = os.environ.get('FSLSUB_LOG_STAGING')
+    if setting is None:
+        try:
+            return read_config().get('log_staging')
+        except (BadConfiguration, MissingConfiguration, ):
+            return None
+    if setting.lower() in ('', '0', 'false', 'no', ):
+        return None
+    if setting.lower() in ('1', 'true', 'yes', ):
+        return True
+    return setting
+
+
+def staging_dir():
+    '''Folder logs are staged in - the log_staging option (or
+    FSLSUB_LOG_STAGING), with True meaning $TMPDIR - or None if staging is
+    disabled'''
+    setting = _setting()
+    if not setting:
+        return None
+    if setting is True:
+        return os.environ.get('TMPDIR') or tempfile.gettempdir()
+    return os.path.expandvars(os.path.expanduser(str(setting)))
+
+
+def script_staging_dir():
+    '''Folder logs are staged in as a shell expression evaluated on the
+    compute node, or None if staging is disabled'''
+    setting = _setting()
+    if not setting:
+        return None
+    if setting is True:
+        return '${TMPDIR:-/tmp}'
+    return str(setting)
+
+
+@contextmanager
+def _exit_on_signal():
+    '''Convert SIGTERM/SIGHUP into SystemExit within the block so clean up
+    code runs. Only possible in the main thread.'''
+    if threading.current_thread() is not threading.main_thread():
+        yield
+        return
+
+    def handler(signum, frame):
+        raise SystemExit(128 + signum)
+    previous = {s: signal.signal(s, handler) for s in _SIGNALS}
+    try:
+        yield
+    finally:
+        for s, h in previous.items():
+            signal.signal(s, h)
+
+
+def _move(staged, log_file, codec):
+    if codec is not None:
+        compress_logs((staged, ), codec)
+        staged += SUFFIXES[codec]
+        log_file += SUFFIXES[codec]
+    try:
+        shutil.move(staged, log_file)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        _get_logger().warning(
+            "Unable to copy log {0} to {1}: {2}".format(
+                staged, log_file, str(e)))
+
+
+@contextmanager
+def logs(log_files, codec=None):
+    '''Context for writing job logs, yielding the list of files to write
+    in place of log_files. With staging enabled these are in a private
+    folder in the staging area and are moved to log_files when the block
+    exits, however it exits (including on SIGTERM/SIGHUP in the main
+    thread). Logs are compressed with codec, if given, on exit.'''
+    folder = staging_dir()
+    if folder is None:
+        try:
+            yield list(log_files)
+        finally:
+            if codec is not None:
+                compress_logs(log_files, codec)
+        return
+    os.makedirs(folder, exist_ok=True)
+    stage = tempfile.mkdtemp(prefix='fsl_sub_', dir=folder)
+    staged = [
+        f if f == '/dev/null' else os.path.join(stage, str(i))
+        for i, f in enumerate(log_files)]
+    try:
+        with _exit_on_signal():
+            yield staged
+    finally:
+        for s, f in zip(staged, log_files):
+            if f != '/dev/null':
+                _move(s, f, codec)
+        shutil.rmtree(stage, ignore_errors=True)
+
+
+def prologue(folder, finish_lines=None):
+    '''Lines for the start of a job script that stage the job's stdout and
+    stderr in folder (a shell expression evaluated on the compute node,
+    created if necessary). They are copied to the scheduler's log files when
+    the script exits (including on SIGTERM/SIGHUP/SIGINT), then finish_lines
+    (e.g. fsl_sub.compression.epilogue()) are run, even if staging wasn't
+    possible. The command must not be exec'd.
+
+    The command runs as a child of the job script, so only reaches
+    SIGTERM etc. if the scheduler signals the job's process group (as most
+    do) - the traps run once the command has exited.'''
+    lines = ['fsl_sub_finish() {', ]
+    lines.extend('    ' + line for line in finish_lines or [':', ])
+    lines.extend([
+        '}',
+        'if mkdir -p "{0}" && fsl_sub_stage=$(mktemp -d "{0}/fsl_sub.XXXXXX"); then'.format(
+            folder),
+        '    exec 3>&1 4>&2 >"$fsl_sub_stage/stdout" 2>"$fsl_sub_stage/stderr"',
+        '    fsl_sub_unstage() {',
+        '        exec 1>&3 2>&4 3>&- 4>&-',
+        '        cat "$fsl_sub_stage/stdout"',
+        '        cat "$fsl_sub_stage/stderr" >&2',
+        '        rm -rf "$fsl_sub_stage"',
+        '        fsl_sub_finish',
+        '    }',
+        '    trap fsl_sub_unstage EXIT',
+        'else',
+        '    trap fsl_sub_finish EXIT',
+        'fi',
+        "trap 'exit 143' TERM",
+        "trap 'exit 129' HUP",
+        "trap 'exit 130' INT",
+    ])
+    return lines
@@ -0,0 +1,124 @@
+# fsl_sub python module
+# Copyright (c) 2018-2021 University of Oxford (Duncan Mortimer)
+
+# Consolidated array task logs - the output of every task of an array is
+# appended to one data file per stream, with an index holding a fixed size
+# entry per task so any task's output can be found with one read. Entries
+# may be individually compressed.
+import fcntl
+import os
+import shutil
+import struct
+
+from fsl_sub.compression import (
+    CODEC_IDS,
+    compress_stream,
+    decompress_stream,
+)
+from fsl_sub.exceptions import UnknownJobId
+
+MAGIC = b'FSLSUBL1'
+# magic, version, entry size, codec id
+HEADER = struct.Struct('<8sHHH2x')
+# offset, length, task id (0 where the task hasn't finished)
+ENTRY = struct.Struct('<QQI4x')
+INDEX_SUFFIX = '.idx'
+CHUNK = 1024 * 1024
+
+
+def index_file(data_file):
+    return data_file + INDEX_SUFFIX
+
+
+def _slot(task_id):
+    return HEADER.size + (int(task_id) - 1) * ENTRY.size
+
+
+def create(data_file, codec=None):
+    '''Create an empty data file and index, entries will be compressed
+    with codec (see fsl_sub.compression) if given'''
+    with open(data_file, 'wb'):
+        pass
+    with open(index_file(data_file), 'wb') as idx:
+        idx.write(HEADER.pack(MAGIC, 1, ENTRY.size, CODEC_IDS[codec]))
+
+
+def append(data_file, source, task_id, codec=None):
+    '''Append the contents of the binary file object source (from its
+    start) to data_file as the output of task_id, returning (offset,
+    length). codec must match that given to create(). The data file is
+    locked while copying so tasks finishing together don't interleave.'''
+    source.seek(0)
+    with open(data_file, 'ab') as df:
+        fcntl.flock(df, fcntl.LOCK_EX)
+        try:
+            offset = df.seek(0, os.SEEK_END)
+            if codec is None:
+                shutil.copyfileobj(source, df, CHUNK)
+            else:
+                compress_stream(source, df, codec, CHUNK)
+            df.flush()
+            length = df.tell() - offset
+        finally:
+            fcntl.flock(df, fcntl.LOCK_UN)
+    # Each task has its own index entry so no lock is needed
+    fd = os.open(index_file(data_file), os.O_WRONLY)
+    try:
+        os.pwrite(fd, ENTRY.pack(offset, length, int(task_id)), _slot(task_id))
+    finally:
+        os.close(fd)
+    return (offset, length, )
+
+
+def _check_header(idx, data_file):
+    '''Returns the codec of the log's entries'''
+    header = idx.read(HEADER.size)
+    if len(header) < HEADER.size:
+        raise ValueError(data_file + " has no task log index")
+    magic, _, entry_size, codec_id = HEADER.unpack(header)
+    if magic != MAGIC or entry_size != ENTRY.size:
+        raise ValueError(data_file + " is not an fsl_sub task log")
+    for codec, c_id in CODEC_IDS.items():
+        if c_id == codec_id:
+            return codec
+    raise ValueError(data_file + " uses an unknown compression method")
+
+
+def entry(data_file, task_id):
+    '''Return (offset, length, codec) of task_id's output in data_file,
+    length is the stored (possibly compressed) size'''
+    with open(index_file(data_file), 'rb') as idx:
+        codec = _check_header(idx, data_file)
+        idx.seek(_slot(task_id))
+        record = idx.read(ENTRY.size)
+    if len(record) == ENTRY.size:
+        offset, length, recorded = ENTRY.unpack(record)
+        if recorded == int(task_id):
+            return (offset, length, codec, )
+    raise UnknownJobId("No output recorded for task " + str(task_id))
+
+
+def tasks(data_file):
+    '''List of the task ids with output in data_file'''
+    with open(index_file(data_file), 'rb') as idx:
+        _check_header(idx, data_file)
+        index = idx.read()
+    count = len(index) // ENTRY.size
+    return [
+        e[2] for e in ENTRY.iter_unpack(index[:count * ENTRY.size]) if e[2]]
+
+
+def read(data_file, task_id, out, chunk=CHUNK):
+    '''Write task_id's output to the binary file object out, in chunks'''
+    offset, length, codec = entry(data_file, task_id)
+    with open(data_file, 'rb') as df:
+        df.seek(offset)
+        if codec is not None:
+            decompress_stream(df, out, codec, length, chunk)
+            return
+        while length:
+            data = df.read(min(chunk, length))
+            if not data:
+                raise ValueError(data_file + " is truncated")
+            out.write(data)
+            length -= len(data)
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import (MagicMock, patch, )
+
+import fsl_sub.consts
+from fsl_sub import aio
+from fsl_sub.exceptions import UnknownJobId
+from fsl_sub.plugins.local_scheduler import request_async
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+def _status(*states):
+    return {
+        'id': 1,
+        'tasks': {str(i + 1): {'status': s} for i, s in enumerate(states)},
+    }
+
+
+class FakePlugin(object):
+    pass
+
+
+class TestConcurrency(unittest.TestCase):
+    def setUp(self):
+        self.addCleanup(aio.set_concurrency, aio.DEFAULT_CONCURRENCY)
+
+    def test_environment(self):
+        with patch('fsl_sub.aio._concurrency', None):
+            with patch.dict(os.environ, {'FSLSUB_AIO_CONCURRENCY': '5'}):
+                self.assertEqual(aio.concurrency(), 5)
+            with patch.dict(os.environ, {'FSLSUB_AIO_CONCURRENCY': 'x'}):
+                self.assertEqual(aio.concurrency(), aio.DEFAULT_CONCURRENCY)
+
+    @patch('fsl_sub.submit', autospec=True)
+    def test_submit(self, mock_submit):
+        lock = threading.Lock()
+        running = [0, 0]
+
+        def fake_submit(command, **kwargs):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.02)
+            with lock:
+                running[0] -= 1
+            return int(command.split()[1])
+        mock_submit.side_effect = fake_submit
+        aio.set_concurrency(3)
+
+        async def submit_all():
+            return await asyncio.gather(*[
+                aio.submit('echo {0}'.format(i), jobram=2)
+                for i in range(12)])
+        self.assertListEqual(run(submit_all()), list(range(12)))
+        self.assertEqual(running[1], 3)
+        self.assertEqual(mock_submit.call_args[1]['jobram'], 2)
+
+    def test_run_command(self):
+        result = run(aio.run_command(['cat'], input='hello'))
+        self.assertEqual(result.returncode, 0)
+        self.assertEqual(result.stdout, 'hello')
+        result = run(aio.run_command(['sh', '-c', 'echo oops >&2; exit 3']))
+        self.assertEqual(result.returncode, 3)
+        self.assertEqual(result.stderr, 'oops\n')
+
+
+@patch('fsl_sub.aio.read_config', return_value={'method': 'sge', })
+@patch('fsl_sub.load_plugins')
+class TestStatus(unittest.TestCase):
+    def setUp(self):
+        self.plugin = FakePlugin()
+
+    def test_wait_sync_plugin(self, mock_lp, mock_rc):
+        c = fsl_sub.consts
+        mock_lp.return_value = {'fsl_sub_plugin_sge': self.plugin}
+        self.plugin.job_status = MagicMock(side_effect=[
+            _status(c.RUNNING), _status(c.QUEUED),
+            _status(c.FINISHED), _status(c.FAILED), ])
+        done, not_done = run(aio.wait([1, 2], poll_interval=0.001))
+        self.assertDictEqual(done, {1: c.FINISHED, 2: c.FAILED})
+        self.assertDictEqual(not_done, {})
+
+    def test_wait_async_plugin(self, mock_lp, mock_rc):
+        c = fsl_sub.consts
+        mock_lp.return_value = {'fsl_sub_plugin_sge': self.plugin}
+        queries = []
+
+        async def batch(job_ids):
+            queries.append(list(job_ids))
+            if len(queries) < 3:
+                return {j: _status(c.RUNNING) for j in job_ids}
+            return {j: _status(c.FINISHED) for j in job_ids}
+        self.plugin.job_status_batch_async = batch
+        done, not_done = run(aio.wait(
+            ['5', '6+7@10'], poll_interval=0.001))
+        self.assertDictEqual(done, {'5': c.FINISHED, '6+7@10': c.FINISHED})
+        self.assertListEqual(queries[0], ['5', '6', '7'])
+        with self.subTest('Timeout'):
+            queries.clear()
+            done, not_done = run(aio.wait(
+                5, timeout=0.01, poll_interval=0.1))
+            self.assertDictEqual(done, {})
+            self.assertDictEqual(not_done, {5: c.RUNNING})
+
+    def test_report(self, mock_lp, mock_rc):
+        c = fsl_sub.consts
+        mock_lp.return_value = {'fsl_sub_plugin_sge': self.plugin}
+        queries = []
+
+        async def batch(job_ids):
+            queries.extend(job_ids)
+            return {j: _status(c.QUEUED) for j in job_ids if j != '9'}
+        self.plugin.job_status_batch_async = batch
+        self.assertEqual(
+            run(aio.report(8))['tasks']['1']['status'], c.QUEUED)
+        run(aio.report('8.1', 2))
+        self.assertListEqual(queries, ['8', '8.2'])
+        self.assertRaises(UnknownJobId, run, aio.report(9))
+
+    @patch('fsl_sub.report', autospec=True, return_value={'id': 3})
+    def test_report_sync(self, mock_report, mock_lp, mock_rc):
+        mock_lp.return_value = {'fsl_sub_plugin_sge': self.plugin}
+        self.assertDictEqual(run(aio.report(3, 1)), {'id': 3})
+        mock_report.assert_called_once_with(3, 1)
+
+
+class TestLocalAsync(unittest.TestCase):
+    def test_request_async(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            socket_path = os.path.join(tempdir, 'sched.sock')
+            requests = []
+
+            async def handle(reader, writer):
+                requests.append(json.loads((await reader.read()).decode()))
+                writer.write(json.dumps(
+                    {'ok': True, 'result': {'5': 'queued'}}).encode())
+                await writer.drain()
+                writer.close()
+
+            async def exchange():
+                server = await asyncio.start_unix_server(handle, socket_path)
+                try:
+                    return await request_async(
+                        socket_path, 'status', job_ids=[5])
+                finally:
+                    server.close()
+                    await server.wait_closed()
+            self.assertDictEqual(run(exchange()), {'5': 'queued'})
+            self.assertListEqual(
+                requests, [{'op': 'status', 'job_ids': [5]}])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+import os
+import tempfile
+import unittest
+from unittest.mock import (MagicMock, patch, )
+
+import fsl_sub
+import fsl_sub.consts
+from fsl_sub.arrays import (
+    chunk_specifier,
+    chunk_task,
+    chunk_task_file,
+    composite_id,
+    expand_holds,
+    is_composite,
+    merge_reports,
+    split_composite,
+)
+from fsl_sub.exceptions import BadSubmission
+
+
+def _status(job_id, *states):
+    return {
+        'id': job_id,
+        'name': 'myjob',
+        'tasks': {str(i + 1): {'status': s} for i, s in enumerate(states)},
+    }
+
+
+class FakePlugin(object):
+    pass
+
+
+class TestCompositeIds(unittest.TestCase):
+    def test_composite_id(self):
+        cid = composite_id([(101, 0), (102, 1000), ('103', 2000)])
+        self.assertEqual(cid, '101+102@1000+103@2000')
+        self.assertTrue(is_composite(cid))
+        self.assertFalse(is_composite(101))
+        self.assertFalse(is_composite('101'))
+        self.assertListEqual(
+            split_composite(cid),
+            [('101', 0), ('102', 1000), ('103', 2000)])
+        self.assertRaises(BadSubmission, split_composite, '101+102@x')
+
+    def test_chunk_task(self):
+        cid = '101+102@1000+103@2000'
+        self.assertEqual(chunk_task(cid, 1), ('101', 1))
+        self.assertEqual(chunk_task(cid, 1000), ('101', 1000))
+        self.assertEqual(chunk_task(cid, 1001), ('102', 1))
+        self.assertEqual(chunk_task(cid, '2500'), ('103', 500))
+        self.assertEqual(chunk_task(101, 5), ('101', 5))
+
+    def test_expand_holds(self):
+        self.assertIsNone(expand_holds(None))
+        self.assertEqual(expand_holds(5), 5)
+        self.assertListEqual(expand_holds([5, 6]), [5, 6])
+        self.assertListEqual(expand_holds('1+2@10'), ['1', '2'])
+        self.assertListEqual(expand_holds([5, '1+2@10']), [5, '1', '2'])
+
+
+class TestChunking(unittest.TestCase):
+    def test_chunk_specifier(self):
+        with self.subTest('Small'):
+            self.assertListEqual(chunk_specifier('10', 10), [('10', 0)])
+        # Chunks are renumbered from 1
+        with self.subTest('Count'):
+            self.assertListEqual(
+                chunk_specifier('25', 10),
+                [('1-10', 0), ('1-10', 10), ('1-5', 20)])
+        with self.subTest('Range'):
+            self.assertListEqual(
+                chunk_specifier('5-16', 5),
+                [('1-5', 4), ('1-5', 9), ('1-2', 14)])
+        with self.subTest('Step'):
+            self.assertListEqual(
+                chunk_specifier('1-20:3', 3),
+                [('1-7:3', 0), ('1-7:3', 9), ('1-1:3', 18)])
+
+    def test_chunk_task_file(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            task_file = os.path.join(tempdir, 'tasks')
+            with open(task_file, 'w') as tf:
+                tf.write('\n'.join('cmd {0}'.format(i) for i in range(1, 8)))
+            with self.subTest('Small'):
+                self.assertListEqual(
+                    chunk_task_file(task_file, 7), [(task_file, 0)])
+            with self.subTest('Split'):
+                chunks = chunk_task_file(task_file, 3)
+                self.assertListEqual([o for _, o in chunks], [0, 3, 6])
+                lines = []
+                for chunk_file, offset in chunks:
+                    self.assertEqual(os.path.dirname(chunk_file), tempdir)
+                    with open(chunk_file, 'r') as cf:
+                        c_lines = cf.read().splitlines()
+                    self.assertEqual(c_lines[0], 'cmd {0}'.format(offset + 1))
+                    lines.extend(c_lines)
+                self.assertEqual(len(lines), 7)
+
+    def test_merge_reports(self):
+        c = fsl_sub.consts
+        merged = merge_reports(
+            '1+2@2',
+            [(_status(1, c.FINISHED, c.RUNNING), 0),
+             (_status(2, c.QUEUED), 2)])
+        self.assertEqual(merged['id'], '1+2@2')
+        self.assertEqual(merged['name'], 'myjob')
+        self.assertDictEqual(
+            merged['tasks'],
+            {'1': {'status': c.FINISHED}, '2': {'status': c.RUNNING},
+             '3': {'status': c.QUEUED}})
+
+
+@patch(
+    'fsl_sub.read_config',
+    autospec=True,
+    return_value={'method': 'sge', })
+@patch('fsl_sub.load_plugins', autospec=True)
+class TestCompositeJobs(unittest.TestCase):
+    def setUp(self):
+        c = fsl_sub.consts
+        self.plugin = FakePlugin()
+        self.plugin.already_queued = MagicMock(return_value=False)
+        self.plugin.job_status = MagicMock(
+            side_effect=lambda j, s=None: {
+                '1': _status(1, c.FINISHED, c.FINISHED),
+                '2': _status(2, c.RUNNING)}[j])
+        self.plugin.qdel = MagicMock(side_effect=[('1 deleted', 0), ('', 1)])
+
+    def test_report(self, mock_lp, mock_rc):
+        mock_lp.return_value = {'fsl_sub_plugin_sge': self.plugin}
+        with self.subTest('All tasks'):
+            report = fsl_sub.report('1+2@2')
+            self.assertListEqual(sorted(report['tasks']), ['1', '2', '3'])
+        with self.subTest('One task'):
+            report = fsl_sub.report('1+2@2', 3)
+            self.assertListEqual(list(report['tasks']), ['3'])
+
+    @patch('fsl_sub.time.sleep', autospec=True)
+    def test_wait(self, mock_sleep, mock_lp, mock_rc):
+        c = fsl_sub.consts
+        mock_lp.return_value = {'fsl_sub_plugin_sge': self.plugin}
+        done, not_done = fsl_sub.wait('1+2@2', timeout=0)
+        self.assertDictEqual(done, {})
+        self.assertDictEqual(not_done, {'1+2@2': c.RUNNING})
+
+    @patch('fsl_sub.get_plugin_qdel', autospec=True)
+    def test_delete_job(self, mock_gpq, mock_lp, mock_rc):
+        mock_lp.return_value = {'fsl_sub_plugin_sge': self.plugin}
+        mock_gpq.return_value = self.plugin.qdel
+        self.assertEqual(fsl_sub.delete_job('1+2@2'), ('1 deleted', 1))
+        self.assertListEqual(
+            [a[0][0] for a in self.plugin.qdel.call_args_list], ['1', '2'])
+
+
+class TestSubmitChunks(unittest.TestCase):
+    @patch('fsl_sub.delete_job', autospec=True)
+    def test_submit_chunks(self, mock_dj):
+        chunks = [({'command': 'a'}, 0), ({'command': 'b'}, 10)]
+        with patch('fsl_sub.submit', side_effect=lambda command: {'a': 1, 'b': 2}[command]):
+            self.assertEqual(fsl_sub._submit_chunks(chunks), '1+2@10')
+        mock_dj.assert_not_called()
+
+        def fail_b(command):
+            if command == 'b':
+                raise BadSubmission('Too big')
+            return 1
+        with patch('fsl_sub.submit', side_effect=fail_b):
+            self.assertRaises(BadSubmission, fsl_sub._submit_chunks, chunks)
+        mock_dj.assert_called_once_with(1)
+
+    @patch('fsl_sub.read_config', return_value={'method': 'sge', })
+    @patch('fsl_sub.delete_job', autospec=True)
+    def test_chunk_files(self, mock_dj, mock_rc):
+        with tempfile.TemporaryDirectory() as tempdir:
+            files = [os.path.join(tempdir, f) for f in ('a', 'b', )]
+            chunks = [
+                ({'command': [f], 'name': 'job'}, i * 10)
+                for i, f in enumerate(files)]
+            ids = {files[0]: 1, files[1]: 2, }
+            with patch(
+                    'fsl_sub.submit',
+                    side_effect=lambda command, **kwargs: ids.get(command[-1], 3)
+                    ) as mock_submit:
+                self.assertEqual(
+                    fsl_sub._submit_chunks(chunks, files), '1+2@10')
+            # Removed once all the chunks have finished
+            cleanup = mock_submit.call_args
+            self.assertListEqual(cleanup[0][0], ['rm', '-f', ] + files)
+            self.assertListEqual(cleanup[1]['jobhold'], [1, 2])
+            with self.subTest('Submission failed'):
+                for f in files:
+                    with open(f, 'w'):
+                        pass
+                def fail_b(command, **kwargs):
+                    if command == [files[1]]:
+                        raise BadSubmission('Too big')
+                    return 1
+                with patch('fsl_sub.submit', side_effect=fail_b):
+                    self.assertRaises(
+                        BadSubmission, fsl_sub._submit_chunks, chunks, files)
+                self.assertListEqual(os.listdir(tempdir), [])
+            with self.subTest('Shell'):
+                mock_rc.return_value = {'method': 'shell', }
+                for f in files:
+                    with open(f, 'w'):
+                        pass
+                with patch('fsl_sub.submit', side_effect=[1, 2]):
+                    fsl_sub._submit_chunks(chunks, files)
+                # Already run, so removed immediately
+                self.assertListEqual(os.listdir(tempdir), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+import io
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from fsl_sub import audit
+from fsl_sub.cmdline import stats_cmd
+
+
+class TestAudit(unittest.TestCase):
+    def setUp(self):
+        self.tempd = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tempd.cleanup)
+        self.log = os.path.join(self.tempd.name, 'audit.log')
+        submissions = [
+            (100, 'alice', 1, 'short.q', 1, 4, 30, None, 'bet'),
+            (200, 'alice', 2, 'short.q', 2, 8, 60, None, 'bet'),
+            (300, 'bob', 3, 'long.q', 4, 16, 600, None, 'feat'),
+            (400, 'bob', 4, 'gpu.q', 1, 32, None, 'cuda', 'eddy_cuda'),
+            (500, 'alice', 5, 'short.q', 1, None, 30, None, 'fast'),
+        ]
+        for s in submissions:
+            audit.append(audit.pack(*s, method='sge'), self.log)
+
+    def test_records(self):
+        recs = list(audit.records(self.log))
+        self.assertEqual(len(recs), 5)
+        first = dict(zip(audit.FIELDS, recs[0]))
+        self.assertEqual(first['time'], 100)
+        self.assertEqual(first['user'].rstrip(b'\0'), b'alice')
+        self.assertEqual(first['queue'].rstrip(b'\0'), b'short.q')
+        self.assertEqual(first['jobram'], 4)
+        with self.subTest('Partial record'):
+            with open(self.log, 'ab') as lf:
+                lf.write(b'\1' * 10)
+            self.assertEqual(len(list(audit.records(self.log))), 5)
+        with self.subTest('Not a log'):
+            with open(self.log, 'r+b') as lf:
+                lf.write(b'NOTALOG!')
+            self.assertRaises(ValueError, list, audit.records(self.log))
+
+    def test_truncation(self):
+        rec = audit.pack(1, 'u' * 40, 1, 'q', 1, 1, 1, None, 'é' * 20)
+        fields = dict(zip(audit.FIELDS, audit.RECORD.unpack(rec)))
+        self.assertEqual(fields['user'], b'u' * 16)
+        # Multi-byte characters are not split
+        self.assertEqual(fields['command'].rstrip(b'\0').decode(), 'é' * 16)
+
+    def test_aggregate(self):
+        stats = audit.aggregate(self.log)
+        self.assertListEqual(list(stats), ['short.q', 'long.q', 'gpu.q'])
+        short = stats['short.q']
+        self.assertEqual(short['jobs'], 3)
+        self.assertEqual(short['slots']['max'], 2)
+        self.assertEqual(short['jobram']['median'], 4)
+        self.assertEqual(short['jobram']['max'], 8)
+        self.assertEqual(short['jobtime']['p90'], 60)
+        self.assertListEqual(
+            list(audit.aggregate(self.log, by='command', user='bob')),
+            ['feat', 'eddy_cuda'])
+        self.assertDictEqual(
+            {k: v['jobs'] for k, v in audit.aggregate(
+                self.log, by='user', since=200, until=500).items()},
+            {'alice': 1, 'bob': 2})
+        self.assertListEqual(
+            list(audit.aggregate(self.log, by='coprocessor')), ['', 'cuda'])
+
+    def test_record(self):
+        with patch.dict(os.environ, {'FSLSUB_AUDIT_LOG': self.log}):
+            audit.record(
+                '6+7@10', 'short.q', 1, None, None, None, ['/usr/bin/mcflirt', '-in', 'x'],
+                'sge', array_task=True)
+        rec = dict(zip(audit.FIELDS, list(audit.records(self.log))[-1]))
+        self.assertEqual(rec['command'].rstrip(b'\0'), b'mcflirt')
+        self.assertEqual(rec['job_id'].rstrip(b'\0'), b'6+7@10')
+        self.assertTrue(rec['array_task'])
+        with patch.dict(os.environ, {'FSLSUB_AUDIT_LOG': ''}):
+            with patch('fsl_sub.audit.read_config', return_value={}):
+                audit.record(8, 'q', 1, None, None, None, 'x', 'sge')
+        self.assertEqual(len(list(audit.records(self.log))), 6)
+
+    def test_stats_cmd(self):
+        with patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            stats_cmd(['--log', self.log, '--by', 'user'])
+        lines = stdout.getvalue().splitlines()
+        self.assertTrue(lines[0].startswith('User'))
+        self.assertTrue(lines[1].startswith('alice'))
+        self.assertIn('4/8/8', lines[1])
+        with patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            stats_cmd(['--log', self.log, '--json', '--since', '1970-01-02'])
+        self.assertDictEqual(json.loads(stdout.getvalue()), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+import io
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from fsl_sub import benchmarks
+
+
+def _results(**medians):
+    return {'scenarios': {
+        n: {'median': m, 'min': m, 'stdev': 0.0} for n, m in medians.items()}}
+
+
+class TestBenchmarks(unittest.TestCase):
+    def test_summarise(self):
+        summary = benchmarks.summarise([3.0, 1.0, 2.0])
+        self.assertEqual(summary['repeats'], 3)
+        self.assertEqual(summary['min'], 1.0)
+        self.assertEqual(summary['median'], 2.0)
+        self.assertEqual(summary['stdev'], 1.0)
+        self.assertEqual(benchmarks.summarise([1.0])['stdev'], 0.0)
+
+    def test_compare(self):
+        comparison = benchmarks.compare(
+            _results(a=1.05, b=1.5, c=1.0), _results(a=1.0, b=1.0))
+        self.assertListEqual(
+            [(c[0], c[4]) for c in comparison], [('a', False), ('b', True)])
+        self.assertAlmostEqual(comparison[1][3], 1.5)
+
+    def test_run_scenario(self):
+        result = benchmarks.run_scenario('queue_selection', repeat=2, scale=0.1)
+        self.assertEqual(result['repeats'], 2)
+        self.assertEqual(len(result['times']), 2)
+
+    def test_main(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            output = os.path.join(tempdir, 'results.json')
+            baseline = os.path.join(tempdir, 'baseline.json')
+            with open(baseline, 'w') as b:
+                json.dump(_results(queue_selection=1e-9), b)
+            args = [
+                'queue_selection', '--repeat', '1', '--scale', '0.1',
+                '--output', output, '--baseline', baseline]
+            with patch('sys.stdout', new_callable=io.StringIO) as stdout:
+                with patch('sys.stderr', new_callable=io.StringIO):
+                    with self.assertRaises(SystemExit) as exit:
+                        benchmarks.main(args)
+            self.assertEqual(exit.exception.code, 1)
+            self.assertIn('REGRESSION', stdout.getvalue())
+            with open(output, 'r') as o:
+                results = json.load(o)
+            self.assertListEqual(
+                list(results['scenarios']), ['queue_selection'])
+
+
+if __name__ == '__main__':
+    unittest.main()
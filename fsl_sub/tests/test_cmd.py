@@ -454,7 +454,9 @@ class TestMain(unittest.TestCase):
             'usescript': False,
             'validate_command': True,
             'as_tuple': False,
-            'project': None
+            'project': None,
+            'skip_completed': False,
+            'idempotency_key': None
         }
 
     def test_noramsplit(self, *args):
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+import gzip
+import io
+import os
+import subprocess
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import fsl_sub.utils
+from fsl_sub import compression
+from fsl_sub import tasklogs
+from fsl_sub.cmdline import logs_cmd
+from fsl_sub.exceptions import BadConfiguration
+
+
+class TestCompression(unittest.TestCase):
+    def setUp(self):
+        self.tempd = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tempd.cleanup)
+        self.text = b''.join(
+            'line {0}\n'.format(i).encode() for i in range(20000))
+
+    def log(self, name, text):
+        path = os.path.join(self.tempd.name, name)
+        with open(path, 'wb') as lf:
+            lf.write(text)
+        return path
+
+    def test_log_compression(self):
+        with patch.dict(os.environ, {'FSLSUB_LOG_COMPRESSION': 'gzip'}):
+            self.assertEqual(compression.log_compression(), 'gzip')
+        with patch.dict(os.environ, {'FSLSUB_LOG_COMPRESSION': ''}):
+            self.assertIsNone(compression.log_compression())
+        with patch.dict(os.environ, {'FSLSUB_LOG_COMPRESSION': 'bzip2'}):
+            self.assertRaises(BadConfiguration, compression.log_compression)
+        with patch.dict(os.environ, {'FSLSUB_LOG_COMPRESSION': 'zstd'}):
+            with patch('fsl_sub.compression.zstandard', None):
+                self.assertEqual(compression.log_compression(), 'gzip')
+
+    def test_compress_file(self):
+        path = self.log('job.o1', self.text)
+        compressed = compression.compress_file(path, 'gzip')
+        self.assertEqual(compressed, path + '.gz')
+        self.assertFalse(os.path.exists(path))
+        with gzip.open(compressed, 'rb') as gf:
+            self.assertEqual(gf.read(), self.text)
+        out = io.BytesIO()
+        compression.open_log(compressed, out, chunk=1000)
+        self.assertEqual(out.getvalue(), self.text)
+        # Missing files and /dev/null are skipped
+        compression.compress_logs([path, '/dev/null'], 'gzip')
+
+    def test_epilogue(self):
+        out = self.log('job.o5', b'output\n')
+        err = self.log('job.e5', b'')
+        script = fsl_sub.utils.job_script(
+            'sh -c "exit 3"', [], '#$', ('sge', '1.0.0'),
+            epilogue=compression.epilogue(
+                'gzip', ['$LOGDIR/job.o$JOB_ID', '$LOGDIR/job.e$JOB_ID']))
+        result = subprocess.run(
+            ['bash', '-c', '\n'.join(script)],
+            env=dict(os.environ, LOGDIR=self.tempd.name, JOB_ID='5'))
+        self.assertEqual(result.returncode, 3)
+        self.assertListEqual(
+            sorted(os.listdir(self.tempd.name)), ['job.e5.gz', 'job.o5.gz'])
+        with gzip.open(out + '.gz') as gf:
+            self.assertEqual(gf.read(), b'output\n')
+        with gzip.open(err + '.gz') as gf:
+            self.assertEqual(gf.read(), b'')
+
+    def test_tasklogs(self):
+        data = os.path.join(self.tempd.name, 'sweep.o7')
+        tasklogs.create(data, 'gzip')
+        tasklogs.append(data, io.BytesIO(self.text), 2, 'gzip')
+        tasklogs.append(data, io.BytesIO(b'one\n'), 1, 'gzip')
+        self.assertLess(tasklogs.entry(data, 2)[1], len(self.text) // 4)
+        out = io.BytesIO()
+        tasklogs.read(data, 2, out, chunk=100)
+        self.assertEqual(out.getvalue(), self.text)
+
+    def test_logs_cmd(self):
+        compression.compress_file(self.log('sweep.o9.1', b'one\n'), 'gzip')
+        self.log('sweep.o9.2', b'two\n')
+        self.log('sweep.e9.1', b'err\n')
+
+        def run(*args):
+            stdout = io.TextIOWrapper(io.BytesIO())
+            with patch('sys.stdout', stdout):
+                logs_cmd(['--logdir', self.tempd.name] + list(args))
+            return stdout.buffer.getvalue()
+        self.assertEqual(run('9'), b'one\ntwo\n')
+        self.assertEqual(run('9', '1'), b'one\n')
+        self.assertEqual(run('9', '--stderr'), b'err\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,12 @@
 #!/usr/bin/env python
 import unittest
 import fsl_sub.config
+import json
 import os
 import shutil
 import subprocess
 import tempfile
+import time
 
 from ruamel.yaml import YAML
 from unittest.mock import patch
@@ -88,6 +90,144 @@ class TestConfig(unittest.TestCase):
         finally:
             shutil.rmtree(test_dir)
 
+    @patch('fsl_sub.config.os.path.expanduser', autospec=True)
+    @patch(
+        'fsl_sub.config._default_layers',
+        autospec=True,
+        return_value=[
+            ('defaults', None, {
+                'method': 'shell', 'dedup_window': 3600, 'live_queue_ttl': 0,
+                'method_opts': {'shell': {'run_parallel': True}}, }, ), ])
+    def test_layered_config(self, mock_dl, mock_expanduser):
+        with tempfile.TemporaryDirectory() as test_dir:
+            site_dir = os.path.join(test_dir, 'etc', 'fslconf')
+            os.makedirs(site_dir)
+            site = os.path.join(site_dir, 'fsl_sub.yml')
+            user = os.path.join(test_dir, '.fsl_sub.yml')
+            env = os.path.join(test_dir, 'env.yml')
+            with open(site, 'w') as f:
+                f.write("method: sge\nqueues:\n  short.q:\n    time: 60\n")
+            with open(user, 'w') as f:
+                f.write("method_opts:\n  shell:\n    run_parallel: false\n")
+            with open(env, 'w') as f:
+                f.write("dedup_window: 0\n")
+            mock_expanduser.return_value = test_dir
+            with patch.dict(
+                    'fsl_sub.config.os.environ',
+                    {'FSLDIR': test_dir, 'FSLSUB_CONF': env, },
+                    clear=True):
+                self.assertListEqual(
+                    [layer for layer, _ in fsl_sub.config.config_files()],
+                    ['site', 'user', 'FSLSUB_CONF', ])
+                self.assertEqual(fsl_sub.config.find_config_file(), env)
+                fsl_sub.config.read_config.cache_clear()
+                try:
+                    config = fsl_sub.config.read_config()
+                finally:
+                    fsl_sub.config.read_config.cache_clear()
+                self.assertEqual(
+                    config,
+                    {
+                        'method': 'sge', 'dedup_window': 0, 'live_queue_ttl': 0,
+                        'method_opts': {'shell': {'run_parallel': False}},
+                        'queues': {'short.q': {'time': 60}}, })
+                provenance = fsl_sub.config.config_provenance()
+            self.assertEqual(
+                provenance[('method', )], ('site', os.path.realpath(site)))
+            self.assertEqual(
+                provenance[('method_opts', 'shell', 'run_parallel')],
+                ('user', user))
+            self.assertEqual(
+                fsl_sub.config.value_origin(
+                    provenance, ('queues', 'short.q', 'time')),
+                ('site', os.path.realpath(site)))
+            self.assertEqual(
+                provenance[('dedup_window', )], ('FSLSUB_CONF', env))
+            annotated = fsl_sub.config.annotated_config(config, provenance)
+            self.assertEqual(annotated, config)
+            self.assertIn(
+                'FSLSUB_CONF', annotated.ca.items['dedup_window'][2].value)
+
+    def test_layered_view(self):
+        site = {
+            'export_vars': ['A'], 'method': 'sge',
+            'queues': {'short.q': {'time': 60}, 'long.q': {'time': 600}}, }
+        user = {'queues': {'long.q': {'time': 1200}}, 'method': 'slurm', }
+        live = {'queues': {'long.q': {'max_size': 64}}, }
+        layers = [('site', 's', site, ), ('user', 'u', user, )]
+        config = fsl_sub.config.LayeredConfig(
+            layers, replace=fsl_sub.config.REPLACED_SETTINGS)
+        with self.subTest("Queues replaced"):
+            self.assertEqual(config['queues'], {'long.q': {'time': 1200}})
+            provenance = config.provenance()
+            self.assertEqual(
+                fsl_sub.config.value_origin(
+                    provenance, ('queues', 'long.q', 'time')), ('user', 'u'))
+            self.assertNotIn(('queues', 'short.q', ), provenance)
+            self.assertEqual(provenance[('method', )], ('user', 'u'))
+        with self.subTest("Queues updated"):
+            updated = fsl_sub.config.LayeredConfig(
+                layers + [('live queues', 'l', live, )],
+                replace=fsl_sub.config.REPLACED_SETTINGS,
+                updates=fsl_sub.config.UPDATE_LAYERS)
+            self.assertEqual(
+                updated['queues'], {'long.q': {'time': 1200, 'max_size': 64}})
+        with self.subTest("Queues merged"):
+            merged = fsl_sub.config.LayeredConfig(layers)
+            self.assertEqual(
+                merged['queues'],
+                {'short.q': {'time': 60}, 'long.q': {'time': 1200}})
+            self.assertListEqual(
+                list(merged), ['export_vars', 'method', 'queues', ])
+        with self.subTest("Values shared, layers unchanged"):
+            self.assertIs(merged['export_vars'], site['export_vars'])
+            merged['queues']['short.q']['time'] = 1
+            merged['method'] = 'shell'
+            del merged['export_vars']
+            self.assertEqual(merged['queues']['short.q']['time'], 1)
+            self.assertEqual(merged['method'], 'shell')
+            self.assertNotIn('export_vars', merged)
+            self.assertEqual(site['queues']['short.q']['time'], 60)
+            self.assertEqual(user['method'], 'slurm')
+            self.assertIn('export_vars', site)
+        with self.subTest("Stacked views"):
+            stacked = fsl_sub.config.LayeredConfig(
+                [('defaults', None, fsl_sub.config.LayeredConfig(layers), ),
+                 ('FSLSUB_CONF', 'e', {'method': 'pbs'}, )])
+            self.assertEqual(
+                stacked.provenance()[('export_vars', )], ('site', 's'))
+            self.assertEqual(stacked['method'], 'pbs')
+
+    @patch('fsl_sub.config.available_plugins', autospec=True)
+    @patch('fsl_sub.config.get_plugin_default_conf', autospec=True)
+    @patch('fsl_sub.config._file_layers', autospec=True)
+    def test_plugin_defaults_on_demand(self, mock_fl, mock_gpdc, mock_ap):
+        mock_ap.return_value = ['shell', 'sge', 'slurm', ]
+        mock_gpdc.side_effect = lambda p: (
+            "method_opts:\n  {0}:\n    queues: {1}\n".format(
+                p, p != 'shell'))
+        mock_fl.return_value = [
+            ('site', '/etc/fsl_sub.yml', {
+                'method': 'sge', 'queues': {},
+                'method_opts': {'slurm': {'projects': True}}, }, ), ]
+        fsl_sub.config.read_config.cache_clear()
+        self.addCleanup(fsl_sub.config.read_config.cache_clear)
+        config = fsl_sub.config.read_config()
+        self.assertListEqual(
+            sorted(config['method_opts']), ['sge', 'slurm', ])
+        self.assertEqual(
+            config['method_opts']['slurm'],
+            {'queues': True, 'projects': True})
+        self.assertListEqual(
+            sorted(c[0][0] for c in mock_gpdc.call_args_list),
+            ['sge', 'slurm', ])
+        self.assertDictEqual(
+            fsl_sub.config.method_config('shell'), {'queues': False})
+        fsl_sub.config.method_config('shell')
+        self.assertEqual(mock_gpdc.call_count, 3)
+        with self.assertRaises(fsl_sub.config.BadConfiguration):
+            fsl_sub.config.method_config('pbs')
+
     @patch('fsl_sub.config.get_plugin_default_conf')
     @patch('fsl_sub.config._internal_config_file')
     @patch('fsl_sub.config.get_plugin_queue_defs', return_value='')
@@ -244,8 +384,8 @@ method_opts:
         'fsl_sub.config.load_default_config',
         autospec=True,
         return_value={'bdict': "somevalue", })
-    @patch('fsl_sub.config.find_config_file', autospec=True)
-    def test_read_config_merge(self, mock_find_config_file, mock_ldc):
+    @patch('fsl_sub.config.config_files', autospec=True)
+    def test_read_config_merge(self, mock_config_files, mock_ldc):
         fsl_sub.config.read_config.cache_clear()
         example_yaml = '''
 adict:
@@ -254,11 +394,11 @@ adict:
         - 2
     astring: hello
 '''
-        mock_find_config_file.return_value = '/etc/fsl_sub.conf'
+        mock_config_files.return_value = [('site', '/etc/fsl_sub.conf', )]
         with patch(
                 'fsl_sub.config.open',
                 unittest.mock.mock_open(read_data=example_yaml)) as m:
-            self.assertDictEqual(
+            self.assertEqual(
                 fsl_sub.config.read_config(),
                 {
                     'adict': {
@@ -313,7 +453,7 @@ method_opts:
             mock_ap.return_value = ['shell', 'sge', ]
             mock__icf.return_value = ntf.name
             mock_gpec.side_effect = plugins
-            self.assertDictEqual(fsl_sub.config.load_default_config(), expected_config)
+            self.assertEqual(fsl_sub.config.load_default_config(), expected_config)
             mock_ap.reset_mock()
             mock__icf.reset_mock()
             mock_gpec.reset_mock()
@@ -322,8 +462,8 @@ method_opts:
         'fsl_sub.config.load_default_config',
         autospec=True,
         return_value={})
-    @patch('fsl_sub.config.find_config_file', autospec=True)
-    def test_read_config(self, mock_find_config_file, mock_ldc):
+    @patch('fsl_sub.config.config_files', autospec=True)
+    def test_read_config(self, mock_config_files, mock_ldc):
         with self.subTest("Test good read"):
             fsl_sub.config.read_config.cache_clear()
             example_yaml = '''
@@ -333,11 +473,11 @@ adict:
         - 2
     astring: hello
 '''
-            mock_find_config_file.return_value = '/etc/fsl_sub.conf'
+            mock_config_files.return_value = [('site', '/etc/fsl_sub.conf', )]
             with patch(
                     'fsl_sub.config.open',
                     unittest.mock.mock_open(read_data=example_yaml)) as m:
-                self.assertDictEqual(
+                self.assertEqual(
                     fsl_sub.config.read_config(),
                     {'adict': {
                         'alist': [1, 2],
@@ -522,6 +662,58 @@ adict:
             self.assertTrue(fsl_sub.config.has_queues())
             self.assertTrue(fsl_sub.config.has_queues('shell'))
 
+    @patch('fsl_sub.config.get_plugin_already_queued', autospec=True, return_value=False)
+    @patch('fsl_sub.config.read_config', autospec=True)
+    def test_has_coprocessors_cached(self, mock_rc, mock_gpaq):
+        with tempfile.TemporaryDirectory() as tempdir:
+            tester = os.path.join(tempdir, 'gpu-test')
+            runs = os.path.join(tempdir, 'runs')
+            with open(tester, 'w') as tf:
+                tf.write('#!/bin/sh\necho run >> {0}\n'.format(runs))
+            os.chmod(tester, 0o755)
+            boot_id = os.path.join(tempdir, 'boot_id')
+            with open(boot_id, 'w') as bf:
+                bf.write('boot-1\n')
+            mock_rc.return_value = {
+                'method': 'shell',
+                'queues': {},
+                'coproc_opts': {
+                    'cuda': {'presence_test': tester},
+                    'phi': {'presence_test': tester},
+                    'fpga': {'presence_test': 'not-a-program'}, },
+            }
+
+            def run_count():
+                with open(runs) as rf:
+                    return len(rf.readlines())
+            with patch.dict(
+                    'fsl_sub.config.os.environ',
+                    {'FSLSUB_STATE_DIR': tempdir, }), patch(
+                    'fsl_sub.config.BOOT_ID', boot_id):
+                with self.subTest("Bulk query"):
+                    self.assertDictEqual(
+                        fsl_sub.config.has_coprocessors(
+                            ['cuda', 'phi', 'fpga', 'tpu', ]),
+                        {'cuda': True, 'phi': True, 'fpga': False,
+                         'tpu': False, })
+                    self.assertEqual(run_count(), 1)
+                with self.subTest("Cached"):
+                    self.assertTrue(fsl_sub.config.has_coprocessor('cuda'))
+                    self.assertEqual(run_count(), 1)
+                with self.subTest("Reboot"):
+                    with open(boot_id, 'w') as bf:
+                        bf.write('boot-2\n')
+                    self.assertTrue(fsl_sub.config.has_coprocessor('cuda'))
+                    self.assertEqual(run_count(), 2)
+                with self.subTest("Test changed"):
+                    os.utime(tester, (0, 0))
+                    self.assertTrue(fsl_sub.config.has_coprocessor('cuda'))
+                    self.assertEqual(run_count(), 3)
+                with self.subTest("Expired"):
+                    mock_rc.return_value['coproc_presence_ttl'] = 0
+                    self.assertTrue(fsl_sub.config.has_coprocessor('cuda'))
+                    self.assertEqual(run_count(), 4)
+
     @patch('fsl_sub.config.get_plugin_already_queued', autospec=True)
     @patch('fsl_sub.config.read_config', autospec=True)
     @patch('fsl_sub.config.sp.run', autospec=True)
@@ -625,5 +817,109 @@ adict:
             )
 
 
+class TestQueueOverlay(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+        env = patch.dict(
+            'fsl_sub.config.os.environ',
+            {'FSLSUB_STATE_DIR': self.tempdir.name, })
+        env.start()
+        self.addCleanup(env.stop)
+        self.config = {
+            'method': 'slurm',
+            'live_queue_ttl': 3600,
+            'queues': {
+                'short.q': {'time': 60, 'max_size': 32, 'map_ram': True},
+                'long.q': {'time': 600, 'max_size': 32}, }, }
+
+    def _store(self, age, queues):
+        overlay_file = fsl_sub.config._queue_overlay_file('slurm')
+        with open(overlay_file, 'w') as f:
+            json.dump({'time': time.time() - age, 'queues': queues}, f)
+
+    @patch('fsl_sub.config.get_plugin_live_queue_defs', autospec=True)
+    def test_refresh(self, mock_glqd):
+        mock_glqd.return_value = {
+            'short.q': {'time': 120, 'max_size': 64, 'parallel_envs': ['smp']},
+            'new.q': {'time': 10}, }
+        lock = fsl_sub.config._queue_overlay_file('slurm') + '.lock'
+        self.assertDictEqual(
+            fsl_sub.config.refresh_queue_overlay('slurm'),
+            {'short.q': {'time': 120, 'max_size': 64}, 'new.q': {'time': 10}})
+        self.assertFalse(os.path.exists(lock))
+        stored, queues = fsl_sub.config._load_queue_overlay('slurm')
+        self.assertAlmostEqual(stored, time.time(), delta=60)
+        self.assertDictEqual(queues['short.q'], {'time': 120, 'max_size': 64})
+        with self.subTest("Refresh running"):
+            open(lock, 'w').close()
+            with self.assertRaises(fsl_sub.config.CommandError):
+                fsl_sub.config.refresh_queue_overlay('slurm')
+            # Another refresher's lock is left alone
+            self.assertTrue(os.path.exists(lock))
+        with self.subTest("Stale lock"):
+            os.utime(lock, (0, 0))
+            fsl_sub.config.refresh_queue_overlay('slurm')
+            self.assertFalse(os.path.exists(lock))
+        with self.subTest("No live limits"):
+            mock_glqd.return_value = None
+            self.assertDictEqual(
+                fsl_sub.config.refresh_queue_overlay('local'), {})
+            self.assertEqual(
+                fsl_sub.config._load_queue_overlay('local'), (None, {}))
+
+    def test_overlay_layer(self):
+        with self.subTest("No overlay"):
+            self.assertIsNone(
+                fsl_sub.config._queue_overlay_layer(self.config))
+        with self.subTest("Fresh"):
+            self._store(10, {
+                'short.q': {'time': 120}, 'new.q': {'time': 10}})
+            layer, _, values = fsl_sub.config._queue_overlay_layer(self.config)
+            self.assertEqual(layer, 'live queues')
+            self.assertDictEqual(values, {'queues': {'short.q': {'time': 120}}})
+        with self.subTest("Expired"):
+            self._store(4000, {'short.q': {'time': 120}})
+            self.assertIsNone(
+                fsl_sub.config._queue_overlay_layer(self.config))
+        with self.subTest("Disabled"):
+            self._store(10, {'short.q': {'time': 120}})
+            self.assertIsNone(fsl_sub.config._queue_overlay_layer(
+                dict(self.config, live_queue_ttl=0)))
+            self.assertIsNone(fsl_sub.config._queue_overlay_layer(
+                dict(self.config, method='shell')))
+            no_ttl = dict(self.config)
+            del no_ttl['live_queue_ttl']
+            self.assertIsNone(fsl_sub.config._queue_overlay_layer(no_ttl))
+
+    @patch('fsl_sub.config.sp.Popen', autospec=True)
+    @patch('fsl_sub.config._file_layers', autospec=True)
+    @patch('fsl_sub.config.load_default_config', autospec=True)
+    def test_read_config(self, mock_ldc, mock_fl, mock_popen):
+        mock_ldc.return_value = {'method': 'shell', 'live_queue_ttl': 3600}
+        mock_fl.return_value = [('site', '/etc/fsl_sub.yml', self.config, )]
+        self._store(10, {'short.q': {'time': 120, 'max_size': 64}})
+        fsl_sub.config.read_config.cache_clear()
+        try:
+            config = fsl_sub.config.read_config()
+        finally:
+            fsl_sub.config.read_config.cache_clear()
+        self.assertEqual(
+            config['queues']['short.q'],
+            {'time': 120, 'max_size': 64, 'map_ram': True})
+        self.assertEqual(config['queues']['long.q'], {'time': 600, 'max_size': 32})
+        # The configuration file's definition is unchanged
+        self.assertEqual(self.config['queues']['short.q']['time'], 60)
+        # Loading the configuration never queries the scheduler
+        self._store(100000, {'short.q': {'time': 120}})
+        fsl_sub.config.read_config.cache_clear()
+        try:
+            config = fsl_sub.config.read_config()
+        finally:
+            fsl_sub.config.read_config.cache_clear()
+        self.assertEqual(config['queues']['short.q']['time'], 60)
+        mock_popen.assert_not_called()
+
+
 if __name__ == '__main__':
     unittest.main()
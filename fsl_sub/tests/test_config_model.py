@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+import os
+import unittest
+import warnings
+from unittest.mock import patch
+
+from ruamel.yaml import YAML
+
+import fsl_sub.config_model as config_model
+from fsl_sub.config_model import (
+    CoprocessorSpec,
+    MethodOptions,
+    QueueSpec,
+    coprocessor_spec,
+    method_options,
+    queue_specs,
+)
+from fsl_sub.config import (LayeredConfig, read_config, )
+from fsl_sub.exceptions import BadConfiguration
+
+
+class TestQueueSpec(unittest.TestCase):
+    def setUp(self):
+        config_model._compiled.clear()
+
+    def test_defaults(self):
+        q = QueueSpec('short.q', {'time': 60, 'max_size': 16, 'slot_size': 4, 'max_slots': 4})
+        self.assertEqual(q.time, 60)
+        self.assertEqual(q.priority, 1)
+        self.assertIsNone(q.group)
+        self.assertFalse(q.default)
+        self.assertTupleEqual(q.parallel_envs, ())
+        self.assertDictEqual(dict(q.copros), {})
+        # Dictionary view of the definition
+        self.assertEqual(q['slot_size'], 4)
+        self.assertNotIn('group', q)
+        self.assertIsNone(q.get('group'))
+        with self.assertRaises(AttributeError):
+            q.time = 1
+        with self.assertRaises(AttributeError):
+            q.other = 1
+
+    def test_typo(self):
+        with self.assertRaises(BadConfiguration) as e:
+            QueueSpec('short.q', {'time': 60, 'patallel_envs': ['openmp']})
+        self.assertIn("did you mean 'parallel_envs'", str(e.exception))
+        # Options unlike any known one are left for plugins
+        QueueSpec('short.q', {'time': 60, 'partition_features': 'x'})
+
+    def test_types(self):
+        with self.assertRaises(BadConfiguration):
+            QueueSpec('short.q', {'time': '1h'})
+        with self.assertRaises(BadConfiguration):
+            QueueSpec('short.q', {'copros': {'cuda': {'max_quantity': 'two'}}})
+        with self.assertRaises(BadConfiguration):
+            QueueSpec('short.q', ['time'])
+
+    def test_queue_specs(self):
+        queues = {'a.q': {'time': 60}, 'b.q': {'time': 120}}
+        specs = queue_specs(queues)
+        self.assertListEqual(list(specs), ['a.q', 'b.q'])
+        self.assertEqual(specs['b.q'].time, 120)
+        self.assertIs(queue_specs(queues), specs)
+        self.assertIs(queue_specs(specs), specs)
+        self.assertIsNot(queue_specs(dict(queues)), specs)
+        with self.subTest('Invalidated'):
+            queues['b.q']['time'] = 180
+            config_model.invalidate()
+            self.assertEqual(queue_specs(queues)['b.q'].time, 180)
+        with self.subTest('Configuration changed'):
+            config = LayeredConfig([('site', None, {'queues': queues}, )])
+            specs = queue_specs(config['queues'])
+            self.assertIs(queue_specs(config['queues']), specs)
+            config['queues']['b.q']['time'] = 240
+            self.assertEqual(queue_specs(config['queues'])['b.q'].time, 240)
+            config['queues']['c.q'] = {'time': 10}
+            self.assertListEqual(
+                list(queue_specs(config['queues'])), ['a.q', 'b.q', 'c.q'])
+            # Assigning the same value keeps the compiled views
+            specs = queue_specs(config['queues'])
+            config['queues']['c.q'] = {'time': 10}
+            self.assertIs(queue_specs(config['queues']), specs)
+        with self.subTest('Configuration re-read'):
+            with patch('fsl_sub.config._file_layers', return_value=[]):
+                read_config.cache_clear()
+                self.addCleanup(read_config.cache_clear)
+                read_config()
+            self.assertDictEqual(config_model._compiled, {})
+            self.assertIsNot(queue_specs(config['queues']), specs)
+
+    def test_example_config(self):
+        example = os.path.join(
+            os.path.dirname(os.path.dirname(__file__)),
+            'example_queue_config.yml')
+        with open(example) as f:
+            queues = YAML(typ='safe').load(f)['queues']
+        specs = queue_specs(queues)
+        self.assertTupleEqual(specs['long'].parallel_envs, ('openmp', ))
+
+
+class TestMethodOptions(unittest.TestCase):
+    def setUp(self):
+        config_model._compiled.clear()
+
+    def test_unset_false(self):
+        m = MethodOptions('shell', {'run_parallel': True})
+        self.assertTrue(m['run_parallel'])
+        self.assertTrue(m.run_parallel)
+        self.assertFalse(m['parallel_disable_matches'])
+        self.assertFalse(m.keep_jobscript)
+        self.assertTrue(m.get('keep_jobscript', True))
+        self.assertNotIn('keep_jobscript', m)
+
+    def test_typo_warns(self):
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter('always')
+            MethodOptions('shell', {'run_paralel': True})
+        self.assertIn("did you mean 'run_parallel'", str(w[0].message))
+        with self.assertRaises(BadConfiguration):
+            MethodOptions('sge', {'max_array_size': 'many'})
+
+    def test_compiled_once(self):
+        opts = {'map_ram': True}
+        self.assertIs(method_options('sge', opts), method_options('sge', opts))
+        opts['map_ram'] = False
+        self.assertFalse(method_options('sge', opts).map_ram)
+
+
+class TestCoprocessorSpec(unittest.TestCase):
+    def setUp(self):
+        config_model._compiled.clear()
+
+    def test_spec(self):
+        opts = {
+            'resource': 'gpu', 'classes': True, 'uses_pe': 'gpu_pe',
+            'class_types': {'K': {'capability': 1}, 'P': {'capability': 2}},
+            'default_class': 'K', }
+        cp = coprocessor_spec('cuda', opts)
+        self.assertEqual(cp.uses_pe, 'gpu_pe')
+        self.assertTrue(cp.include_more_capable)
+        self.assertIs(coprocessor_spec('cuda', opts), cp)
+
+    def test_invalid(self):
+        with self.assertRaises(BadConfiguration):
+            CoprocessorSpec('cuda', {'users_modules': True})
+        with self.assertRaises(BadConfiguration):
+            CoprocessorSpec(
+                'cuda', {'classes': True, 'default_class': 'V',
+                         'class_types': {'K': {'capability': 1}}})
+        with self.assertRaises(BadConfiguration):
+            CoprocessorSpec('cuda', {'class_types': {'K': {'capability': 'x'}}})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,6 +2,7 @@
 import unittest
 import fsl_sub.coprocessors
 import fsl_sub.config
+import fsl_sub.exceptions
 
 from ruamel.yaml import YAML
 from unittest.mock import patch
@@ -145,6 +146,7 @@ coproc_opts:
 class TestCoprocessors(unittest.TestCase):
     def setUp(self):
         fsl_sub.config.read_config.cache_clear()
+        fsl_sub.coprocessors._catalogs.clear()
         global test_config
         patcher = patch(
             'fsl_sub.config.read_config', autospec=True)
@@ -194,6 +196,45 @@ class TestCoprocessors(unittest.TestCase):
             )
             mock_get_modules.assert_called_once_with('cuda')
 
+    def test_coproc_class(self):
+        self.assertListEqual(
+            fsl_sub.coprocessors.coproc_class('P', ['K', 'P', 'V', ]),
+            ['P', 'V', ])
+        self.assertRaises(
+            fsl_sub.exceptions.BadConfiguration,
+            fsl_sub.coprocessors.coproc_class, 'G', ['K', 'P', 'V', ])
+
+    @patch('fsl_sub.coprocessors.get_modules', autospec=True)
+    def test_catalog(self, mock_get_modules):
+        mock_get_modules.return_value = ['7.5', ]
+        catalog = fsl_sub.coprocessors.coprocessor_catalog()
+        self.assertIs(fsl_sub.coprocessors.coprocessor_catalog(), catalog)
+        self.assertIn('cuda', catalog)
+        self.assertNotIn('fpga', catalog)
+        self.assertEqual(catalog.queues('cuda'), {'cuda.q', })
+        self.assertEqual(catalog.queues('fpga'), frozenset())
+        self.assertEqual(catalog.max_quantity('fpga'), 0)
+        self.assertEqual(catalog.exclusive_queues, {'cuda.q', 'phi.q', })
+        self.assertListEqual(catalog.more_capable('cuda', 'P'), ['P', 'V', ])
+        with self.subTest("Toolkits queried once"):
+            self.assertDictEqual(
+                fsl_sub.coprocessors.coproc_info(),
+                {'available': ['cuda', 'phi', ], 'classes': ['K', 'P', 'V', ],
+                 'toolkits': ['7.5', ]})
+            fsl_sub.coprocessors.coproc_info()
+            self.assertEqual(mock_get_modules.call_count, 1)
+        with self.subTest("Non-exclusive"):
+            queues = {
+                'gpu.q': {'copros': {'cuda': {'exclusive': False}}},
+                'cpu.q': {}, }
+            catalog = fsl_sub.coprocessors.CoprocessorCatalog(queues)
+            self.assertEqual(catalog.exclusive_queues, frozenset())
+            self.assertIsNone(catalog.classes('cuda'))
+        with self.subTest("Toolkits of missing coprocessor"):
+            self.assertRaises(
+                fsl_sub.exceptions.BadConfiguration,
+                catalog.toolkits, 'phi')
+
     @patch('fsl_sub.coprocessors.get_modules', autospec=True)
     @patch(
         'fsl_sub.coprocessors.coprocessor_config',
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+import itertools
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+import fsl_sub
+from fsl_sub.config import read_config
+from fsl_sub.exceptions import BadSubmission
+from fsl_sub.dedup import (
+    index_key,
+    lookup,
+    record,
+    submission_key,
+)
+
+
+class TestDedup(unittest.TestCase):
+    def setUp(self):
+        self.tempd = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tempd.cleanup)
+        patcher = patch.dict(
+            'fsl_sub.utils.os.environ',
+            {'FSLSUB_STATE_DIR': self.tempd.name, 'MYVAR': 'a'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.args = {
+            'command': ['mycmd', 'arg'], 'jobram': 8, 'export_vars': ['MYVAR'],
+            'as_tuple': False, 'idempotency_key': True, }
+
+    def test_submission_key(self):
+        key = submission_key(self.args, cwd='/x')
+        with self.subTest('Same submission'):
+            self.assertEqual(
+                key,
+                submission_key(
+                    dict(self.args, command='mycmd arg', as_tuple=True), cwd='/x'))
+        with self.subTest('Different folder'):
+            self.assertNotEqual(key, submission_key(self.args, cwd='/y'))
+        with self.subTest('Different resources'):
+            self.assertNotEqual(
+                key, submission_key(dict(self.args, jobram=16), cwd='/x'))
+        with self.subTest('Different environment'):
+            with patch.dict('fsl_sub.dedup.os.environ', {'MYVAR': 'b'}):
+                self.assertNotEqual(key, submission_key(self.args, cwd='/x'))
+        with self.subTest('Array task file contents'):
+            task_file = os.path.join(self.tempd.name, 'tasks')
+            with open(task_file, 'w') as tf:
+                tf.write('a\n')
+            array_args = dict(self.args, command=task_file, array_task=True)
+            a_key = submission_key(array_args, cwd='/x')
+            with open(task_file, 'w') as tf:
+                tf.write('b\n')
+            self.assertNotEqual(a_key, submission_key(array_args, cwd='/x'))
+
+    def test_index_key(self):
+        self.assertEqual(index_key('mykey', {}), index_key('mykey', {}))
+        self.assertNotEqual(index_key('mykey', {}), index_key('other', {}))
+
+    def test_lookup_record(self):
+        key = index_key('mykey', {})
+        self.assertIsNone(lookup(key, 60))
+        os.makedirs(os.path.join(self.tempd.name, 'submissions'))
+        record(key, 123, 60)
+        self.assertEqual(lookup(key, 60), 123)
+        folder = os.path.join(self.tempd.name, 'submissions')
+
+        def entries():
+            return sorted(f for f in os.listdir(folder) if not f.startswith('.'))
+        with patch('fsl_sub.dedup.time.time', return_value=time.time() + 61):
+            self.assertIsNone(lookup(key, 60))
+            record(index_key('other', {}), 456, 60)
+            self.assertEqual(entries(), [index_key('other', {})])
+        with self.subTest('Pruned at most once per window'):
+            with patch('fsl_sub.dedup._prune') as mock_prune:
+                record(key, 789, 60)
+                mock_prune.assert_not_called()
+            self.assertEqual(len(entries()), 2)
+
+    @patch('fsl_sub.read_config', return_value={'method': 'sge', 'dedup_window': 60})
+    def test_submit_once(self, mock_rc):
+        job_ids = itertools.count(100)
+
+        def slow_submit(**kwargs):
+            time.sleep(0.1)
+            return next(job_ids)
+
+        with patch('fsl_sub.submit', side_effect=slow_submit) as mock_submit:
+            results = []
+            threads = [
+                threading.Thread(
+                    target=lambda: results.append(fsl_sub._submit_once(self.args)))
+                for _ in range(4)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEqual(results, [100, 100, 100, 100])
+            mock_submit.assert_called_once()
+            self.assertIsNone(mock_submit.call_args[1]['idempotency_key'])
+            self.assertEqual(
+                fsl_sub._submit_once(dict(self.args, as_tuple=True)), (100, ))
+            self.assertEqual(
+                fsl_sub._submit_once(dict(self.args, jobram=16)), 101)
+
+    @patch('fsl_sub.read_config', return_value={'method': 'sge', 'dedup_window': 60})
+    def test_idempotency_key_values(self, mock_rc):
+        with patch('fsl_sub._submit_once', side_effect=AssertionError) as mock_once:
+            for disabled in (None, False, 0, ''):
+                with self.subTest(disabled=disabled):
+                    with patch('fsl_sub.time.perf_counter', side_effect=StopIteration):
+                        # Reaching the normal submission path is enough
+                        self.assertRaises(
+                            StopIteration, fsl_sub.submit, ['echo', 'a'],
+                            idempotency_key=disabled)
+            mock_once.assert_not_called()
+        for bad in (1, ['key'], 2.5):
+            with self.subTest(bad=bad):
+                self.assertRaises(
+                    BadSubmission, fsl_sub.submit, ['echo', 'a'],
+                    idempotency_key=bad)
+
+    def test_idempotency_key_false(self):
+        read_config.cache_clear()
+        self.addCleanup(read_config.cache_clear)
+        # Shell job ids are the submitting process id
+        with patch.dict('fsl_sub.utils.os.environ', {'FSLSUB_CONF': ''}), \
+                patch('os.getpid', side_effect=itertools.count(100)):
+            here = os.getcwd()
+            self.addCleanup(os.chdir, here)
+            os.chdir(self.tempd.name)
+            job_a = fsl_sub.submit(['echo', 'a'], idempotency_key=False)
+            job_b = fsl_sub.submit(['echo', 'b'], idempotency_key=False)
+        self.assertNotEqual(job_a, job_b)
+
+    @patch('fsl_sub.read_config', return_value={'method': 'shell'})
+    def test_submit_once_shell(self, mock_rc):
+        with patch('fsl_sub.submit', side_effect=[1, 2]):
+            self.assertEqual(fsl_sub._submit_once(self.args), 1)
+            self.assertEqual(fsl_sub._submit_once(self.args), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
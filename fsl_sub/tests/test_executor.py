@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+import operator
+import os
+import shlex
+import tempfile
+import unittest
+import fsl_sub.consts
+from concurrent.futures import as_completed
+from unittest.mock import (MagicMock, patch, )
+from fsl_sub.exceptions import (BadSubmission, JobFailed, )
+from fsl_sub.executor import (FslSubExecutor, _run_payload, )
+
+
+def fake_shell_submit(command, array_task=False, **kwargs):
+    '''Run payloads immediately as the shell plugin would'''
+    if array_task:
+        with open(command, 'r') as tf:
+            lines = [shlex.split(line) for line in tf.readlines()]
+    else:
+        lines = [command]
+    for line in lines:
+        if isinstance(line, list) and line[1:3] == ['-m', 'fsl_sub.executor']:
+            _run_payload(line[3])
+    return 123
+
+
+def in_state(state):
+    '''job_status_batch() reporting all jobs in state'''
+    return lambda job_ids: {
+        j: {'tasks': {'1': {'status': state}}} for j in job_ids}
+
+
+class FakePlugin(object):
+    pass
+
+
+@patch('fsl_sub.submit', autospec=True, side_effect=fake_shell_submit)
+class TestExecutor(unittest.TestCase):
+    def setUp(self):
+        self.tempd = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tempd.cleanup)
+        self.plugin = FakePlugin()
+        self.plugin.job_status_batch = MagicMock(
+            name='job_status_batch',
+            side_effect=in_state(fsl_sub.consts.FINISHED))
+        patch('fsl_sub.read_config', return_value={'method': 'sge', }).start()
+        self.load_plugins = patch('fsl_sub.load_plugins', return_value={
+            'fsl_sub_plugin_sge': self.plugin, }).start()
+        self.addCleanup(patch.stopall)
+
+    def test_callable(self, mock_submit):
+        with FslSubExecutor(
+                workdir=self.tempd.name, poll_interval=0.01, jobram=4) as ex:
+            future = ex.submit(operator.add, 2, 3)
+            self.assertEqual(future.result(timeout=5), 5)
+            self.assertEqual(future.job_id, 123)
+        command = mock_submit.call_args[0][0]
+        self.assertEqual(command[1:3], ['-m', 'fsl_sub.executor'])
+        self.assertEqual(mock_submit.call_args[1]['jobram'], 4)
+
+    def test_callable_exception(self, mock_submit):
+        with FslSubExecutor(workdir=self.tempd.name, poll_interval=0.01) as ex:
+            future = ex.submit(operator.truediv, 1, 0)
+            with self.assertRaises(ZeroDivisionError):
+                future.result(timeout=5)
+
+    def test_command(self, mock_submit):
+        with FslSubExecutor(workdir=self.tempd.name, poll_interval=0.01) as ex:
+            future = ex.submit('echo hello')
+            self.assertEqual(future.result(timeout=5), 123)
+            with self.assertRaises(BadSubmission):
+                ex.submit('echo', 'hello')
+
+    def test_command_failed(self, mock_submit):
+        self.plugin.job_status_batch.side_effect = in_state(
+            fsl_sub.consts.FAILED)
+        with FslSubExecutor(workdir=self.tempd.name, poll_interval=0.01) as ex:
+            future = ex.submit('false')
+            with self.assertRaises(JobFailed):
+                future.result(timeout=5)
+
+    def test_unknown_state(self, mock_submit):
+        # Jobs that vanish from the scheduler's reports are not successes
+        self.plugin.job_status_batch.side_effect = lambda job_ids: {}
+        with FslSubExecutor(workdir=self.tempd.name, poll_interval=0.01) as ex:
+            future = ex.submit('true')
+            with self.assertRaises(JobFailed):
+                future.result(timeout=5)
+
+    def test_up_to_date(self, mock_submit):
+        mock_submit.side_effect = None
+        mock_submit.return_value = None
+        with FslSubExecutor(workdir=self.tempd.name, poll_interval=0.01) as ex:
+            self.assertIsNone(ex.submit('echo').result(timeout=5))
+            self.assertIsNone(ex.submit(operator.neg, 1).result(timeout=5))
+            self.assertListEqual(
+                list(ex.map(operator.neg, [1, 2], timeout=5)), [None, None])
+        self.plugin.job_status_batch.assert_not_called()
+
+    def test_submit_error(self, mock_submit):
+        mock_submit.side_effect = BadSubmission("No queues")
+        with FslSubExecutor(workdir=self.tempd.name) as ex:
+            future = ex.submit('echo')
+            self.assertIsInstance(future.exception(), BadSubmission)
+
+    def test_map(self, mock_submit):
+        with FslSubExecutor(workdir=self.tempd.name, poll_interval=0.01) as ex:
+            results = list(ex.map(operator.mul, [1, 2, 3], [4, 5, 6], timeout=5))
+        self.assertListEqual(results, [4, 10, 18])
+        # One array task submitted
+        self.assertEqual(mock_submit.call_count, 1)
+        self.assertTrue(mock_submit.call_args[1]['array_task'])
+
+    def test_map_quoting(self, mock_submit):
+        python = os.path.join(self.tempd.name, 'my python')
+        with FslSubExecutor(
+                workdir=self.tempd.name, poll_interval=0.01, python=python) as ex:
+            ex.map(operator.neg, [1])
+        with open(mock_submit.call_args[0][0]) as tf:
+            self.assertEqual(shlex.split(tf.read())[0], python)
+
+    def test_polling(self, mock_submit):
+        with FslSubExecutor(workdir=self.tempd.name, poll_interval=0.01) as ex:
+            for i in range(3):
+                ex.submit(operator.neg, i).result(timeout=5)
+        # The plugin is looked up once, not on every poll
+        self.assertEqual(self.load_plugins.call_count, 1)
+        self.assertEqual(self.plugin.job_status_batch.call_count, 3)
+
+    def test_as_completed(self, mock_submit):
+        with FslSubExecutor(workdir=self.tempd.name, poll_interval=0.01) as ex:
+            futures = [ex.submit(operator.neg, i) for i in range(3)]
+            results = sorted(f.result() for f in as_completed(futures, timeout=5))
+        self.assertListEqual(results, [-2, -1, 0])
+
+    @patch('fsl_sub.delete_job', autospec=True, return_value=('', 0))
+    def test_cancel(self, mock_delete, mock_submit):
+        self.plugin.job_status_batch.side_effect = in_state(
+            fsl_sub.consts.QUEUED)
+        ex = FslSubExecutor(workdir=self.tempd.name, poll_interval=0.01)
+        future = ex.submit('sleep 100')
+        self.assertTrue(future.cancel())
+        mock_delete.assert_called_once_with(123)
+        self.assertTrue(future.cancelled())
+        ex.shutdown()
+
+    @patch('fsl_sub.delete_job', autospec=True, return_value=('', 0))
+    def test_cancel_chunked_task(self, mock_delete, mock_submit):
+        self.plugin.job_status_batch.side_effect = in_state(
+            fsl_sub.consts.QUEUED)
+        mock_submit.side_effect = None
+        mock_submit.return_value = '11+13@3'
+        ex = FslSubExecutor(workdir=self.tempd.name, poll_interval=0.01)
+        ex.map(operator.neg, range(5))
+        futures = list(ex._pending['11+13@3'])
+        with self.subTest("First chunk"):
+            self.assertTrue(futures[2].cancel())
+            mock_delete.assert_called_with('11.3')
+        with self.subTest("Later chunk"):
+            self.assertTrue(futures[3].cancel())
+            mock_delete.assert_called_with('13.1')
+        ex.shutdown(cancel_futures=True)
+
+    def test_shutdown_removes_workdir(self, mock_submit):
+        here = os.getcwd()
+        os.chdir(self.tempd.name)
+        self.addCleanup(os.chdir, here)
+        ex = FslSubExecutor(poll_interval=0.01)
+        workdir = ex.workdir
+        self.assertTrue(os.path.isdir(workdir))
+        ex.submit(operator.add, 1, 1).result(timeout=5)
+        ex.shutdown()
+        self.assertFalse(os.path.exists(workdir))
+        with self.assertRaises(RuntimeError):
+            ex.submit(operator.add, 1, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
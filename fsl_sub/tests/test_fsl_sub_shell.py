@@ -1,4 +1,6 @@
 #!/usr/bin/env python
+import gzip
+import io
 import os
 import shlex
 import subprocess
@@ -6,6 +8,7 @@ import tempfile
 import unittest
 import fsl_sub.plugins.fsl_sub_plugin_shell
 import fsl_sub.exceptions
+import fsl_sub.tasklogs as tasklogs
 from unittest.mock import (patch, ANY, )
 from fsl_sub.utils import bash_cmd
 
@@ -329,6 +332,91 @@ step:{4}
 '''.format(self.job_id, subjob, 1, 3, 1))
             self.assertEqual(joberror, '')
 
+    @patch(
+        'fsl_sub.plugins.fsl_sub_plugin_shell.method_config',
+        return_value={'consolidate_logs': True, })
+    @patch(
+        'fsl_sub.plugins.fsl_sub_plugin_shell._get_cores',
+        autospec=True, return_value=2)
+    def test__run_parallel_consolidated(self, mock_gc, mock_mc, mock_bash):
+        jobs = [self.job, self.job, self.job, ]
+        fsl_sub.plugins.fsl_sub_plugin_shell._run_parallel(
+            jobs, self.job_id, self.p_env, self.stdout, self.stderr
+        )
+        self.assertListEqual(
+            sorted(os.listdir(self.outdir.name)),
+            ['errorfile', 'jobfile', 'stderr', 'stderr.idx', 'stdout', 'stdout.idx'])
+        for subjob in (1, 2, 3):
+            out = io.BytesIO()
+            tasklogs.read(self.stdout, subjob, out)
+            self.assertEqual(
+                out.getvalue().decode(),
+                '''jobid:{0}
+taskid:{1}
+start:{2}
+end:{3}
+step:{4}
+'''.format(self.job_id, subjob, 1, 3, 1))
+            self.assertEqual(tasklogs.entry(self.stderr, subjob)[1], 0)
+        with self.subTest('Failing task'):
+            with self.assertRaises(fsl_sub.exceptions.BadSubmission) as bs:
+                fsl_sub.plugins.fsl_sub_plugin_shell._run_parallel(
+                    [self.errorjob], self.job_id, self.p_env, self.stdout,
+                    self.stderr)
+            self.assertIn('taskid:1', str(bs.exception))
+            out = io.BytesIO()
+            tasklogs.read(self.stderr, 1, out)
+            self.assertTrue(out.getvalue().startswith(b'jobid:111'))
+
+    @patch(
+        'fsl_sub.plugins.fsl_sub_plugin_shell.log_compression',
+        return_value='gzip')
+    @patch(
+        'fsl_sub.plugins.fsl_sub_plugin_shell._get_cores',
+        autospec=True, return_value=2)
+    def test__run_parallel_compressed(self, mock_gc, mock_lc, mock_bash):
+        fsl_sub.plugins.fsl_sub_plugin_shell._run_parallel(
+            [self.job, self.job], self.job_id, self.p_env, self.stdout,
+            self.stderr
+        )
+        self.assertListEqual(
+            sorted(os.listdir(self.outdir.name)),
+            ['errorfile', 'jobfile', 'stderr.1.gz', 'stderr.2.gz',
+             'stdout.1.gz', 'stdout.2.gz'])
+        with gzip.open(self.stdout + '.2.gz', 'rt') as jout:
+            self.assertIn('taskid:2', jout.read())
+        with self.subTest('Failing task'):
+            with self.assertRaises(fsl_sub.exceptions.BadSubmission) as bs:
+                fsl_sub.plugins.fsl_sub_plugin_shell._run_job(
+                    [self.errorjob], self.job_id, self.p_env, self.stdout,
+                    self.stderr)
+            self.assertIn('jobid:111', str(bs.exception))
+            self.assertTrue(os.path.exists(self.stderr + '.gz'))
+
+    @patch(
+        'fsl_sub.plugins.fsl_sub_plugin_shell._get_cores',
+        autospec=True, return_value=2)
+    def test__run_parallel_staged(self, mock_gc, mock_bash):
+        with tempfile.TemporaryDirectory() as stage:
+            with patch.dict(os.environ, {'FSLSUB_LOG_STAGING': stage}):
+                fsl_sub.plugins.fsl_sub_plugin_shell._run_parallel(
+                    [self.job, self.job], self.job_id, self.p_env,
+                    self.stdout, self.stderr
+                )
+                with self.assertRaises(
+                        fsl_sub.exceptions.BadSubmission) as bs:
+                    fsl_sub.plugins.fsl_sub_plugin_shell._run_job(
+                        [self.errorjob], self.job_id, self.p_env,
+                        self.stdout, self.stderr)
+            self.assertIn('jobid:111', str(bs.exception))
+            self.assertListEqual(os.listdir(stage), [])
+        self.assertListEqual(
+            sorted(os.listdir(self.outdir.name)),
+            ['errorfile', 'jobfile', 'stderr', 'stderr.1', 'stderr.2',
+             'stdout', 'stdout.1', 'stdout.2'])
+        with open(self.stdout + '.2') as jout:
+            self.assertIn('taskid:2', jout.read())
+
     @patch(
         'fsl_sub.plugins.fsl_sub_plugin_shell._get_cores',
         autospec=True)
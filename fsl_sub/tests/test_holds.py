@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+import itertools
+import unittest
+from fsl_sub.holds import (
+    barrier_holds,
+    compress_holds,
+)
+
+
+class TestCompressHolds(unittest.TestCase):
+    def test_unchanged(self):
+        with self.subTest('None'):
+            self.assertIsNone(compress_holds(None))
+        with self.subTest('Single id'):
+            self.assertEqual(compress_holds(123), 123)
+            self.assertEqual(compress_holds('123'), '123')
+            self.assertEqual(compress_holds(['123.4']), ['123.4'])
+        with self.subTest('Complex hold'):
+            self.assertEqual(
+                compress_holds('afterok:1,afterok:1'), 'afterok:1,afterok:1')
+
+    def test_deduplicate(self):
+        self.assertListEqual(
+            compress_holds([3, '1', 3, 2, 1]), ['3', '1', '2'])
+        self.assertListEqual(compress_holds('1,2, 1'), ['1', '2'])
+
+    def test_collapse_tasks(self):
+        with self.subTest('SGE style'):
+            self.assertListEqual(
+                compress_holds(['10.1', '10.2', '11.1', '10', '12']),
+                ['10', '11.1', '12'])
+        with self.subTest('Slurm style'):
+            self.assertListEqual(
+                compress_holds(['10_1', '10_2']), ['10'])
+        with self.subTest('Not collapsed'):
+            self.assertListEqual(
+                compress_holds(['10.1', '10.2', '10.1'], collapse_tasks=False),
+                ['10.1', '10.2'])
+
+
+class TestBarrierHolds(unittest.TestCase):
+    def test_barrier_holds(self):
+        job_ids = itertools.count(1000)
+        chunks = []
+
+        def barrier(chunk):
+            chunks.append(chunk)
+            return next(job_ids)
+
+        holds = [str(i) for i in range(10)]
+        with self.subTest('Short list'):
+            self.assertListEqual(barrier_holds(holds, 10, barrier), holds)
+            self.assertListEqual(chunks, [])
+        with self.subTest('One level'):
+            self.assertListEqual(
+                barrier_holds(holds, 4, barrier), ['1000', '1001', '1002'])
+            self.assertListEqual(
+                chunks, [holds[0:4], holds[4:8], holds[8:10]])
+        with self.subTest('Several levels'):
+            chunks.clear()
+            self.assertListEqual(barrier_holds(holds, 2, barrier), ['1011', '1012'])
+            self.assertEqual(len(chunks), 5 + 3 + 2)
+        with self.subTest('Bad limit'):
+            self.assertRaises(ValueError, barrier_holds, holds, 1, barrier)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+import io
+import json
+import logging
+import os
+import tempfile
+import threading
+import unittest
+from unittest.mock import patch
+
+from fsl_sub import jsonlog
+
+
+class TestCorrelation(unittest.TestCase):
+    def test_correlation(self):
+        self.assertIsNone(jsonlog.correlation_id())
+        with patch.dict(os.environ, {'FSLSUB_CORRELATION_ID': ''}):
+            with jsonlog.correlation() as cid:
+                self.assertEqual(len(cid), 16)
+                with jsonlog.correlation('other') as inner:
+                    self.assertEqual(inner, cid)
+                self.assertEqual(jsonlog.correlation_id(), cid)
+                seen = []
+                t = threading.Thread(
+                    target=lambda: seen.append(jsonlog.correlation_id()))
+                t.start()
+                t.join()
+                self.assertListEqual(seen, [None])
+        self.assertIsNone(jsonlog.correlation_id())
+        with patch.dict(os.environ, {'FSLSUB_CORRELATION_ID': 'pipeline1'}):
+            with jsonlog.correlation() as cid:
+                self.assertEqual(cid, 'pipeline1')
+
+    def test_correlated(self):
+        @jsonlog.correlated
+        def job():
+            return jsonlog.correlation_id()
+        first = job()
+        self.assertIsNotNone(first)
+        self.assertNotEqual(first, job())
+
+
+class TestJsonFormatter(unittest.TestCase):
+    def setUp(self):
+        self.stream = io.StringIO()
+        self.handler = logging.StreamHandler(self.stream)
+        self.handler.setFormatter(jsonlog.JsonFormatter())
+        self.logger = logging.getLogger('fsl_sub.test_jsonlog')
+        self.logger.addHandler(self.handler)
+        self.logger.setLevel(logging.INFO)
+        self.addCleanup(self.logger.removeHandler, self.handler)
+
+    def test_format(self):
+        with jsonlog.correlation('abc'):
+            self.logger.info(
+                "Submitted job %s", 123,
+                extra={'method': 'sge', 'queue': 'short.q', 'slots': 2})
+        entry = json.loads(self.stream.getvalue())
+        self.assertEqual(entry['message'], 'Submitted job 123')
+        self.assertEqual(entry['correlation_id'], 'abc')
+        self.assertEqual(entry['level'], 'INFO')
+        self.assertEqual(entry['method'], 'sge')
+        self.assertEqual(entry['slots'], 2)
+        self.assertNotIn('args', entry)
+
+    def test_lazy(self):
+        class Expensive(object):
+            def __str__(self):
+                raise AssertionError("Formatted when not logged")
+        self.logger.debug("Not logged %s", Expensive())
+        self.assertEqual(self.stream.getvalue(), '')
+
+
+class TestConfigure(unittest.TestCase):
+    def setUp(self):
+        self.logger = logging.getLogger('fsl_sub.test_configure')
+        self.handler = logging.StreamHandler(io.StringIO())
+        self.logger.addHandler(self.handler)
+        self.addCleanup(self.logger.removeHandler, self.handler)
+        env = patch.dict(os.environ)
+        env.start()
+        self.addCleanup(env.stop)
+        os.environ.pop('FSLSUB_LOG_FORMAT', None)
+        os.environ.pop('FSLSUB_LOG_FILE', None)
+
+    def test_text(self):
+        formatter = self.handler.formatter
+        jsonlog.configure(self.logger, self.handler, {})
+        self.assertIs(self.handler.formatter, formatter)
+
+    def test_json_stderr(self):
+        os.environ['FSLSUB_LOG_FORMAT'] = 'json'
+        jsonlog.configure(self.logger, self.handler, {})
+        self.assertIsInstance(self.handler.formatter, jsonlog.JsonFormatter)
+
+    def test_json_file(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            log_file = os.path.join(tempdir, 'fsl_sub.log')
+            jsonlog.configure(
+                self.logger, self.handler,
+                {'log_format': 'json', 'log_file': log_file})
+            file_handler = self.logger.handlers[-1]
+            self.addCleanup(self.logger.removeHandler, file_handler)
+            self.logger.info("Submitted")
+            file_handler.close()
+            with open(log_file) as lf:
+                self.assertEqual(json.loads(lf.read())['message'], 'Submitted')
+        self.assertEqual(self.handler.stream.getvalue(), '')
+
+
+if __name__ == '__main__':
+    unittest.main()
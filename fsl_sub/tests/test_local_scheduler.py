@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+import gzip
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+import fsl_sub.consts
+import fsl_sub.cmdline
+from fsl_sub.config import read_config
+from fsl_sub.exceptions import (BadSubmission, UnknownJobId, )
+from fsl_sub.plugins import fsl_sub_plugin_local as plugin
+from fsl_sub.plugins.local_scheduler import (Scheduler, request, serve, )
+
+QUEUES = {
+    'short.q': {'time': 60, 'max_slots': 2, 'max_size': 4, },
+}
+
+
+class TestScheduler(unittest.TestCase):
+    def setUp(self):
+        self.tempd = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tempd.cleanup)
+        self.scheduler = Scheduler(QUEUES, poll_interval=0.01)
+        self.thread = threading.Thread(target=self.scheduler.run)
+        self.thread.start()
+        self.addCleanup(self.thread.join)
+        self.addCleanup(self.scheduler.stop)
+
+    def job(self, script, **kwargs):
+        spec = {
+            'name': 'test', 'queue': 'short.q', 'script': script,
+            'cwd': self.tempd.name, 'logdir': self.tempd.name,
+            'env': {'PATH': os.environ['PATH']}, }
+        spec.update(kwargs)
+        return self.scheduler.submit(spec)
+
+    def wait(self, job_id, timeout=10):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            tasks = self.scheduler.status([job_id])[str(job_id)]['tasks']
+            if all(t['status'] in (fsl_sub.consts.FINISHED, fsl_sub.consts.FAILED)
+                   for t in tasks.values()):
+                return tasks
+            time.sleep(0.01)
+        self.fail("Job {0} did not finish".format(job_id))
+
+    def test_run(self):
+        j = self.job('echo $LOCAL_JOB_ID; exit 2')
+        tasks = self.wait(j)
+        self.assertEqual(tasks['1']['status'], fsl_sub.consts.FAILED)
+        self.assertEqual(tasks['1']['exit_status'], 2)
+        with open(os.path.join(self.tempd.name, 'test.o' + str(j))) as log:
+            self.assertEqual(log.read(), str(j) + '\n')
+
+    def test_resources(self):
+        with self.subTest('Too many threads'):
+            self.assertRaises(ValueError, self.job, 'true', threads=3)
+        with self.subTest('Too much RAM'):
+            self.assertRaises(ValueError, self.job, 'true', ram=5 * 1024)
+        with self.subTest('Unknown queue'):
+            self.assertRaises(ValueError, self.job, 'true', queue='long.q')
+        with self.subTest('Slots'):
+            # Two slots so the third job can only start once one finishes
+            stamp = 'date +%s.%N > {0}'
+            jobs = [
+                self.job('sleep 0.3; ' + stamp.format('end' + str(i)))
+                for i in range(2)]
+            jobs.append(self.job(stamp.format('start2')))
+            for j in jobs:
+                self.wait(j)
+
+            def read(name):
+                with open(os.path.join(self.tempd.name, name)) as f:
+                    return float(f.read())
+            self.assertGreaterEqual(
+                read('start2'), min(read('end0'), read('end1')))
+
+    def test_holds(self):
+        j1 = self.job('sleep 0.2; echo first > order')
+        j2 = self.job('echo second >> order', holds=[j1])
+        self.assertEqual(
+            self.scheduler.status([j2])[str(j2)]['tasks']['1']['status'],
+            fsl_sub.consts.HELD)
+        self.wait(j2)
+        with open(os.path.join(self.tempd.name, 'order')) as f:
+            self.assertEqual(f.read(), 'first\nsecond\n')
+
+    def test_array(self):
+        j1 = self.job(
+            'echo $LOCAL_TASK_ID $LOCAL_TASK_COUNT', array=[2, 6, 2], array_limit=1)
+        j2 = self.job('true', array=[2, 6, 2], array_hold=j1)
+        tasks = self.wait(j2)
+        self.assertListEqual(sorted(tasks), ['2', '4', '6'])
+        with open(os.path.join(self.tempd.name, 'test.o{0}.4'.format(j1))) as log:
+            self.assertEqual(log.read(), '4 3\n')
+        j1_tasks = self.wait(j1)
+        for t in tasks:
+            self.assertLessEqual(j1_tasks[t]['end_time'], tasks[t]['start_time'])
+
+    def test_qdel(self):
+        j1 = self.job('sleep 30')
+        j2 = self.job('true', holds=[j1])
+        time.sleep(0.1)
+        self.scheduler.qdel(j2)
+        self.scheduler.qdel(j1)
+        for j in (j1, j2):
+            tasks = self.wait(j)
+            self.assertEqual(tasks['1']['status'], fsl_sub.consts.FAILED)
+            self.assertEqual(tasks['1']['error_message'], 'Deleted')
+        self.assertRaises(ValueError, self.scheduler.qdel, 99)
+        with self.subTest('Exits successfully when deleted'):
+            j = self.job("trap 'exit 0' TERM; echo started; sleep 30 & wait")
+            log = os.path.join(self.tempd.name, 'test.o' + str(j))
+            for _ in range(100):
+                if os.path.exists(log) and os.path.getsize(log):
+                    break
+                time.sleep(0.05)
+            self.scheduler.qdel(j)
+            tasks = self.wait(j)
+            self.assertEqual(tasks['1']['exit_status'], 0)
+            self.assertEqual(tasks['1']['status'], fsl_sub.consts.FAILED)
+
+    @patch(
+        'fsl_sub.plugins.fsl_sub_plugin_local.method_config',
+        return_value={'copy_environment': False, })
+    def test_staged_logs(self, mock_mc):
+        stage = os.path.join(self.tempd.name, 'stage')
+        task_file = os.path.join(self.tempd.name, 'tasks')
+        with open(task_file, 'w') as tf:
+            tf.write('echo one\necho two >&2\n')
+        with patch.dict(os.environ, {
+                'FSLSUB_LOG_STAGING': stage, 'FSLSUB_LOG_COMPRESSION': 'gzip'}):
+            with patch(
+                    'fsl_sub.plugins.fsl_sub_plugin_local._request',
+                    side_effect=lambda op, job: self.scheduler.submit(job)):
+                j = plugin.submit(
+                    [task_file], 'test', 'short.q', array_task=True,
+                    logdir=self.tempd.name)
+        tasks = self.wait(j)
+        self.assertEqual(tasks['2']['status'], fsl_sub.consts.FINISHED)
+        logs = sorted(f for f in os.listdir(self.tempd.name) if f.endswith('.gz'))
+        self.assertListEqual(logs, [
+            'test.{0}{1}.{2}.gz'.format(s, j, t)
+            for s in ('e', 'o', ) for t in (1, 2, )])
+        with gzip.open(os.path.join(
+                self.tempd.name, 'test.e{0}.2.gz'.format(j)), 'rt') as log:
+            self.assertEqual(log.read(), 'two\n')
+        self.assertListEqual(os.listdir(stage), [])
+
+
+class TestLocalPlugin(unittest.TestCase):
+    def test_hold_ids(self):
+        self.assertListEqual(plugin._hold_ids(None), [])
+        self.assertListEqual(plugin._hold_ids('3,1.2'), [1, 3])
+        self.assertListEqual(plugin._hold_ids([2, '2', '1']), [1, 2])
+        self.assertRaises(BadSubmission, plugin._hold_ids, 'afterok:1')
+
+    def test_script_options(self):
+        script = '\n'.join((
+            '#!/bin/bash', '#LOCAL --name myjob --queue short.q',
+            '#LOCAL --threads 2 --hold 1,2', 'mycommand', ))
+        options = plugin._script_options(script)
+        self.assertEqual(options['name'], 'myjob')
+        self.assertEqual(options['threads'], 2)
+        self.assertEqual(options['hold'], '1,2')
+        self.assertRaises(
+            BadSubmission, plugin._script_options, '#LOCAL --bad 1\n')
+
+    @patch(
+        'fsl_sub.plugins.fsl_sub_plugin_local.method_config',
+        return_value={'notify_ram_usage': True, 'array_limits': True,
+                      'job_priorities': True, 'min_priority': -1023,
+                      'max_priority': 0, 'copy_environment': False, })
+    @patch('fsl_sub.plugins.fsl_sub_plugin_local._request', return_value=42)
+    def test_submit(self, mock_request, mock_mc):
+        with tempfile.TemporaryDirectory() as tempdir:
+            task_file = os.path.join(tempdir, 'tasks')
+            with open(task_file, 'w') as tf:
+                tf.write('a\nb\nc\n')
+            job_id = plugin.submit(
+                [task_file], 'myjob', 'short.q', threads=2, array_task=True,
+                jobhold=['7', '5'], jobram=2, priority=10, array_limit=2,
+                logdir=tempdir, export_vars=['MYVAR=1'])
+        self.assertEqual(job_id, 42)
+        job = mock_request.call_args[1]['job']
+        self.assertEqual(job['array'], [1, 3, 1])
+        self.assertEqual(job['holds'], [5, 7])
+        self.assertEqual(job['ram'], 2048)
+        self.assertEqual(job['priority'], 0)
+        self.assertEqual(job['array_limit'], 2)
+        self.assertEqual(job['env']['MYVAR'], '1')
+        self.assertEqual(job['env']['FSLSUB_ARRAYTASKID_VAR'], 'LOCAL_TASK_ID')
+        self.assertIn('sed -n -e "${LOCAL_TASK_ID}p"', job['script'])
+        self.assertIn('#LOCAL --threads 2', job['script'])
+
+    @patch(
+        'fsl_sub.plugins.fsl_sub_plugin_local.method_config',
+        return_value={'copy_environment': False, })
+    @patch('fsl_sub.plugins.fsl_sub_plugin_local._request', return_value=42)
+    def test_submit_compression(self, mock_request, mock_mc):
+        with tempfile.TemporaryDirectory() as tempdir:
+            task_file = os.path.join(tempdir, 'tasks')
+            with open(task_file, 'w') as tf:
+                tf.write('a\nb\n')
+            with patch.dict(os.environ, {'FSLSUB_LOG_COMPRESSION': 'gzip'}):
+                plugin.submit(
+                    [task_file], 'myjob', 'short.q', array_task=True,
+                    logdir=tempdir)
+        script = mock_request.call_args[1]['job']['script']
+        self.assertIn(
+            'for fsl_sub_log in "{0}" "{1}"; do'.format(
+                os.path.join(tempdir, 'myjob.o${LOCAL_JOB_ID}.${LOCAL_TASK_ID}'),
+                os.path.join(tempdir, 'myjob.e${LOCAL_JOB_ID}.${LOCAL_TASK_ID}')),
+            script)
+        # exec would prevent the compression step running
+        self.assertNotIn('exec ', script)
+
+    @patch('fsl_sub.plugins.fsl_sub_plugin_local._request')
+    def test_job_status(self, mock_request):
+        now = time.time()
+        task = {
+            'status': fsl_sub.consts.RUNNING, 'start_time': now,
+            'end_time': None, 'sub_time': now, }
+        mock_request.return_value = {
+            '5': {'id': 5, 'submission_time': now,
+                  'tasks': {'1': dict(task), '2': dict(task)}}}
+        status = plugin.job_status('5.2')
+        self.assertListEqual(list(status['tasks']), ['2'])
+        self.assertIsNone(status['tasks']['2']['end_time'])
+        self.assertAlmostEqual(
+            status['tasks']['2']['start_time'].timestamp(), now, places=3)
+        self.assertRaises(UnknownJobId, plugin.job_status, 6)
+        self.assertListEqual(
+            list(plugin.job_status_batch([5, 6])), [5])
+
+
+LIVE_CONFIG = '''---
+method: local
+live_queue_ttl: 3600
+method_opts:
+  local:
+    socket: {socket}
+    autostart: False
+queues:
+  short.q:
+    time: 60
+    max_slots: 8
+    max_size: 16
+    slot_size: 2
+    default: True
+'''
+
+
+class TestLiveQueues(unittest.TestCase):
+    def setUp(self):
+        self.tempd = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tempd.cleanup)
+        self.socket = os.path.join(self.tempd.name, 'sched.sock')
+        conf_file = os.path.join(self.tempd.name, 'fsl_sub.yml')
+        with open(conf_file, 'w') as cf:
+            cf.write(LIVE_CONFIG.format(socket=self.socket))
+        env = patch.dict(os.environ, {
+            'FSLSUB_CONF': conf_file, 'FSLSUB_STATE_DIR': self.tempd.name, })
+        env.start()
+        self.addCleanup(env.stop)
+        read_config.cache_clear()
+        self.addCleanup(read_config.cache_clear)
+        # A scheduler started before the queues were enlarged
+        thread = threading.Thread(
+            target=serve, args=(self.socket, QUEUES, ), daemon=True)
+        thread.start()
+        self.addCleanup(thread.join)
+        deadline = time.monotonic() + 10
+        while not os.path.exists(self.socket):
+            if time.monotonic() > deadline:
+                self.fail("Local scheduler did not start")
+            time.sleep(0.01)
+        self.addCleanup(request, self.socket, 'shutdown')
+
+    def test_permissions(self):
+        self.assertEqual(os.stat(self.socket).st_mode & 0o777, 0o600)
+        folder = os.path.join(self.tempd.name, 'new')
+        with patch('fsl_sub.plugins.local_scheduler.Scheduler', side_effect=RuntimeError):
+            self.assertRaises(
+                RuntimeError, serve, os.path.join(folder, 'sched.sock'), QUEUES)
+        self.assertEqual(os.stat(folder).st_mode & 0o777, 0o700)
+
+    def test_live_queue_defs(self):
+        self.assertDictEqual(
+            plugin.live_queue_defs(),
+            {'short.q': {'max_slots': 2, 'max_size': 4}})
+
+    def test_refresh_queues(self):
+        with patch('sys.stdout') as mock_stdout:
+            with self.assertRaises(SystemExit) as exit:
+                fsl_sub.cmdline.main(['--refresh_queues', ])
+        self.assertEqual(exit.exception.code, 0)
+        printed = ''.join(c[0][0] for c in mock_stdout.write.call_args_list)
+        self.assertEqual(printed, 'short.q: max_size=4, max_slots=2\n')
+        read_config.cache_clear()
+        queue = read_config()['queues']['short.q']
+        self.assertEqual(queue['max_slots'], 2)
+        self.assertEqual(queue['max_size'], 4)
+        self.assertEqual(queue['time'], 60)
+
+
+if __name__ == '__main__':
+    unittest.main()
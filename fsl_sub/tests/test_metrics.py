@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import fsl_sub.metrics as metrics
+
+
+@patch('fsl_sub.metrics.getpass.getuser', return_value='auser')
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.tempd = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tempd.cleanup)
+        env = patch.dict(os.environ, {'FSLSUB_METRICS_DIR': self.tempd.name})
+        env.start()
+        self.addCleanup(env.stop)
+
+    def prom(self):
+        with open(os.path.join(self.tempd.name, 'fsl_sub_auser.prom')) as pf:
+            return pf.read().splitlines()
+
+    def test_disabled(self, mock_user):
+        with patch.dict(os.environ, {'FSLSUB_METRICS_DIR': ''}):
+            with patch('fsl_sub.metrics.read_config', return_value={}):
+                metrics.submission('sge', 'short.q', 0.2)
+        self.assertListEqual(os.listdir(self.tempd.name), [])
+
+    def test_submission(self, mock_user):
+        metrics.submission('sge', 'short.q', 0.2)
+        metrics.submission('sge', 'short.q', 3)
+        metrics.submission('sge', None, 0.01)
+        lines = self.prom()
+        self.assertIn('# TYPE fsl_sub_submissions_total counter', lines)
+        self.assertIn(
+            'fsl_sub_submissions_total{method="sge",queue="short.q",user="auser"} 2',
+            lines)
+        self.assertIn(
+            'fsl_sub_submissions_total{method="sge",queue="",user="auser"} 1',
+            lines)
+        self.assertIn(
+            'fsl_sub_submit_duration_seconds_bucket{method="sge",user="auser",le="0.25"} 2',
+            lines)
+        self.assertIn(
+            'fsl_sub_submit_duration_seconds_bucket{method="sge",user="auser",le="+Inf"} 3',
+            lines)
+        self.assertIn(
+            'fsl_sub_submit_duration_seconds_count{method="sge",user="auser"} 3',
+            lines)
+        # Only the metrics file is visible to the collector
+        self.assertListEqual(
+            [f for f in os.listdir(self.tempd.name) if not f.startswith('.')],
+            ['fsl_sub_auser.prom'])
+
+    def test_shell_tasks(self, mock_user):
+        metrics.shell_tasks([(0, 5), (0, 20), (1, 2)])
+        lines = self.prom()
+        self.assertIn(
+            'fsl_sub_shell_tasks_total{exit_status="0",user="auser"} 2', lines)
+        self.assertIn(
+            'fsl_sub_shell_tasks_total{exit_status="1",user="auser"} 1', lines)
+        self.assertIn(
+            'fsl_sub_shell_task_duration_seconds_sum{user="auser"} 27.0', lines)
+
+    def test_corrupt_state(self, mock_user):
+        state = os.path.join(self.tempd.name, '.fsl_sub_auser.json')
+        with open(state, 'w') as sf:
+            sf.write('{')
+        metrics.shell_fallback('sge', 'already_queued')
+        with open(state) as sf:
+            self.assertDictEqual(json.load(sf), {
+                'fsl_sub_shell_fallbacks_total': {
+                    'method="sge",reason="already_queued",user="auser"': 1}})
+
+    def test_label_escaping(self, mock_user):
+        self.assertEqual(
+            metrics._label_key({'b': 'x"y', 'a': 'c\\d'}),
+            'a="c\\\\d",b="x\\"y"')
+
+
+if __name__ == '__main__':
+    unittest.main()
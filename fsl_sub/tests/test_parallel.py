@@ -66,6 +66,7 @@ queues:
             with open(cfile, 'w') as cf:
                 for a in outputs:
                     cf.write("echo " + a + '\n')
+            self.addCleanup(os.chdir, os.getcwd())
             os.chdir(tempdir)
             jid = str(fsl_sub.submit(
                 cfile,
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+import io
+import json
+import os
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
+from fsl_sub import profiling
+
+
+@profiling.profiled('outer')
+def outer(recurse=False):
+    profiling.lap('start')
+    if recurse:
+        outer()
+    inner()
+    profiling.lap('inner')
+    return 'done'
+
+
+@profiling.profiled('inner')
+def inner():
+    profiling.lap('work')
+
+
+@profiling.profiled('main', start_session=True)
+def main(dest=None):
+    profiling.lap('parse')
+    if dest is not None:
+        profiling.enable(dest)
+    return outer()
+
+
+class TestProfiling(unittest.TestCase):
+    def test_destination(self):
+        for value, dest in (
+                ('', None), ('0', None), ('no', None), ('False', None),
+                ('1', 'stderr'), ('true', 'stderr'), ('Yes', 'stderr'),
+                ('stderr', 'stderr'), ('file:prof.json', 'prof.json'),
+                ('/tmp/prof.json', '/tmp/prof.json'),
+                ('./prof.json', './prof.json'), ):
+            with self.subTest(value):
+                with patch.dict(os.environ, {'FSLSUB_PROFILE': value}):
+                    self.assertEqual(profiling.destination(), dest)
+        with patch.dict(os.environ, {'FSLSUB_PROFILE': 'prof.json'}):
+            with self.assertLogs('fsl_sub.profiling', 'WARNING'):
+                self.assertEqual(profiling.destination(), 'stderr')
+
+    def test_threads(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            prof_file = os.path.join(tempdir, 'profile.json')
+            with patch.dict(os.environ, {'FSLSUB_PROFILE': prof_file}):
+                with profiling.session('main'):
+                    with ThreadPoolExecutor(max_workers=4) as pool:
+                        results = list(pool.map(
+                            lambda _: outer(), range(16)))
+                    self.assertListEqual(results, ['done'] * 16)
+            with open(prof_file) as pf:
+                records = [json.loads(line) for line in pf]
+        self.assertEqual(records[0]['label'], 'main')
+        self.assertIn('outer', records[0]['phases'])
+        self.assertEqual(len(records), 1)
+        self.assertIsNone(profiling._session)
+
+    def test_disabled(self):
+        with patch.dict(os.environ, {'FSLSUB_PROFILE': '0'}):
+            with patch('sys.stderr', new_callable=io.StringIO) as stderr:
+                self.assertEqual(outer(), 'done')
+                self.assertEqual(main(), 'done')
+        self.assertEqual(stderr.getvalue(), '')
+        self.assertIsNone(profiling._session)
+
+    def test_stderr(self):
+        with patch.dict(os.environ, {'FSLSUB_PROFILE': '1'}):
+            with patch('sys.stderr', new_callable=io.StringIO) as stderr:
+                outer(recurse=True)
+        summary = stderr.getvalue()
+        self.assertTrue(summary.startswith('fsl_sub profile (outer '))
+        for phase in ('outer.start', 'outer.inner', 'inner.work', 'inner '):
+            self.assertIn(phase, summary)
+        self.assertEqual(summary.count('\n'), 1)
+
+    def test_json(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            prof_file = os.path.join(tempdir, 'profile.json')
+            with patch.dict(os.environ, {
+                    'FSLSUB_PROFILE': prof_file,
+                    'FSLSUB_PROFILE_DUMP': 'cprofile'}):
+                outer(recurse=True)
+                outer()
+            with open(prof_file) as pf:
+                records = [json.loads(line) for line in pf]
+            self.assertEqual(len(records), 2)
+            phases = records[0]['phases']
+            # The recursive call is timed as part of the outermost call
+            self.assertLessEqual(
+                phases['outer.start'] + phases['outer.inner'], phases['outer'])
+            self.assertTrue(os.path.exists(records[0]['dump']))
+            self.assertEqual(os.path.dirname(records[0]['dump']), tempdir)
+
+    def test_enable_later(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            prof_file = os.path.join(tempdir, 'profile.json')
+            with patch.dict(os.environ, {'FSLSUB_PROFILE': ''}):
+                main(prof_file)
+            with open(prof_file) as pf:
+                record = json.loads(pf.read())
+        self.assertEqual(record['label'], 'main')
+        self.assertListEqual(
+            sorted(record['phases']),
+            ['inner', 'inner.work', 'main', 'main.parse',
+             'outer', 'outer.inner', 'outer.start'])
+
+
+if __name__ == '__main__':
+    unittest.main()
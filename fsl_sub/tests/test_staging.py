@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+import gzip
+import os
+import signal
+import subprocess
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+
+from fsl_sub import staging
+
+
+class TestSettings(unittest.TestCase):
+    @patch('fsl_sub.staging.read_config', return_value={})
+    def test_staging_dir(self, mock_rc):
+        with patch.dict(os.environ, {}, clear=True):
+            self.assertIsNone(staging.staging_dir())
+            self.assertIsNone(staging.script_staging_dir())
+        with patch.dict(os.environ, {'FSLSUB_LOG_STAGING': '0'}):
+            self.assertIsNone(staging.staging_dir())
+        with patch.dict(
+                os.environ,
+                {'FSLSUB_LOG_STAGING': 'true', 'TMPDIR': '/scratch'}):
+            self.assertEqual(staging.staging_dir(), '/scratch')
+            self.assertEqual(staging.script_staging_dir(), '${TMPDIR:-/tmp}')
+        with patch.dict(
+                os.environ,
+                {'FSLSUB_LOG_STAGING': '$JOBDIR/logs', 'JOBDIR': '/local'}):
+            self.assertEqual(staging.staging_dir(), '/local/logs')
+            self.assertEqual(staging.script_staging_dir(), '$JOBDIR/logs')
+        mock_rc.return_value = {'log_staging': True}
+        with patch.dict(os.environ, {'TMPDIR': '/scratch'}):
+            os.environ.pop('FSLSUB_LOG_STAGING', None)
+            self.assertEqual(staging.staging_dir(), '/scratch')
+
+
+class TestLogs(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+        self.stage = os.path.join(self.tempdir.name, 'stage')
+        self.logs = [
+            os.path.join(self.tempdir.name, n) for n in ('job.o1', 'job.e1')]
+        env = patch.dict(os.environ, {'FSLSUB_LOG_STAGING': self.stage})
+        env.start()
+        self.addCleanup(env.stop)
+
+    def _write(self, staged):
+        self.assertTrue(all(s.startswith(self.stage) for s in staged))
+        for s, text in zip(staged, ('out', 'err', )):
+            with open(s, 'w') as f:
+                f.write(text)
+        self.assertFalse(os.path.exists(self.logs[0]))
+
+    def test_moved(self):
+        with staging.logs(self.logs) as staged:
+            self._write(staged)
+        for log, text in zip(self.logs, ('out', 'err', )):
+            with open(log) as f:
+                self.assertEqual(f.read(), text)
+        self.assertListEqual(os.listdir(self.stage), [])
+
+    def test_moved_on_error(self):
+        with self.assertRaises(RuntimeError):
+            with staging.logs(self.logs) as staged:
+                self._write(staged)
+                raise RuntimeError()
+        self.assertTrue(all(os.path.exists(f) for f in self.logs))
+        self.assertListEqual(os.listdir(self.stage), [])
+
+    def test_moved_on_sigterm(self):
+        with self.assertRaises(SystemExit) as e:
+            with staging.logs(self.logs) as staged:
+                self._write(staged)
+                os.kill(os.getpid(), signal.SIGTERM)
+                time.sleep(5)
+        self.assertEqual(e.exception.code, 128 + signal.SIGTERM)
+        self.assertTrue(all(os.path.exists(f) for f in self.logs))
+        self.assertEqual(
+            signal.getsignal(signal.SIGTERM), signal.SIG_DFL)
+
+    def test_compressed(self):
+        with staging.logs(self.logs, 'gzip') as staged:
+            self._write(staged)
+        with gzip.open(self.logs[0] + '.gz', 'rt') as f:
+            self.assertEqual(f.read(), 'out')
+        self.assertFalse(os.path.exists(self.logs[0]))
+
+    def test_dev_null(self):
+        with staging.logs(['/dev/null', self.logs[1]]) as staged:
+            self.assertEqual(staged[0], '/dev/null')
+        self.assertTrue(os.path.exists('/dev/null'))
+
+    def test_disabled(self):
+        with patch.dict(os.environ, {'FSLSUB_LOG_STAGING': 'no'}):
+            with staging.logs(self.logs, 'gzip') as staged:
+                self.assertListEqual(staged, self.logs)
+                for s in staged:
+                    with open(s, 'w') as f:
+                        f.write('x')
+        self.assertTrue(all(os.path.exists(f + '.gz') for f in self.logs))
+
+
+class TestPrologue(unittest.TestCase):
+    def _script(self, folder, body, finish_lines=None):
+        return '\n'.join(
+            ['#!/bin/bash']
+            + staging.prologue(folder, finish_lines)
+            + body) + '\n'
+
+    def test_prologue(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            script = self._script(tempdir, [
+                'echo hello',
+                'echo oops >&2',
+                'ls "$fsl_sub_stage" > "{0}/staged"'.format(tempdir),
+                'exit 3',
+            ], ['echo finished'])
+            result = subprocess.run(
+                ['bash', '-c', script], stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE, universal_newlines=True,
+                cwd=tempdir)
+            self.assertEqual(result.returncode, 3)
+            self.assertEqual(result.stdout, 'hello\nfinished\n')
+            self.assertEqual(result.stderr, 'oops\n')
+            with open(os.path.join(tempdir, 'staged')) as f:
+                self.assertEqual(f.read(), 'stderr\nstdout\n')
+            self.assertListEqual(os.listdir(tempdir), ['staged'])
+
+    def test_prologue_folder(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            with self.subTest('Created'):
+                script = self._script(
+                    os.path.join(tempdir, 'stage'), ['echo hello'])
+                result = subprocess.run(
+                    ['bash', '-c', script], stdout=subprocess.PIPE,
+                    universal_newlines=True)
+                self.assertEqual(result.stdout, 'hello\n')
+                self.assertListEqual(
+                    os.listdir(os.path.join(tempdir, 'stage')), [])
+            with self.subTest('Unavailable'):
+                blocker = os.path.join(tempdir, 'file')
+                with open(blocker, 'w'):
+                    pass
+                script = self._script(
+                    os.path.join(blocker, 'stage'), ['echo hello', 'exit 2'],
+                    ['echo finished'])
+                result = subprocess.run(
+                    ['bash', '-c', script], stdout=subprocess.PIPE,
+                    stderr=subprocess.DEVNULL, universal_newlines=True)
+                self.assertEqual(result.returncode, 2)
+                self.assertEqual(result.stdout, 'hello\nfinished\n')
+
+    def test_prologue_terminated(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            script = self._script(tempdir, [
+                'echo started',
+                'sleep 30',
+            ])
+            # Schedulers signal the job's whole process group
+            p = subprocess.Popen(
+                ['bash', '-c', script], stdout=subprocess.PIPE,
+                universal_newlines=True, start_new_session=True,
+                cwd=tempdir)
+            for _ in range(100):
+                staged = [
+                    os.path.join(tempdir, d, 'stdout')
+                    for d in os.listdir(tempdir)]
+                if staged and os.path.getsize(staged[0]):
+                    break
+                time.sleep(0.05)
+            os.killpg(p.pid, signal.SIGTERM)
+            stdout, _ = p.communicate()
+            self.assertEqual(p.returncode, 143)
+            self.assertEqual(stdout, 'started\n')
+            self.assertListEqual(os.listdir(tempdir), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+import io
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from fsl_sub import tasklogs
+from fsl_sub.cmdline import logs_cmd
+from fsl_sub.exceptions import UnknownJobId
+
+
+class TestTaskLogs(unittest.TestCase):
+    def setUp(self):
+        self.tempd = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tempd.cleanup)
+        self.data = os.path.join(self.tempd.name, 'sweep.o1234')
+        tasklogs.create(self.data)
+        # Tasks finish out of order
+        for task_id, text in ((3, b'third\n'), (1, b'first\n'), (2, b''), ):
+            tasklogs.append(self.data, io.BytesIO(text), task_id)
+
+    def output(self, task_id, chunk=tasklogs.CHUNK):
+        out = io.BytesIO()
+        tasklogs.read(self.data, task_id, out, chunk)
+        return out.getvalue()
+
+    def test_read(self):
+        self.assertEqual(self.output(1), b'first\n')
+        self.assertEqual(self.output(3, chunk=2), b'third\n')
+        self.assertEqual(self.output(2), b'')
+        self.assertEqual(tasklogs.entry(self.data, 1), (6, 6, None))
+        self.assertListEqual(tasklogs.tasks(self.data), [1, 2, 3])
+        self.assertRaises(UnknownJobId, self.output, 4)
+        tasklogs.append(self.data, io.BytesIO(b'sixth\n'), 6)
+        self.assertRaises(UnknownJobId, self.output, 5)
+        self.assertListEqual(tasklogs.tasks(self.data), [1, 2, 3, 6])
+
+    def test_not_a_log(self):
+        with open(tasklogs.index_file(self.data), 'r+b') as idx:
+            idx.write(b'NOTALOG!')
+        self.assertRaises(ValueError, self.output, 1)
+
+    def test_logs_cmd(self):
+        tasklogs.create(os.path.join(self.tempd.name, 'sweep.e1234'))
+
+        def run(*args):
+            stdout = io.TextIOWrapper(io.BytesIO())
+            with patch('sys.stdout', stdout):
+                logs_cmd(['--logdir', self.tempd.name] + list(args))
+            return stdout.buffer.getvalue()
+        self.assertEqual(run('1234', '3'), b'third\n')
+        self.assertEqual(run('1234'), b'first\nthird\n')
+        self.assertEqual(run('1234', '--stderr'), b'')
+        with patch('sys.stderr', new_callable=io.StringIO) as stderr:
+            with self.assertRaises(SystemExit) as se:
+                run('999')
+        self.assertEqual(se.exception.code, 1)
+        self.assertIn('No logs for job 999', stderr.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+import os
+import subprocess
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+
+import fsl_sub
+from fsl_sub.config import read_config
+from fsl_sub.exceptions import BadSubmission
+from fsl_sub.uptodate import (
+    _id_ranges,
+    command_hash,
+    command_line,
+    completed_marker,
+    filter_array_file,
+    is_up_to_date,
+    record_on_success,
+)
+
+
+class TestUpToDate(unittest.TestCase):
+    def setUp(self):
+        self.tempd = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tempd.cleanup)
+        self.here = os.getcwd()
+        os.chdir(self.tempd.name)
+        self.addCleanup(os.chdir, self.here)
+        self.done_dir = os.path.join(self.tempd.name, 'done')
+        patcher = patch.dict(
+            'fsl_sub.uptodate.os.environ',
+            {'FSLSUB_COMPLETED_DIR': self.done_dir})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def touch(self, name, age=0):
+        path = os.path.join(self.tempd.name, name)
+        with open(path, 'w'):
+            pass
+        mtime = time.time() - age
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def test_command_line(self):
+        self.assertEqual(command_line('a b'), 'a b')
+        self.assertEqual(command_line(['a; b']), 'a; b')
+        self.assertEqual(command_line(['a', 'b c']), "a 'b c'")
+
+    def test_command_hash(self):
+        self.assertEqual(command_hash('a', '/x'), command_hash('a', '/x'))
+        self.assertNotEqual(command_hash('a', '/x'), command_hash('a', '/y'))
+        self.assertNotEqual(command_hash('a', '/x'), command_hash('b', '/x'))
+
+    def test_is_up_to_date(self):
+        old_in = self.touch('in', age=100)
+        new_out = self.touch('out', age=10)
+        with self.subTest('Outputs newer'):
+            self.assertTrue(is_up_to_date([old_in], [new_out]))
+        with self.subTest('Missing output'):
+            self.assertFalse(
+                is_up_to_date([old_in], [new_out, os.path.join(self.tempd.name, 'x')]))
+        with self.subTest('Input newer'):
+            new_in = self.touch('in2')
+            self.assertFalse(is_up_to_date([old_in, new_in], [new_out]))
+        with self.subTest('No outputs'):
+            self.assertFalse(is_up_to_date([old_in]))
+        with self.subTest('Missing input'):
+            with self.assertRaises(BadSubmission):
+                is_up_to_date([os.path.join(self.tempd.name, 'x')], [new_out])
+
+    def test_record_on_success(self):
+        for command, returncode in (('true', 0), ('false', 1), ):
+            with self.subTest(command):
+                marker = completed_marker(command)
+                self.assertFalse(is_up_to_date(cmd_line=command))
+                result = subprocess.run(['bash', '-c', record_on_success(command)])
+                self.assertEqual(result.returncode, returncode)
+                self.assertEqual(os.path.exists(marker), returncode == 0)
+                self.assertEqual(is_up_to_date(cmd_line=command), returncode == 0)
+
+    def test_filter_array_file(self):
+        task_file = os.path.join(self.tempd.name, 'tasks')
+        with open(task_file, 'w') as tf:
+            tf.write('echo a\necho b\necho c\n')
+        inp = self.touch('in', age=100)
+        out_a = self.touch('a', age=10)
+        with self.subTest('Nothing up to date'):
+            self.assertTupleEqual(
+                filter_array_file(task_file), (task_file, 0, None))
+        with self.subTest('Outputs per line'):
+            new_file, skipped, task_ids = filter_array_file(
+                task_file, inputs=[[inp]] * 3,
+                outputs=[[out_a], ['b'], ['c']])
+            self.assertEqual(skipped, 1)
+            self.assertEqual(task_ids, '2-3')
+            with open(new_file) as nf:
+                self.assertEqual(nf.read(), 'echo b\necho c\n')
+        with self.subTest('Wrong length'):
+            with self.assertRaises(BadSubmission):
+                filter_array_file(task_file, outputs=[[out_a]])
+        with self.subTest('Completed lines'):
+            subprocess.run(['bash', '-c', record_on_success('echo c')])
+            new_file, skipped, task_ids = filter_array_file(
+                task_file, skip_completed=True)
+            self.assertEqual(skipped, 1)
+            self.assertEqual(task_ids, '1-2')
+            with open(new_file) as nf:
+                lines = nf.read().splitlines()
+            self.assertListEqual(
+                lines, [record_on_success('echo a'), record_on_success('echo b')])
+        with self.subTest('All complete'):
+            subprocess.run(['bash', '-c', record_on_success('echo a')])
+            subprocess.run(['bash', '-c', record_on_success('echo b')])
+            self.assertTupleEqual(
+                filter_array_file(task_file, skip_completed=True),
+                (None, 3, None))
+
+    def test_submit_array_file(self):
+        read_config.cache_clear()
+        self.addCleanup(read_config.cache_clear)
+        task_file = self.touch('tasks')
+        with open(task_file, 'w') as tf:
+            tf.write('printenv FSLSUB_ARRAY_TASK_IDS\n' * 3)
+        job_id = fsl_sub.submit(
+            task_file, array_task=True,
+            outputs=[['out1'], [self.touch('out2')], ['out3']])
+        with open(os.path.join(
+                self.tempd.name, 'tasks.o{0}.2'.format(job_id))) as log:
+            self.assertEqual(log.read(), '1,3\n')
+        # The file holding the remaining tasks has been removed
+        self.assertListEqual(
+            [f for f in os.listdir(self.tempd.name) if f.endswith('.pending')],
+            [])
+
+    def test_id_ranges(self):
+        self.assertEqual(_id_ranges([1, 2, 3, 5, 7, 8]), '1-3,5,7-8')
+        self.assertEqual(_id_ranges([4]), '4')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -952,6 +952,91 @@ class TestConda(unittest.TestCase):
         self.assertEqual(fsl_sub.utils.conda_check_update(), update_dict)
 
 
+@patch(
+    'fsl_sub.utils.conda_json', autospec=True
+)
+class TestCondaQuery(unittest.TestCase):
+    def setUp(self):
+        tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tempdir.cleanup)
+        self.env = op.join(tempdir.name, 'env')
+        self.meta = op.join(self.env, 'conda-meta')
+        os.makedirs(self.meta)
+        env = patch.dict(
+            'fsl_sub.utils.os.environ',
+            {'FSLSUB_STATE_DIR': op.join(tempdir.name, 'state'), })
+        env.start()
+        self.addCleanup(env.stop)
+        fsl_sub.utils._conda_results.clear()
+        self.addCleanup(fsl_sub.utils._conda_results.clear)
+
+    def test_cached(self, mock_json):
+        mock_json.return_value = [{'name': 'fsl_sub'}, ]
+        for _ in range(2):
+            self.assertListEqual(
+                fsl_sub.utils.get_conda_packages(self.env), ['fsl_sub', ])
+        self.assertEqual(mock_json.call_count, 1)
+        with self.subTest("On disk"):
+            fsl_sub.utils._conda_results.clear()
+            fsl_sub.utils.get_conda_packages(self.env)
+            self.assertEqual(mock_json.call_count, 1)
+        with self.subTest("Environment changed"):
+            os.utime(self.meta, (0, 0))
+            fsl_sub.utils.get_conda_packages(self.env)
+            self.assertEqual(mock_json.call_count, 2)
+        with self.subTest("Caching disabled"):
+            with patch.dict(
+                    'fsl_sub.utils.os.environ',
+                    {'FSLSUB_CONDA_CACHE_TTL': '0', }):
+                fsl_sub.utils.get_conda_packages(self.env)
+            self.assertEqual(mock_json.call_count, 3)
+
+    def test_not_cached_outside_fsl(self, mock_json):
+        mock_json.return_value = [{'name': 'fsl_sub'}, ]
+        for _ in range(2):
+            fsl_sub.utils.get_conda_packages(op.join(self.env, 'missing'))
+        self.assertEqual(mock_json.call_count, 2)
+
+    def test_errors_not_cached(self, mock_json):
+        mock_json.side_effect = [PackageError('offline'), {'x': []}, ]
+        self.assertRaises(
+            PackageError, fsl_sub.utils.conda_query, 'search', 'x',
+            conda_env=self.env)
+        self.assertDictEqual(
+            fsl_sub.utils.conda_query('search', 'x', conda_env=self.env),
+            {'x': []})
+
+    @patch('fsl_sub.utils.conda_pkg_dirs_writeable', autospec=True, return_value=False)
+    @patch('fsl_sub.utils.conda_fsl_env', autospec=True)
+    def test_check_update_precedence(self, mock_env, mock_writeable, mock_json):
+        mock_env.return_value = self.env
+        mock_json.side_effect = PackageError('listing failed')
+        with self.assertRaises(PackageError) as e:
+            fsl_sub.utils.conda_check_update()
+        self.assertIn('No permission', str(e.exception))
+
+
+class TestCondaChannelsCache(unittest.TestCase):
+    def test_cached(self):
+        with tempfile.TemporaryDirectory() as fsldir:
+            os.makedirs(op.join(fsldir, 'etc', 'fslconf'))
+            env_file = op.join(
+                fsldir, 'etc', 'fslconf', 'fslpython_environment.yml')
+            with open(env_file, 'w') as ef:
+                ef.write('channels:\n - defaults\n')
+            fsl_sub.utils._load_conda_env_file.cache_clear()
+            for _ in range(2):
+                self.assertListEqual(
+                    fsl_sub.utils.conda_channels(fsldir), ['defaults', ])
+            self.assertEqual(
+                fsl_sub.utils._load_conda_env_file.cache_info().misses, 1)
+            with open(env_file, 'w') as ef:
+                ef.write('channels:\n - conda-forge\n')
+            os.utime(env_file, (0, 0))
+            self.assertListEqual(
+                fsl_sub.utils.conda_channels(fsldir), ['conda-forge', ])
+
+
 class TestPlugins(unittest.TestCase):
     def setUp(self):
         fsl_sub.utils.load_plugins.cache_clear()
@@ -1234,6 +1319,45 @@ class TestUtils(unittest.TestCase):
             sorted(['VAR=1', "VAR2"])
         )
 
+    def test_envspec(self):
+        spec = fsl_sub.utils.EnvSpec(['VAR', 'VAR2=a=b', ])
+        self.assertIsNone(spec['VAR'])
+        self.assertEqual(spec['VAR2'], 'a=b')
+        self.assertListEqual(list(spec), ['VAR', 'VAR2=a=b'])
+        spec.add('VAR=1')
+        spec.set('VAR3', 2)
+        self.assertEqual(spec, ['VAR=1', 'VAR2=a=b', 'VAR3=2'])
+        with self.subTest("No overwrite"):
+            spec.update(['VAR2=c', 'VAR4', ], overwrite=False)
+            self.assertEqual(
+                spec, ['VAR=1', 'VAR2=a=b', 'VAR3=2', 'VAR4'])
+        with self.subTest("Merge"):
+            other = fsl_sub.utils.EnvSpec({'VAR4': 'x', 'VAR5': None})
+            other.update(spec, overwrite=False)
+            self.assertEqual(
+                other, ['VAR4=x', 'VAR5', 'VAR=1', 'VAR2=a=b', 'VAR3=2'])
+            self.assertNotEqual(other, spec)
+            self.assertEqual(other.copy(), other)
+        with self.subTest("Render"):
+            self.assertDictEqual(
+                spec.assignments(), {'VAR': '1', 'VAR2': 'a=b', 'VAR3': '2'})
+            self.assertEqual(spec.render(), 'VAR=1,VAR2=a=b,VAR3=2,VAR4')
+            self.assertDictEqual(
+                spec.environment({'PATH': '/bin'}, {'VAR4': 'y', }),
+                {'PATH': '/bin', 'VAR': '1', 'VAR2': 'a=b', 'VAR3': '2',
+                 'VAR4': 'y'})
+        with self.subTest("Update list"):
+            fsl_sub.utils.update_envvar_list(spec, 'VAR4=z')
+            self.assertEqual(spec['VAR4'], 'z')
+
+    def test_control_threads_envspec(self):
+        env_vars = ['THREADS', ]
+        spec = fsl_sub.utils.EnvSpec(['OTHER', 'THREADS=4', ])
+        fsl_sub.utils.control_threads(
+            env_vars, 2, env_dict={}, add_to_list=spec)
+        self.assertEqual(spec, ['OTHER', 'THREADS=2', 'FSLSUB_PARALLEL=2'])
+        self.assertListEqual(env_vars, ['THREADS', ])
+
     @patch('fsl_sub.utils.shutil.which')
     def test_check_command(self, mock_which):
         mock_which.return_value = None
@@ -1665,6 +1789,14 @@ class TestMergeDict(unittest.TestCase):
                     'another': 'item', 'yetanother': 'value'},
                     'bvalue': 1, 'cvalue': [0, 1]}
             )
+        with self.subTest('Arguments unchanged'):
+            merged = fsl_sub.utils.merge_dict(a, d)
+            merged['avalue']['another'] = 'changed'
+            merged['bvalue'] = 2
+            self.assertDictEqual(
+                a, {'avalue': {'another': 'dict'}, 'bvalue': 1, 'cvalue': [0, 1, ]})
+            self.assertDictEqual(
+                d, {'avalue': {'something': 'else', 'yetanother': 'value'}})
 
 
 @patch('fsl_sub.utils.conda_json', autospec=True)
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+import unittest
+import fsl_sub
+import fsl_sub.consts
+from unittest.mock import (MagicMock, patch, )
+from fsl_sub.exceptions import (BadSubmission, UnknownJobId, )
+
+
+def _status(*states):
+    return {
+        'id': 1,
+        'tasks': {str(i + 1): {'status': s} for i, s in enumerate(states)},
+    }
+
+
+class FakePlugin(object):
+    pass
+
+
+@patch('fsl_sub.time.sleep', autospec=True)
+@patch(
+    'fsl_sub.read_config',
+    autospec=True,
+    return_value={'method': 'sge', })
+@patch('fsl_sub.load_plugins', autospec=True)
+class WaitTests(unittest.TestCase):
+    def setUp(self):
+        self.plugin = FakePlugin()
+        self.plugin.job_status = MagicMock(name='job_status')
+
+    def test_job_state(self, mock_lp, mock_rc, mock_sleep):
+        c = fsl_sub.consts
+        self.assertIsNone(fsl_sub._job_state(None))
+        self.assertEqual(fsl_sub._job_state(_status(c.FINISHED)), c.FINISHED)
+        self.assertEqual(
+            fsl_sub._job_state(_status(c.FINISHED, c.FAILED)), c.FAILED)
+        self.assertEqual(
+            fsl_sub._job_state(_status(c.FINISHED, c.QUEUED, c.RUNNING)), c.RUNNING)
+        self.assertEqual(
+            fsl_sub._job_state(_status(c.FAILED, c.HELD)), c.HELD)
+
+    def test_wait_all(self, mock_lp, mock_rc, mock_sleep):
+        c = fsl_sub.consts
+        mock_lp.return_value = {'fsl_sub_plugin_sge': self.plugin}
+        self.plugin.job_status.side_effect = [
+            _status(c.RUNNING), _status(c.QUEUED),
+            _status(c.FINISHED), _status(c.RUNNING),
+            _status(c.FAILED),
+        ]
+        done, not_done = fsl_sub.wait([1, 2], poll_interval=1)
+        self.assertDictEqual(done, {1: c.FINISHED, 2: c.FAILED})
+        self.assertDictEqual(not_done, {})
+        self.assertEqual(mock_sleep.call_count, 2)
+        # Back-off should increase the sleep interval
+        first = mock_sleep.call_args_list[0][0][0]
+        self.assertTrue(0.5 <= first <= 1)
+        second = mock_sleep.call_args_list[1][0][0]
+        self.assertTrue(0.75 <= second <= 1.5)
+
+    def test_wait_any(self, mock_lp, mock_rc, mock_sleep):
+        c = fsl_sub.consts
+        mock_lp.return_value = {'fsl_sub_plugin_sge': self.plugin}
+        self.plugin.job_status.side_effect = [
+            _status(c.RUNNING), _status(c.FINISHED),
+        ]
+        done, not_done = fsl_sub.wait([1, 2], mode=c.WAIT_ANY)
+        self.assertDictEqual(done, {2: c.FINISHED})
+        self.assertDictEqual(not_done, {1: c.RUNNING})
+        mock_sleep.assert_not_called()
+
+    def test_wait_batch(self, mock_lp, mock_rc, mock_sleep):
+        c = fsl_sub.consts
+        mock_lp.return_value = {'fsl_sub_plugin_sge': self.plugin}
+        self.plugin.job_status_batch = MagicMock(
+            name='job_status_batch',
+            return_value={1: _status(c.FINISHED), 2: _status(c.FINISHED)})
+        fsl_sub.wait([1, 2])
+        self.plugin.job_status_batch.assert_called_once_with([1, 2])
+        self.plugin.job_status.assert_not_called()
+
+    def test_wait_plugin_job_wait(self, mock_lp, mock_rc, mock_sleep):
+        mock_lp.return_value = {'fsl_sub_plugin_sge': self.plugin}
+        self.plugin.job_wait = MagicMock(
+            name='job_wait', return_value=({1: fsl_sub.consts.FINISHED}, {}))
+        fsl_sub.wait(1, timeout=10)
+        self.plugin.job_wait.assert_called_once_with([1], 10, 'all')
+
+    def test_wait_unknown(self, mock_lp, mock_rc, mock_sleep):
+        c = fsl_sub.consts
+        mock_lp.return_value = {'fsl_sub_plugin_sge': self.plugin}
+
+        def job_status(job_id):
+            if job_id == 2:
+                raise UnknownJobId("Unrecognised job id 2")
+            return _status(c.RUNNING)
+        self.plugin.job_status.side_effect = job_status
+        done, not_done = fsl_sub.wait([1, 2], mode=c.WAIT_ANY)
+        self.assertDictEqual(done, {2: c.UNKNOWN})
+        self.assertDictEqual(not_done, {1: c.RUNNING})
+        self.assertEqual(mock_sleep.call_count, fsl_sub.UNKNOWN_POLLS - 1)
+        with self.subTest('Reappears'):
+            mock_sleep.reset_mock()
+            self.plugin.job_status_batch = MagicMock(
+                name='job_status_batch',
+                side_effect=[{}, {}, {1: _status(c.QUEUED)}, {}, {},
+                             {1: _status(c.FINISHED)}])
+            done, not_done = fsl_sub.wait(1)
+            self.assertDictEqual(done, {1: c.FINISHED})
+
+    @patch('fsl_sub.time.monotonic', autospec=True)
+    def test_wait_timeout(self, mock_mono, mock_lp, mock_rc, mock_sleep):
+        c = fsl_sub.consts
+        mock_lp.return_value = {'fsl_sub_plugin_sge': self.plugin}
+        mock_mono.side_effect = [0, 5, 11]
+        self.plugin.job_status.return_value = _status(c.QUEUED)
+        done, not_done = fsl_sub.wait(1, timeout=10, poll_interval=20)
+        self.assertDictEqual(done, {})
+        self.assertDictEqual(not_done, {1: c.QUEUED})
+        # Sleep is limited to the time remaining
+        mock_sleep.assert_called_once_with(5)
+
+    def test_wait_shell(self, mock_lp, mock_rc, mock_sleep):
+        mock_rc.return_value = {'method': 'shell', }
+        self.assertTupleEqual(
+            fsl_sub.wait([1, 2]),
+            ({1: fsl_sub.consts.FINISHED, 2: fsl_sub.consts.FINISHED}, {}))
+        mock_lp.assert_not_called()
+
+    def test_bad_mode(self, mock_lp, mock_rc, mock_sleep):
+        with self.assertRaises(BadSubmission):
+            fsl_sub.wait(1, mode='some')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+import os
+import shutil
+import tempfile
+import unittest
+import fsl_sub.workflow
+from unittest.mock import patch
+from fsl_sub.exceptions import BadSubmission
+from fsl_sub.workflow import (
+    load_workflow,
+    submit_dag,
+)
+
+WORKFLOW = '''---
+defaults:
+  jobram: 4
+steps:
+  - name: prep
+    command: prep.sh
+  - name: fit_a
+    command: fit.sh a
+    depends: prep
+  - name: fit_b
+    command: fit.sh b
+    depends: prep
+  - name: post_a
+    command: post.sh a
+    depends: fit_a
+  - name: post_b
+    command: post.sh b
+    depends: fit_b
+  - name: merge
+    command: merge.sh
+    jobram: 16
+    depends: [prep, post_a, post_b, fit_a]
+'''
+
+
+class FakeSubmit(object):
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, command, **kwargs):
+        self.calls.append((command, kwargs))
+        if kwargs.get('array_task'):
+            with open(command, 'r') as tf:
+                kwargs['tasks'] = tf.read().splitlines()
+        return 100 + len(self.calls)
+
+
+@patch('fsl_sub.workflow.method_config', return_value={'array_holds': True})
+@patch('fsl_sub.workflow.read_config', return_value={'method': 'sge'})
+class TestWorkflow(unittest.TestCase):
+    def setUp(self):
+        self.tempd = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tempd.cleanup)
+        self.wf_file = os.path.join(self.tempd.name, 'pipeline.yml')
+        with open(self.wf_file, 'w') as wf:
+            wf.write(WORKFLOW)
+
+    def test_load_workflow(self, mock_rc, mock_mc):
+        steps, defaults = load_workflow(self.wf_file)
+        self.assertEqual(len(steps), 6)
+        self.assertDictEqual(defaults, {'jobram': 4})
+        with self.assertRaises(BadSubmission):
+            load_workflow(os.path.join(self.tempd.name, 'missing.yml'))
+
+    def test_submit_dag(self, mock_rc, mock_mc):
+        steps, defaults = load_workflow(self.wf_file)
+        fake = FakeSubmit()
+        with patch('fsl_sub.submit', new=fake):
+            job_ids = submit_dag(
+                steps, defaults, workdir=self.tempd.name)
+        self.assertEqual(len(fake.calls), 4)
+        prep, fit, post, merge = fake.calls
+        self.assertEqual(prep[0], 'prep.sh')
+        self.assertNotIn('jobhold', prep[1])
+        self.assertEqual(prep[1]['jobram'], 4)
+        with self.subTest('Fan-out collapsed to array'):
+            self.assertTrue(fit[1]['array_task'])
+            self.assertListEqual(fit[1]['tasks'], ['fit.sh a', 'fit.sh b'])
+            self.assertListEqual(fit[1]['jobhold'], ['101'])
+        with self.subTest('One-to-one dependencies use array hold'):
+            self.assertListEqual(post[1]['tasks'], ['post.sh a', 'post.sh b'])
+            self.assertEqual(post[1]['array_hold'], 102)
+            self.assertNotIn('jobhold', post[1])
+        with self.subTest('Implied holds removed'):
+            self.assertListEqual(merge[1]['jobhold'], ['103'])
+            self.assertEqual(merge[1]['jobram'], 16)
+        self.assertDictEqual(
+            job_ids,
+            {'prep': 101, 'fit_a': 102, 'fit_b': 102,
+             'post_a': 103, 'post_b': 103, 'merge': 104})
+
+    def test_no_array_holds(self, mock_rc, mock_mc):
+        mock_mc.return_value = {'array_holds': False}
+        steps, defaults = load_workflow(self.wf_file)
+        fake = FakeSubmit()
+        with patch('fsl_sub.submit', new=fake):
+            submit_dag(steps, defaults, workdir=self.tempd.name)
+        self.assertListEqual(fake.calls[2][1]['jobhold'], ['102'])
+
+    def test_no_collapse(self, mock_rc, mock_mc):
+        steps, defaults = load_workflow(self.wf_file)
+        fake = FakeSubmit()
+        with patch('fsl_sub.submit', new=fake):
+            submit_dag(steps, defaults, collapse_arrays=False, max_workers=1)
+        self.assertEqual(len(fake.calls), 6)
+        merge = fake.calls[-1]
+        # fit_a and prep are implied by post_a
+        self.assertListEqual(merge[1]['jobhold'], ['104', '105'])
+
+    def test_up_to_date_steps(self, mock_rc, mock_mc):
+        steps, defaults = load_workflow(self.wf_file)
+        fake = FakeSubmit()
+
+        def post_up_to_date(command, **kwargs):
+            job_id = fake(command, **kwargs)
+            if 'post.sh a' in fake.calls[-1][1].get('tasks', []):
+                return None
+            return job_id
+        with patch('fsl_sub.submit', new=post_up_to_date):
+            job_ids = submit_dag(steps, defaults, workdir=self.tempd.name)
+        merge = fake.calls[-1]
+        # Hold on the jobs the up to date array would have held on
+        self.assertListEqual(merge[1]['jobhold'], ['102'])
+        self.assertIsNone(job_ids['post_a'])
+
+        fake = FakeSubmit()
+
+        def prep_up_to_date(command, **kwargs):
+            job_id = fake(command, **kwargs)
+            return None if command == 'prep.sh' else job_id
+        with patch('fsl_sub.submit', new=prep_up_to_date):
+            submit_dag(steps, defaults, workdir=self.tempd.name)
+        self.assertNotIn('jobhold', fake.calls[1][1])
+        self.assertEqual(fake.calls[2][1]['array_hold'], 102)
+
+    @patch('fsl_sub.read_config', return_value={'method': 'sge'})
+    def test_workdir_removed(self, mock_frc, mock_rc, mock_mc):
+        steps, defaults = load_workflow(self.wf_file)
+        here = os.getcwd()
+        self.addCleanup(os.chdir, here)
+        os.chdir(self.tempd.name)
+
+        def workdirs():
+            return [
+                d for d in os.listdir(self.tempd.name)
+                if d.startswith('fsl_sub_workflow_')]
+        fake = FakeSubmit()
+        with patch('fsl_sub.submit', new=fake):
+            submit_dag(steps, defaults)
+        with self.subTest("Removed after the array tasks"):
+            cleanup = fake.calls[-1]
+            workdir = os.path.join(self.tempd.name, workdirs()[0])
+            self.assertListEqual(cleanup[0], ['rm', '-rf', workdir])
+            self.assertListEqual(cleanup[1]['jobhold'], [102, 103])
+        fake = FakeSubmit()
+        with patch('fsl_sub.submit', new=fake):
+            # Nothing submitted
+            with patch(
+                    'fsl_sub.workflow._submit_unit', return_value=None):
+                submit_dag(steps, defaults)
+        with self.subTest("Removed when nothing submitted"):
+            self.assertListEqual(fake.calls, [])
+            self.assertEqual(len(workdirs()), 1)
+        with self.subTest("Shell removes immediately"):
+            shutil.rmtree(workdir)
+            mock_frc.return_value = {'method': 'shell'}
+            with patch('fsl_sub.submit', new=FakeSubmit()):
+                submit_dag(steps, defaults)
+            self.assertListEqual(workdirs(), [])
+
+    def test_bad_workflows(self, mock_rc, mock_mc):
+        with self.subTest('Cycle'):
+            with self.assertRaises(BadSubmission):
+                submit_dag([
+                    {'name': 'a', 'command': 'a', 'depends': 'b'},
+                    {'name': 'b', 'command': 'b', 'depends': 'a'}, ])
+        with self.subTest('Unknown dependency'):
+            with self.assertRaises(BadSubmission):
+                submit_dag([{'name': 'a', 'command': 'a', 'depends': 'c'}])
+        with self.subTest('Duplicate'):
+            with self.assertRaises(BadSubmission):
+                submit_dag([
+                    {'name': 'a', 'command': 'a'},
+                    {'name': 'a', 'command': 'b'}, ])
+        with self.subTest('Bad option'):
+            with self.assertRaises(BadSubmission):
+                submit_dag([{'name': 'a', 'command': 'a', 'jobhold': 1}])
+
+    def test_dict_steps(self, mock_rc, mock_mc):
+        fake = FakeSubmit()
+        with patch('fsl_sub.submit', new=fake):
+            job_ids = submit_dag({
+                'a': {'command': ['echo', 'a b']},
+                'b': {'command': 'echo', 'depends': 'a', 'usescript': False}, })
+        self.assertDictEqual(job_ids, {'a': 101, 'b': 102})
+        self.assertEqual(fake.calls[1][1]['name'], 'b')
+        self.assertIs(fsl_sub.workflow.fsl_sub.submit, fsl_sub.submit)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+import os
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+
+import fsl_sub.utils
+from fsl_sub import wrappers
+
+
+class TestWrappers(unittest.TestCase):
+    def setUp(self):
+        self.tempd = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tempd.cleanup)
+        self.folder = os.path.join(self.tempd.name, 'wrappers')
+        self.script = [
+            '#!/bin/bash', '', '#$ -q short.q',
+            '# Command line: fsl_sub -q short.q bet',
+            '# Submission time (H:M:S DD/MM/YYYY): 10:00:00 01/01/2021',
+            '', 'bet in out', '']
+
+    def wrappers(self):
+        return sorted(
+            f for f in os.listdir(self.folder) if not f.startswith('.'))
+
+    def test_cached_wrapper(self):
+        path = wrappers.cached_wrapper(self.script, self.folder)
+        self.assertTrue(os.access(path, os.X_OK))
+        with open(path) as wf:
+            # Provenance comments are only true of the first submission
+            self.assertEqual(
+                wf.read(),
+                '\n'.join(self.script[:3] + self.script[5:]) + '\n')
+        with self.subTest('Provenance ignored'):
+            later = list(self.script)
+            later[4] = '# Submission time (H:M:S DD/MM/YYYY): 11:00:00 01/01/2021'
+            self.assertEqual(
+                wrappers.cached_wrapper(later, self.folder), path)
+        with self.subTest('Different script'):
+            other = self.script[:-2] + ['fast in', '']
+            self.assertNotEqual(
+                wrappers.cached_wrapper(other, self.folder), path)
+        self.assertEqual(len(self.wrappers()), 2)
+
+    def test_environment(self):
+        with patch.dict(os.environ, {'FSLSUB_WRAPPER_DIR': self.folder}):
+            self.assertEqual(wrappers.wrapper_dir(), self.folder)
+        with patch.dict(os.environ, {
+                'FSLSUB_WRAPPER_DIR': '', 'FSLSUB_STATE_DIR': self.tempd.name}):
+            with patch('fsl_sub.wrappers.read_config', return_value={}):
+                self.assertEqual(wrappers.wrapper_dir(), self.folder)
+
+    @patch('fsl_sub.wrappers.read_config', return_value={'wrapper_max_age': 60})
+    def test_collect(self, mock_rc):
+        old = wrappers.cached_wrapper(self.script, self.folder)
+        new = wrappers.cached_wrapper(self.script[:-2] + ['fast', ''], self.folder)
+        past = time.time() - 120
+        os.utime(old, (past, past))
+        self.assertEqual(wrappers.collect(self.folder), 1)
+        self.assertListEqual(self.wrappers(), [os.path.basename(new)])
+        with self.subTest('Reuse refreshes age'):
+            os.utime(new, (past, past))
+            wrappers.cached_wrapper(self.script[:-2] + ['fast', ''], self.folder)
+            self.assertEqual(wrappers.collect(self.folder), 0)
+
+
+class TestScriptTemplate(unittest.TestCase):
+    def test_reuse(self):
+        fsl_sub.utils._script_template.cache_clear()
+        for task in range(3):
+            script = fsl_sub.utils.job_script(
+                ['./mycommand', str(task)], [['-q', 'short.q'], '-V'],
+                '#$', ('sge', '2.0.0'))
+            self.assertEqual(script[2:4], ['#$ -q short.q', '#$ -V'])
+            self.assertEqual(script[-2], './mycommand ' + str(task))
+        info = fsl_sub.utils._script_template.cache_info()
+        self.assertEqual((info.hits, info.misses), (2, 1))
+
+    def test_job_options(self):
+        fsl_sub.utils._script_template.cache_clear()
+        scripts = [
+            fsl_sub.utils.job_script(
+                ['./mycommand'],
+                [['-q', 'short.q'], ['-N', name], ['-hold_jid', hold]],
+                '#$', ('sge', '2.0.0'), modules=['fsl'])
+            for name, hold in (('job_a', '1'), ('job_b', '2'), )]
+        info = fsl_sub.utils._script_template.cache_info()
+        # One compiled template, filled in with each job's options
+        self.assertEqual((info.hits, info.misses), (1, 1))
+        self.assertEqual(
+            scripts[0][2:6],
+            ['#$ -q short.q', '#$ -N job_a', '#$ -hold_jid 1', 'module load fsl'])
+        self.assertEqual(scripts[1][3:5], ['#$ -N job_b', '#$ -hold_jid 2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
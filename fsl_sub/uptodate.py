@@ -0,0 +1,164 @@
+# fsl_sub python module
+# Copyright (c) 2018-2021 University of Oxford (Duncan Mortimer)
+
+# Make-style checks for jobs that need not be re-run
+import hashlib
+import logging
+import os
+import shlex
+import tempfile
+
+from fsl_sub.exceptions import BadSubmission
+from fsl_sub.utils import fsl_sub_state_dir
+
+# Environment variable set to the original task ids of a filtered array task
+# file, see filter_array_file()
+TASK_IDS_VAR = 'FSLSUB_ARRAY_TASK_IDS'
+
+
+def _get_logger():
+    return logging.getLogger(__name__)
+
+
+def completed_dir():
+    '''Folder holding the markers of successfully completed commands.
+    Must be visible from the compute nodes.'''
+    try:
+        return os.environ['FSLSUB_COMPLETED_DIR']
+    except KeyError:
+        return os.path.join(fsl_sub_state_dir(), 'completed')
+
+
+def command_line(command):
+    '''Return command (list or string) as a single shell command line'''
+    if isinstance(command, str):
+        return command
+    if len(command) == 1:
+        return command[0]
+    return ' '.join(shlex.quote(str(c)) for c in command)
+
+
+def command_hash(cmd_line, cwd=None):
+    '''Hash of a command line and the folder it is run in'''
+    if cwd is None:
+        cwd = os.getcwd()
+    return hashlib.sha1(
+        '\0'.join((cwd, cmd_line)).encode('utf-8')).hexdigest()
+
+
+def completed_marker(cmd_line):
+    return os.path.join(completed_dir(), command_hash(cmd_line))
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def _newest(paths):
+    '''Newest modification time of paths, raises BadSubmission if an input
+    is missing'''
+    newest = 0
+    for p in paths:
+        mtime = _mtime(p)
+        if mtime is None:
+            raise BadSubmission("Input file {0} does not exist".format(p))
+        newest = max(newest, mtime)
+    return newest
+
+
+def is_up_to_date(inputs=None, outputs=None, cmd_line=None):
+    '''Returns True if all outputs exist and are newer than all the inputs,
+    or, if cmd_line is given, when this command has previously completed
+    successfully since the inputs were modified.'''
+    if inputs is None:
+        inputs = []
+    newest_input = _newest(inputs)
+    if outputs:
+        out_times = [_mtime(o) for o in outputs]
+        if None not in out_times and min(out_times) >= newest_input:
+            return True
+    if cmd_line is not None:
+        marker_time = _mtime(completed_marker(cmd_line))
+        if marker_time is not None and marker_time >= newest_input:
+            return True
+    return False
+
+
+def record_on_success(cmd_line):
+    '''Return a shell one-liner that runs cmd_line, records its successful
+    completion and exits with its exit status'''
+    os.makedirs(completed_dir(), exist_ok=True)
+    return "{0}; rc=$?; [ $rc -eq 0 ] && touch {1}; exit $rc".format(
+        cmd_line, shlex.quote(completed_marker(cmd_line)))
+
+
+def _per_line(spec, nlines, what):
+    if spec is None:
+        return [None] * nlines
+    if len(spec) != nlines:
+        raise BadSubmission(
+            "Array task {0} must be a list with an entry for each "
+            "line of the task file".format(what))
+    return spec
+
+
+def _id_ranges(ids):
+    '''Ascending task ids as a comma separated list of ids and first-last
+    ranges'''
+    ranges = []
+    for i in ids:
+        if ranges and ranges[-1][1] == i - 1:
+            ranges[-1][1] = i
+        else:
+            ranges.append([i, i])
+    return ','.join(
+        str(a) if a == b else '{0}-{1}'.format(a, b) for a, b in ranges)
+
+
+def filter_array_file(task_file, inputs=None, outputs=None, skip_completed=False):
+    '''Check each line of an array task file. inputs and outputs (if given)
+    are lists with one list of files per line.
+    Returns (task file to submit, number of lines skipped, task ids). The
+    task file is None if all lines are up to date, the original file if no
+    lines are, otherwise a new file holding only the lines that need to run
+    which the caller should remove once the tasks have run. task ids is
+    then the original line numbers of the new file's lines (see
+    _id_ranges(), exported to the tasks as TASK_IDS_VAR), otherwise None.'''
+    logger = _get_logger()
+    try:
+        with open(task_file, 'r') as tf:
+            lines = [line.strip() for line in tf.readlines()]
+    except OSError as e:
+        raise BadSubmission(
+            "Unable to read array task file {0}: {1}".format(task_file, str(e)))
+    inputs = _per_line(inputs, len(lines), 'inputs')
+    outputs = _per_line(outputs, len(lines), 'outputs')
+    pending = []
+    task_ids = []
+    for task_id, (line, l_inputs, l_outputs) in enumerate(
+            zip(lines, inputs, outputs), start=1):
+        if is_up_to_date(
+                l_inputs, l_outputs,
+                cmd_line=line if skip_completed else None):
+            continue
+        pending.append(line)
+        task_ids.append(task_id)
+    skipped = len(lines) - len(pending)
+    if not pending:
+        return (None, skipped, None)
+    if skip_completed:
+        pending = [record_on_success(line) for line in pending]
+    elif not skipped:
+        return (task_file, 0, None)
+    logger.info(
+        "{0} of {1} array tasks are up to date".format(skipped, len(lines)))
+    fd, new_file = tempfile.mkstemp(
+        prefix=os.path.basename(task_file) + '.',
+        suffix='.pending',
+        dir=os.path.dirname(os.path.abspath(task_file)))
+    with os.fdopen(fd, 'w') as nf:
+        nf.write('\n'.join(pending) + '\n')
+    return (new_file, skipped, _id_ranges(task_ids))
@@ -2,6 +2,7 @@
 # Copyright (c) 2018-2020, University of Oxford (Duncan Mortimer)
 
 import datetime
+import hashlib
 import importlib
 import json
 import logging
@@ -15,6 +16,9 @@ import shutil
 import subprocess
 import sys
 import tempfile
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from functools import lru_cache
 from math import ceil
 from ruamel.yaml.comments import CommentedMap
@@ -120,6 +124,21 @@ def get_plugin_queue_defs(plugin_name):
         return ''
 
 
+def get_plugin_live_queue_defs(plugin_name):
+    '''{queue: {limit: value}} of the limits the plugin's scheduler enforces,
+    or None if the plugin can't report them'''
+    PLUGINS = load_plugins()
+    grid_module = 'fsl_sub_plugin_' + plugin_name
+
+    if grid_module not in PLUGINS:
+        raise CommandError("Plugin {} not found". format(plugin_name))
+
+    try:
+        return PLUGINS[grid_module].live_queue_defs()
+    except AttributeError:
+        return None
+
+
 def get_plugin_already_queued(plugin_name):
     PLUGINS = load_plugins()
     grid_module = 'fsl_sub_plugin_' + plugin_name
@@ -285,45 +304,143 @@ def check_command_file(cmds):
     return lineno + 1
 
 
+class EnvSpec(object):
+    '''Ordered environment variables to export to a job. Each variable is
+    either passed through from the submitting environment (value None) or
+    set to a value. Setting, getting and merging are O(1) per variable and
+    a variable keeps its position when overwritten.
+
+    Iterating gives the 'VAR'/'VAR=VALUE' strings plugins have always been
+    passed as export_vars, so an EnvSpec compares equal to such a list.'''
+    __slots__ = ('_vars', )
+
+    def __init__(self, exports=None):
+        self._vars = OrderedDict()
+        if exports is not None:
+            self.update(exports)
+
+    @staticmethod
+    def parse(export):
+        '''Split 'VAR=VALUE' into ('VAR', 'VALUE') and 'VAR' into ('VAR', None)'''
+        name, equals, value = export.partition('=')
+        return (name, value if equals else None, )
+
+    def set(self, name, value=None, overwrite=True):
+        '''Export name (set to value if not None). If overwrite is False an
+        existing entry for name is left unchanged.'''
+        if overwrite or name not in self._vars:
+            self._vars[name] = None if value is None else str(value)
+
+    def add(self, export, overwrite=True):
+        '''Add a 'VAR' or 'VAR=VALUE' string'''
+        self.set(*self.parse(export), overwrite=overwrite)
+
+    def update(self, exports, overwrite=True):
+        '''Merge another EnvSpec, a dictionary or a list of 'VAR'/'VAR=VALUE'
+        strings'''
+        if isinstance(exports, EnvSpec):
+            exports = exports._vars
+        if isinstance(exports, dict):
+            for name, value in exports.items():
+                self.set(name, value, overwrite)
+        else:
+            for export in exports:
+                self.add(export, overwrite)
+
+    def get(self, name, default=None):
+        return self._vars.get(name, default)
+
+    def __getitem__(self, name):
+        return self._vars[name]
+
+    def __contains__(self, name):
+        return name in self._vars
+
+    def __len__(self):
+        return len(self._vars)
+
+    def __iter__(self):
+        for name, value in self._vars.items():
+            yield name if value is None else '='.join((name, value))
+
+    def __eq__(self, other):
+        if isinstance(other, EnvSpec):
+            return list(self._vars.items()) == list(other._vars.items())
+        if isinstance(other, (list, tuple, )):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __repr__(self):
+        return 'EnvSpec({0})'.format(list(self))
+
+    def copy(self):
+        return EnvSpec(self)
+
+    def names(self):
+        return list(self._vars)
+
+    def items(self):
+        '''(name, value) pairs, value is None for pass through variables'''
+        return self._vars.items()
+
+    def assignments(self):
+        '''Dictionary of the variables set to a value'''
+        return {k: v for k, v in self._vars.items() if v is not None}
+
+    def environment(self, base, source=None):
+        '''Return a copy of the dictionary base with the exports applied, pass
+        through variables are copied from source (default os.environ) where
+        they are set'''
+        if source is None:
+            source = os.environ
+        env = dict(base)
+        for name, value in self._vars.items():
+            if value is not None:
+                env[name] = value
+            elif name in source:
+                env[name] = source[name]
+        return env
+
+    def render(self, separator=','):
+        '''The exports as one string, e.g. for a scheduler's export option'''
+        return separator.join(self)
+
+
 def control_threads(env_vars, threads, env_dict=None, add_to_list=None):
     '''Set the specified environment variables to the number of
-    threads.'''
-    if isinstance(threads, int):
-        st = str(threads)
-    if 'FSLSUB_PARALLEL' not in env_vars:
-        env_vars.append('FSLSUB_PARALLEL')
+    threads. add_to_list may be an EnvSpec or list of exports.'''
+    st = str(threads)
+    names = list(env_vars)
+    if 'FSLSUB_PARALLEL' not in names:
+        names.append('FSLSUB_PARALLEL')
 
-    for ev in env_vars:
+    for ev in names:
         if env_dict is None:
             os.environ[ev] = st
         else:
             env_dict[ev] = st
 
-        export_item = '='.join((ev, st))
-        if add_to_list is not None:
-            update_envvar_list(add_to_list, export_item)
+        if isinstance(add_to_list, EnvSpec):
+            add_to_list.set(ev, st)
+        elif add_to_list is not None:
+            update_envvar_list(add_to_list, '='.join((ev, st)))
 
 
 def update_envvar_list(envlist, variable, overwrite=True):
-    '''Updates envlist (['VAR', 'VAR2=VALUE', ]) to include variable (variable string can contain =VALUE)
+    '''Updates envlist (['VAR', 'VAR2=VALUE', ] or an EnvSpec) to include variable (variable string can contain =VALUE)
     will ensure no duplicates or multiple setting of same variable to different values.
-    If overwrite is True will overwrite existing value in envlist, otherwise will only add missing variables.'''
-    if len(envlist) == 0:
-        envlist.append(variable)
+    If overwrite is True will overwrite existing value in envlist, otherwise will only add missing variables.
+    Prefer EnvSpec.add(), updating a list is O(n).'''
+    if isinstance(envlist, EnvSpec):
+        envlist.add(variable, overwrite)
         return
-    # Remove any =...
-    var = variable.split('=')[0]
-
-    found = False
+    var = EnvSpec.parse(variable)[0]
     for index, lvar in enumerate(envlist):
-        if '=' in lvar:
-            lvar = lvar.split('=')[0]
-        if lvar == var:
-            found = True
+        if EnvSpec.parse(lvar)[0] == var:
             if overwrite:
-                envlist.pop(index)
-    if (found and overwrite) or not found:
-        envlist.append(variable)
+                envlist[index] = variable
+            return
+    envlist.append(variable)
 
 
 def split_ram_by_slots(jram, jslots):
@@ -388,6 +505,14 @@ def user_input(prompt):
     return input(prompt)
 
 
+def fsl_sub_state_dir():
+    '''Folder for fsl_sub's per-user state, FSLSUB_STATE_DIR or ~/.fsl_sub'''
+    try:
+        return os.environ['FSLSUB_STATE_DIR']
+    except KeyError:
+        return os.path.join(os.path.expanduser('~'), '.fsl_sub')
+
+
 @lru_cache()
 def find_fsldir(prompt=True):
     fsldir = None
@@ -437,22 +562,31 @@ def conda_bin(fsldir=None):
     return conda_bin
 
 
+@lru_cache()
+def _load_conda_env_file(env_file, mtime):
+    '''Parsed environment YAML, cached on the file's modification time'''
+    yaml = YAML(typ='safe')
+    with open(env_file, "r") as fsl_pyenv:
+        return yaml.load(fsl_pyenv)
+
+
 def conda_channels(fsldir=None):
     channels = []
-    yaml = YAML(typ='safe')
     if fsldir is None:
         fsldir = find_fsldir(fsldir)
     if fsldir is not None:
+        env_file = os.path.join(
+            fsldir,
+            'etc',
+            'fslconf',
+            'fslpython_environment.yml')
         try:
-            with open(
-                    os.path.join(
-                        fsldir,
-                        'etc',
-                        'fslconf',
-                        'fslpython_environment.yml'),
-                    "r") as fsl_pyenv:
-                conda_env = yaml.load(fsl_pyenv)
-
+            try:
+                mtime = os.stat(env_file).st_mtime
+            except OSError:
+                conda_env = _load_conda_env_file.__wrapped__(env_file, None)
+            else:
+                conda_env = _load_conda_env_file(env_file, mtime)
         except Exception as e:
             raise NoCondaEnvFile(
                 "Unable to access fslpython_environment.yml file: "
@@ -557,16 +691,105 @@ def conda_json(command, options, with_channel=True):
     return conda_result
 
 
+CONDA_CACHE_TTL = 3600
+# Read only conda commands (conda_query()) results, keyed on the command and
+# the state of the FSL environment
+_conda_results = {}
+
+
+def conda_cache_ttl():
+    '''Seconds conda query results are reused for, FSLSUB_CONDA_CACHE_TTL
+    (0 disables caching)'''
+    try:
+        return int(os.environ.get('FSLSUB_CONDA_CACHE_TTL', CONDA_CACHE_TTL))
+    except ValueError:
+        return CONDA_CACHE_TTL
+
+
+def _conda_stamp(conda_env=None, fsldir=None):
+    '''Modification time of the FSL environment's conda-meta folder, which
+    changes whenever packages are installed, updated or removed, or None if
+    there is no FSL conda environment'''
+    try:
+        if conda_env is None:
+            if fsldir is None:
+                fsldir = find_fsldir(prompt=False)
+            if fsldir is None:
+                return None
+            conda_env = conda_fsl_env(fsldir)
+        return os.stat(os.path.join(conda_env, 'conda-meta')).st_mtime
+    except (NoCondaEnv, OSError, ):
+        return None
+
+
+def conda_query(command, options, with_channel=True, conda_env=None, fsldir=None):
+    '''conda_json() for read only commands (info, list, search and
+    update --dry-run). Results are reused while the FSL conda environment
+    (conda_env, or that of fsldir) is unchanged - once per process and for
+    conda_cache_ttl() seconds on disk (in fsl_sub's state folder). Results
+    aren't cached outside an FSL conda environment.'''
+    if isinstance(options, str):
+        options = [options, ]
+    stamp = _conda_stamp(conda_env, fsldir)
+    ttl = conda_cache_ttl()
+    if stamp is None or ttl <= 0:
+        return conda_json(command, options, with_channel)
+    key = json.dumps([command, list(options), with_channel, stamp, ])
+    try:
+        return _conda_results[key]
+    except KeyError:
+        pass
+    folder = os.path.join(fsl_sub_state_dir(), 'conda')
+    cache_file = os.path.join(
+        folder, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json')
+    try:
+        with open(cache_file, 'r') as cf:
+            cached = json.load(cf)
+        if cached['key'] == key and time.time() - cached['time'] < ttl:
+            _conda_results[key] = cached['result']
+            return cached['result']
+    except (OSError, ValueError, KeyError, TypeError, ):
+        pass
+    result = conda_json(command, options, with_channel)
+    _conda_results[key] = result
+    try:
+        os.makedirs(folder, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=folder, prefix='.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as cf:
+                json.dump(
+                    {'key': key, 'time': time.time(), 'result': result, }, cf)
+            os.replace(tmp_path, cache_file)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+    except OSError:
+        # Caching is an optimisation only
+        pass
+    return result
+
+
+def _concurrently(*calls):
+    '''Run the (function, args) calls in parallel threads, returning their
+    (finished) futures in order so results/exceptions can be taken in order
+    of precedence'''
+    with ThreadPoolExecutor(max_workers=len(calls)) as executor:
+        return [executor.submit(f, *args) for f, args in calls]
+
+
 def conda_find_packages(match, fsldir=None):
     if isinstance(match, str):
         match = [match, ]
-    if not conda_pkg_dirs_writeable(fsldir):
+    writeable, search = _concurrently(
+        (conda_pkg_dirs_writeable, (fsldir, )),
+        (conda_query, ('search', match, True, None, fsldir, )), )
+    if not writeable.result():
         raise PackageError(
             "No permission to change Conda environment folder, re-try with "
             "'sudo --preserve-env=FSLDIR fsl_sub_plugin -l'.")
 
     try:
-        conda_result = conda_json('search', match)
+        conda_result = search.result()
     except PackageError as e:
         raise PackageError(
             "Unable to search for packages! ({0})".format(e))
@@ -578,7 +801,7 @@ def conda_pkg_dirs_writeable(fsldir=None):
     if fsldir is None:
         fsldir = find_fsldir()
     try:
-        conda_result = conda_json('info', [], with_channel=False)
+        conda_result = conda_query('info', [], with_channel=False, fsldir=fsldir)
     except PackageError as e:
         raise PackageError("Unable to check for updates ({0})".format(str(e)))
 
@@ -599,7 +822,7 @@ def get_conda_packages(conda_env):
     ]
 
     try:
-        conda_result = conda_json('list', args, with_channel=False)
+        conda_result = conda_query('list', args, with_channel=False, conda_env=conda_env)
     except PackageError as e:
         raise PackageError("Unable to get package listing ({0})".format(str(e)))
 
@@ -612,13 +835,16 @@ def conda_check_update(fsldir=None):
     except NoCondaEnv as e:
         raise PackageError("Unable to check for updates ({0})".format(str(e)))
 
-    if not conda_pkg_dirs_writeable(fsldir):
+    writeable, listing = _concurrently(
+        (conda_pkg_dirs_writeable, (fsldir, )),
+        (get_conda_packages, (conda_env, )), )
+    if not writeable.result():
         raise PackageError(
             "No permission to change Conda environment folder, re-try with "
             "'sudo --preserve-env=FSLDIR fsl_sub_update -c'.")
 
     try:
-        packages = get_conda_packages(conda_env)
+        packages = listing.result()
     except PackageError as e:
         raise UpdateError(e)
 
@@ -633,7 +859,7 @@ def conda_check_update(fsldir=None):
     ]
     args.extend(packages)
     try:
-        conda_result = conda_json('update', args)
+        conda_result = conda_query('update', args, conda_env=conda_env)
     except PackageError as e:
         raise UpdateError("Unable to check for updates ({0})".format(str(e)))
 
@@ -673,13 +899,16 @@ def conda_update(fsldir=None):
     except NoCondaEnv as e:
         raise UpdateError("Unable to update! ({0})".format(str(e)))
 
-    if not conda_pkg_dirs_writeable(fsldir):
+    writeable, listing = _concurrently(
+        (conda_pkg_dirs_writeable, (fsldir, )),
+        (get_conda_packages, (conda_env, )), )
+    if not writeable.result():
         raise UpdateError(
             "No permission to change Conda environment folder, re-try with "
             "'sudo --preserve-env=FSLDIR fsl_sub_update'.")
 
     try:
-        packages = get_conda_packages(conda_env)
+        packages = listing.result()
     except PackageError as e:
         raise UpdateError(e)
 
@@ -807,12 +1036,44 @@ def writelines_nl(fh, lines):
     fh.writelines(listplusnl(lines))
 
 
-def job_script(command, command_args, q_prefix, q_plugin, modules=None, extra_lines=None, modules_paths=None):
+@lru_cache(maxsize=128)
+def _script_template(bash, q_plugin, modules, modules_paths, version):
+    '''Job script header for a plugin and set of modules, as the lines
+    before and after the scheduler options. The options (queue, job name,
+    holds, log folders, array...) differ between jobs so are added by
+    job_script().'''
+    logger = logging.getLogger('fsl_sub.fsl_sub_plugin_' + q_plugin[0])
+    job_def = []
+    logger.debug("Creating module load lines")
+    logger.debug("Adding modules paths")
+    if modules_paths:
+        mpaths = list(modules_paths)
+        mpaths.append('$MODULEPATH')
+        job_def.append('MODULEPATH=' + ':'.join(mpaths))
+    logger.debug("Module list is " + str(modules))
+    for module in modules:
+        job_def.append("module load " + module)
+
+    job_def.append(
+        "# Built by fsl_sub v.{0} and fsl_sub_plugin_{1} v.{2}".format(
+            version, q_plugin[0], q_plugin[1]
+        ))
+    return (('#!' + bash, '', ), tuple(job_def), )
+
+
+def job_script(command, command_args, q_prefix, q_plugin, modules=None, extra_lines=None, modules_paths=None, epilogue=None):
     '''Build a job script for 'command' with arguments 'command_args'.
     q_prefix is prefix to add to queue command lines,
     q_plugin is a tuple (plugin short name, plugin_version)
     modules is a list of shell modules to load and extra_lines will be added between the
-    header and the command line'''
+    header and the command line
+    epilogue is a list of lines run after the command (which must not exec),
+    the script exits with the command's exit status, e.g.
+    fsl_sub.compression.epilogue()
+
+    Headers are compiled once per plugin and set of modules (see
+    _script_template), so repeated submissions only add the scheduler
+    options and the command.'''
 
     if modules_paths is None:
         modules_paths = []
@@ -820,31 +1081,18 @@ def job_script(command, command_args, q_prefix, q_plugin, modules=None, extra_li
         modules = []
     if extra_lines is None:
         extra_lines = []
-    logger = logging.getLogger('fsl_sub.fsl_sub_plugin_' + q_plugin[0])
-    bash = bash_cmd()
 
-    job_def = ['#!' + bash, '', ]
+    head, tail = _script_template(
+        bash_cmd(), tuple(q_plugin), tuple(modules), tuple(modules_paths),
+        VERSION)
+    job_def = list(head)
     for cmd in command_args:
-        if type(cmd) is list:
+        if type(cmd) in (list, tuple, ):
             cmd = [str(c) for c in cmd]
             job_def.append(' '.join((q_prefix, ' '.join(cmd))))
         else:
             job_def.append(' '.join((q_prefix, str(cmd))))
-
-    logger.debug("Creating module load lines")
-    logger.debug("Adding modules paths")
-    if modules_paths:
-        mpaths = list(modules_paths)
-        mpaths.append('$MODULEPATH')
-        job_def.append('MODULEPATH=' + ':'.join(mpaths))
-    logger.debug("Module list is " + str(modules))
-    for module in modules:
-        job_def.append("module load " + module)
-
-    job_def.append(
-        "# Built by fsl_sub v.{0} and fsl_sub_plugin_{1} v.{2}".format(
-            VERSION, q_plugin[0], q_plugin[1]
-        ))
+    job_def.extend(tail)
     job_def.append("# Command line: " + " ".join(sys.argv))
     job_def.append("# Submission time (H:M:S DD/MM/YYYY): " + datetime.datetime.now().strftime("%H:%M:%S %d/%m/%Y"))
     job_def.append('')
@@ -853,11 +1101,17 @@ def job_script(command, command_args, q_prefix, q_plugin, modules=None, extra_li
         job_def.append(" ".join(command))
     else:
         job_def.append(command)
+    if epilogue:
+        job_def.append('fsl_sub_status=$?')
+        job_def.extend(epilogue)
+        job_def.append('exit $fsl_sub_status')
     job_def.append('')
     return job_def
 
 
 def write_wrapper(content):
+    '''Write the job script lines in content to a new temporary file owned
+    by the caller, see fsl_sub.wrappers.cached_wrapper() for a shared copy'''
     with tempfile.NamedTemporaryFile(
             mode='wt',
             delete=False) as wrapper:
@@ -867,13 +1121,16 @@ def write_wrapper(content):
 
 
 def merge_dict(base_dict, addition_dict):
-    for k, v in base_dict.items():
-        if k in addition_dict:
-            if type(addition_dict[k]) == dict:
-                addition_dict[k] = merge_dict(v, addition_dict[k])
-    new_dict = base_dict.copy()
-    new_dict.update(addition_dict)
-    return new_dict
+    '''Return base_dict updated with addition_dict, recursing into
+    dictionaries present in both. Neither argument is modified - only the
+    dictionaries present in both are rebuilt, other values are shared with
+    the arguments.'''
+    merged = dict(base_dict)
+    for k, v in addition_dict.items():
+        if isinstance(v, dict) and isinstance(merged.get(k), dict):
+            v = merge_dict(merged[k], v)
+        merged[k] = v
+    return merged
 
 
 def merge_commentedmap(d, n):
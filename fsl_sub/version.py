@@ -1 +1 @@
-VERSION = '2.5.8'
+VERSION = '2.6.0'
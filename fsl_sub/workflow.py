@@ -0,0 +1,348 @@
+# fsl_sub python module
+# Copyright (c) 2018-2021 University of Oxford (Duncan Mortimer)
+
+# Submission of pipelines of interdependent steps
+import inspect
+import logging
+import os
+import shlex
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from ruamel.yaml import (YAML, YAMLError, )
+
+import fsl_sub
+from fsl_sub.config import (
+    method_config,
+    read_config,
+)
+from fsl_sub.exceptions import BadSubmission
+
+# Options that are managed by the workflow rather than the step
+_RESERVED = ('jobhold', 'array_hold', 'as_tuple', 'command', )
+
+
+def _get_logger():
+    return logging.getLogger(__name__)
+
+
+_SUBMIT_OPTIONS = [
+    a for a in inspect.signature(fsl_sub.submit).parameters
+    if a not in _RESERVED]
+
+
+class _Unit(object):
+    '''A single job submission - either one step or several collapsed steps
+    forming an array task'''
+    __slots__ = ('steps', 'deps', 'options', 'job_id', 'array_parent', )
+
+    def __init__(self, steps, deps, options):
+        self.steps = steps
+        self.deps = deps
+        self.options = options
+        self.job_id = None
+        self.array_parent = None
+
+    @property
+    def name(self):
+        return self.steps[0]['name']
+
+
+def load_workflow(filename):
+    '''Read a workflow YAML file, returns (steps, defaults)'''
+    yaml = YAML(typ='safe')
+    try:
+        with open(filename, 'r') as wf:
+            workflow = yaml.load(wf)
+    except (OSError, YAMLError, ) as e:
+        raise BadSubmission(
+            "Unable to read workflow file {0}: {1}".format(filename, str(e)))
+    if not isinstance(workflow, dict) or 'steps' not in workflow:
+        raise BadSubmission("Workflow file must define 'steps'")
+    return (workflow['steps'], workflow.get('defaults', {}))
+
+
+def _normalise_steps(steps, defaults):
+    '''Return list of step dicts with name, command, depends and options'''
+    if isinstance(steps, dict):
+        steps = [dict(spec, name=name) for name, spec in steps.items()]
+    normalised = []
+    names = set()
+    for index, step in enumerate(steps):
+        try:
+            name = str(step['name'])
+            command = step['command']
+        except (KeyError, TypeError, ):
+            raise BadSubmission(
+                "Workflow step {0} must have a name and command".format(index + 1))
+        if name in names:
+            raise BadSubmission("Duplicate workflow step " + name)
+        names.add(name)
+        depends = step.get('depends', [])
+        if depends is None:
+            depends = []
+        elif isinstance(depends, str):
+            depends = [depends, ]
+        options = dict(defaults)
+        for k, v in step.items():
+            if k in ('name', 'command', 'depends', ):
+                continue
+            if k not in _SUBMIT_OPTIONS:
+                raise BadSubmission(
+                    "Unrecognised option '{0}' in workflow step {1}".format(k, name))
+            options[k] = v
+        options.setdefault('name', name)
+        normalised.append({
+            'name': name,
+            'command': command,
+            'depends': [str(d) for d in depends],
+            'options': options,
+        })
+    for step in normalised:
+        for d in step['depends']:
+            if d not in names:
+                raise BadSubmission(
+                    "Workflow step {0} depends on unknown step {1}".format(
+                        step['name'], d))
+    return normalised
+
+
+def _levels(steps):
+    '''Topologically sort steps, returning a list of levels, each a list
+    of steps whose dependencies are all in earlier levels'''
+    remaining = {s['name']: s for s in steps}
+    placed = set()
+    levels = []
+    while remaining:
+        level = [
+            s for s in remaining.values()
+            if all(d in placed for d in s['depends'])]
+        if not level:
+            raise BadSubmission(
+                "Workflow contains a dependency cycle involving: "
+                + ', '.join(sorted(remaining.keys())))
+        for s in level:
+            del remaining[s['name']]
+        placed.update(s['name'] for s in level)
+        levels.append(level)
+    return levels
+
+
+def _collapsible(step):
+    options = step['options']
+    return not (
+        options.get('array_task', False)
+        or options.get('usescript', False))
+
+
+def _options_key(options):
+    return repr(sorted(
+        (k, v) for k, v in options.items() if k != 'name'))
+
+
+def _build_units(levels, collapse_arrays):
+    '''Group steps into submission units, collapsing fan-out steps with
+    identical dependencies and resources into array tasks. Steps that each
+    depend on a different task of one array are also collapsed, ordered to
+    match the parent array.'''
+    step_unit = {}
+    unit_levels = []
+    for level in levels:
+        groups = {}
+        units = []
+        for step in level:
+            if collapse_arrays and _collapsible(step):
+                key = (tuple(sorted(step['depends'])), _options_key(step['options']), )
+                if key in groups:
+                    groups[key].steps.append(step)
+                    step_unit[step['name']] = groups[key]
+                    continue
+            unit = _Unit([step, ], None, dict(step['options']))
+            if collapse_arrays and _collapsible(step):
+                groups[key] = unit
+            units.append(unit)
+            step_unit[step['name']] = unit
+
+        if collapse_arrays:
+            chains = {}
+            for unit in list(units):
+                step = unit.steps[0]
+                if len(unit.steps) > 1 or not _collapsible(step) or len(step['depends']) != 1:
+                    continue
+                parent = step_unit[step['depends'][0]]
+                if len(parent.steps) < 2:
+                    continue
+                key = (id(parent), _options_key(step['options']), )
+                chains.setdefault(key, (parent, []))[1].append(unit)
+            for parent, chained in chains.values():
+                if len(chained) < 2:
+                    continue
+                order = {s['name']: i for i, s in enumerate(parent.steps)}
+                chained.sort(key=lambda u: order[u.steps[0]['depends'][0]])
+                merged = chained[0]
+                for unit in chained[1:]:
+                    merged.steps.append(unit.steps[0])
+                    step_unit[unit.steps[0]['name']] = merged
+                    units.remove(unit)
+
+        for unit in units:
+            unit.deps = []
+            for step in unit.steps:
+                for d in step['depends']:
+                    if step_unit[d] not in unit.deps:
+                        unit.deps.append(step_unit[d])
+        unit_levels.append(units)
+    return unit_levels, step_unit
+
+
+def _reduce_holds(unit_levels):
+    '''Remove dependencies that are implied by other dependencies'''
+    ancestors = {}
+    for units in unit_levels:
+        for unit in units:
+            anc = set()
+            for d in unit.deps:
+                anc.add(id(d))
+                anc.update(ancestors[id(d)])
+            ancestors[id(unit)] = anc
+            unit.deps = [
+                d for d in unit.deps
+                if not any(
+                    id(d) in ancestors[id(o)] for o in unit.deps if o is not d)]
+
+
+def _find_array_parent(unit):
+    '''If each task of this array depends only on the matching task of a
+    single array of the same size, return that array'''
+    if len(unit.steps) < 2 or len(unit.deps) != 1:
+        return None
+    parent = unit.deps[0]
+    if len(parent.steps) != len(unit.steps):
+        return None
+    for step, p_step in zip(unit.steps, parent.steps):
+        if step['depends'] != [p_step['name'], ]:
+            return None
+    return parent
+
+
+def _command_line(command):
+    if isinstance(command, list):
+        return ' '.join(shlex.quote(str(c)) for c in command)
+    return command
+
+
+def _hold_ids(unit):
+    '''Job ids to hold on, replacing steps that were up to date (and so
+    not submitted) with the jobs they would have held on'''
+    holds = set()
+    for d in unit.deps:
+        if d.job_id is None:
+            holds.update(_hold_ids(d))
+        else:
+            holds.add(str(d.job_id))
+    return holds
+
+
+def _submit_unit(unit, workdir, array_holds):
+    options = dict(unit.options)
+    if (unit.array_parent is not None and array_holds
+            and unit.array_parent.job_id is not None):
+        options['array_hold'] = unit.array_parent.job_id
+    else:
+        holds = _hold_ids(unit)
+        if holds:
+            options['jobhold'] = sorted(holds)
+    if len(unit.steps) == 1:
+        command = unit.steps[0]['command']
+    else:
+        command = os.path.join(workdir, unit.name + '.tasks')
+        with open(command, 'w') as tf:
+            for step in unit.steps:
+                tf.write(_command_line(step['command']) + '\n')
+        options['array_task'] = True
+    return fsl_sub.submit(command, **options)
+
+
+def submit_dag(
+        steps, defaults=None, collapse_arrays=True,
+        workdir=None, max_workers=4):
+    '''Submit a pipeline of interdependent steps, returns a dict of
+    job ids keyed on step name (steps collapsed into an array task share
+    the array's job id, steps that were up to date have None).
+
+    Requires:
+
+    steps - list of dicts (or dict keyed on step name) with keys:
+        name - unique name of the step (also used as the job name)
+        command - command line (string or list)
+        depends - optional step name or list of step names that must
+            complete before this step can run
+        any other fsl_sub.submit option, e.g. jobram, jobtime, threads
+
+    Optional:
+    defaults - dict of fsl_sub.submit options applied to all steps
+    collapse_arrays - submit steps with identical dependencies and options
+            as a single array task
+    workdir - folder to write array task files into, defaults to a new
+            folder in the current directory, removed once the array tasks
+            have finished
+    max_workers - number of jobs of each level submitted concurrently
+
+    Steps are submitted level by level in dependency order, holding only on
+    the jobs that are not already implied by another hold. Steps that are up
+    to date are not submitted and their dependents hold on the jobs they
+    would have held on instead.
+    '''
+    logger = _get_logger()
+    if defaults is None:
+        defaults = {}
+    steps = _normalise_steps(steps, defaults)
+    levels = _levels(steps)
+    unit_levels, step_unit = _build_units(levels, collapse_arrays)
+    _reduce_holds(unit_levels)
+    for units in unit_levels:
+        for unit in units:
+            unit.array_parent = _find_array_parent(unit)
+
+    config = read_config()
+    array_holds = method_config(config['method']).get('array_holds', False)
+    if config['method'] == 'shell':
+        # Shell jobs run on submission so must be run in order
+        max_workers = 1
+    own_workdir = False
+    if any(len(u.steps) > 1 for units in unit_levels for u in units):
+        if workdir is None:
+            workdir = tempfile.mkdtemp(
+                prefix='fsl_sub_workflow_', dir=os.getcwd())
+            own_workdir = True
+        else:
+            os.makedirs(workdir, exist_ok=True)
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            for level, units in enumerate(unit_levels):
+                logger.info(
+                    "Submitting workflow level {0} ({1} jobs)".format(
+                        level + 1, len(units)))
+                job_ids = pool.map(
+                    lambda u: _submit_unit(u, workdir, array_holds), units)
+                for unit, job_id in zip(units, job_ids):
+                    unit.job_id = job_id
+                    logger.debug("{0}: {1}".format(unit.name, job_id))
+    finally:
+        if own_workdir:
+            _remove_workdir(workdir, unit_levels)
+
+    return {name: unit.job_id for name, unit in step_unit.items()}
+
+
+def _remove_workdir(workdir, unit_levels):
+    '''Remove the array task files once the array tasks reading them have
+    finished, or now if none were submitted'''
+    job_ids = [
+        u.job_id for units in unit_levels for u in units
+        if len(u.steps) > 1 and u.job_id is not None]
+    if job_ids:
+        fsl_sub._remove_after([workdir, ], job_ids, 'workflow')
+    else:
+        shutil.rmtree(workdir, ignore_errors=True)
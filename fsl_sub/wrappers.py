@@ -0,0 +1,138 @@
+# fsl_sub python module
+# Copyright (c) 2018-2021 University of Oxford (Duncan Mortimer)
+
+# Content-addressed cache of job scripts (wrappers), identical scripts are
+# written once and shared between submissions
+import hashlib
+import logging
+import os
+import tempfile
+import time
+
+from fsl_sub.config import read_config
+from fsl_sub.exceptions import (BadConfiguration, MissingConfiguration, )
+from fsl_sub.utils import (
+    fsl_sub_state_dir,
+    writelines_nl,
+)
+
+DEFAULT_MAX_AGE = 7 * 24 * 3600
+# Lines of the job_script() header that differ between otherwise identical
+# submissions, ignored when identifying a script
+PROVENANCE = ('# Command line: ', '# Submission time ', )
+_STAMP = '.collected'
+
+
+def _get_logger():
+    return logging.getLogger(__name__)
+
+
+def _config():
+    try:
+        return read_config()
+    except (BadConfiguration, MissingConfiguration, ):
+        return {}
+
+
+def wrapper_dir():
+    '''Folder holding cached wrappers, FSLSUB_WRAPPER_DIR, the wrapper_dir
+    option or ~/.fsl_sub/wrappers'''
+    folder = os.environ.get('FSLSUB_WRAPPER_DIR') or _config().get(
+        'wrapper_dir')
+    if not folder:
+        folder = os.path.join(fsl_sub_state_dir(), 'wrappers')
+    return folder
+
+
+def max_age():
+    '''Seconds since last use after which a cached wrapper is removed'''
+    return _config().get('wrapper_max_age', DEFAULT_MAX_AGE)
+
+
+def _without_provenance(lines):
+    return [line for line in lines if not line.startswith(PROVENANCE)]
+
+
+def script_digest(lines):
+    '''Hash of a job script (list of lines), ignoring provenance comments'''
+    digest = hashlib.sha1()
+    for line in _without_provenance(lines):
+        digest.update(line.encode('utf-8'))
+        digest.update(b'\n')
+    return digest.hexdigest()
+
+
+def cached_wrapper(lines, folder=None):
+    '''Return the path to an executable file containing the job script
+    lines, writing it if an identical script isn't already cached. The file
+    is shared with other submissions so must not be modified or removed and
+    doesn't include the provenance comments, which would only be true of the
+    first submission.'''
+    if folder is None:
+        folder = wrapper_dir()
+    path = os.path.join(folder, script_digest(lines) + '.sh')
+    try:
+        # Reuse, marking the wrapper as recently used
+        os.utime(path)
+        return path
+    except FileNotFoundError:
+        pass
+    os.makedirs(folder, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=folder, prefix='.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as wrapper:
+            writelines_nl(wrapper, _without_provenance(lines))
+        os.chmod(tmp_path, 0o755)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    _maybe_collect(folder)
+    return path
+
+
+def _maybe_collect(folder):
+    '''Garbage collect the cache at most once an hour (or max_age)'''
+    age = max_age()
+    stamp = os.path.join(folder, _STAMP)
+    now = time.time()
+    try:
+        if now - os.stat(stamp).st_mtime < min(age, 3600):
+            return
+    except FileNotFoundError:
+        pass
+    with open(stamp, 'a'):
+        pass
+    os.utime(stamp, (now, now))
+    collect(folder, age)
+
+
+def collect(folder=None, age=None):
+    '''Remove wrappers (and abandoned temporary files) not used within the
+    last age seconds, returning the number removed'''
+    if folder is None:
+        folder = wrapper_dir()
+    if age is None:
+        age = max_age()
+    expired = time.time() - age
+    try:
+        entries = list(os.scandir(folder))
+    except OSError:
+        return 0
+    removed = 0
+    for e in entries:
+        if not e.name.endswith(('.sh', '.tmp', )):
+            continue
+        try:
+            if e.stat().st_mtime < expired:
+                os.remove(e.path)
+                removed += 1
+        except OSError:
+            pass
+    if removed:
+        _get_logger().debug(
+            "Removed %d unused wrapper(s) from %s", removed, folder)
+    return removed
@@ -43,7 +43,7 @@ setup(
             'default_config.yml', 'default_coproc_config.yml',
             'example_queue_config.yml', 'example_coproc_config.yml',
             'README.md', 'INSTALL.md', 'CONFIGURATION.md', 'CHANGES.md', ],
-        'fsl_sub.plugins': ['fsl_sub_shell.yml'],
+        'fsl_sub.plugins': ['fsl_sub_shell.yml', 'fsl_sub_local.yml'],
     },
     include_package_data=True,
     entry_points={
@@ -51,8 +51,11 @@ setup(
             'fsl_sub=fsl_sub.cmdline:main',
             'fsl_sub_config=fsl_sub.cmdline:example_config',
             'fsl_sub_report=fsl_sub.cmdline:report_cmd',
+            'fsl_sub_stats=fsl_sub.cmdline:stats_cmd',
+            'fsl_sub_logs=fsl_sub.cmdline:logs_cmd',
             'fsl_sub_plugin=fsl_sub.cmdline:install_plugin',
             'fsl_sub_update=fsl_sub.cmdline:update',
+            'fsl_sub_benchmark=fsl_sub.benchmarks:main',
         ]
     }
 )